@@ -6,6 +6,7 @@
 """This module contains tools for adapting sync code for use in async coroutines."""
 
 import functools
+import threading
 import azure.iot.device.common.asyncio_compat as asyncio_compat
 
 
@@ -31,6 +32,9 @@ def emulate_async(fn):
 
 class AwaitableCallback(object):
     """A sync callback whose completion can be waited upon.
+
+    If the callback is called with an 'error' keyword argument, the callback function is not
+    invoked, and the error is raised when the completion is awaited.
     """
 
     def __init__(self, callback):
@@ -39,13 +43,31 @@ class AwaitableCallback(object):
         :param callback: Callback function to be made awaitable.
         """
         loop = asyncio_compat.get_running_loop()
+        loop_thread = threading.current_thread()
         self.future = asyncio_compat.create_future(loop)
 
+        def set_outcome(set_value, value):
+            # The future is already done if the task awaiting it was cancelled
+            if not self.future.done():
+                set_value(value)
+
+        def complete(set_value, value):
+            if threading.current_thread() is loop_thread:
+                # Called on the loop itself, which happens when the pipeline runs on the loop, so
+                # the future can be completed directly.
+                set_outcome(set_value, value)
+            else:
+                # Use event loop from outer scope, since the threads it will be used in will not
+                # have an event loop. future.set_result() has to be called in an event loop or it
+                # does not work.
+                loop.call_soon_threadsafe(set_outcome, set_value, value)
+
         def wrapping_callback(*args, **kwargs):
+            if kwargs.get("error"):
+                complete(self.future.set_exception, kwargs["error"])
+                return None
             result = callback(*args, **kwargs)
-            # Use event loop from outer scope, since the threads it will be used in will not have
-            # an event loop. future.set_result() has to be called in an event loop or it does not work.
-            loop.call_soon_threadsafe(self.future.set_result, result)
+            complete(self.future.set_result, result)
             return result
 
         self.callback = wrapping_callback
@@ -0,0 +1,103 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains helpers for handling message payloads without copying them.
+
+A payload can be text, which is sent as UTF-8, a number, which is sent as its string
+representation, None, which is sent as an empty payload, or any object which supports the buffer
+protocol, such as bytes, bytearray, memoryview or array.array.  Buffers are passed around as they
+are, and are only copied when the code they're handed to can't read them in place.
+"""
+
+import six
+
+
+def _is_buffer(data):
+    try:
+        memoryview(data)
+    except TypeError:
+        return False
+    return True
+
+
+def _view_size(view):
+    # memoryview.nbytes doesn't exist on Python 2.7
+    return getattr(view, "nbytes", len(view) * view.itemsize)
+
+
+def get_size(data):
+    """
+    Return the number of bytes that would be sent on the wire for a payload.
+
+    :raises: TypeError if the payload isn't a supported type.
+    """
+    if data is None:
+        return 0
+    if isinstance(data, (six.binary_type, bytearray)):
+        return len(data)
+    if isinstance(data, six.text_type):
+        return len(data.encode("utf-8"))
+    if isinstance(data, (int, float)):
+        return len(str(data))
+    if isinstance(data, memoryview):
+        return _view_size(data)
+    return _view_size(memoryview(data))
+
+
+def get_bytes_like(data):
+    """
+    Return a payload as an object which zlib, base64, sqlite3 and friends can read as bytes.  Bytes,
+    bytearrays and (on Python 3) other buffers are returned as they are, without being copied.
+
+    :raises: TypeError if the payload isn't a supported type.
+    """
+    if data is None:
+        return b""
+    if isinstance(data, (six.binary_type, bytearray)):
+        return data
+    if isinstance(data, six.text_type):
+        return data.encode("utf-8")
+    if isinstance(data, (int, float)):
+        return str(data).encode("utf-8")
+    if not _is_buffer(data):
+        raise TypeError("Payload of type {} is not supported".format(type(data).__name__))
+    if six.PY2:
+        # The Python 2.7 standard library can't read memoryviews
+        return memoryview(data).tobytes()
+    return data
+
+
+def get_publishable(data):
+    """
+    Return a payload in a form which the MQTT client accepts.  Paho only takes text, numbers, bytes
+    and bytearrays.  A memoryview over a whole bytes or bytearray object is unwrapped, so that it
+    isn't copied.  Any other buffer is copied into a bytes object.
+
+    :raises: TypeError if the payload isn't a supported type.
+    """
+    if data is None or isinstance(data, (six.binary_type, bytearray, six.text_type, int, float)):
+        return data
+    if not _is_buffer(data):
+        raise TypeError("Payload of type {} is not supported".format(type(data).__name__))
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    obj = getattr(view, "obj", None)
+    if (
+        isinstance(obj, (six.binary_type, bytearray))
+        and view.c_contiguous
+        and _view_size(view) == len(obj)
+    ):
+        return obj
+    return view.tobytes()
+
+
+def to_text(data):
+    """
+    Decode a UTF-8 payload without making an intermediate bytes copy of it.
+
+    :raises: UnicodeDecodeError if the payload isn't valid UTF-8.
+    """
+    if isinstance(data, six.text_type):
+        return data
+    return six.text_type(get_bytes_like(data), "utf-8")
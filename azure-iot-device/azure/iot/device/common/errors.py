@@ -159,6 +159,14 @@ class PipelineError(Exception):
     pass
 
 
+class PipelineQueueFullError(PipelineError):
+    """
+    Operation could not be queued because the pipeline queue is full
+    """
+
+    pass
+
+
 status_code_to_error = {
     400: ArgumentError,
     401: UnauthorizedError,
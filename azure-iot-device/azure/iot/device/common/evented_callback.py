@@ -0,0 +1,70 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains callbacks which can be waited upon from synchronous code."""
+
+import threading
+from concurrent.futures import Future
+
+
+class EventedCallback(object):
+    """A sync callback whose completion can be waited upon.
+
+    If the callback is called with an 'error' keyword argument, that error is raised by
+    wait_for_completion().  Otherwise, the first positional argument (if any) is returned.
+    """
+
+    def __init__(self):
+        """Creates an instance of an EventedCallback."""
+        self.completion_event = threading.Event()
+        self.result = None
+        self.exception = None
+
+        def wrapping_callback(*args, **kwargs):
+            if kwargs.get("error"):
+                self.exception = kwargs["error"]
+            elif args:
+                self.result = args[0]
+            self.completion_event.set()
+
+        self.callback = wrapping_callback
+
+    def __call__(self, *args, **kwargs):
+        """Calls the callback."""
+        self.callback(*args, **kwargs)
+
+    def wait_for_completion(self):
+        """Wait for the callback to be called.
+
+        :returns: The first positional argument the callback was called with, if any.
+        :raises: The error the callback was called with, if any.
+        """
+        self.completion_event.wait()
+        if self.exception:
+            raise self.exception
+        return self.result
+
+
+class FutureCallback(object):
+    """A sync callback which completes a concurrent.futures.Future.
+
+    If the callback is called with an 'error' keyword argument, the future fails with that error.
+    Otherwise, the result of the future is the first positional argument (if any).
+
+    The future is already running when it is created, because an operation can't be taken back
+    once it has been handed to the pipeline.  It can't be cancelled.
+    """
+
+    def __init__(self):
+        """Creates an instance of a FutureCallback."""
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+
+    def __call__(self, *args, **kwargs):
+        """Calls the callback."""
+        if kwargs.get("error"):
+            self.future.set_exception(kwargs["error"])
+        else:
+            self.future.set_result(args[0] if args else None)
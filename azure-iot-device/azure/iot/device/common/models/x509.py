@@ -14,17 +14,34 @@ class X509(object):
     a TLS connection using x509 certificates
     """
 
-    def __init__(self, cert_file, key_file, pass_phrase=None):
+    def __init__(
+        self, cert_file=None, key_file=None, pass_phrase=None, cert_data=None, key_data=None
+    ):
         """
         Initializer for X509 Certificate
         :param cert_file: The file path to contents of the certificate (or certificate chain)
          used to authenticate the device.
         :param key_file: The file path to the key associated with the certificate
         :param pass_phrase: (optional) The pass_phrase used to encode the key file
+        :param cert_data: (optional) The PEM contents of the certificate (or certificate chain),
+         used instead of cert_file when the certificate is only held in memory.
+        :param key_data: (optional) The PEM contents of the key, used instead of key_file when the
+         key is only held in memory.  If neither key_file nor key_data is provided, the key must be
+         included with the certificate.
+
+        The ssl module can only load certificates and keys from files, so cert_data and key_data
+        are written, exactly as given, to a temporary directory which only the current user can
+        read.  The directory is in memory (/dev/shm) where possible, and is deleted as soon as the
+        key has been loaded.  Encrypt key_data and provide a pass_phrase to make sure that the key
+        is never stored unencrypted, even briefly.
         """
+        if cert_file is None and cert_data is None:
+            raise ValueError("Either cert_file or cert_data must be provided")
         self._cert_file = cert_file
         self._key_file = key_file
         self._pass_phrase = pass_phrase
+        self._cert_data = cert_data
+        self._key_data = key_data
 
     @property
     def certificate_file(self):
@@ -37,3 +54,11 @@ class X509(object):
     @property
     def pass_phrase(self):
         return self._pass_phrase
+
+    @property
+    def certificate_data(self):
+        return self._cert_data
+
+    @property
+    def key_data(self):
+        return self._key_data
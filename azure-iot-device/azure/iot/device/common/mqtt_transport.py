@@ -6,13 +6,34 @@
 
 import paho.mqtt.client as mqtt
 import logging
-import ssl
 import threading
+import time
 import traceback
+from collections import OrderedDict
 from . import errors
+from . import ssl_context_cache
+from . import buffers
 
 logger = logging.getLogger(__name__)
 
+# The standard port for MQTT over TLS
+DEFAULT_PORT = 8883
+
+# How long, in seconds, to remember an acknowledgement for a MID which has not been established yet.
+# Operations are normally established within milliseconds of being sent, so anything older than
+# this belongs to an operation which will never be established, and must not be allowed to
+# complete a later operation which happens to reuse the MID.
+UNKNOWN_COMPLETION_TTL = 10.0
+
+# The maximum number of acknowledgements for unknown MIDs to remember at once
+MAX_UNKNOWN_COMPLETIONS = 1000
+
+# How often, in seconds, the transport checks for operations which were not acknowledged in time
+ACK_TIMEOUT_CHECK_INTERVAL = 1.0
+
+# Monotonic where available, so that expiry is not thrown off by changes to the system clock
+_clock = getattr(time, "monotonic", time.time)
+
 # mapping of Paho conack rc codes to Error object classes
 paho_conack_rc_to_error = {
     mqtt.CONNACK_REFUSED_PROTOCOL_VERSION: errors.ProtocolClientError,
@@ -64,6 +85,45 @@ def _create_error_from_rc_code(rc):
         return errors.ProtocolClientError("Unknown CONACK rc={}".format(rc))
 
 
+class _ResumableSSLContext(object):
+    """
+    Wrapper around a (possibly shared) SSLContext which offers the TLS session of the previous
+    connection whenever Paho opens a new socket, so that a reconnect can resume the session
+    instead of doing a full handshake.  Everything else is delegated to the wrapped context.
+    """
+
+    def __init__(self, ssl_context):
+        self._ssl_context = ssl_context
+        self._ssl_socket = None
+        self.session = None
+
+    def __getattr__(self, name):
+        return getattr(self._ssl_context, name)
+
+    def wrap_socket(self, sock, **kwargs):
+        if self.session is not None:
+            kwargs["session"] = self.session
+        self._ssl_socket = self._ssl_context.wrap_socket(sock, **kwargs)
+        return self._ssl_socket
+
+    def save_session(self):
+        """
+        Keep the session of the current connection so that it can be offered on the next one.
+        This must be called once the handshake has completed.
+        """
+        # SSLSession objects only exist from Python 3.6 onwards
+        session = getattr(self._ssl_socket, "session", None)
+        if session is not None:
+            self.session = session
+
+    @property
+    def session_reused(self):
+        """
+        Whether the current connection resumed the session of a previous connection.
+        """
+        return bool(getattr(self._ssl_socket, "session_reused", False))
+
+
 class MQTTTransport(object):
     """
     A wrapper class that provides an implementation-agnostic MQTT message broker interface.
@@ -78,7 +138,16 @@ class MQTTTransport(object):
     :type on_mqtt_connection_failure_handler: Function
     """
 
-    def __init__(self, client_id, hostname, username, ca_cert=None, x509_cert=None):
+    def __init__(
+        self,
+        client_id,
+        hostname,
+        username,
+        ca_cert=None,
+        x509_cert=None,
+        port=DEFAULT_PORT,
+        ack_timeout=None,
+    ):
         """
         Constructor to instantiate an MQTT protocol wrapper.
         :param str client_id: The id of the client connecting to the broker.
@@ -86,9 +155,13 @@ class MQTTTransport(object):
         :param str username: Username for login to the remote broker.
         :param str ca_cert: Certificate which can be used to validate a server-side TLS connection (optional).
         :param x509_cert: Certificate which can be used to authenticate connection to a server in lieu of a password (optional).
+        :param int port: The port of the remote broker (optional).  Defaults to 8883.
+        :param float ack_timeout: The number of seconds to wait for a publish, subscribe or unsubscribe
+        to be acknowledged before failing it with a TimeoutError (optional).  Defaults to waiting forever.
         """
         self._client_id = client_id
         self._hostname = hostname
+        self._port = port
         self._username = username
         self._mqtt_client = None
         self._ca_cert = ca_cert
@@ -99,7 +172,10 @@ class MQTTTransport(object):
         self.on_mqtt_message_received_handler = None
         self.on_mqtt_connection_failure_handler = None
 
-        self._op_manager = OperationManager()
+        self._ack_timeout = ack_timeout
+        self._op_manager = OperationManager(ack_timeout=ack_timeout)
+        self._ack_timeout_timer = None
+        self._ack_timeout_timer_lock = threading.Lock()
 
         self._mqtt_client = self._create_mqtt_client()
 
@@ -115,14 +191,19 @@ class MQTTTransport(object):
         )
         mqtt_client.enable_logger(logging.getLogger("paho"))
 
-        # Configure TLS/SSL
-        ssl_context = self._create_ssl_context()
-        mqtt_client.tls_set_context(context=ssl_context)
+        # Configure TLS/SSL.  The context is wrapped so that reconnects can resume the TLS session.
+        self._ssl_context = _ResumableSSLContext(self._create_ssl_context())
+        mqtt_client.tls_set_context(context=self._ssl_context)
 
         # Set event handlers
         def on_connect(client, userdata, flags, rc):
             logger.info("connected with result code: {}".format(rc))
 
+            if not rc:
+                # The handshake is complete, so the session can be kept for the next connection
+                self._ssl_context.save_session()
+                logger.info("TLS session reused: {}".format(self._ssl_context.session_reused))
+
             if rc:
                 if self.on_mqtt_connection_failure_handler:
                     try:
@@ -203,29 +284,69 @@ class MQTTTransport(object):
         logger.info("Created MQTT protocol client, assigned callbacks")
         return mqtt_client
 
+    @property
+    def tls_session_reused(self):
+        """
+        Whether the current connection resumed the TLS session of the previous connection
+        instead of doing a full handshake.
+        """
+        return self._ssl_context.session_reused
+
+    @property
+    def operation_stats(self):
+        """
+        A snapshot of the bookkeeping for publishes, subscribes and unsubscribes, including how
+        many are waiting for a response and how long responses took.  See OperationManager.get_stats.
+        """
+        return self._op_manager.get_stats()
+
+    def _establish_operation(self, mid, callback):
+        self._op_manager.establish_operation(mid, callback)
+        self._schedule_ack_timeout_check()
+
+    def _schedule_ack_timeout_check(self):
+        """
+        Make sure that a check for operations which were not acknowledged in time is scheduled for
+        as long as any operations are pending.
+        """
+        if self._ack_timeout is None:
+            return
+        with self._ack_timeout_timer_lock:
+            if self._ack_timeout_timer is None and self._op_manager.has_pending_operations:
+                self._ack_timeout_timer = threading.Timer(
+                    min(ACK_TIMEOUT_CHECK_INTERVAL, self._ack_timeout), self._check_ack_timeouts
+                )
+                self._ack_timeout_timer.daemon = True
+                self._ack_timeout_timer.start()
+
+    def _check_ack_timeouts(self):
+        with self._ack_timeout_timer_lock:
+            self._ack_timeout_timer = None
+        try:
+            self._op_manager.expire_operations()
+        except Exception:
+            logger.error("Unexpected error checking for operations which were not acknowledged")
+            logger.error(traceback.format_exc())
+        self._schedule_ack_timeout_check()
+
     def _create_ssl_context(self):
         """
-        This method creates the SSLContext object used by Paho to authenticate the connection.
+        This method gets the SSLContext object used by Paho to authenticate the connection.  The
+        context is shared with any other transport which uses the same certificates.
         """
-        logger.info("creating a SSL context")
-        ssl_context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1_2)
+        return ssl_context_cache.get_ssl_context(ca_cert=self._ca_cert, x509_cert=self._x509_cert)
 
-        if self._ca_cert:
-            ssl_context.load_verify_locations(cadata=self._ca_cert)
-        else:
-            ssl_context.load_default_certs()
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.check_hostname = True
-
-        if self._x509_cert is not None:
-            logger.info("configuring SSL context with client-side certificate and key")
-            ssl_context.load_cert_chain(
-                self._x509_cert.certificate_file,
-                self._x509_cert.key_file,
-                self._x509_cert.pass_phrase,
-            )
+    def set_max_inflight_messages(self, max_inflight_messages):
+        """
+        Set the maximum number of QoS 1 and 2 messages which can be in the process of being
+        transmitted at the same time.  Messages beyond this number are queued by the MQTT client.
 
-        return ssl_context
+        :param int max_inflight_messages: The maximum number of in-flight messages.  0 means no limit.
+
+        :raises: ValueError if max_inflight_messages is negative
+        """
+        logger.info("setting max inflight messages to {}".format(max_inflight_messages))
+        self._mqtt_client.max_inflight_messages_set(max_inflight_messages)
 
     def connect(self, password=None):
         """
@@ -241,7 +362,7 @@ class MQTTTransport(object):
 
         self._mqtt_client.username_pw_set(username=self._username, password=password)
 
-        rc = self._mqtt_client.connect(host=self._hostname, port=8883)
+        rc = self._mqtt_client.connect(host=self._hostname, port=self._port)
         logger.debug("_mqtt_client.connect returned rc={}".format(rc))
         if rc:
             raise _create_error_from_rc_code(rc)
@@ -292,7 +413,7 @@ class MQTTTransport(object):
         logger.debug("_mqtt_client.subscribe returned rc={}".format(rc))
         if rc:
             raise _create_error_from_rc_code(rc)
-        self._op_manager.establish_operation(mid, callback)
+        self._establish_operation(mid, callback)
 
     def unsubscribe(self, topic, callback=None):
         """
@@ -308,99 +429,188 @@ class MQTTTransport(object):
         logger.debug("_mqtt_client.unsubscribe returned rc={}".format(rc))
         if rc:
             raise _create_error_from_rc_code(rc)
-        self._op_manager.establish_operation(mid, callback)
+        self._establish_operation(mid, callback)
 
     def publish(self, topic, payload, qos=1, callback=None):
         """
         Send a message via the MQTT broker.
 
         :param str topic: topic: The topic that the message should be published on.
-        :param str payload: The actual message to send.
+        :param payload: The actual message to send.  This can be text, a number, None, or any
+          object which supports the buffer protocol.  Bytes, bytearrays and memoryviews over a
+          whole bytes or bytearray object are handed to paho without being copied.
         :param int qos: the desired quality of service level for the subscription. Defaults to 1.
         :param callback: A callback to be triggered upon completion (Optional).
 
+        :raises: TypeError if the payload isn't a supported type
         :raises: ValueError if qos is not 0, 1 or 2
         :raises: ValueError if topic is None or has zero string length
         :raises: ValueError if topic contains a wildcard ("+")
         :raises: ValueError if the length of the payload is greater than 268435455 bytes
         """
         logger.info("sending")
-        (rc, mid) = self._mqtt_client.publish(topic=topic, payload=payload, qos=qos)
+        (rc, mid) = self._mqtt_client.publish(
+            topic=topic, payload=buffers.get_publishable(payload), qos=qos
+        )
         logger.debug("_mqtt_client.publish returned rc={}".format(rc))
         if rc:
             raise _create_error_from_rc_code(rc)
-        self._op_manager.establish_operation(mid, callback)
+        self._establish_operation(mid, callback)
 
 
 class OperationManager(object):
     """Tracks pending operations and thier associated callbacks until completion.
+
+    Callbacks are called with no arguments when an operation completes, or with a single keyword
+    argument, error, when an operation fails.
     """
 
-    def __init__(self):
+    def __init__(self, ack_timeout=None):
+        """
+        :param float ack_timeout: (Optional) The number of seconds to wait for an operation to be
+          acknowledged before failing it with a TimeoutError.  Expiry only happens when
+          expire_operations is called.  If this is None, operations never time out.
+        """
+        self._ack_timeout = ack_timeout
+
         # Maps mid->callback for operations where a request has been sent
         # but the reponse has not yet been received
         self._pending_operation_callbacks = {}
 
-        # Maps mid->mid for responses received that are NOT established in the _pending_operation_callbacks dict.
+        # Maps mid->time the operation was established, oldest first
+        self._pending_operation_times = OrderedDict()
+
+        # Maps mid->time the response was received, for responses received that are NOT established
+        # in the _pending_operation_callbacks dict, oldest first.
         # Necessary because sometimes an operation will complete with a response before the
         # Paho call returns.
-        # TODO: make this map mid to something more useful (result code?)
-        self._unknown_operation_completions = {}
+        self._unknown_operation_completions = OrderedDict()
+
+        self._completed_count = 0
+        self._timed_out_count = 0
+        self._discarded_unknown_completion_count = 0
+        self._ack_latency_count = 0
+        self._ack_latency_total = 0.0
+        self._ack_latency_min = None
+        self._ack_latency_max = None
 
         self._lock = threading.Lock()
 
+    @property
+    def has_pending_operations(self):
+        """
+        True if any operation is still waiting to be acknowledged.
+        """
+        return bool(self._pending_operation_callbacks)
+
+    def _discard_old_unknown_completions(self, now):
+        """
+        Forget acknowledgements for unknown MIDs which are too old to belong to an operation that is
+        still going to be established.  Must be called with the lock held.
+        """
+        unknown = self._unknown_operation_completions
+        while unknown and (
+            len(unknown) > MAX_UNKNOWN_COMPLETIONS
+            or next(iter(unknown.values())) < now - UNKNOWN_COMPLETION_TTL
+        ):
+            mid, _ = unknown.popitem(last=False)
+            self._discarded_unknown_completion_count += 1
+            logger.warning("Discarding response for unknown MID: {}".format(mid))
+
+    def _record_ack_latency(self, latency):
+        """
+        Must be called with the lock held.
+        """
+        self._ack_latency_count += 1
+        self._ack_latency_total += latency
+        if self._ack_latency_min is None or latency < self._ack_latency_min:
+            self._ack_latency_min = latency
+        if self._ack_latency_max is None or latency > self._ack_latency_max:
+            self._ack_latency_max = latency
+
+    def _trigger_callback(self, mid, callback, error=None):
+        if callback:
+            try:
+                if error:
+                    callback(error=error)
+                else:
+                    callback()
+            except Exception:
+                logger.error("Unexpected error calling callback for MID: {}".format(mid))
+                logger.error(traceback.format_exc())
+        else:
+            logger.info("No callback for MID: {}".format(mid))
+
     def establish_operation(self, mid, callback=None):
         """Establish a pending operation identified by MID, and store its completion callback.
 
         If the operation has already been completed, the callback will be triggered.
         """
         trigger_callback = False
+        replaced_callback = None
+        replaced = False
 
         with self._lock:
+            now = _clock()
+            self._discard_old_unknown_completions(now)
+
             # Check to see if a response was already received for this MID before this method was
             # able to be called due to threading shenanigans
             if mid in self._unknown_operation_completions:
 
                 # Clear the recorded unknown response now that it has been resolved
                 del self._unknown_operation_completions[mid]
+                self._completed_count += 1
 
                 # Since the operation has already completed, indicate callback should trigger
                 trigger_callback = True
 
             else:
+                # Paho reuses MIDs once it runs out of them.  If an operation with this MID is still
+                # pending, its response is never going to be told apart from the new one, so fail it.
+                if mid in self._pending_operation_callbacks:
+                    replaced_callback = self._pending_operation_callbacks.pop(mid)
+                    del self._pending_operation_times[mid]
+                    replaced = True
+
                 # Store the operation as pending, along with callback
                 self._pending_operation_callbacks[mid] = callback
+                self._pending_operation_times[mid] = now
                 logger.info("Waiting for response on MID: {}".format(mid))
 
-        # Now that the lock has been released, if the callback should be triggered,
-        # go ahead and trigger it now.
+        # Now that the lock has been released, trigger any callbacks.
+        if replaced:
+            logger.error("MID: {} was reused before it was acknowledged".format(mid))
+            self._trigger_callback(
+                mid,
+                replaced_callback,
+                error=errors.ProtocolClientError(
+                    "MID {} was reused before the operation was acknowledged".format(mid)
+                ),
+            )
         if trigger_callback:
             logger.info("Response for MID: {} was received early - triggering callback".format(mid))
-            if callback:
-                try:
-                    callback()
-                except Exception:
-                    logger.error("Unexpected error calling callback for MID: {}".format(mid))
-                    logger.error(traceback.format_exc())
-            else:
-                logger.info("No callback for MID: {}".format(mid))
+            self._trigger_callback(mid, callback)
 
     def complete_operation(self, mid):
         """Complete an operation identified by MID and trigger the associated completion callback.
 
         If the operation MID is unknown, the completion status will be stored until
-        the operation is established.
+        the operation is established, or until it is too old to be matched.
         """
         callback = None
         trigger_callback = False
 
         with self._lock:
+            now = _clock()
+
             # If the mid is associated with an established pending operation, trigger the associated callback
             if mid in self._pending_operation_callbacks:
 
                 # Retrieve the callback, and clear the pending operation now that it has been completed
-                callback = self._pending_operation_callbacks[mid]
-                del self._pending_operation_callbacks[mid]
+                callback = self._pending_operation_callbacks.pop(mid)
+                self._record_ack_latency(now - self._pending_operation_times.pop(mid))
+                self._completed_count += 1
 
                 # Since the operation is complete, indicate the callback should be triggered
                 trigger_callback = True
@@ -408,9 +618,9 @@ class OperationManager(object):
             else:
                 # Otherwise, store the mid as an unknown response
                 logger.warning("Response received for unknown MID: {}".format(mid))
-                self._unknown_operation_completions[
-                    mid
-                ] = mid  # TODO: set something more useful here
+                self._unknown_operation_completions.pop(mid, None)
+                self._unknown_operation_completions[mid] = now
+                self._discard_old_unknown_completions(now)
 
         # Now that the lock has been released, if the callback should be triggered,
         # go ahead and trigger it now.
@@ -418,11 +628,64 @@ class OperationManager(object):
             logger.info(
                 "Response received for recognized MID: {} - triggering callback".format(mid)
             )
-            if callback:
-                try:
-                    callback()
-                except Exception:
-                    logger.error("Unexpected error calling callback for MID: {}".format(mid))
-                    logger.error(traceback.format_exc())
-            else:
-                logger.info("No callback set for MID: {}".format(mid))
+            self._trigger_callback(mid, callback)
+
+    def expire_operations(self):
+        """Fail every pending operation which has waited longer than ack_timeout for a response,
+        and forget responses for unknown MIDs which are too old to be matched.
+
+        :returns: The number of operations which were failed.
+        """
+        expired = []
+
+        with self._lock:
+            now = _clock()
+            self._discard_old_unknown_completions(now)
+
+            if self._ack_timeout is not None:
+                times = self._pending_operation_times
+                while times and next(iter(times.values())) <= now - self._ack_timeout:
+                    mid, _ = times.popitem(last=False)
+                    expired.append((mid, self._pending_operation_callbacks.pop(mid)))
+                self._timed_out_count += len(expired)
+
+        for mid, callback in expired:
+            logger.error("No response received for MID: {} - failing operation".format(mid))
+            self._trigger_callback(
+                mid,
+                callback,
+                error=errors.TimeoutError(
+                    "Operation was not acknowledged within {} seconds".format(self._ack_timeout)
+                ),
+            )
+        return len(expired)
+
+    def get_stats(self):
+        """
+        Return a snapshot of the bookkeeping, in a dict with the following keys:
+
+        pending: Operations waiting for a response.
+        unknown_completions: Responses waiting for their operation to be established.
+        completed: Operations which completed successfully.
+        timed_out: Operations which were failed because they were not acknowledged in time.
+        discarded_unknown_completions: Responses which were never matched to an operation.
+        ack_latency: None if nothing has been acknowledged yet, otherwise a dict with the count,
+          min, max and mean of the time, in seconds, between establishing and completing operations.
+        """
+        with self._lock:
+            ack_latency = None
+            if self._ack_latency_count:
+                ack_latency = {
+                    "count": self._ack_latency_count,
+                    "min": self._ack_latency_min,
+                    "max": self._ack_latency_max,
+                    "mean": self._ack_latency_total / self._ack_latency_count,
+                }
+            return {
+                "pending": len(self._pending_operation_callbacks),
+                "unknown_completions": len(self._unknown_operation_completions),
+                "completed": self._completed_count,
+                "timed_out": self._timed_out_count,
+                "discarded_unknown_completions": self._discarded_unknown_completion_count,
+                "ack_latency": ack_latency,
+            }
@@ -0,0 +1,210 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the CallbackDispatcher, which runs the callbacks that a pipeline makes into
+client code: operation completions, connection state changes and incoming events.
+
+By default these callbacks run on the callback thread (see pipeline_thread), one at a time.  A
+callback which is slow, such as a done callback which a user added to the future of a send, holds
+up every callback behind it, including the completions of every other operation on that thread.
+A CallbackDispatcher runs them somewhere else instead:
+
+DISPATCH_POOL runs callbacks on a pool of worker threads which is shared by every pipeline that
+uses the same number of workers.  Callbacks can run at the same time, in any order.
+
+DISPATCH_ORDERED runs the callbacks of each pipeline one at a time, in the order they were made,
+on the same shared pool.  A slow callback only holds up the callbacks of its own pipeline.
+
+DISPATCH_INLINE runs callbacks straight away, on the pipeline thread.  This saves a thread switch
+for every operation, but it is only safe if no callback ever blocks or waits for the pipeline.
+"""
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from azure.iot.device.common import unhandled_exceptions
+
+logger = logging.getLogger(__name__)
+
+# Callback dispatch modes
+DISPATCH_THREAD = "thread"
+DISPATCH_POOL = "pool"
+DISPATCH_ORDERED = "ordered"
+DISPATCH_INLINE = "inline"
+
+DEFAULT_WORKERS = 4
+
+# Most callbacks of one pipeline that DISPATCH_ORDERED runs before letting other pipelines use the
+# worker
+_MAX_ORDERED_BATCH = 32
+
+# Shared worker pools, by number of workers
+_pools = {}
+_pools_lock = threading.Lock()
+
+clock = time.time
+
+
+def _get_pool(workers):
+    with _pools_lock:
+        if workers not in _pools:
+            logger.info("Creating callback pool with {} workers".format(workers))
+            _pools[workers] = ThreadPoolExecutor(max_workers=workers)
+        return _pools[workers]
+
+
+def create_callback_dispatcher(mode=DISPATCH_THREAD, name=None, workers=DEFAULT_WORKERS):
+    """
+    Create the CallbackDispatcher for a new pipeline.
+
+    :param str mode: DISPATCH_THREAD to use the callback thread, or one of DISPATCH_POOL,
+      DISPATCH_ORDERED or DISPATCH_INLINE.
+    :param str name: The name of the dispatcher, used for logging.
+    :param int workers: The number of worker threads in the pool used by DISPATCH_POOL and
+      DISPATCH_ORDERED.
+
+    :returns: A CallbackDispatcher, or None for DISPATCH_THREAD.
+    :raises: ValueError if the mode is invalid.
+    """
+    if mode == DISPATCH_THREAD:
+        return None
+    return CallbackDispatcher(mode, name=name, workers=workers)
+
+
+class CallbackDispatcher(object):
+    """
+    Runs the callbacks of a pipeline, and keeps track of how long they wait to run.
+
+    :ivar str mode: One of DISPATCH_POOL, DISPATCH_ORDERED or DISPATCH_INLINE.
+    :ivar str name: The name of the dispatcher, used for logging.
+    """
+
+    def __init__(self, mode, name=None, workers=DEFAULT_WORKERS):
+        """
+        Initializer for CallbackDispatcher objects.
+
+        :raises: ValueError if the mode is invalid or workers is less than 1.
+        """
+        if mode not in (DISPATCH_POOL, DISPATCH_ORDERED, DISPATCH_INLINE):
+            raise ValueError("Invalid callback dispatch mode: {}".format(mode))
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.mode = mode
+        self.name = name
+        self._pool = None if mode == DISPATCH_INLINE else _get_pool(workers)
+
+        # Callbacks waiting for their turn with DISPATCH_ORDERED, and whether a worker is running
+        # them
+        self._ordered = collections.deque()
+        self._draining = False
+
+        self._queue_depth = 0
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_min = None
+        self._wait_max = None
+        self._lock = threading.Lock()
+
+    def dispatch(self, func):
+        """
+        Return a function which runs func the way this dispatcher runs callbacks, without waiting
+        for it to complete.  Like pipeline_thread.invoke_on_callback_thread_nowait, the function
+        returns a Future, and exceptions raised by func are reported as unhandled exceptions.
+        """
+
+        def wrapper(*args, **kwargs):
+            return self._submit(func, args, kwargs)
+
+        return wrapper
+
+    def _submit(self, func, args, kwargs):
+        submitted = clock()
+        with self._lock:
+            self._queue_depth += 1
+
+        def run():
+            self._record_start(clock() - submitted)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                unhandled_exceptions.exception_caught_in_background_thread(e)
+
+        if self.mode == DISPATCH_POOL:
+            return self._pool.submit(run)
+
+        future = Future()
+        if self.mode == DISPATCH_INLINE:
+            _run_into_future(run, future)
+        else:
+            with self._lock:
+                self._ordered.append((run, future))
+                start_draining = not self._draining
+                self._draining = True
+            if start_draining:
+                self._pool.submit(self._drain)
+        return future
+
+    def _drain(self):
+        """
+        Run the callbacks waiting with DISPATCH_ORDERED, in order.  After a batch of them, the
+        rest are handed back to the pool so that other pipelines get a turn.
+        """
+        for _ in range(_MAX_ORDERED_BATCH):
+            with self._lock:
+                if not self._ordered:
+                    self._draining = False
+                    return
+                run, future = self._ordered.popleft()
+            _run_into_future(run, future)
+        self._pool.submit(self._drain)
+
+    def _record_start(self, wait):
+        with self._lock:
+            self._queue_depth -= 1
+            self._wait_count += 1
+            self._wait_total += wait
+            if self._wait_min is None or wait < self._wait_min:
+                self._wait_min = wait
+            if self._wait_max is None or wait > self._wait_max:
+                self._wait_max = wait
+
+    def get_stats(self):
+        """
+        Return a snapshot of the dispatcher's bookkeeping, in a dict with the following keys:
+
+        mode: The dispatch mode.
+        queue_depth: Callbacks waiting to run.
+        dispatched: Callbacks which have started running.
+        wait_time: None if no callback has run yet, otherwise a dict with the count, min, max and
+          mean of the time, in seconds, between a callback being made and starting to run.
+        """
+        with self._lock:
+            wait_time = None
+            if self._wait_count:
+                wait_time = {
+                    "count": self._wait_count,
+                    "min": self._wait_min,
+                    "max": self._wait_max,
+                    "mean": self._wait_total / self._wait_count,
+                }
+            return {
+                "mode": self.mode,
+                "queue_depth": self._queue_depth,
+                "dispatched": self._wait_count,
+                "wait_time": wait_time,
+            }
+
+
+def _run_into_future(run, future):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = run()
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
@@ -0,0 +1,147 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains DeadlineScheduler, which calls functions when operations reach their
+deadlines.
+
+Every pipeline in the process shares one scheduler, which keeps the deadlines in a heap and waits
+for the earliest one on a single thread.  Scheduling and cancelling are cheap, so an operation can
+have a deadline without costing a thread of its own.
+
+Scheduled functions are called on the scheduler's thread, so they must be quick and must never
+block.  Functions which need to touch the pipeline should hand themselves to the pipeline thread,
+for example with pipeline_thread.invoke_on_pipeline_thread_nowait.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+from . import operation_flow
+from azure.iot.device.common import unhandled_exceptions
+
+logger = logging.getLogger(__name__)
+
+# Cancelled calls are left in the heap until they reach the top.  Once there are at least this
+# many of them, and they are more than half of the heap, the heap is rebuilt without them.
+_COMPACT_MIN_CANCELLED = 64
+
+
+class ScheduledCall(object):
+    """
+    A function which is waiting to be called by a DeadlineScheduler.
+    """
+
+    __slots__ = ("when", "func", "cancelled", "_scheduler")
+
+    def __init__(self, scheduler, when, func):
+        self._scheduler = scheduler
+        self.when = when
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stop the function from being called, if it hasn't been called yet.
+        """
+        self._scheduler._cancel(self)
+
+
+class DeadlineScheduler(object):
+    """
+    Calls functions at given times on the operation_flow clock, using a single thread.  The thread
+    is started the first time something is scheduled.
+    """
+
+    def __init__(self):
+        # A heap of (when, sequence number, ScheduledCall).  The sequence number keeps calls with
+        # the same time in the order they were scheduled.
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled_count = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def call_at(self, when, func):
+        """
+        Call func, with no arguments, once the operation_flow clock reaches when.
+
+        :returns: A ScheduledCall object which can be used to cancel the call.
+        """
+        call = ScheduledCall(self, when, func)
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), call))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="deadlines")
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0][2] is call:
+                # The new call is the earliest, so the thread has to wait for less time
+                self._condition.notify()
+        return call
+
+    def _cancel(self, call):
+        with self._condition:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            self._cancelled_count += 1
+            if self._cancelled_count >= _COMPACT_MIN_CANCELLED and self._cancelled_count * 2 > len(
+                self._heap
+            ):
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled_count = 0
+
+    @property
+    def pending_count(self):
+        """
+        The number of calls which are waiting to be made and haven't been cancelled.
+        """
+        with self._condition:
+            return len(self._heap) - self._cancelled_count
+
+    def _pop_due_call(self):
+        """
+        Wait until the earliest call is due, then take it out of the heap and return it.
+        """
+        with self._condition:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled_count -= 1
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - operation_flow.clock()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                call = heapq.heappop(self._heap)[2]
+                # Mark it so that cancelling it from now on does nothing
+                call.cancelled = True
+                return call
+
+    def _run(self):
+        while True:
+            call = self._pop_due_call()
+            try:
+                call.func()
+            except Exception as e:
+                logger.error("Unexpected error calling scheduled function", exc_info=e)
+                unhandled_exceptions.exception_caught_in_background_thread(e)
+
+
+_scheduler = DeadlineScheduler()
+
+
+def call_at(when, func):
+    """
+    Call func, with no arguments, on the shared DeadlineScheduler once the operation_flow clock
+    reaches when.
+
+    :returns: A ScheduledCall object which can be used to cancel the call.
+    """
+    return _scheduler.call_at(when, func)
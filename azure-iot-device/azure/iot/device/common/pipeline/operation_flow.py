@@ -6,13 +6,54 @@
 
 import logging
 import sys
+import time
 from . import pipeline_thread
-from azure.iot.device.common import unhandled_exceptions
+from azure.iot.device.common import errors, unhandled_exceptions
 
 from six.moves import queue
 
 logger = logging.getLogger(__name__)
 
+# Operation deadlines are measured on a clock which doesn't jump when the wall clock is changed.
+clock = getattr(time, "monotonic", time.time)
+
+
+def set_timeout(op, timeout):
+    """
+    Give an operation a deadline which is timeout seconds from now.  If the operation hasn't
+    completed by then, it completes with a TimeoutError.
+
+    :param PipelineOperation op: Operation to set the deadline on
+    :param float timeout: Number of seconds the operation is allowed to take.  If this is None,
+      the deadline of the operation is left unchanged.
+    """
+    if timeout is not None:
+        op.deadline = clock() + timeout
+
+
+def time_remaining(op):
+    """
+    Return the number of seconds left before the given operation reaches its deadline, or None if
+    the operation doesn't have a deadline.  This is never less than 0.
+    """
+    if op.deadline is None:
+        return None
+    return max(op.deadline - clock(), 0.0)
+
+
+def has_expired(op):
+    """
+    Return True if the given operation has a deadline which has already passed.
+    """
+    return op.deadline is not None and clock() >= op.deadline
+
+
+def timeout_error(op):
+    """
+    Return the error that an operation completes with when it reaches its deadline.
+    """
+    return errors.TimeoutError("{} did not complete before its deadline".format(op.name))
+
 
 @pipeline_thread.runs_on_pipeline_thread
 def delegate_to_different_op(stage, original_op, new_op):
@@ -36,6 +77,8 @@ def delegate_to_different_op(stage, original_op, new_op):
     to be used.  (or a "copy data back" function needs to be added to this function
     as an optional parameter.)
 
+    Unless new_op already has a deadline, it is given the deadline of original_op.
+
     :param PipelineStage stage: stage to delegate the operation to
     :param PipelineOperation original_op: Operation that is being continued using a
       different op.  This is most likely the operation that is currently being handled
@@ -62,6 +105,8 @@ def delegate_to_different_op(stage, original_op, new_op):
         complete_op(stage, original_op)
 
     new_op.callback = new_op_complete
+    if new_op.deadline is None:
+        new_op.deadline = original_op.deadline
     pass_op_to_next_stage(stage, new_op)
 
 
@@ -72,7 +117,9 @@ def pass_op_to_next_stage(stage, op):
     in the pipeline.  If there is no next stage in the pipeline, this function
     will fail the operation and call complete_op to return the failure back up the
     pipeline.  If the operation is already in an error state, this function will
-    complete the operation in order to return that error to the caller.
+    complete the operation in order to return that error to the caller.  If the operation
+    has passed its deadline, this function will fail the operation with a TimeoutError
+    instead of passing it on.
 
     :param PipelineStage stage: stage that the operation is being passed from
     :param PipelineOperation op: Operation which is being passed on
@@ -80,6 +127,10 @@ def pass_op_to_next_stage(stage, op):
     if op.error:
         logger.error("{}({}): op has error.  completing.".format(stage.name, op.name))
         complete_op(stage, op)
+    elif has_expired(op):
+        logger.error("{}({}): op has passed its deadline.  completing.".format(stage.name, op.name))
+        op.error = timeout_error(op)
+        complete_op(stage, op)
     elif not stage.next:
         logger.error("{}({}): no next stage.  completing with error".format(stage.name, op.name))
         op.error = NotImplementedError(
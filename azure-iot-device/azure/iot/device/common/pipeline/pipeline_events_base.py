@@ -18,10 +18,14 @@ class PipelineEvent(object):
     have the opportunity to tie a PipelineEvent to a PipelineOperation object
     if they are waiting for a response for that particular operation.
 
+    Like PipelineOperation, every subclass has to declare __slots__ for the attributes it adds.
+
     :ivar name: The name of the event.  This is used primarily for logging
     :type name: str
     """
 
+    __slots__ = ("name",)
+
     def __init__(self):
         """
         Initializer for PipelineEvent objects.
@@ -59,6 +63,8 @@ class IotResponseEvent(PipelineEvent):
     :ivar respons_body:
     """
 
+    __slots__ = ("request_id", "status_code", "response_body")
+
     def __init__(self, request_id, status_code, response_body):
         super(IotResponseEvent, self).__init__()
         self.request_id = request_id
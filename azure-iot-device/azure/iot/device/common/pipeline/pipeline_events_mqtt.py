@@ -11,6 +11,8 @@ class IncomingMQTTMessageEvent(PipelineEvent):
     A PipelineEvent object which represents an incoming MQTT message on some MQTT topic
     """
 
+    __slots__ = ("topic", "payload")
+
     def __init__(self, topic, payload):
         """
         Initializer for IncomingMQTTMessageEvent objects.
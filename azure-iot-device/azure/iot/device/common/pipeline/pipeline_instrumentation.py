@@ -0,0 +1,259 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains PipelineInstrumentation, which records where the time goes in a pipeline.
+
+Instrumentation is off unless a pipeline is given a PipelineInstrumentation object.  Each time it
+measures, it calls its hooks with the phase, the name of the operation or event, the stage (for
+PHASE_STAGE) and the number of seconds, and adds the time to a histogram.  The phases are:
+
+PHASE_PIPELINE_QUEUE: The time an operation waits for the pipeline thread after it is given to the
+  pipeline, or an incoming message waits for it after the transport receives it.
+
+PHASE_STAGE: The time an operation or event spends in one stage, not counting the time spent in the
+  stages it is passed on to.  This is the time spent in run_op or handle_pipeline_event, so the
+  work done when the stage is called back later, such as when a PUBACK arrives, isn't counted.
+
+PHASE_CALLBACK_QUEUE: The time a callback into the client waits to start running, on the callback
+  thread or with the callback dispatcher.
+
+PHASE_PUBLISH_QUEUE: The time a telemetry message waits for room in the publish queue before it is
+  given to the pipeline.
+
+PHASE_END_TO_END: The time from an operation being given to the pipeline until the callback which
+  completes it in the client starts running.
+"""
+
+import logging
+import math
+import threading
+import time
+from azure.iot.device.common import unhandled_exceptions
+
+logger = logging.getLogger(__name__)
+
+PHASE_PIPELINE_QUEUE = "pipeline_queue"
+PHASE_STAGE = "stage"
+PHASE_CALLBACK_QUEUE = "callback_queue"
+PHASE_PUBLISH_QUEUE = "publish_queue"
+PHASE_END_TO_END = "end_to_end"
+
+# Histogram bucket i counts the times of up to 2**i microseconds.  The last bucket also counts
+# everything longer, which is about a minute and up.
+_BUCKET_COUNT = 27
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+def get_stage_instrumentation(stage):
+    """
+    Get the PipelineInstrumentation object of the pipeline that stage belongs to, or None if the
+    pipeline isn't instrumented.
+    """
+    return getattr(stage.pipeline_root or stage, "instrumentation", None)
+
+
+class Histogram(object):
+    """
+    Counts of durations, in buckets which double in size from 1 microsecond up.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * _BUCKET_COUNT
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.buckets[_bucket(seconds)] += 1
+
+    def percentile(self, percent):
+        """
+        Return the upper bound, in seconds, of the bucket holding the given percentile, or None if
+        nothing has been recorded.  This is never more than the longest time recorded.
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(_upper_bound(i), self.max)
+
+    def get_stats(self):
+        """
+        Return the histogram as a dict with the count, min, max and mean, the p50, p90 and p99
+        percentiles (see percentile) and the buckets, as a list of [upper bound, count] pairs for
+        the buckets which aren't empty.  All times are in seconds.
+        """
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": [[_upper_bound(i), count] for i, count in enumerate(self.buckets) if count],
+        }
+
+
+def _bucket(seconds):
+    micros = seconds * 1000000.0
+    if micros <= 1:
+        return 0
+    mantissa, exponent = math.frexp(micros)
+    if mantissa == 0.5:
+        exponent -= 1
+    return min(exponent, _BUCKET_COUNT - 1)
+
+
+def _upper_bound(bucket):
+    return (2**bucket) / 1000000.0
+
+
+class PipelineInstrumentation(object):
+    """
+    Records how long the operations and events of one or more pipelines spend in each phase, in
+    histograms and by calling hooks.  The same object can be given to any number of pipelines.
+
+    Hooks are called with (phase, name, stage, seconds), where stage is the name of the stage for
+    PHASE_STAGE and None otherwise.  They run on whichever thread took the measurement, which is
+    usually the pipeline thread, so they must be quick and must never block.  Exceptions raised by
+    hooks are reported as unhandled exceptions.
+    """
+
+    def __init__(self, hooks=None):
+        """
+        Initializer for PipelineInstrumentation objects.
+
+        :param list hooks: (Optional) Functions to call with every measurement.
+        """
+        # A tuple, replaced instead of changed, so that it can be read without the lock
+        self._hooks = tuple(hooks or ())
+        self._histograms = {}
+        self._lock = threading.Lock()
+        # The stages currently running on each thread, as [start, time spent in later stages]
+        self._local = threading.local()
+
+    def add_hook(self, hook):
+        """
+        Call hook with every measurement from now on.
+        """
+        with self._lock:
+            self._hooks = self._hooks + (hook,)
+
+    def remove_hook(self, hook):
+        """
+        Stop calling hook.
+
+        :raises: ValueError if hook was never added.
+        """
+        with self._lock:
+            hooks = list(self._hooks)
+            hooks.remove(hook)
+            self._hooks = tuple(hooks)
+
+    def record(self, phase, name, seconds, stage=None):
+        """
+        Record that the operation or event with the given name spent seconds in phase.
+        """
+        key = (phase, stage, name)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.record(seconds)
+        for hook in self._hooks:
+            try:
+                hook(phase, name, stage, seconds)
+            except Exception as e:
+                unhandled_exceptions.exception_caught_in_background_thread(e)
+
+    def enter_stage(self):
+        """
+        Start timing a stage.  Every call must be followed by a call to exit_stage on the same
+        thread.  Stages entered before that call are counted as later stages.
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append([clock(), 0.0])
+
+    def exit_stage(self, stage, name):
+        """
+        Stop timing the stage which was entered last, and record the time spent in it, less the
+        time spent in the stages entered after it.
+        """
+        stack = self._local.stack
+        start, later = stack.pop()
+        elapsed = clock() - start
+        if stack:
+            stack[-1][1] += elapsed
+        self.record(PHASE_STAGE, name, elapsed - later, stage=stage)
+
+    def time_queued(self, phase, name, invoke, func):
+        """
+        Return invoke(func), where invoke is a decorator which hands calls to another thread, such
+        as pipeline_thread.invoke_on_pipeline_thread.  The time each call waits between being made
+        and func starting is recorded in phase.
+        """
+
+        def run(queued, args, kwargs):
+            self.record(phase, name, clock() - queued)
+            return func(*args, **kwargs)
+
+        handed_off = invoke(run)
+
+        def wrapper(*args, **kwargs):
+            return handed_off(clock(), args, kwargs)
+
+        return wrapper
+
+    def time_end_to_end(self, name, callback):
+        """
+        Return a function which calls callback, after recording the time since time_end_to_end was
+        called in PHASE_END_TO_END.
+        """
+        started = clock()
+
+        def wrapper(*args, **kwargs):
+            self.record(PHASE_END_TO_END, name, clock() - started)
+            return callback(*args, **kwargs)
+
+        return wrapper
+
+    def get_stats(self):
+        """
+        Return a snapshot of the histograms (see Histogram.get_stats), in a dict of phases.  Each
+        phase holds a dict of histograms by operation or event name, except PHASE_STAGE, which holds
+        a dict of those by stage name.  Phases with nothing recorded are left out.
+        """
+        with self._lock:
+            histograms = [
+                (key, histogram.get_stats()) for key, histogram in self._histograms.items()
+            ]
+        stats = {}
+        for (phase, stage, name), histogram in histograms:
+            by_name = stats.setdefault(phase, {})
+            if stage is not None:
+                by_name = by_name.setdefault(stage, {})
+            by_name[name] = histogram
+        return stats
+
+    def reset(self):
+        """
+        Throw away everything recorded so far.
+        """
+        with self._lock:
+            self._histograms = {}
@@ -16,6 +16,9 @@ class PipelineOperation(object):
     next stage.  If the operation gets to the end of the pipeline without being handled
     (completed), then it is treated as an error.
 
+    Operations use __slots__ to keep the cost of a queued operation down, so every subclass has to
+    declare __slots__ for the attributes it adds, even if it doesn't add any.
+
     :ivar name: The name of the operation.  This is used primarily for logging
     :type name: str
     :ivar callback: The callback that is called when the operation is completed, either
@@ -28,8 +31,14 @@ class PipelineOperation(object):
     :ivar error: The presence of a value in the error attribute indicates that the operation failed,
       absence of this value indicates that the operation either succeeded or hasn't been handled yet.
     :type error: Error
+    :ivar deadline: The time, as returned by operation_flow.clock(), after which the operation fails
+      with a TimeoutError.  None means that the operation can take as long as it needs.  Use
+      operation_flow.set_timeout to set this.
+    :type deadline: float
     """
 
+    __slots__ = ("name", "callback", "needs_connection", "error", "deadline")
+
     def __init__(self, callback=None):
         """
         Initializer for PipelineOperation objects.
@@ -46,6 +55,7 @@ class PipelineOperation(object):
         self.callback = callback
         self.needs_connection = False
         self.error = None
+        self.deadline = None
 
 
 class ConnectOperation(PipelineOperation):
@@ -57,7 +67,7 @@ class ConnectOperation(PipelineOperation):
     Even though this is an base operation, it will most likely be handled by a more specific stage (such as an IoTHub or MQTT stage).
     """
 
-    pass
+    __slots__ = ()
 
 
 class ReconnectOperation(PipelineOperation):
@@ -72,7 +82,7 @@ class ReconnectOperation(PipelineOperation):
     Even though this is an base operation, it will most likely be handled by a more specific stage (such as an IoTHub or MQTT stage).
     """
 
-    pass
+    __slots__ = ()
 
 
 class DisconnectOperation(PipelineOperation):
@@ -84,7 +94,7 @@ class DisconnectOperation(PipelineOperation):
     Even though this is an base operation, it will most likely be handled by a more specific stage (such as an IoTHub or MQTT stage).
     """
 
-    pass
+    __slots__ = ()
 
 
 class EnableFeatureOperation(PipelineOperation):
@@ -101,6 +111,8 @@ class EnableFeatureOperation(PipelineOperation):
     Even though this is an base operation, it will most likely be handled by a more specific stage (such as an IoTHub or MQTT stage).
     """
 
+    __slots__ = ("feature_name",)
+
     def __init__(self, feature_name, callback=None):
         """
         Initializer for EnableFeatureOperation objects.
@@ -129,6 +141,8 @@ class DisableFeatureOperation(PipelineOperation):
     Even though this is an base operation, it will most likely be handled by a more specific stage (such as an IoTHub or MQTT stage).
     """
 
+    __slots__ = ("feature_name",)
+
     def __init__(self, feature_name, callback=None):
         """
         Initializer for DisableFeatureOperation objects.
@@ -162,6 +176,15 @@ class SendIotRequestAndWaitForResponseOperation(PipelineOperation):
     :type response_body: Undefined
     """
 
+    __slots__ = (
+        "request_type",
+        "method",
+        "resource_location",
+        "request_body",
+        "status_code",
+        "response_body",
+    )
+
     def __init__(self, request_type, method, resource_location, request_body, callback=None):
         """
         Initializer for SendIotRequestAndWaitForResponseOperation objects
@@ -197,6 +220,8 @@ class SendIotRequestOperation(PipelineOperation):
     (such as IoTHub or MQTT stages).
     """
 
+    __slots__ = ("method", "resource_location", "request_type", "request_body", "request_id")
+
     def __init__(
         self, request_type, method, resource_location, request_body, request_id, callback=None
     ):
@@ -13,6 +13,8 @@ class SetMQTTConnectionArgsOperation(PipelineOperation):
     This operation is in the group of MQTT operations because its attributes are very specific to the MQTT protocol.
     """
 
+    __slots__ = ("client_id", "hostname", "username", "ca_cert", "client_cert", "sas_token")
+
     def __init__(
         self,
         client_id,
@@ -54,12 +56,16 @@ class MQTTPublishOperation(PipelineOperation):
     This operation is in the group of MQTT operations because its attributes are very specific to the MQTT protocol.
     """
 
-    def __init__(self, topic, payload, callback=None):
+    __slots__ = ("topic", "payload", "qos")
+
+    def __init__(self, topic, payload, qos=1, callback=None):
         """
         Initializer for MQTTPublishOperation objects.
 
         :param str topic: The name of the topic to publish to
         :param str payload: The payload to publish
+        :param int qos: The MQTT quality of service to publish with.  Publishes with a qos of 0 are
+          completed as soon as they are handed to the transport, without waiting for a PUBACK.
         :param Function callback: The function that gets called when this operation is complete or has failed.
           The callback function must accept A PipelineOperation object which indicates the specific operation which
           has completed or failed.
@@ -67,6 +73,7 @@ class MQTTPublishOperation(PipelineOperation):
         super(MQTTPublishOperation, self).__init__(callback=callback)
         self.topic = topic
         self.payload = payload
+        self.qos = qos
         self.needs_connection = True
 
 
@@ -77,6 +84,8 @@ class MQTTSubscribeOperation(PipelineOperation):
     This operation is in the group of MQTT operations because its attributes are very specific to the MQTT protocol.
     """
 
+    __slots__ = ("topic",)
+
     def __init__(self, topic, callback=None):
         """
         Initializer for MQTTSubscribeOperation objects.
@@ -98,6 +107,8 @@ class MQTTUnsubscribeOperation(PipelineOperation):
     This operation is in the group of MQTT operations because its attributes are very specific to the MQTT protocol.
     """
 
+    __slots__ = ("topic",)
+
     def __init__(self, topic, callback=None):
         """
         Initializer for MQTTUnsubscribeOperation objects.
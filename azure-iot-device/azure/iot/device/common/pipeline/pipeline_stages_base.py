@@ -4,16 +4,23 @@
 # license information.
 # --------------------------------------------------------------------------
 
+import copy
+import functools
 import logging
 import abc
 import six
 import uuid
+import random
+import threading
+from collections import deque
 from six.moves import queue
 from . import pipeline_events_base
 from . import pipeline_ops_base
 from . import operation_flow
+from . import deadline_scheduler
+from . import pipeline_instrumentation
 from . import pipeline_thread
-from azure.iot.device.common import unhandled_exceptions
+from azure.iot.device.common import unhandled_exceptions, errors
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +100,9 @@ class PipelineStage(object):
         :param PipelineOperation op: The operation to run.
         """
         logger.info("{}({}): running".format(self.name, op.name))
+        instrumentation = pipeline_instrumentation.get_stage_instrumentation(self)
+        if instrumentation is not None:
+            instrumentation.enter_stage()
         try:
             self._execute_op(op)
         except Exception as e:
@@ -101,6 +111,9 @@ class PipelineStage(object):
             logger.error(msg="Unexpected error in {}._execute_op() call".format(self), exc_info=e)
             op.error = e
             operation_flow.complete_op(self, op)
+        finally:
+            if instrumentation is not None:
+                instrumentation.exit_stage(self.name, op.name)
 
     @abc.abstractmethod
     def _execute_op(self, op):
@@ -126,10 +139,16 @@ class PipelineStage(object):
 
         :param PipelineEvent event: The event that is being passed back up the pipeline
         """
+        instrumentation = pipeline_instrumentation.get_stage_instrumentation(self)
+        if instrumentation is not None:
+            instrumentation.enter_stage()
         try:
             self._handle_pipeline_event(event)
         except Exception as e:
             unhandled_exceptions.exception_caught_in_background_thread(e)
+        finally:
+            if instrumentation is not None:
+                instrumentation.exit_stage(self.name, event.name)
 
     @pipeline_thread.runs_on_pipeline_thread
     def _handle_pipeline_event(self, event):
@@ -176,18 +195,152 @@ class PipelineRootStage(PipelineStage):
     :ivar on_disconnected_handler: Handler which can be set by users of the pipeline to
       receive events every time the underlying transport disconnects
     :type on_disconnected_handler: Function
+    :ivar executors: The pipeline and callback threads used by this pipeline, or None to use the
+      ones which are shared by every pipeline in the process.
+    :type executors: pipeline_thread.Executors
+    :ivar callback_dispatcher: The object which runs the callbacks of this pipeline, or None to run
+      them on the callback thread.
+    :type callback_dispatcher: callback_dispatcher.CallbackDispatcher
+    :ivar instrumentation: The object which records where the time goes in this pipeline, or None
+      if the pipeline isn't instrumented.
+    :type instrumentation: pipeline_instrumentation.PipelineInstrumentation
     """
 
-    def __init__(self):
+    def __init__(self, executors=None, callback_dispatcher=None, instrumentation=None):
         super(PipelineRootStage, self).__init__()
         self.on_pipeline_event_handler = None
         self.on_connected_handler = None
         self.on_disconnected_handler = None
         self.connected = False
+        self.executors = executors
+        self.callback_dispatcher = callback_dispatcher
+        self.instrumentation = instrumentation
 
-    def run_op(self, op):
-        op.callback = pipeline_thread.invoke_on_callback_thread_nowait(op.callback)
-        pipeline_thread.invoke_on_pipeline_thread(super(PipelineRootStage, self).run_op)(op)
+    def run_op(self, op, on_finished=None):
+        """
+        Run the given operation.  See PipelineStage.run_op.
+
+        :param PipelineOperation op: The operation to run.
+        :param Function on_finished: (Optional) Function which is called with op, on the pipeline
+          thread, once the pipeline is done with op.  This is when the callback of op is called,
+          unless op reaches its deadline first.  Then the callback is called with a TimeoutError
+          while the stages may still hold op, and on_finished is called when they let it go.
+        """
+        self._wrap_op_callback(op, on_finished)
+        self._enter_pipeline(pipeline_thread.invoke_on_pipeline_thread, op)(op)
+
+    def run_op_nowait(self, op, on_finished=None):
+        """
+        Run the given operation without waiting for the pipeline thread to start running it.  This
+        is for callers which must never block, such as the asyncio clients.  Operations are still
+        run in the order they're given to the pipeline.
+
+        :param PipelineOperation op: The operation to run.
+        :param Function on_finished: (Optional) See run_op.
+        """
+        self._wrap_op_callback(op, on_finished)
+        self._enter_pipeline(pipeline_thread.invoke_on_pipeline_thread_nowait, op)(op)
+
+    def _enter_pipeline(self, invoke, op):
+        """
+        Return a function which runs op on the pipeline thread, using invoke, which is one of the
+        invoke_on_pipeline_thread decorators.  If the pipeline is instrumented, the time op waits
+        for the pipeline thread is recorded.
+        """
+        run_op = super(PipelineRootStage, self).run_op
+        if self.instrumentation is None:
+            return invoke(run_op, executors=self.executors)
+        return self.instrumentation.time_queued(
+            pipeline_instrumentation.PHASE_PIPELINE_QUEUE,
+            op.name,
+            functools.partial(invoke, executors=self.executors),
+            run_op,
+        )
+
+    def _wrap_op_callback(self, op, on_finished=None):
+        """
+        Make the callback of op run like the other callbacks of this pipeline, and by the deadline
+        of op if it has one.  on_finished is called when the pipeline completes op.
+        """
+        if self.instrumentation is not None:
+            op.callback = self.instrumentation.time_end_to_end(op.name, op.callback)
+        op.callback = self._invoke_on_callback_nowait(op.callback, op.name)
+        if op.deadline is not None:
+            op.callback = self._enforce_deadline(op, op.callback, on_finished)
+        elif on_finished is not None:
+            callback = op.callback
+
+            @pipeline_thread.runs_on_pipeline_thread
+            def on_complete(op):
+                on_finished(op)
+                callback(op)
+
+            op.callback = on_complete
+
+    def _invoke_on_callback_nowait(self, func, name):
+        """
+        Return a function which runs func, a callback into the caller of the pipeline, on the
+        callback thread or with the callback_dispatcher, without waiting for it to complete.  If
+        the pipeline is instrumented, the time it waits to start is recorded under name.
+        """
+        if self.callback_dispatcher is None:
+            invoke = functools.partial(
+                pipeline_thread.invoke_on_callback_thread_nowait, executors=self.executors
+            )
+        else:
+            invoke = self.callback_dispatcher.dispatch
+        if self.instrumentation is None:
+            return invoke(func)
+        return self.instrumentation.time_queued(
+            pipeline_instrumentation.PHASE_CALLBACK_QUEUE, name, invoke, func
+        )
+
+    def _enforce_deadline(self, op, callback, on_finished=None):
+        """
+        Make sure that op completes by its deadline.  If the pipeline hasn't completed op by then,
+        callback is called with a copy of op which failed with a TimeoutError, and the completion
+        that eventually comes from the pipeline is ignored.  op itself is left alone, because the
+        stages may still be holding it.  Stages which hold on to ops are expected to release them
+        when they reach their deadline, so this is only a backstop which guarantees that callers
+        are never left waiting.
+
+        :param Function on_finished: (Optional) Called with op when the pipeline completes op,
+          even if that is after the deadline.
+        :returns: The callback to use for op.  It calls callback at most once.
+        """
+        # This is a dict and not a bool so that the closures below can change it on py27
+        state = {"completed": False}
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_complete(op):
+            if on_finished is not None:
+                on_finished(op)
+            if state["completed"]:
+                logger.info(
+                    "{}({}): completed after reaching its deadline.  ignoring.".format(
+                        self.name, op.name
+                    )
+                )
+                return
+            state["completed"] = True
+            scheduled_call.cancel()
+            callback(op)
+
+        def on_deadline():
+            if not state["completed"]:
+                logger.error("{}({}): deadline reached.  completing.".format(self.name, op.name))
+                state["completed"] = True
+                timed_out_op = copy.copy(op)
+                timed_out_op.error = operation_flow.timeout_error(op)
+                callback(timed_out_op)
+
+        # This runs on the scheduler's thread, so the pipeline thread has to be named explicitly
+        on_deadline = pipeline_thread.invoke_on_pipeline_thread_nowait(
+            on_deadline, executors=self.executors
+        )
+
+        scheduled_call = deadline_scheduler.call_at(op.deadline, on_deadline)
+        return on_complete
 
     @pipeline_thread.runs_on_pipeline_thread
     def _execute_op(self, op):
@@ -227,7 +380,7 @@ class PipelineRootStage(PipelineStage):
           through the handle_pipeline_event (if provided).
         """
         if self.on_pipeline_event_handler:
-            pipeline_thread.invoke_on_callback_thread_nowait(self.on_pipeline_event_handler)(event)
+            self._invoke_on_callback_nowait(self.on_pipeline_event_handler, event.name)(event)
         else:
             logger.warning("incoming pipeline event with no handler.  dropping.")
 
@@ -240,7 +393,7 @@ class PipelineRootStage(PipelineStage):
         )
         self.connected = True
         if self.on_connected_handler:
-            pipeline_thread.invoke_on_callback_thread_nowait(self.on_connected_handler)()
+            self._invoke_on_callback_nowait(self.on_connected_handler, "on_connected")()
 
     @pipeline_thread.runs_on_pipeline_thread
     def on_disconnected(self):
@@ -251,7 +404,7 @@ class PipelineRootStage(PipelineStage):
         )
         self.connected = False
         if self.on_disconnected_handler:
-            pipeline_thread.invoke_on_callback_thread_nowait(self.on_disconnected_handler)()
+            self._invoke_on_callback_nowait(self.on_disconnected_handler, "on_disconnected")()
 
 
 class EnsureConnectionStage(PipelineStage):
@@ -306,6 +459,183 @@ class EnsureConnectionStage(PipelineStage):
         )
 
 
+class ReconnectStage(PipelineStage):
+    """
+    This stage is responsible for re-establishing the connection when it drops unexpectedly.
+
+    When the transport disconnects without a DisconnectOperation having been requested, this
+    stage sends a ReconnectOperation down after a delay.  The delay is chosen using capped
+    exponential backoff with full jitter: before attempt n (counting from 0), the stage waits a
+    random amount of time between 0 and min(max_delay, initial_delay * 2^n) seconds.  The jitter
+    spreads out reconnect attempts when many devices lose their connection at the same moment.
+
+    While the stage is waiting to reconnect, operations which need a connection are held in this
+    stage instead of being passed down, and they are released once the connection comes back.  If
+    reconnecting is abandoned, the held operations fail with the error from the last attempt, and
+    on_reconnect_abandoned_handler is called with that error so that lower stages can fail the
+    operations they are holding for the connection.
+    """
+
+    def __init__(self, initial_delay=1.0, max_delay=60.0, max_attempts=None):
+        """
+        Initializer for ReconnectStage objects.
+
+        :param float initial_delay: The upper bound, in seconds, of the delay before the first
+          reconnect attempt.
+        :param float max_delay: The largest upper bound, in seconds, of the delay before any
+          reconnect attempt.
+        :param int max_attempts: (Optional) The number of reconnect attempts to make before giving
+          up.  None means keep trying until the connection comes back or a DisconnectOperation is run.
+        """
+        super(ReconnectStage, self).__init__()
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.reconnecting = False
+        self.attempt = 0
+        self.waiting_ops = deque()
+        self._should_be_connected = False
+        self._timer = None
+        self.on_reconnect_abandoned_handler = None
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _execute_op(self, op):
+        if isinstance(op, pipeline_ops_base.DisconnectOperation):
+            # A requested disconnect is never a reason to reconnect.
+            self._should_be_connected = False
+            if self.reconnecting:
+                logger.info(
+                    "{}({}): disconnect requested.  Abandoning reconnect.".format(
+                        self.name, op.name
+                    )
+                )
+                self._stop_reconnecting(errors.ConnectionDroppedError("Connection was dropped"))
+            operation_flow.pass_op_to_next_stage(self, op)
+
+        elif self.reconnecting and op.needs_connection:
+            logger.info(
+                "{}({}): waiting to reconnect.  Holding op until connected.".format(
+                    self.name, op.name
+                )
+            )
+            self._release_expired_waiting_ops()
+            self.waiting_ops.append(op)
+
+        else:
+            operation_flow.pass_op_to_next_stage(self, op)
+
+    def get_delay(self, attempt):
+        """
+        Return the number of seconds to wait before the given reconnect attempt.
+        """
+        cap = min(self.max_delay, self.initial_delay * (2**attempt))
+        return random.uniform(0, cap)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def on_connected(self):
+        self._should_be_connected = True
+        if self.reconnecting:
+            logger.info(
+                "{}: connection re-established after {} attempts".format(self.name, self.attempt)
+            )
+            self._stop_reconnecting(None)
+        super(ReconnectStage, self).on_connected()
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def on_disconnected(self):
+        if self._should_be_connected and not self.reconnecting:
+            logger.warning("{}: connection dropped unexpectedly.  Reconnecting.".format(self.name))
+            self.reconnecting = True
+            self.attempt = 0
+            self._schedule_reconnect()
+        super(ReconnectStage, self).on_disconnected()
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _schedule_reconnect(self):
+        delay = self.get_delay(self.attempt)
+        logger.info(
+            "{}: reconnect attempt {} in {:.2f} seconds".format(self.name, self.attempt + 1, delay)
+        )
+        self._timer = threading.Timer(delay, self._on_timer_expired)
+        self._timer.daemon = True
+        self._timer.start()
+
+    @pipeline_thread.invoke_on_pipeline_thread_nowait
+    def _on_timer_expired(self):
+        self._timer = None
+        if not self.reconnecting:
+            return
+        self.attempt += 1
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_reconnect_complete(op):
+            if not self.reconnecting:
+                # Either the connection came back (and on_connected already released the
+                # waiting ops) or a disconnect was requested in the meantime.
+                return
+            if not op.error:
+                # on_connected normally handles this, but don't leave ops stranded if it didn't.
+                self._stop_reconnecting(None)
+            elif self.max_attempts is not None and self.attempt >= self.max_attempts:
+                logger.error(
+                    "{}: giving up after {} reconnect attempts: {}".format(
+                        self.name, self.attempt, op.error
+                    )
+                )
+                self._should_be_connected = False
+                self._stop_reconnecting(op.error)
+                unhandled_exceptions.exception_caught_in_background_thread(op.error)
+            else:
+                logger.info(
+                    "{}: reconnect attempt {} failed: {}".format(self.name, self.attempt, op.error)
+                )
+                self._schedule_reconnect()
+
+        operation_flow.pass_op_to_next_stage(
+            self, pipeline_ops_base.ReconnectOperation(callback=on_reconnect_complete)
+        )
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _release_expired_waiting_ops(self):
+        """
+        Fail the waiting ops which have passed their deadline, so that ops don't pile up in this
+        stage while the connection stays down.
+        """
+        if any(operation_flow.has_expired(op) for op in self.waiting_ops):
+            waiting_ops = self.waiting_ops
+            self.waiting_ops = deque()
+            for op in waiting_ops:
+                if operation_flow.has_expired(op):
+                    op.error = operation_flow.timeout_error(op)
+                    operation_flow.complete_op(self, op)
+                else:
+                    self.waiting_ops.append(op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _stop_reconnecting(self, error):
+        """
+        Leave the reconnecting state and release the waiting ops.  If error is set, the waiting
+        ops are failed with that error and on_reconnect_abandoned_handler is called with it,
+        otherwise the waiting ops are passed down.
+        """
+        self.reconnecting = False
+        self.attempt = 0
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        waiting_ops = self.waiting_ops
+        self.waiting_ops = deque()
+        while waiting_ops:
+            op = waiting_ops.popleft()
+            if error:
+                op.error = error
+                operation_flow.complete_op(self, op)
+            else:
+                operation_flow.pass_op_to_next_stage(self, op)
+        if error and self.on_reconnect_abandoned_handler:
+            self.on_reconnect_abandoned_handler(error)
+
+
 class SerializeConnectOpsStage(PipelineStage):
     """
     This stage is responsible for serializing connect, disconnect, and reconnect ops on
@@ -435,6 +765,7 @@ class CoordinateRequestAndResponseStage(PipelineStage):
     def __init__(self):
         super(CoordinateRequestAndResponseStage, self).__init__()
         self.pending_responses = {}
+        self.response_timers = {}
 
     @pipeline_thread.runs_on_pipeline_thread
     def _execute_op(self, op):
@@ -453,14 +784,17 @@ class CoordinateRequestAndResponseStage(PipelineStage):
                         self.name, op.name, op.request_type, op.method, op.resource_location
                     )
                 )
-                if send_request_op.error:
+                if request_id not in self.pending_responses:
+                    # op reached its deadline and has already been completed
+                    pass
+                elif send_request_op.error:
                     op.error = send_request_op.error
                     logger.info(
                         "{}({}): removing request {} from pending list".format(
                             self.name, op.name, request_id
                         )
                     )
-                    del (self.pending_responses[request_id])
+                    self._remove_pending_response(request_id)
                     operation_flow.complete_op(self, op)
                 else:
                     # request sent.  Nothing to do except wait for the response
@@ -476,6 +810,8 @@ class CoordinateRequestAndResponseStage(PipelineStage):
                 "{}({}): adding request {} to pending list".format(self.name, op.name, request_id)
             )
             self.pending_responses[request_id] = op
+            if op.deadline is not None:
+                self._start_response_timer(request_id, op)
 
             new_op = pipeline_ops_base.SendIotRequestOperation(
                 method=op.method,
@@ -485,6 +821,7 @@ class CoordinateRequestAndResponseStage(PipelineStage):
                 request_type=op.request_type,
                 callback=on_send_request_done,
             )
+            new_op.deadline = op.deadline
             operation_flow.pass_op_to_next_stage(self, new_op)
 
         else:
@@ -503,8 +840,7 @@ class CoordinateRequestAndResponseStage(PipelineStage):
                 )
             )
             if event.request_id in self.pending_responses:
-                op = self.pending_responses[event.request_id]
-                del (self.pending_responses[event.request_id])
+                op = self._remove_pending_response(event.request_id)
                 op.status_code = event.status_code
                 op.response_body = event.response_body
                 logger.info(
@@ -526,3 +862,36 @@ class CoordinateRequestAndResponseStage(PipelineStage):
                 )
         else:
             operation_flow.pass_event_to_previous_stage(self, event)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _start_response_timer(self, request_id, op):
+        """
+        Schedule a call which fails op if its response hasn't arrived by the deadline of op.
+        Without this, a lost response would leave op in the pending list forever.
+        """
+
+        @pipeline_thread.invoke_on_pipeline_thread_nowait
+        def on_deadline():
+            if request_id in self.pending_responses:
+                logger.error(
+                    "{}({}): no response to request {} before the deadline.  completing.".format(
+                        self.name, op.name, request_id
+                    )
+                )
+                self._remove_pending_response(request_id)
+                op.error = operation_flow.timeout_error(op)
+                operation_flow.complete_op(self, op)
+
+        self.response_timers[request_id] = deadline_scheduler.call_at(op.deadline, on_deadline)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _remove_pending_response(self, request_id):
+        """
+        Remove a request from the pending list, and stop waiting for its deadline.
+
+        :returns: The SendIotRequestAndWaitForResponseOperation which was waiting for the response.
+        """
+        scheduled_call = self.response_timers.pop(request_id, None)
+        if scheduled_call:
+            scheduled_call.cancel()
+        return self.pending_responses.pop(request_id)
@@ -6,14 +6,18 @@
 
 import logging
 import six
+from collections import deque
 from . import (
     pipeline_ops_base,
+    pipeline_stages_base,
     PipelineStage,
     pipeline_ops_mqtt,
     pipeline_events_mqtt,
     operation_flow,
+    pipeline_instrumentation,
     pipeline_thread,
 )
+from azure.iot.device.common import mqtt_transport
 from azure.iot.device.common.mqtt_transport import MQTTTransport
 from azure.iot.device.common import unhandled_exceptions, errors
 
@@ -25,8 +29,40 @@ class MQTTTransportStage(PipelineStage):
     PipelineStage object which is responsible for interfacing with the MQTT protocol wrapper object.
     This stage handles all MQTT operations and any other operations (such as ConnectOperation) which
     is not in the MQTT group of operations, but can only be run at the protocol level.
+
+    Publishes are sent using a sliding window.  If max_inflight_publishes publishes are already waiting
+    for a PUBACK, any new MQTTPublishOperation waits in a queue inside this stage until a PUBACK arrives.
+    Queued publishes which pass their deadline before they get a slot fail without being sent.  If
+    the connection drops or fails while a ReconnectStage above this one is reconnecting, queued
+    publishes stay in the queue and are sent as PUBACKs arrive once the connection is back.  They
+    fail with a ConnectionDroppedError when a requested disconnect completes, when the ReconnectStage
+    gives up, or when the connection drops or fails with nothing to bring it back.  Publishes which
+    are already in flight stay in the window, because the MQTTTransport keeps them and sends them
+    again when it reconnects.  They are completed by their PUBACK, or by the ack_timeout.
+
+    Publishes with a qos of 0 never get a PUBACK, so they are not counted against the window and
+    never wait in the queue.  They are completed as soon as the transport accepts them.
     """
 
+    def __init__(
+        self, max_inflight_publishes=None, port=mqtt_transport.DEFAULT_PORT, ack_timeout=None
+    ):
+        """
+        Initializer for MQTTTransportStage objects.
+
+        :param int max_inflight_publishes: (Optional) The maximum number of publishes which can be waiting
+          for an acknowledgement at any one time.  If this is None, publishes are never queued.
+        :param int port: (Optional) The port to connect to.  Defaults to 8883.
+        :param float ack_timeout: (Optional) The number of seconds to wait for a publish, subscribe or
+          unsubscribe to be acknowledged before failing it.  If this is None, wait forever.
+        """
+        super(MQTTTransportStage, self).__init__()
+        self.max_inflight_publishes = max_inflight_publishes
+        self.port = port
+        self.ack_timeout = ack_timeout
+        self._inflight_publish_count = 0
+        self._queued_publishes = deque()
+
     @pipeline_thread.runs_on_pipeline_thread
     def _cancel_pending_connection_op(self):
         """
@@ -62,11 +98,23 @@ class MQTTTransportStage(PipelineStage):
                 username=self.username,
                 ca_cert=self.ca_cert,
                 x509_cert=self.client_cert,
+                port=self.port,
+                ack_timeout=self.ack_timeout,
             )
             self.transport.on_mqtt_connected_handler = self._on_mqtt_connected
             self.transport.on_mqtt_connection_failure_handler = self._on_mqtt_connection_failure
             self.transport.on_mqtt_disconnected_handler = self._on_mqtt_disconnected
             self.transport.on_mqtt_message_received_handler = self._on_mqtt_message_received
+            if pipeline_instrumentation.get_stage_instrumentation(self) is not None:
+
+                def on_mqtt_message_received(topic, payload):
+                    self._on_mqtt_message_received(
+                        topic, payload, received=pipeline_instrumentation.clock()
+                    )
+
+                self.transport.on_mqtt_message_received_handler = on_mqtt_message_received
+            if self.max_inflight_publishes:
+                self.transport.set_max_inflight_messages(self.max_inflight_publishes)
 
             # There can only be one pending connection operation (Connect, Reconnect, Disconnect)
             # at a time. The existing one must be completed or canceled before a new one is set.
@@ -80,6 +128,11 @@ class MQTTTransportStage(PipelineStage):
             # complete a Disconnect operation.
             self._pending_connection_op = None
 
+            # If the ReconnectStage gives up, nothing will ever drain the queued publishes
+            reconnect_stage = self._find_reconnect_stage()
+            if reconnect_stage is not None:
+                reconnect_stage.on_reconnect_abandoned_handler = self._on_reconnect_abandoned
+
             self.pipeline_root.transport = self.transport
             operation_flow.complete_op(self, op)
 
@@ -121,21 +174,32 @@ class MQTTTransportStage(PipelineStage):
                 operation_flow.complete_op(self, op)
 
         elif isinstance(op, pipeline_ops_mqtt.MQTTPublishOperation):
-            logger.info("{}({}): publishing on {}".format(self.name, op.name, op.topic))
-
-            @pipeline_thread.invoke_on_pipeline_thread_nowait
-            def on_published():
-                logger.info("{}({}): PUBACK received. completing op.".format(self.name, op.name))
-                operation_flow.complete_op(self, op)
-
-            self.transport.publish(topic=op.topic, payload=op.payload, callback=on_published)
+            if (
+                op.qos
+                and self.max_inflight_publishes
+                and self._inflight_publish_count >= self.max_inflight_publishes
+            ):
+                logger.info(
+                    "{}({}): {} publishes in flight.  queueing.".format(
+                        self.name, op.name, self._inflight_publish_count
+                    )
+                )
+                self._queued_publishes.append(op)
+            else:
+                self._publish(op)
 
         elif isinstance(op, pipeline_ops_mqtt.MQTTSubscribeOperation):
             logger.info("{}({}): subscribing to {}".format(self.name, op.name, op.topic))
 
             @pipeline_thread.invoke_on_pipeline_thread_nowait
-            def on_subscribed():
-                logger.info("{}({}): SUBACK received. completing op.".format(self.name, op.name))
+            def on_subscribed(error=None):
+                if error:
+                    logger.error("{}({}): subscribe failed: {}".format(self.name, op.name, error))
+                    op.error = error
+                else:
+                    logger.info(
+                        "{}({}): SUBACK received. completing op.".format(self.name, op.name)
+                    )
                 operation_flow.complete_op(self, op)
 
             self.transport.subscribe(topic=op.topic, callback=on_subscribed)
@@ -144,8 +208,14 @@ class MQTTTransportStage(PipelineStage):
             logger.info("{}({}): unsubscribing from {}".format(self.name, op.name, op.topic))
 
             @pipeline_thread.invoke_on_pipeline_thread_nowait
-            def on_unsubscribed():
-                logger.info("{}({}): UNSUBACK received.  completing op.".format(self.name, op.name))
+            def on_unsubscribed(error=None):
+                if error:
+                    logger.error("{}({}): unsubscribe failed: {}".format(self.name, op.name, error))
+                    op.error = error
+                else:
+                    logger.info(
+                        "{}({}): UNSUBACK received.  completing op.".format(self.name, op.name)
+                    )
                 operation_flow.complete_op(self, op)
 
             self.transport.unsubscribe(topic=op.topic, callback=on_unsubscribed)
@@ -153,16 +223,140 @@ class MQTTTransportStage(PipelineStage):
         else:
             operation_flow.pass_op_to_next_stage(self, op)
 
+    @pipeline_thread.runs_on_pipeline_thread
+    def _publish(self, op):
+        """
+        Publish the payload for an MQTTPublishOperation and count it against the in-flight window
+        until the PUBACK is received.
+        """
+        logger.info("{}({}): publishing on {}".format(self.name, op.name, op.topic))
+
+        if not op.qos:
+            self.transport.publish(topic=op.topic, payload=op.payload, qos=0)
+            logger.info("{}({}): qos 0 publish sent. completing op.".format(self.name, op.name))
+            operation_flow.complete_op(self, op)
+            return
+
+        @pipeline_thread.invoke_on_pipeline_thread_nowait
+        def on_published(error=None):
+            if error:
+                logger.error("{}({}): publish failed: {}".format(self.name, op.name, error))
+                op.error = error
+            else:
+                logger.info("{}({}): PUBACK received. completing op.".format(self.name, op.name))
+            self._inflight_publish_count -= 1
+            operation_flow.complete_op(self, op)
+            self._publish_queued_ops()
+
+        self._inflight_publish_count += 1
+        try:
+            self.transport.publish(
+                topic=op.topic, payload=op.payload, qos=op.qos, callback=on_published
+            )
+        except Exception:
+            self._inflight_publish_count -= 1
+            raise
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _publish_queued_ops(self):
+        """
+        Publish queued MQTTPublishOperation objects until the in-flight window is full again.
+        """
+        while self._queued_publishes and (
+            self._inflight_publish_count < self.max_inflight_publishes
+        ):
+            op = self._queued_publishes.popleft()
+            if operation_flow.has_expired(op):
+                logger.error(
+                    "{}({}): op passed its deadline while queued.  completing.".format(
+                        self.name, op.name
+                    )
+                )
+                op.error = operation_flow.timeout_error(op)
+                operation_flow.complete_op(self, op)
+                continue
+            try:
+                self._publish(op)
+            except Exception as e:
+                logger.error(
+                    msg="{}({}): Unexpected error publishing queued op".format(self.name, op.name),
+                    exc_info=e,
+                )
+                op.error = e
+                operation_flow.complete_op(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _find_reconnect_stage(self):
+        """
+        Return the first ReconnectStage above this stage, or None if there isn't one.
+        """
+        stage = self.previous
+        while stage is not None:
+            if isinstance(stage, pipeline_stages_base.ReconnectStage):
+                return stage
+            stage = stage.previous
+        return None
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _is_reconnecting(self):
+        """
+        Return True if a ReconnectStage above this stage is going to bring the connection back.
+        """
+        reconnect_stage = self._find_reconnect_stage()
+        return reconnect_stage is not None and reconnect_stage.reconnecting
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _on_reconnect_abandoned(self, error):
+        """
+        Handler that gets called by the ReconnectStage when it stops trying to reconnect.
+
+        :param Exception error: The Exception which made the ReconnectStage give up.
+        """
+        self._fail_queued_publishes(error)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _fail_queued_publishes(self, cause):
+        """
+        Fail every queued MQTTPublishOperation with a ConnectionDroppedError.  They were never given
+        to the MQTTTransport, so nothing would ever take them out of the queue once the connection
+        is gone for good.  Publishes which are in flight are left in the window, because the
+        MQTTTransport keeps them across the drop and calls back when they are acknowledged or fail.
+
+        :param Exception cause: The Exception that caused the connection to drop or fail, if any.
+        """
+        if not self._queued_publishes:
+            return
+        logger.error(
+            "{}: failing {} queued publishes because the connection is gone".format(
+                self.name, len(self._queued_publishes)
+            )
+        )
+        queued = self._queued_publishes
+        self._queued_publishes = deque()
+        for op in queued:
+            try:
+                six.raise_from(errors.ConnectionDroppedError, cause)
+            except errors.ConnectionDroppedError as e:
+                op.error = e
+            operation_flow.complete_op(self, op)
+
     @pipeline_thread.invoke_on_pipeline_thread_nowait
-    def _on_mqtt_message_received(self, topic, payload):
+    def _on_mqtt_message_received(self, topic, payload, received=None):
         """
         Handler that gets called by the protocol library when an incoming message arrives.
         Convert that message into a pipeline event and pass it up for someone to handle.
+
+        If the pipeline is instrumented, received is the time the message arrived, on the
+        pipeline_instrumentation clock.
         """
-        operation_flow.pass_event_to_previous_stage(
-            stage=self,
-            event=pipeline_events_mqtt.IncomingMQTTMessageEvent(topic=topic, payload=payload),
-        )
+        event = pipeline_events_mqtt.IncomingMQTTMessageEvent(topic=topic, payload=payload)
+        if received is not None:
+            self.pipeline_root.instrumentation.record(
+                pipeline_instrumentation.PHASE_PIPELINE_QUEUE,
+                event.name,
+                pipeline_instrumentation.clock() - received,
+            )
+        operation_flow.pass_event_to_previous_stage(stage=self, event=event)
 
     @pipeline_thread.invoke_on_pipeline_thread_nowait
     def _on_mqtt_connected(self):
@@ -197,6 +391,11 @@ class MQTTTransportStage(PipelineStage):
 
         logger.error("{}: _on_mqtt_connection_failure called: {}".format(self.name, cause))
 
+        # If this was the last reconnect attempt, the ReconnectStage fails the queued publishes when
+        # it gives up.
+        if not self._is_reconnecting():
+            self._fail_queued_publishes(cause)
+
         if isinstance(
             self._pending_connection_op, pipeline_ops_base.ConnectOperation
         ) or isinstance(self._pending_connection_op, pipeline_ops_base.ReconnectOperation):
@@ -223,6 +422,8 @@ class MQTTTransportStage(PipelineStage):
         self.on_disconnected()
 
         if isinstance(self._pending_connection_op, pipeline_ops_base.DisconnectOperation):
+            self._fail_queued_publishes(cause)
+
             logger.info("{}: completing disconnect op".format(self.name))
             op = self._pending_connection_op
             self._pending_connection_op = None
@@ -237,6 +438,9 @@ class MQTTTransportStage(PipelineStage):
             operation_flow.complete_op(stage=self, op=op)
         else:
             logger.warning("{}: disconnection was unexpected".format(self.name))
+            # A ReconnectStage which is bringing the connection back needs the queued publishes kept
+            if not self._is_reconnecting():
+                self._fail_queued_publishes(cause)
             # Regardless of cause, it is now a ConnectionDroppedError
             try:
                 six.raise_from(errors.ConnectionDroppedError, cause)
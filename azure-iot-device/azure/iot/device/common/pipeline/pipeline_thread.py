@@ -7,8 +7,9 @@ import functools
 import logging
 import threading
 import traceback
+import zlib
 from multiprocessing.pool import ThreadPool
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from azure.iot.device.common import unhandled_exceptions
 
 logger = logging.getLogger(__name__)
@@ -70,10 +71,214 @@ These decorators use concurrent.futures.Future and the ThreadPoolExecutor becaus
 
 3. concurrent.futures is available as a backport to 2.7.
 
+By default, every pipeline in the process shares the same pipeline thread and the same callback
+thread.  A pipeline can be given its own Executors object instead, which holds the pipeline and
+callback threads used by that pipeline (and by any other pipeline which shares the object).  The
+decorated functions find the Executors they belong to in one of these ways:
+
+1. `executors` is passed to the decorator.  This is used where a client enters its pipeline.
+
+2. The function is decorated while running on one of the threads of an Executors object.  This
+  covers the closures which stages create while handling an operation, such as the callbacks they
+  give to the transport.
+
+3. The function is a method of a stage whose pipeline_root has an Executors object.  This covers
+  the methods which the transport or a timer calls.
+
+Anything else runs on the threads which are shared by the whole process.
+
+The pipeline of an asyncio client can run on the client's event loop instead, with an
+EventLoopExecutors object.  The loop's thread is then the pipeline thread: calls made on it run
+straight away instead of being handed to another thread.
+
 """
 
+# Executor scopes.  These control which pipelines share their pipeline and callback threads.
+SCOPE_GLOBAL = "global"
+SCOPE_CLIENT = "client"
+SCOPE_SHARDED = "sharded"
+SCOPE_EVENT_LOOP = "event_loop"
+
+DEFAULT_SHARD_COUNT = 4
+
 _executors = {}
 
+# Executors objects for the sharded scope, by (shard_count, shard)
+_shards = {}
+_shards_lock = threading.Lock()
+
+# The Executors object and the name of the thread (pipeline or callback) that the code running on
+# the current thread belongs to, if any
+_local = threading.local()
+
+
+class Executors(object):
+    """
+    A pipeline thread and a callback thread which belong to one or more pipelines, instead of
+    being shared by every pipeline in the process.  The threads are created the first time they
+    are needed.
+
+    :ivar str name: The name of the Executors object, used for logging.
+    """
+
+    # Whether the threads are named after what they're used for
+    renames_threads = True
+
+    def __init__(self, name):
+        self.name = name
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def get(self, thread_name):
+        """
+        Get the ThreadPoolExecutor object with the given name, creating it if needed.
+        """
+        executor = self._executors.get(thread_name)
+        if executor is None:
+            with self._lock:
+                executor = self._executors.get(thread_name)
+                if executor is None:
+                    logger.info("Creating {} executor for {}".format(thread_name, self.name))
+                    executor = ThreadPoolExecutor(max_workers=1)
+                    self._executors[thread_name] = executor
+        return executor
+
+    def is_current_thread(self, thread_name):
+        """
+        Return True if the current thread is the thread with the given name.
+        """
+        return (
+            threading.current_thread().name is thread_name
+            and getattr(_local, "executors", None) is self
+        )
+
+
+class EventLoopExecutors(Executors):
+    """
+    Runs a pipeline and its callbacks on an asyncio event loop instead of on threads of their own.
+    Calls made on the loop's thread run straight away.  Calls from other threads, such as the
+    transport's network thread or a timer, are handed to the loop with call_soon_threadsafe.
+    Callbacks are scheduled with call_soon, so that client code never runs in the middle of a
+    pipeline stage.
+
+    Until the object is bound to a loop, functions run on the thread which calls them.  Nothing in
+    a pipeline runs on its own before the client makes its first call, so this only happens while
+    the pipeline is being built.
+
+    :ivar loop: The event loop, or None if the object hasn't been bound to one yet.
+    """
+
+    renames_threads = False
+
+    def __init__(self, name):
+        super(EventLoopExecutors, self).__init__(name)
+        self.loop = None
+        self._thread = None
+        self._executor = _EventLoopExecutor(self)
+
+    def bind(self, loop):
+        """
+        Run everything on the given loop from now on.  This has to be called on the loop's thread.
+
+        :raises: RuntimeError if the object is already bound to a different loop.
+        """
+        if self.loop is loop:
+            return
+        if self.loop is not None:
+            raise RuntimeError("{} is already bound to another event loop".format(self.name))
+        logger.info("Binding {} to event loop".format(self.name))
+        self._thread = threading.current_thread()
+        self.loop = loop
+
+    def get(self, thread_name):
+        return self._executor
+
+    def is_current_thread(self, thread_name):
+        if self.loop is None:
+            return True
+        return thread_name == "pipeline" and threading.current_thread() is self._thread
+
+    def is_loop_thread(self):
+        """
+        Return True if the current thread is the one which runs the loop.
+        """
+        return threading.current_thread() is self._thread
+
+
+class _EventLoopExecutor(object):
+    """
+    Runs functions on the loop of an EventLoopExecutors object.  It has the same submit method as a
+    ThreadPoolExecutor.
+    """
+
+    def __init__(self, executors):
+        self._executors = executors
+
+    def submit(self, fn):
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        if self._executors.is_loop_thread():
+            self._executors.loop.call_soon(run)
+        else:
+            self._executors.loop.call_soon_threadsafe(run)
+        return future
+
+
+def get_executors(scope=SCOPE_GLOBAL, key=None, shard_count=DEFAULT_SHARD_COUNT):
+    """
+    Get the Executors object for a new pipeline.
+
+    :param str scope: SCOPE_GLOBAL to use the threads shared by the whole process, SCOPE_CLIENT to
+      give the pipeline threads of its own, SCOPE_SHARDED to share the threads of one of
+      shard_count Executors objects, picked by key, or SCOPE_EVENT_LOOP to run the pipeline on the
+      event loop of an asyncio client.
+    :param str key: The identity of the client the pipeline belongs to, such as its device id.
+    :param int shard_count: The number of Executors objects to spread pipelines across with
+      SCOPE_SHARDED.
+
+    :returns: An Executors object, or None for SCOPE_GLOBAL.
+    :raises: ValueError if the scope is invalid.
+    """
+    if scope == SCOPE_GLOBAL:
+        return None
+    elif scope == SCOPE_CLIENT:
+        return Executors(name=key)
+    elif scope == SCOPE_EVENT_LOOP:
+        return EventLoopExecutors(name=key)
+    elif scope == SCOPE_SHARDED:
+        # crc32 spreads similar keys (device1, device2, ...) evenly and, unlike hash(), gives
+        # the same shard in every process.
+        shard = (zlib.crc32(str(key).encode("utf-8")) & 0xFFFFFFFF) % shard_count
+        with _shards_lock:
+            if (shard_count, shard) not in _shards:
+                _shards[(shard_count, shard)] = Executors(
+                    name="shard {} of {}".format(shard, shard_count)
+                )
+            return _shards[(shard_count, shard)]
+    else:
+        raise ValueError("Invalid executor scope: {}".format(scope))
+
+
+def _get_stage_executors(obj):
+    """
+    Get the Executors object of the pipeline that obj belongs to, if obj is a pipeline stage and
+    its pipeline has one.
+    """
+    executors = getattr(getattr(obj, "pipeline_root", None), "executors", None)
+    if isinstance(executors, Executors):
+        return executors
+    return None
+
 
 def _get_named_executor(thread_name):
     """
@@ -88,12 +293,28 @@ def _get_named_executor(thread_name):
     return _executors[thread_name]
 
 
-def _invoke_on_executor_thread(func, thread_name, block=True):
+def _run_as(executors, thread_name, func, args, kwargs):
+    """
+    Call func as code which runs on the named thread of executors.
+    """
+    previous = (getattr(_local, "executors", None), getattr(_local, "thread_name", None))
+    _local.executors = executors
+    _local.thread_name = thread_name
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.executors, _local.thread_name = previous
+
+
+def _invoke_on_executor_thread(func, thread_name, block=True, executors=None):
     """
     Return wrapper to run the function on a given thread.  If block==False,
     the call returns immediately without waiting for the decorated function to complete.
     If block==True, the call waits for the decorated function to complete before returning.
+    If executors is None, the thread is picked as described at the top of this module.
     """
+    if executors is None:
+        executors = getattr(_local, "executors", None)
 
     # Mocks on py27 don't have a __name__ attribute.  Use str() if you can't use __name__
     try:
@@ -104,13 +325,26 @@ def _invoke_on_executor_thread(func, thread_name, block=True):
         function_has_name = False
 
     def wrapper(*args, **kwargs):
-        if threading.current_thread().name is not thread_name:
+        target_executors = executors
+        if target_executors is None and args:
+            target_executors = _get_stage_executors(args[0])
+
+        if target_executors is None:
+            on_thread = (
+                threading.current_thread().name is thread_name
+                and getattr(_local, "executors", None) is None
+            )
+        else:
+            on_thread = target_executors.is_current_thread(thread_name)
+
+        if not on_thread:
             logger.info("Starting {} in {} thread".format(function_name, thread_name))
 
             def thread_proc():
-                threading.current_thread().name = thread_name
+                if target_executors is None or target_executors.renames_threads:
+                    threading.current_thread().name = thread_name
                 try:
-                    return func(*args, **kwargs)
+                    return _run_as(target_executors, thread_name, func, args, kwargs)
                 except Exception as e:
                     if not block:
                         unhandled_exceptions.exception_caught_in_background_thread(e)
@@ -123,15 +357,23 @@ def _invoke_on_executor_thread(func, thread_name, block=True):
                         traceback.print_exc()
                     raise
 
-            # TODO: add a timeout here and throw exception on failure
-            future = _get_named_executor(thread_name).submit(thread_proc)
+            # There is no timeout here on purpose.  Functions that run on these threads never
+            # wait for the network, so they always finish quickly.  Waiting for the network is
+            # bounded by the operation deadlines, which are enforced by PipelineRootStage.
+            if target_executors is None:
+                executor = _get_named_executor(thread_name)
+            else:
+                executor = target_executors.get(thread_name)
+            future = executor.submit(thread_proc)
             if block:
                 return future.result()
             else:
                 return future
         else:
             logger.debug("Already in {} thread for {}".format(thread_name, function_name))
-            return func(*args, **kwargs)
+            if target_executors is None:
+                return func(*args, **kwargs)
+            return _run_as(target_executors, thread_name, func, args, kwargs)
 
     # Silly hack:  On 2.7, we can't use @functools.wraps on callables don't have a __name__ attribute
     # attribute(like MagicMock object), so we only do it when we have a name.  functools.update_wrapper
@@ -143,25 +385,29 @@ def _invoke_on_executor_thread(func, thread_name, block=True):
         return wrapper
 
 
-def invoke_on_pipeline_thread(func):
+def invoke_on_pipeline_thread(func, executors=None):
     """
     Run the decorated function on the pipeline thread.
     """
-    return _invoke_on_executor_thread(func=func, thread_name="pipeline")
+    return _invoke_on_executor_thread(func=func, thread_name="pipeline", executors=executors)
 
 
-def invoke_on_pipeline_thread_nowait(func):
+def invoke_on_pipeline_thread_nowait(func, executors=None):
     """
     Run the decorated function on the pipeline thread, but don't wait for it to complete
     """
-    return _invoke_on_executor_thread(func=func, thread_name="pipeline", block=False)
+    return _invoke_on_executor_thread(
+        func=func, thread_name="pipeline", block=False, executors=executors
+    )
 
 
-def invoke_on_callback_thread_nowait(func):
+def invoke_on_callback_thread_nowait(func, executors=None):
     """
     Run the decorated function on the callback thread, but don't wait for it to complete
     """
-    return _invoke_on_executor_thread(func=func, thread_name="callback", block=False)
+    return _invoke_on_executor_thread(
+        func=func, thread_name="callback", block=False, executors=executors
+    )
 
 
 def _assert_executor_thread(func, thread_name):
@@ -174,7 +420,8 @@ def _assert_executor_thread(func, thread_name):
     def wrapper(*args, **kwargs):
 
         assert (
-            threading.current_thread().name == thread_name
+            getattr(_local, "thread_name", None) == thread_name
+            or threading.current_thread().name == thread_name
         ), """
             Function {function_name} is not running inside {thread_name} thread.
             It should be. You should use invoke_on_{thread_name}_thread(_nowait) to enter the
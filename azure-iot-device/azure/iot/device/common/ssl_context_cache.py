@@ -0,0 +1,173 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains a process-wide cache of the SSLContext objects used to secure
+connections, so that transports with the same TLS configuration can share one context.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import weakref
+import six
+
+logger = logging.getLogger(__name__)
+
+# Contexts are only kept alive by the transports using them.  Once the last transport using a
+# context goes away, the context is dropped from the cache.
+_contexts = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+# In-memory certificates and keys are written here, when it exists, so that they never reach a
+# disk.  It is a filesystem held in memory on most Linux systems.
+_MEMORY_TEMP_DIR = "/dev/shm"
+
+
+def _digest(data):
+    if isinstance(data, six.text_type):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_key(path):
+    """
+    Identify a file by its path and modification details, so that a file which is replaced on
+    disk (e.g. when a certificate is rotated) does not reuse a stale context.
+    """
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except (OSError, IOError):
+        # Let load_cert_chain() report the problem with the file
+        return (path, None, None)
+    return (path, stat.st_mtime, stat.st_size)
+
+
+def _make_key(ca_cert, x509_cert):
+    ca_key = _digest(ca_cert) if ca_cert else None
+    if x509_cert is None:
+        return (ca_key, None)
+    cert_key = (
+        _file_key(x509_cert.certificate_file),
+        _digest(x509_cert.certificate_data) if x509_cert.certificate_data else None,
+        _file_key(x509_cert.key_file),
+        _digest(x509_cert.key_data) if x509_cert.key_data else None,
+        # The cache outlives the X509 object, so it must not keep the pass phrase itself
+        _digest(x509_cert.pass_phrase) if x509_cert.pass_phrase else None,
+    )
+    return (ca_key, cert_key)
+
+
+def _make_private_dir():
+    """
+    Create a directory which only the current user can open, preferably in memory, and return its
+    path.
+    """
+    base_dir = None
+    if os.path.isdir(_MEMORY_TEMP_DIR) and os.access(_MEMORY_TEMP_DIR, os.W_OK | os.X_OK):
+        base_dir = _MEMORY_TEMP_DIR
+    return tempfile.mkdtemp(prefix="azure-iot-", dir=base_dir)
+
+
+def _write_temp_file(private_dir, data):
+    """
+    Write certificate or key material to a file in private_dir which only the current user can
+    read, and return its path.
+    """
+    if isinstance(data, six.text_type):
+        data = data.encode("utf-8")
+    fd, path = tempfile.mkstemp(suffix=".pem", dir=private_dir)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return path
+
+
+def _load_cert_chain(ssl_context, x509_cert):
+    """
+    Load the client certificate and key of x509_cert into ssl_context.
+
+    ssl.SSLContext.load_cert_chain() can only load from files, so an in-memory certificate or key
+    is written to a private directory first, which is removed as soon as it has been loaded.  The
+    key is written as it was given, so an unencrypted key is briefly readable by the current user
+    in that directory.
+    """
+    if not (x509_cert.certificate_data or x509_cert.key_data):
+        ssl_context.load_cert_chain(
+            x509_cert.certificate_file, x509_cert.key_file, x509_cert.pass_phrase
+        )
+        return
+
+    private_dir = _make_private_dir()
+    try:
+        cert_file = x509_cert.certificate_file
+        if x509_cert.certificate_data:
+            cert_file = _write_temp_file(private_dir, x509_cert.certificate_data)
+        key_file = x509_cert.key_file
+        if x509_cert.key_data:
+            key_file = _write_temp_file(private_dir, x509_cert.key_data)
+        ssl_context.load_cert_chain(cert_file, key_file, x509_cert.pass_phrase)
+    finally:
+        shutil.rmtree(private_dir, ignore_errors=True)
+
+
+def create_ssl_context(ca_cert=None, x509_cert=None):
+    """
+    Create a new SSLContext which uses TLS 1.2, requires a server certificate and checks the
+    hostname.
+
+    :param str ca_cert: (Optional) Certificates used to validate the server.  If not provided,
+      the default system certificates are used.
+    :param x509_cert: (Optional) The X509 object used to authenticate the client.
+    """
+    logger.info("creating a SSL context")
+    ssl_context = ssl.SSLContext(protocol=ssl.PROTOCOL_TLSv1_2)
+
+    if ca_cert:
+        ssl_context.load_verify_locations(cadata=ca_cert)
+    else:
+        ssl_context.load_default_certs()
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    ssl_context.check_hostname = True
+
+    if x509_cert is not None:
+        logger.info("configuring SSL context with client-side certificate and key")
+        _load_cert_chain(ssl_context, x509_cert)
+
+    return ssl_context
+
+
+def get_ssl_context(ca_cert=None, x509_cert=None):
+    """
+    Return an SSLContext for the given configuration, reusing a cached context if one is already
+    in use by another transport.  Callers must not modify the returned context.
+
+    :param str ca_cert: (Optional) Certificates used to validate the server.  If not provided,
+      the default system certificates are used.
+    :param x509_cert: (Optional) The X509 object used to authenticate the client.
+    """
+    key = _make_key(ca_cert, x509_cert)
+    with _lock:
+        ssl_context = _contexts.get(key)
+        if ssl_context is None:
+            ssl_context = create_ssl_context(ca_cert=ca_cert, x509_cert=x509_cert)
+            _contexts[key] = ssl_context
+        else:
+            logger.info("reusing a cached SSL context")
+    return ssl_context
+
+
+def clear():
+    """
+    Remove all contexts from the cache.  Transports which already have a context keep using it.
+    """
+    with _lock:
+        _contexts.clear()
@@ -6,6 +6,13 @@ as a Device or Module.
 
 from .sync_clients import IoTHubDeviceClient, IoTHubModuleClient
 from .sync_inbox import InboxEmpty
-from .models import Message, MethodResponse
+from .models import Message, MessageTemplate, MethodResponse
 
-__all__ = ["IoTHubDeviceClient", "IoTHubModuleClient", "Message", "InboxEmpty", "MethodResponse"]
+__all__ = [
+    "IoTHubDeviceClient",
+    "IoTHubModuleClient",
+    "Message",
+    "MessageTemplate",
+    "InboxEmpty",
+    "MethodResponse",
+]
@@ -42,49 +42,60 @@ class AbstractIoTHubClient(object):
         self._edge_pipeline = None
 
     @classmethod
-    def create_from_connection_string(cls, connection_string, ca_cert=None):
+    def create_from_connection_string(cls, connection_string, ca_cert=None, **kwargs):
         """
         Instantiate the client from a IoTHub device or module connection string.
 
         :param str connection_string: The connection string for the IoTHub you wish to connect to.
         :param str ca_cert: (OPTIONAL) The trusted certificate chain. Necessary when using a
         connection string with a GatewayHostName parameter.
+        :param kwargs: (OPTIONAL) Options used to configure the pipeline.  See IoTHubPipelineConfig
+        for the supported options (e.g. max_inflight_publishes, max_queued_publishes, queue_full_policy).
 
-        :raises: ValueError if given an invalid connection_string.
+        :raises: ValueError if given an invalid connection_string or pipeline option.
         """
         # TODO: Make this device/module specific and reject non-matching connection strings.
         # This will require refactoring of the auth package to use common objects (e.g. ConnectionString)
         # in order to differentiate types of connection strings.
         authentication_provider = auth.SymmetricKeyAuthenticationProvider.parse(connection_string)
         authentication_provider.ca_cert = ca_cert  # TODO: make this part of the instantiation
-        iothub_pipeline = pipeline.IoTHubPipeline(authentication_provider)
+        iothub_pipeline = pipeline.IoTHubPipeline(
+            authentication_provider, pipeline.IoTHubPipelineConfig(**kwargs)
+        )
         return cls(iothub_pipeline)
 
     @classmethod
-    def create_from_shared_access_signature(cls, sas_token):
+    def create_from_shared_access_signature(cls, sas_token, **kwargs):
         """
         Instantiate the client from a Shared Access Signature (SAS) token.
 
         This method of instantiation is not recommended for general usage.
 
         :param str sas_token: The string representation of a SAS token.
+        :param kwargs: (OPTIONAL) Options used to configure the pipeline.  See IoTHubPipelineConfig.
 
-        :raises: ValueError if given an invalid sas_token
+        :raises: ValueError if given an invalid sas_token or pipeline option
         """
         authentication_provider = auth.SharedAccessSignatureAuthenticationProvider.parse(sas_token)
-        iothub_pipeline = pipeline.IoTHubPipeline(authentication_provider)
+        iothub_pipeline = pipeline.IoTHubPipeline(
+            authentication_provider, pipeline.IoTHubPipelineConfig(**kwargs)
+        )
         return cls(iothub_pipeline)
 
     @abc.abstractmethod
-    def connect(self):
+    def connect(self, timeout=None):
+        pass
+
+    @abc.abstractmethod
+    def disconnect(self, timeout=None):
         pass
 
     @abc.abstractmethod
-    def disconnect(self):
+    def send_d2c_message(self, message, timeout=None):
         pass
 
     @abc.abstractmethod
-    def send_d2c_message(self, message):
+    def send_d2c_messages(self, messages, max_inflight=None, timeout=None):
         pass
 
     @abc.abstractmethod
@@ -96,11 +107,11 @@ class AbstractIoTHubClient(object):
         pass
 
     @abc.abstractmethod
-    def get_twin(self):
+    def get_twin(self, timeout=None):
         pass
 
     @abc.abstractmethod
-    def patch_twin_reported_properties(self, reported_properties_patch):
+    def patch_twin_reported_properties(self, reported_properties_patch, timeout=None):
         pass
 
     @abc.abstractmethod
@@ -111,7 +122,7 @@ class AbstractIoTHubClient(object):
 @six.add_metaclass(abc.ABCMeta)
 class AbstractIoTHubDeviceClient(AbstractIoTHubClient):
     @classmethod
-    def create_from_x509_certificate(cls, x509, hostname, device_id):
+    def create_from_x509_certificate(cls, x509, hostname, device_id, **kwargs):
         """
         Instantiate a client which using X509 certificate authentication.
         :param hostname: Host running the IotHub. Can be found in the Azure portal in the Overview tab as the string hostname.
@@ -119,12 +130,15 @@ class AbstractIoTHubDeviceClient(AbstractIoTHubClient):
         If the cert comes from a CER file, it needs to be base64 encoded.
         :type x509: X509
         :param device_id: The ID is used to uniquely identify a device in the IoTHub
+        :param kwargs: (OPTIONAL) Options used to configure the pipeline.  See IoTHubPipelineConfig.
         :return: A IoTHubClient which can use X509 authentication.
         """
         authentication_provider = auth.X509AuthenticationProvider(
             x509=x509, hostname=hostname, device_id=device_id
         )
-        iothub_pipeline = pipeline.IoTHubPipeline(authentication_provider)
+        iothub_pipeline = pipeline.IoTHubPipeline(
+            authentication_provider, pipeline.IoTHubPipelineConfig(**kwargs)
+        )
         return cls(iothub_pipeline)
 
     @abc.abstractmethod
@@ -146,13 +160,15 @@ class AbstractIoTHubModuleClient(AbstractIoTHubClient):
         self._edge_pipeline = edge_pipeline
 
     @classmethod
-    def create_from_edge_environment(cls):
+    def create_from_edge_environment(cls, **kwargs):
         """
         Instantiate the client from the IoT Edge environment.
 
         This method can only be run from inside an IoT Edge container, or in a debugging
         environment configured for Edge development (e.g. Visual Studio, Visual Studio Code)
 
+        :param kwargs: (OPTIONAL) Options used to configure the pipeline.  See IoTHubPipelineConfig.
+
         :raises: IoTEdgeError if the IoT Edge container is not configured correctly.
         :raises: ValueError if debug variables are invalid
         """
@@ -206,12 +222,14 @@ class AbstractIoTHubModuleClient(AbstractIoTHubClient):
                 workload_uri=workload_uri,
                 api_version=api_version,
             )
-        iothub_pipeline = pipeline.IoTHubPipeline(authentication_provider)
+        iothub_pipeline = pipeline.IoTHubPipeline(
+            authentication_provider, pipeline.IoTHubPipelineConfig(**kwargs)
+        )
         edge_pipeline = pipeline.EdgePipeline(authentication_provider)
         return cls(iothub_pipeline, edge_pipeline=edge_pipeline)
 
     @classmethod
-    def create_from_x509_certificate(cls, x509, hostname, device_id, module_id):
+    def create_from_x509_certificate(cls, x509, hostname, device_id, module_id, **kwargs):
         """
         Instantiate a client which using X509 certificate authentication.
         :param hostname: Host running the IotHub. Can be found in the Azure portal in the Overview tab as the string hostname.
@@ -220,16 +238,19 @@ class AbstractIoTHubModuleClient(AbstractIoTHubClient):
         :type x509: X509
         :param device_id: The ID is used to uniquely identify a device in the IoTHub
         :param module_id : The ID of the module to uniquely identify a module on a device on the IoTHub.
+        :param kwargs: (OPTIONAL) Options used to configure the pipeline.  See IoTHubPipelineConfig.
         :return: A IoTHubClient which can use X509 authentication.
         """
         authentication_provider = auth.X509AuthenticationProvider(
             x509=x509, hostname=hostname, device_id=device_id, module_id=module_id
         )
-        iothub_pipeline = pipeline.IoTHubPipeline(authentication_provider)
+        iothub_pipeline = pipeline.IoTHubPipeline(
+            authentication_provider, pipeline.IoTHubPipelineConfig(**kwargs)
+        )
         return cls(iothub_pipeline)
 
     @abc.abstractmethod
-    def send_to_output(self, message, output_name):
+    def send_to_output(self, message, output_name, timeout=None):
         pass
 
     @abc.abstractmethod
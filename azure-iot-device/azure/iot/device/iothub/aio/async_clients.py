@@ -7,8 +7,12 @@
 Azure IoTHub Device SDK for Python.
 """
 
+import asyncio
+import collections
+import functools
 import logging
-from azure.iot.device.common import async_adapter
+from azure.iot.device.common import async_adapter, asyncio_compat
+from azure.iot.device.common.pipeline import pipeline_thread
 from azure.iot.device.iothub.abstract_clients import (
     AbstractIoTHubClient,
     AbstractIoTHubDeviceClient,
@@ -46,6 +50,86 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         self._iothub_pipeline.on_disconnected = self._on_disconnected
         self._iothub_pipeline.on_method_request_received = self._inbox_manager.route_method_request
         self._iothub_pipeline.on_twin_patch_received = self._inbox_manager.route_twin_patch
+        # The pipeline is called directly on the event loop, so it must never block.  Operations are
+        # handed to the pipeline thread without waiting, and sends wait here for room in the
+        # publish queue.
+        self._iothub_pipeline.submit_nowait = True
+        self._iothub_pipeline.on_publish_slot_released = self._on_publish_slot_released
+        # Futures of the sends waiting for room in the publish queue, and the loop they belong to
+        self._publish_waiters = collections.deque()
+        self._loop = None
+
+    def _on_publish_slot_released(self):
+        """Helper handler that is called, on any thread, when there is room in the publish queue"""
+        if self._publish_waiters:
+            self._call_soon_on_loop(self._wake_publish_waiter)
+
+    def _call_soon_on_loop(self, callback, *args):
+        """Helper that schedules a callback on the client's loop from any thread, unless the loop
+        has been closed (e.g. a PUBACK arriving while the application shuts down).
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            logger.debug("Event loop is closed, not scheduling {}".format(callback))
+            return
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop was closed after it was checked
+            logger.debug("Event loop is closed, not scheduling {}".format(callback))
+
+    def _wake_publish_waiter(self):
+        """Helper that wakes the first send waiting for room in the publish queue"""
+        while self._publish_waiters:
+            waiter = self._publish_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _release_publish_waiters(self, waiters):
+        """Helper that wakes every send in waiters, so each checks for room in the publish queue
+        again, and waits anew if there is still none.
+        """
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _make_async(self, pipeline_method, publishes=False):
+        """Return a coroutine function which calls a method of the IoTHubPipeline on the event loop.
+
+        The pipeline method only hands an operation to the pipeline, so it returns straight away
+        and no executor thread is needed.  A send which would block until there is room in the
+        publish queue waits for it on the loop first.  If the pipeline runs on the event loop, it
+        is bound to the running loop by the first call.
+
+        :param pipeline_method: The IoTHubPipeline method.
+        :param bool publishes: Whether the method takes a slot in the publish queue.
+        """
+        executors = self._iothub_pipeline.executors
+
+        @functools.wraps(pipeline_method)
+        async def call_on_loop(*args, **kwargs):
+            loop = asyncio_compat.get_running_loop()
+            if isinstance(executors, pipeline_thread.EventLoopExecutors):
+                executors.bind(loop)
+            self._loop = loop
+            while publishes and self._iothub_pipeline.publish_would_block():
+                waiter = asyncio_compat.create_future(loop)
+                self._publish_waiters.append(waiter)
+                # Room may have been made before the waiter was added, with nothing to wake
+                if not self._iothub_pipeline.publish_would_block():
+                    waiter.cancel()
+                    break
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if not waiter.cancelled():
+                        # This send was woken up, but won't use the room, so wake the next one
+                        self._wake_publish_waiter()
+                    raise
+            return pipeline_method(*args, **kwargs)
+
+        return call_on_loop
 
     def _on_connected(self):
         """Helper handler that is called upon an iothub pipeline connect"""
@@ -56,39 +140,50 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         logger.info("Connection State - Disconnected")
         self._inbox_manager.clear_all_method_requests()
         logger.info("Cleared all pending method requests due to disconnect")
+        # Don't hold on to the sends waiting for room across a disconnect.  If the loop is gone
+        # they can never run again, so they are just dropped.
+        waiters, self._publish_waiters = self._publish_waiters, collections.deque()
+        if waiters:
+            self._call_soon_on_loop(self._release_publish_waiters, waiters)
 
-    async def connect(self):
+    async def connect(self, timeout=None):
         """Connects the client to an Azure IoT Hub or Azure IoT Edge Hub instance.
 
         The destination is chosen based on the credentials passed via the auth_provider parameter
         that was provided when this object was initialized.
+
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Connecting to Hub...")
-        connect_async = async_adapter.emulate_async(self._iothub_pipeline.connect)
+        connect_async = self._make_async(self._iothub_pipeline.connect)
 
         def sync_callback():
             logger.info("Successfully connected to Hub")
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await connect_async(callback=callback)
+        await connect_async(callback=callback, timeout=timeout)
         await callback.completion()
 
-    async def disconnect(self):
+    async def disconnect(self, timeout=None):
         """Disconnect the client from the Azure IoT Hub or Azure IoT Edge Hub instance.
+
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Disconnecting from Hub...")
-        disconnect_async = async_adapter.emulate_async(self._iothub_pipeline.disconnect)
+        disconnect_async = self._make_async(self._iothub_pipeline.disconnect)
 
         def sync_callback():
             logger.info("Successfully disconnected from Hub")
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await disconnect_async(callback=callback)
+        await disconnect_async(callback=callback, timeout=timeout)
         await callback.completion()
 
-    async def send_d2c_message(self, message):
+    async def send_d2c_message(self, message, timeout=None):
         """Sends a message to the default events endpoint on the Azure IoT Hub or Azure IoT Edge Hub instance.
 
         If the connection to the service has not previously been opened by a call to connect, this
@@ -96,21 +191,66 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         :param message: The actual message to send. Anything passed that is not an instance of the
         Message class will be converted to Message object.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         if not isinstance(message, Message):
             message = Message(message)
 
         logger.info("Sending message to Hub...")
-        send_d2c_message_async = async_adapter.emulate_async(self._iothub_pipeline.send_d2c_message)
+        send_d2c_message_async = self._make_async(
+            self._iothub_pipeline.send_d2c_message, publishes=True
+        )
 
         def sync_callback():
             logger.info("Successfully sent message to Hub")
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await send_d2c_message_async(message, callback=callback)
+        await send_d2c_message_async(message, callback=callback, timeout=timeout)
+        await callback.completion()
+
+    async def send_d2c_messages(self, messages, max_inflight=None, timeout=None):
+        """Sends a batch of messages to the default events endpoint on the Azure IoT Hub or Azure IoT
+        Edge Hub instance.
+
+        All of the messages are submitted to the pipeline at once, and up to max_inflight of them
+        can be waiting for an acknowledgement from the service at any one time.
+
+        If the connection to the service has not previously been opened by a call to connect, this
+        function will open the connection before sending the messages.
+
+        :param messages: An iterable of messages to send. Anything passed that is not an instance of
+        the Message class will be converted to Message object.
+        :param int max_inflight: Optionally provide the maximum number of messages which can be
+        waiting for an acknowledgement at the same time.
+        :param float timeout: Optionally provide a number of seconds after which the messages which
+        haven't been acknowledged yet fail with a TimeoutError.
+
+        :returns: A list with one entry per message, in the same order as the messages. Each entry
+        is None if that message was sent successfully, or the error which caused it to fail.
+        """
+        messages = [m if isinstance(m, Message) else Message(m) for m in messages]
+
+        logger.info("Sending batch of {} messages to Hub...".format(len(messages)))
+        send_d2c_messages_async = self._make_async(self._iothub_pipeline.send_d2c_messages)
+
+        results = None
+
+        def sync_callback(batch_results):
+            nonlocal results
+            logger.info("Finished sending batch of messages to Hub")
+            results = batch_results
+
+        callback = async_adapter.AwaitableCallback(sync_callback)
+
+        await send_d2c_messages_async(
+            messages, max_inflight=max_inflight, callback=callback, timeout=timeout
+        )
         await callback.completion()
 
+        return results
+
     async def receive_method_request(self, method_name=None):
         """Receive a method request via the Azure IoT Hub or Azure IoT Edge Hub.
 
@@ -132,18 +272,18 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         logger.info("Received method request")
         return method_request
 
-    async def send_method_response(self, method_response):
+    async def send_method_response(self, method_response, timeout=None):
         """Send a response to a method request via the Azure IoT Hub or Azure IoT Edge Hub.
 
         If the connection to the service has not previously been opened by a call to connect, this
         function will open the connection before sending the event.
 
         :param method_response: The MethodResponse to send
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Sending method response to Hub...")
-        send_method_response_async = async_adapter.emulate_async(
-            self._iothub_pipeline.send_method_response
-        )
+        send_method_response_async = self._make_async(self._iothub_pipeline.send_method_response)
 
         def sync_callback():
             logger.info("Successfully sent method response to Hub")
@@ -151,38 +291,44 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         callback = async_adapter.AwaitableCallback(sync_callback)
 
         # TODO: maybe consolidate method_request, result and status into a new object
-        await send_method_response_async(method_response, callback=callback)
+        await send_method_response_async(method_response, callback=callback, timeout=timeout)
         await callback.completion()
 
-    async def _enable_feature(self, feature_name):
+    async def _enable_feature(self, feature_name, timeout=None):
         """Enable an Azure IoT Hub feature
 
         :param feature_name: The name of the feature to enable.
         See azure.iot.device.common.pipeline.constant for possible values.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Enabling feature:" + feature_name + "...")
-        enable_feature_async = async_adapter.emulate_async(self._iothub_pipeline.enable_feature)
+        enable_feature_async = self._make_async(self._iothub_pipeline.enable_feature)
 
         def sync_callback():
             logger.info("Successfully enabled feature:" + feature_name)
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await enable_feature_async(feature_name, callback=callback)
+        await enable_feature_async(feature_name, callback=callback, timeout=timeout)
         await callback.completion()
 
-    async def get_twin(self):
+    async def get_twin(self, timeout=None):
         """
         Gets the device or module twin from the Azure IoT Hub or Azure IoT Edge Hub service.
 
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.  If the twin feature has to be enabled first, enabling it gets the same
+        timeout.
+
         :returns: Twin object which was retrieved from the hub
         """
         logger.info("Getting twin")
 
         if not self._iothub_pipeline.feature_enabled[constant.TWIN]:
-            await self._enable_feature(constant.TWIN)
+            await self._enable_feature(constant.TWIN, timeout=timeout)
 
-        get_twin_async = async_adapter.emulate_async(self._iothub_pipeline.get_twin)
+        get_twin_async = self._make_async(self._iothub_pipeline.get_twin)
 
         twin = None
 
@@ -193,12 +339,12 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await get_twin_async(callback=callback)
+        await get_twin_async(callback=callback, timeout=timeout)
         await callback.completion()
 
         return twin
 
-    async def patch_twin_reported_properties(self, reported_properties_patch):
+    async def patch_twin_reported_properties(self, reported_properties_patch, timeout=None):
         """
         Update reported properties with the Azure IoT Hub or Azure IoT Edge Hub service.
 
@@ -207,22 +353,23 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         :param reported_properties_patch:
         :type reported_properties_patch: dict, str, int, float, bool, or None (JSON compatible values)
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.  If the twin feature has to be enabled first, enabling it gets the same
+        timeout.
         """
         logger.info("Patching twin reported properties")
 
         if not self._iothub_pipeline.feature_enabled[constant.TWIN]:
-            await self._enable_feature(constant.TWIN)
+            await self._enable_feature(constant.TWIN, timeout=timeout)
 
-        patch_twin_async = async_adapter.emulate_async(
-            self._iothub_pipeline.patch_twin_reported_properties
-        )
+        patch_twin_async = self._make_async(self._iothub_pipeline.patch_twin_reported_properties)
 
         def sync_callback():
             logger.info("Successfully sent twin patch")
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await patch_twin_async(patch=reported_properties_patch, callback=callback)
+        await patch_twin_async(patch=reported_properties_patch, callback=callback, timeout=timeout)
         await callback.completion()
 
     async def receive_twin_desired_properties_patch(self):
@@ -298,7 +445,7 @@ class IoTHubModuleClient(GenericIoTHubClient, AbstractIoTHubModuleClient):
         super().__init__(iothub_pipeline=iothub_pipeline, edge_pipeline=edge_pipeline)
         self._iothub_pipeline.on_input_message_received = self._inbox_manager.route_input_message
 
-    async def send_to_output(self, message, output_name):
+    async def send_to_output(self, message, output_name, timeout=None):
         """Sends an event/message to the given module output.
 
         These are outgoing events and are meant to be "output events"
@@ -309,6 +456,8 @@ class IoTHubModuleClient(GenericIoTHubClient, AbstractIoTHubModuleClient):
         :param message: message to send to the given output. Anything passed that is not an instance of the
         Message class will be converted to Message object.
         :param output_name: Name of the output to send the event to.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         if not isinstance(message, Message):
             message = Message(message)
@@ -316,8 +465,8 @@ class IoTHubModuleClient(GenericIoTHubClient, AbstractIoTHubModuleClient):
         message.output_name = output_name
 
         logger.info("Sending message to output:" + output_name + "...")
-        send_output_event_async = async_adapter.emulate_async(
-            self._iothub_pipeline.send_output_event
+        send_output_event_async = self._make_async(
+            self._iothub_pipeline.send_output_event, publishes=True
         )
 
         def sync_callback():
@@ -325,7 +474,7 @@ class IoTHubModuleClient(GenericIoTHubClient, AbstractIoTHubModuleClient):
 
         callback = async_adapter.AwaitableCallback(sync_callback)
 
-        await send_output_event_async(message, callback=callback)
+        await send_output_event_async(message, callback=callback, timeout=timeout)
         await callback.completion()
 
     async def receive_input_message(self, input_name):
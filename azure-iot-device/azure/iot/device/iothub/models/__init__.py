@@ -3,5 +3,5 @@
 This package provides object models for use within the Azure IoT Hub Device SDK.
 """
 
-from .message import Message
+from .message import Message, MessageTemplate
 from .methods import MethodRequest, MethodResponse
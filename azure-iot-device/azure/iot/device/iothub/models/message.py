@@ -11,7 +11,9 @@
 class Message(object):
     """Represents a message to or from IoTHub
 
-    :ivar data: The data that constitutes the payload
+    :ivar data: The data that constitutes the payload.  This can be a str, a number, or any object
+      which supports the buffer protocol, such as bytes, bytearray or memoryview.  Buffers are sent
+      without being copied.
     :ivar custom_properties: Dictionary of custom message properties
     :ivar lock_token: Used by receiver to abandon, reject or complete the message
     :ivar message id: A user-settlable identifier for the message used for request-reply patterns. Format: A case-sensitive string (up to 128 characters long) of ASCII 7-bit alphanumeric characters + {'-', ':', '.', '+', '%', '_', '#', '*', '?', '!', '(', ')', ',', '=', '@', ';', '$', '''}
@@ -25,22 +27,59 @@ class Message(object):
     :ivar content_encoding: Content encoding of the message data. Can be 'utf-8', 'utf-16' or 'utf-32'
     :ivar content_type: Content type property used to route messages with the message-body. Can be 'application/json'
     :ivar output_name: Name of the output that the is being sent to.
+    :ivar qos: MQTT quality of service to send the message with.  0 sends the message without waiting
+      for the service to acknowledge it, so it can be lost.  None uses the default for the client.
+    :ivar template: The MessageTemplate the message was created from, or None.
     """
 
+    # Messages can pile up by the thousand in inboxes and send queues, so they use slots instead of
+    # a __dict__, and only create their custom_properties dictionary when it's first used.
+    __slots__ = (
+        "data",
+        "_custom_properties",
+        "lock_token",
+        "message_id",
+        "sequence_number",
+        "to",
+        "expiry_time_utc",
+        "enqueued_time",
+        "correlation_id",
+        "user_id",
+        "ack",
+        "content_encoding",
+        "content_type",
+        "output_name",
+        "qos",
+        "template",
+    )
+
     def __init__(
-        self, data, message_id=None, content_encoding=None, content_type=None, output_name=None
+        self,
+        data,
+        message_id=None,
+        content_encoding=None,
+        content_type=None,
+        output_name=None,
+        qos=None,
     ):
         """
         Initializer for Message
 
-        :param data: The  data that constitutes the payload
+        :param data: The  data that constitutes the payload.  A str, a number, or any object which
+          supports the buffer protocol, such as bytes, bytearray or memoryview.
         :param str message_id: A user-settable identifier for the message used for request-reply patterns. Format: A case-sensitive string (up to 128 characters long) of ASCII 7-bit alphanumeric characters + {'-', ':', '.', '+', '%', '_', '#', '*', '?', '!', '(', ')', ',', '=', '@', ';', '$', '''}
         :param str content_encoding: Content encoding of the message data. Can be 'utf-8', 'utf-16' or 'utf-32'
         :param str content_type: Content type property used to routes with the message body. Can be 'application/json'
         :param str output_name: Name of the output that the is being sent to.
+        :param int qos: MQTT quality of service to send the message with, 0 or 1.  None uses the
+          default for the client.
+
+        :raises: ValueError if qos is not None, 0 or 1
         """
+        if qos not in (None, 0, 1):
+            raise ValueError("Invalid qos: {}".format(qos))
         self.data = data
-        self.custom_properties = {}
+        self._custom_properties = None
         self.lock_token = None
         self.message_id = message_id
         self.sequence_number = None
@@ -53,6 +92,116 @@ class Message(object):
         self.content_encoding = content_encoding
         self.content_type = content_type
         self.output_name = output_name
+        self.qos = qos
+        self.template = None
+
+    @property
+    def custom_properties(self):
+        if self._custom_properties is None:
+            self._custom_properties = {}
+        return self._custom_properties
+
+    @custom_properties.setter
+    def custom_properties(self, value):
+        self._custom_properties = value
 
     def __str__(self):
         return str(self.data)
+
+
+class MessageTemplate(object):
+    """A set of properties shared by many outgoing messages.
+
+    Messages created from a template get its content type, content encoding, output name and custom
+    properties.  The client encodes these properties once per template instead of once per message,
+    and only encodes the properties which are set on each message, such as the message id, when the
+    message is sent.  Changing a templated property on a message is allowed, but the message is then
+    encoded like any other message.
+
+    The properties of a template can't be changed once it is created.
+
+    :ivar content_type: Content type property used to route messages with the message body.
+    :ivar content_encoding: Content encoding of the message data.
+    :ivar output_name: Name of the output that the messages are sent to.
+    :ivar custom_properties: Dictionary of custom message properties.  This is a copy, so changing it
+      doesn't change the template.
+    """
+
+    __slots__ = (
+        "_content_type",
+        "_content_encoding",
+        "_output_name",
+        "_custom_properties",
+        "__weakref__",
+    )
+
+    def __init__(
+        self, content_type=None, content_encoding=None, output_name=None, custom_properties=None
+    ):
+        """
+        Initializer for MessageTemplate
+
+        :param str content_type: Content type property used to route messages with the message
+          body.  Can be 'application/json'
+        :param str content_encoding: Content encoding of the message data.  Can be 'utf-8', 'utf-16'
+          or 'utf-32'
+        :param str output_name: Name of the output that the messages are sent to.
+        :param dict custom_properties: Dictionary of custom message properties.
+        """
+        self._content_type = content_type
+        self._content_encoding = content_encoding
+        self._output_name = output_name
+        self._custom_properties = dict(custom_properties or {})
+
+    @property
+    def content_type(self):
+        return self._content_type
+
+    @property
+    def content_encoding(self):
+        return self._content_encoding
+
+    @property
+    def output_name(self):
+        return self._output_name
+
+    @property
+    def custom_properties(self):
+        return dict(self._custom_properties)
+
+    def create_message(self, data, message_id=None, qos=None):
+        """
+        Create a message with the properties of this template.
+
+        :param data: The data that constitutes the payload.
+        :param str message_id: A user-settable identifier for the message.
+        :param int qos: MQTT quality of service to send the message with, 0 or 1.  None uses the
+          default for the client.
+
+        :returns: A new Message object.
+        :raises: ValueError if qos is not None, 0 or 1
+        """
+        message = Message(
+            data,
+            message_id=message_id,
+            content_encoding=self._content_encoding,
+            content_type=self._content_type,
+            output_name=self._output_name,
+            qos=qos,
+        )
+        if self._custom_properties:
+            message.custom_properties = dict(self._custom_properties)
+        message.template = self
+        return message
+
+    def matches(self, message):
+        """
+        Return True if a message still has every property of this template, and no other custom
+        properties.
+        """
+        return (
+            message.content_type == self._content_type
+            and message.content_encoding == self._content_encoding
+            and message.output_name == self._output_name
+            and (message._custom_properties or {}) == self._custom_properties
+        )
@@ -15,6 +15,8 @@ class MethodRequest(object):
     :ivar dict payload: The JSON payload being sent with the request.
     """
 
+    __slots__ = ("_request_id", "_name", "_payload")
+
     def __init__(self, request_id, name, payload):
         """Initializer for a MethodRequest.
 
@@ -48,6 +50,8 @@ class MethodResponse(object):
     :type payload: dict, str, int, float, bool, or None (JSON compatible values)
     """
 
+    __slots__ = ("request_id", "status", "payload")
+
     def __init__(self, request_id, status, payload=None):
         """Initializer for MethodResponse.
 
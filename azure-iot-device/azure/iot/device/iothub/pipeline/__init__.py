@@ -7,3 +7,4 @@ INTERNAL USAGE ONLY
 
 from .iothub_pipeline import IoTHubPipeline
 from .edge_pipeline import EdgePipeline
+from .config import IoTHubPipelineConfig
@@ -0,0 +1,126 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the format used to pack many telemetry messages into the body of a single
+message.
+
+The body of an aggregated message is a UTF-8 encoded JSON array with one object per message:
+
+    [
+        {
+            "body": "<payload>",
+            "base64Encoded": false,
+            "properties": {"<custom property>": "<value>", ...},
+            "systemProperties": {"messageId": "<message id>", ...}
+        },
+        ...
+    ]
+
+Payloads which are valid UTF-8 are stored as text.  Any other payload is base64 encoded, and
+base64Encoded is set to true.  Only the system properties which are set on the message are included.
+The expiry time is never included, because IoTHub can't expire a message inside an aggregated one,
+so messages which have one shouldn't be aggregated.
+
+The JSON only uses ASCII characters, so the length of an entry returned by encode_item is also its
+size in bytes.  Each entry adds one more byte to the body for the comma or bracket after it, and the
+opening bracket adds one byte.
+
+The aggregated message is only sent with a qos of 0 if every message in it asked for a qos of 0.
+"""
+
+import base64
+import json
+from azure.iot.device.common import buffers
+from azure.iot.device.iothub.models import Message
+
+# Custom property set on an aggregated message.  Its value is the number of messages in the body.
+AGGREGATED_PROPERTY = "iothub-aggregated"
+
+CONTENT_TYPE = "application/json"
+CONTENT_ENCODING = "utf-8"
+
+# Message attributes which are carried in systemProperties, along with their names in the JSON
+_system_properties = [
+    ("message_id", "messageId"),
+    ("correlation_id", "correlationId"),
+    ("user_id", "userId"),
+    ("content_type", "contentType"),
+    ("content_encoding", "contentEncoding"),
+]
+
+
+def _encode_item(message):
+    payload = buffers.get_bytes_like(message.data)
+    try:
+        item = {"body": buffers.to_text(payload), "base64Encoded": False}
+    except UnicodeDecodeError:
+        item = {"body": base64.b64encode(payload).decode("ascii"), "base64Encoded": True}
+    item["properties"] = dict(message.custom_properties)
+
+    system_properties = {}
+    for attribute, name in _system_properties:
+        value = getattr(message, attribute, None)
+        if value is None:
+            continue
+        system_properties[name] = value
+    item["systemProperties"] = system_properties
+    return item
+
+
+def encode_item(message):
+    """
+    Encode a message as an entry of an aggregated body.
+
+    :param message: The Message object to encode.
+    :returns: The entry, as a str of ASCII-only JSON.
+    """
+    return json.dumps(_encode_item(message), separators=(",", ":"))
+
+
+def encode_messages(messages, items=None):
+    """
+    Pack a list of messages into a single aggregated message.
+
+    :param list messages: The Message objects to pack.
+    :param list items: (Optional) The entries already returned by encode_item for the messages.
+    :returns: A new Message object.
+    """
+    if items is None:
+        items = [encode_item(message) for message in messages]
+    body = "[" + ",".join(items) + "]"
+    aggregated_message = Message(
+        body.encode("utf-8"), content_type=CONTENT_TYPE, content_encoding=CONTENT_ENCODING
+    )
+    aggregated_message.custom_properties[AGGREGATED_PROPERTY] = str(len(messages))
+    qos_values = set(message.qos for message in messages)
+    if qos_values == set([0]):
+        aggregated_message.qos = 0
+    elif 1 in qos_values:
+        aggregated_message.qos = 1
+    return aggregated_message
+
+
+def decode_messages(data):
+    """
+    Unpack the body of an aggregated message back into a list of messages.  Payloads are returned
+    as bytes.
+
+    :param data: The body of an aggregated message.
+    :returns: A list of Message objects.
+    """
+    messages = []
+    for item in json.loads(buffers.to_text(data)):
+        if item.get("base64Encoded"):
+            payload = base64.b64decode(item["body"])
+        else:
+            payload = item["body"].encode("utf-8")
+        message = Message(payload)
+        message.custom_properties = dict(item.get("properties", {}))
+        system_properties = item.get("systemProperties", {})
+        for attribute, name in _system_properties:
+            if name in system_properties:
+                setattr(message, attribute, system_properties[name])
+        messages.append(message)
+    return messages
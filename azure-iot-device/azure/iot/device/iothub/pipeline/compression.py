@@ -0,0 +1,97 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the codecs used to compress outgoing message payloads and decompress
+incoming ones.
+"""
+
+import zlib
+from azure.iot.device.common import buffers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Supported compression algorithms.  These are also the values used for the content_encoding of
+# a compressed message.
+GZIP = "gzip"
+DEFLATE = "deflate"
+ZSTD = "zstd"
+
+# Custom message property which names the algorithm used to compress the payload, so that routes
+# and backend applications can decompress it without looking at the system properties.
+COMPRESSION_PROPERTY = "iothub-compression"
+
+# Adding 16 to the window size makes zlib read and write gzip headers instead of zlib headers.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _gzip_compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompress(data):
+    return zlib.decompress(data, _GZIP_WBITS)
+
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=3 if level < 0 else level).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+_codecs = {
+    GZIP: (_gzip_compress, _gzip_decompress),
+    DEFLATE: (zlib.compress, zlib.decompress),
+    ZSTD: (_zstd_compress, _zstd_decompress),
+}
+
+
+def is_available(algorithm):
+    """
+    Return True if payloads can be compressed and decompressed with the given algorithm.
+    """
+    if algorithm == ZSTD:
+        return zstandard is not None
+    return algorithm in _codecs
+
+
+def get_payload_bytes(data):
+    """
+    Return the bytes that would be sent on the wire for a message payload, or None if the payload
+    isn't text or a buffer and is therefore left alone.  Buffers are returned without being copied.
+    """
+    if data is None or isinstance(data, (int, float)):
+        return None
+    try:
+        return buffers.get_bytes_like(data)
+    except TypeError:
+        return None
+
+
+def compress(algorithm, data, level=-1):
+    """
+    Compress bytes with the given algorithm.
+
+    :param str algorithm: One of GZIP, DEFLATE or ZSTD.
+    :param data: The bytes to compress.  Any buffer can be used.
+    :param int level: The compression level.  -1 uses the default level for the algorithm.
+    """
+    return _codecs[algorithm][0](data, level)
+
+
+def decompress(algorithm, data):
+    """
+    Decompress bytes which were compressed with the given algorithm.
+
+    :raises: ValueError if the algorithm is not supported.
+    """
+    if not is_available(algorithm):
+        raise ValueError("Unsupported compression algorithm: {}".format(algorithm))
+    return _codecs[algorithm][1](buffers.get_bytes_like(data))
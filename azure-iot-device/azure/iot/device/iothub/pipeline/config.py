@@ -0,0 +1,268 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the configuration object used to customize the behavior of an
+IoTHubPipeline.
+"""
+
+import logging
+from azure.iot.device.common import mqtt_transport
+from azure.iot.device.common.pipeline import (
+    callback_dispatcher,
+    pipeline_instrumentation,
+    pipeline_thread,
+)
+from . import compression as payload_compression
+from . import serializers
+from . import constant
+
+logger = logging.getLogger(__name__)
+
+# Queue full policies.  These control what happens when a caller tries to send a message
+# while the publish queue is already full.
+QUEUE_FULL_BLOCK = "block"
+QUEUE_FULL_ERROR = "error"
+
+DEFAULT_MAX_INFLIGHT_PUBLISHES = 20
+DEFAULT_MAX_QUEUED_PUBLISHES = 1000
+DEFAULT_OUTBOX_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_RECONNECT_INITIAL_DELAY = 1.0
+DEFAULT_RECONNECT_MAX_DELAY = 60.0
+
+
+class IoTHubPipelineConfig(object):
+    """
+    Object which stores all of the options which can be used to customize an IoTHubPipeline.
+
+    :ivar max_inflight_publishes: The maximum number of publishes that can be waiting for an
+      acknowledgement from the service at any one time.  Publishes beyond this number wait in a
+      queue inside the pipeline until an acknowledgement is received.  None means no limit.
+    :type max_inflight_publishes: int
+    :ivar max_queued_publishes: The maximum number of telemetry messages that can be waiting to be
+      published, not counting the ones which are in flight.  None means no limit.
+    :type max_queued_publishes: int
+    :ivar queue_full_policy: What to do when a message is sent while the queue is full.
+      QUEUE_FULL_BLOCK blocks the caller until there is room in the queue.  QUEUE_FULL_ERROR
+      raises a PipelineQueueFullError.
+    :type queue_full_policy: str
+    :ivar outbox_path: Path of a SQLite database used to store telemetry while the client is
+      disconnected.  Stored messages are sent when the client connects again.  None disables the
+      outbox.
+    :type outbox_path: str
+    :ivar outbox_max_bytes: The maximum number of bytes to keep in the outbox.  When this is
+      exceeded, the oldest messages are dropped.  Messages larger than this can't be stored, so
+      sending one fails while the connection is down.  None means no limit.
+    :type outbox_max_bytes: int
+    :ivar auto_reconnect: Whether the pipeline should reconnect by itself when the connection drops
+      unexpectedly.
+    :type auto_reconnect: bool
+    :ivar reconnect_initial_delay: The upper bound, in seconds, of the random delay before the first
+      reconnect attempt.  The bound doubles with every failed attempt.
+    :type reconnect_initial_delay: float
+    :ivar reconnect_max_delay: The largest upper bound, in seconds, of the random delay before any
+      reconnect attempt.
+    :type reconnect_max_delay: float
+    :ivar reconnect_max_attempts: The number of reconnect attempts to make before giving up.  None
+      means never give up.
+    :type reconnect_max_attempts: int
+    :ivar port: The port used to connect to the IoTHub (or gateway) over MQTT.
+    :type port: int
+    :ivar ack_timeout: The number of seconds to wait for the service to acknowledge a message,
+      subscription or unsubscription before failing the operation with a TimeoutError.  None means
+      wait forever.
+    :type ack_timeout: float
+    :ivar operation_timeout: The number of seconds a client operation is allowed to take before it
+      fails with a TimeoutError, for operations which aren't given a timeout of their own.  None
+      means wait forever.
+    :type operation_timeout: float
+    :ivar compression: The algorithm used to compress the payload of outgoing telemetry, which can
+      be "gzip", "deflate" or, if the zstandard package is installed, "zstd".  Compressed messages
+      have their content_encoding and their "iothub-compression" custom property set to the name
+      of the algorithm.  None disables compression.
+    :type compression: str
+    :ivar compression_threshold: The size, in bytes, of the smallest payload which is compressed.
+    :type compression_threshold: int
+    :ivar decompress_received: Whether to decompress the payload of C2D and input messages whose
+      content_encoding or "iothub-compression" custom property names an algorithm.  Defaults to
+      False, in which case received messages are passed to the client as they arrive.
+    :type decompress_received: bool
+    :ivar aggregation_max_messages: The largest number of telemetry messages to pack into a single
+      publish.  Aggregated messages are sent with content_type "application/json" and their
+      "iothub-aggregated" custom property set to the number of messages in the body, which is a
+      JSON array described in the aggregation module.  None disables aggregation.
+    :type aggregation_max_messages: int
+    :ivar aggregation_max_bytes: The largest size, in bytes, of the body of an aggregated message,
+      counted after the payloads and properties are encoded.  Telemetry messages with an
+      expiry_time_utc are never aggregated.
+    :type aggregation_max_bytes: int
+    :ivar aggregation_linger: The longest time, in seconds, that a telemetry message waits for
+      others to be sent along with it.
+    :type aggregation_linger: float
+    :ivar telemetry_qos: The MQTT quality of service used to send telemetry messages which don't
+      set their own.  With a qos of 0, messages are sent without waiting for the service to
+      acknowledge them, which is faster but means they can be lost.
+    :type telemetry_qos: int
+    :ivar memoryview_payloads: Whether received C2D and input messages have their data set to a
+      read-only memoryview over the payload instead of bytes, so that it can be sliced and parsed
+      without being copied.
+    :type memoryview_payloads: bool
+    :ivar serializer: The JSON library used for twins, reported property patches, desired property
+      patches and method payloads, which can be "json", or "orjson" or "ujson" if the package is
+      installed.  None uses the fastest one which is installed.
+    :type serializer: str
+    :ivar executor_scope: Which clients share the thread that runs the pipeline and the thread that
+      calls back into client code.  "global" shares one of each between every client in the
+      process.  "client" gives each client its own.  "sharded" spreads the clients across
+      executor_shards pairs of threads, by device and module id.  "event_loop" runs both on the
+      event loop the client is used from, without any threads, and can only be used with the
+      asyncio clients.
+    :type executor_scope: str
+    :ivar executor_shards: The number of pairs of threads to spread the clients across when
+      executor_scope is "sharded".
+    :type executor_shards: int
+    :ivar callback_dispatch: Where callbacks into client code run, such as the completions of
+      operations and the handlers for connection changes and incoming messages.  "thread" runs
+      them one at a time on the callback thread from executor_scope.  "pool" runs them on a pool
+      of callback_workers threads, shared by every client which uses the same number of workers,
+      in any order.  "ordered" runs the callbacks of each client one at a time, in order, on the
+      same shared pool, so that a slow callback only holds up its own client.  "inline" runs them
+      on the pipeline thread, which is fastest, but only safe if no callback ever blocks.
+    :type callback_dispatch: str
+    :ivar callback_workers: The number of threads in the pool used when callback_dispatch is
+      "pool" or "ordered".
+    :type callback_workers: int
+    :ivar instrumentation: The object which records how long operations and events spend in each
+      stage of the pipeline and waiting for threads, or None to record nothing.  One object can
+      be shared by several clients.  Its hooks and get_stats give the results.
+    :type instrumentation: pipeline_instrumentation.PipelineInstrumentation
+    """
+
+    def __init__(
+        self,
+        max_inflight_publishes=DEFAULT_MAX_INFLIGHT_PUBLISHES,
+        max_queued_publishes=DEFAULT_MAX_QUEUED_PUBLISHES,
+        queue_full_policy=QUEUE_FULL_BLOCK,
+        outbox_path=None,
+        outbox_max_bytes=DEFAULT_OUTBOX_MAX_BYTES,
+        auto_reconnect=True,
+        reconnect_initial_delay=DEFAULT_RECONNECT_INITIAL_DELAY,
+        reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY,
+        reconnect_max_attempts=None,
+        port=mqtt_transport.DEFAULT_PORT,
+        ack_timeout=None,
+        operation_timeout=None,
+        compression=None,
+        compression_threshold=constant.DEFAULT_COMPRESSION_THRESHOLD,
+        decompress_received=False,
+        aggregation_max_messages=None,
+        aggregation_max_bytes=constant.DEFAULT_AGGREGATION_MAX_BYTES,
+        aggregation_linger=constant.DEFAULT_AGGREGATION_LINGER,
+        telemetry_qos=1,
+        memoryview_payloads=False,
+        serializer=None,
+        executor_scope=pipeline_thread.SCOPE_GLOBAL,
+        executor_shards=pipeline_thread.DEFAULT_SHARD_COUNT,
+        callback_dispatch=callback_dispatcher.DISPATCH_THREAD,
+        callback_workers=callback_dispatcher.DEFAULT_WORKERS,
+        instrumentation=None,
+    ):
+        """
+        Initializer for IoTHubPipelineConfig objects.
+
+        :raises: ValueError if any of the options are invalid
+        """
+        if max_inflight_publishes is not None and max_inflight_publishes < 1:
+            raise ValueError("max_inflight_publishes must be at least 1")
+        if max_queued_publishes is not None and max_queued_publishes < 0:
+            raise ValueError("max_queued_publishes cannot be negative")
+        if queue_full_policy not in (QUEUE_FULL_BLOCK, QUEUE_FULL_ERROR):
+            raise ValueError("Invalid queue_full_policy: {}".format(queue_full_policy))
+        if outbox_max_bytes is not None and outbox_max_bytes < 1:
+            raise ValueError("outbox_max_bytes must be at least 1")
+        if reconnect_initial_delay <= 0:
+            raise ValueError("reconnect_initial_delay must be greater than 0")
+        if reconnect_max_delay < reconnect_initial_delay:
+            raise ValueError("reconnect_max_delay cannot be less than reconnect_initial_delay")
+        if reconnect_max_attempts is not None and reconnect_max_attempts < 1:
+            raise ValueError("reconnect_max_attempts must be at least 1")
+        if not 0 < port < 65536:
+            raise ValueError("Invalid port: {}".format(port))
+        if ack_timeout is not None and ack_timeout <= 0:
+            raise ValueError("ack_timeout must be greater than 0")
+        if operation_timeout is not None and operation_timeout <= 0:
+            raise ValueError("operation_timeout must be greater than 0")
+        if compression is not None and not payload_compression.is_available(compression):
+            raise ValueError("Unsupported compression algorithm: {}".format(compression))
+        if compression_threshold < 0:
+            raise ValueError("compression_threshold cannot be negative")
+        if aggregation_max_messages is not None and aggregation_max_messages < 2:
+            raise ValueError("aggregation_max_messages must be at least 2")
+        if aggregation_max_bytes < 1:
+            raise ValueError("aggregation_max_bytes must be at least 1")
+        if aggregation_linger < 0:
+            raise ValueError("aggregation_linger cannot be negative")
+        if telemetry_qos not in (0, 1):
+            raise ValueError("Invalid telemetry_qos: {}".format(telemetry_qos))
+        if serializer is not None and not serializers.is_available(serializer):
+            raise ValueError("Unsupported serializer: {}".format(serializer))
+        if executor_scope not in (
+            pipeline_thread.SCOPE_GLOBAL,
+            pipeline_thread.SCOPE_CLIENT,
+            pipeline_thread.SCOPE_SHARDED,
+            pipeline_thread.SCOPE_EVENT_LOOP,
+        ):
+            raise ValueError("Invalid executor_scope: {}".format(executor_scope))
+        if executor_shards < 1:
+            raise ValueError("executor_shards must be at least 1")
+        if callback_dispatch not in (
+            callback_dispatcher.DISPATCH_THREAD,
+            callback_dispatcher.DISPATCH_POOL,
+            callback_dispatcher.DISPATCH_ORDERED,
+            callback_dispatcher.DISPATCH_INLINE,
+        ):
+            raise ValueError("Invalid callback_dispatch: {}".format(callback_dispatch))
+        if callback_workers < 1:
+            raise ValueError("callback_workers must be at least 1")
+        if instrumentation is not None and not isinstance(
+            instrumentation, pipeline_instrumentation.PipelineInstrumentation
+        ):
+            raise ValueError("instrumentation must be a PipelineInstrumentation object")
+
+        self.max_inflight_publishes = max_inflight_publishes
+        self.max_queued_publishes = max_queued_publishes
+        self.queue_full_policy = queue_full_policy
+        self.outbox_path = outbox_path
+        self.outbox_max_bytes = outbox_max_bytes
+        self.auto_reconnect = auto_reconnect
+        self.reconnect_initial_delay = reconnect_initial_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_max_attempts = reconnect_max_attempts
+        self.port = port
+        self.ack_timeout = ack_timeout
+        self.operation_timeout = operation_timeout
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.decompress_received = decompress_received
+        self.aggregation_max_messages = aggregation_max_messages
+        self.aggregation_max_bytes = aggregation_max_bytes
+        self.aggregation_linger = aggregation_linger
+        self.telemetry_qos = telemetry_qos
+        self.memoryview_payloads = memoryview_payloads
+        self.serializer = serializer
+        self.executor_scope = executor_scope
+        self.executor_shards = executor_shards
+        self.callback_dispatch = callback_dispatch
+        self.callback_workers = callback_workers
+        self.instrumentation = instrumentation
+
+    @property
+    def max_outstanding_publishes(self):
+        """
+        The total number of telemetry messages which can be in the pipeline at once, both in
+        flight and queued, or None if there is no limit.
+        """
+        if self.max_inflight_publishes is None or self.max_queued_publishes is None:
+            return None
+        return self.max_inflight_publishes + self.max_queued_publishes
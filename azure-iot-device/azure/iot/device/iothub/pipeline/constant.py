@@ -12,3 +12,17 @@ INPUT_MSG = "input"
 METHODS = "methods"
 TWIN = "twin"
 TWIN_PATCHES = "twin_patches"
+
+# Default maximum number of telemetry messages from a single batch that can be waiting
+# for an acknowledgement at the same time
+DEFAULT_BATCH_MAX_INFLIGHT = 100
+
+# Default size, in bytes, of the smallest telemetry payload which is compressed when compression
+# is enabled.  Smaller payloads rarely get smaller once the compression headers are added.
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# Defaults used when packing many telemetry messages into a single publish.  The byte limit is on
+# the encoded body, and leaves room for the properties under the 256KB IoTHub message size limit.
+DEFAULT_AGGREGATION_MAX_MESSAGES = 100
+DEFAULT_AGGREGATION_MAX_BYTES = 128 * 1024
+DEFAULT_AGGREGATION_LINGER = 0.1
@@ -5,18 +5,26 @@
 # --------------------------------------------------------------------------
 
 import logging
-import sys
+import threading
+from azure.iot.device.common import errors, unhandled_exceptions
 from azure.iot.device.common.pipeline import (
+    callback_dispatcher,
+    operation_flow,
+    pipeline_instrumentation,
     pipeline_stages_base,
     pipeline_ops_base,
     pipeline_stages_mqtt,
+    pipeline_thread,
 )
 from . import (
+    config,
     constant,
+    outbox,
     pipeline_stages_iothub,
     pipeline_events_iothub,
     pipeline_ops_iothub,
     pipeline_stages_iothub_mqtt,
+    serializers,
 )
 from azure.iot.device.iothub.auth.x509_authentication_provider import X509AuthenticationProvider
 
@@ -24,11 +32,33 @@ logger = logging.getLogger(__name__)
 
 
 class IoTHubPipeline(object):
-    def __init__(self, auth_provider):
+    """
+    Adapter between the IoTHub clients and the pipeline.
+
+    Every method which starts an operation accepts a callback.  When the operation succeeds, the
+    callback is called with the result of the operation (if any).  When the operation fails, the
+    callback is called with a single keyword argument, error, which contains the cause of the failure.
+    """
+
+    def __init__(self, auth_provider, pipeline_configuration=None):
         """
         Constructor for instantiating a pipeline adapter object
         :param auth_provider: The authentication provider
+        :param pipeline_configuration: (Optional) The IoTHubPipelineConfig object used to customize
+        the pipeline.  If this is not provided, the default configuration is used.
         """
+        if pipeline_configuration is None:
+            pipeline_configuration = config.IoTHubPipelineConfig()
+        self.pipeline_configuration = pipeline_configuration
+
+        # Limits the number of telemetry messages which can be in the pipeline at the same time.
+        # Slots are taken on the caller's thread so that the caller feels the backpressure.
+        max_outstanding_publishes = pipeline_configuration.max_outstanding_publishes
+        if max_outstanding_publishes is None:
+            self._publish_slots = None
+        else:
+            self._publish_slots = threading.BoundedSemaphore(max_outstanding_publishes)
+
         self.feature_enabled = {
             constant.C2D_MSG: False,
             constant.INPUT_MSG: False,
@@ -44,16 +74,96 @@ class IoTHubPipeline(object):
         self.on_input_message_received = None
         self.on_method_request_received = None
         self.on_twin_patch_received = None
+        # Called on the callback thread whenever a telemetry message leaves the publish queue
+        self.on_publish_slot_released = None
+        # Whether operations are handed to the pipeline thread without waiting for it to start
+        # running them.  Callers which must never block also have to use publish_would_block, to
+        # avoid blocking on a full publish queue.
+        self.submit_nowait = False
+
+        serializer = serializers.get_serializer(pipeline_configuration.serializer)
+        # The pipeline_thread.Executors object which runs the pipeline, or None for the threads
+        # shared by every pipeline.  With the event_loop executor_scope, the client binds it to its
+        # event loop.
+        client_key = "{}/{}".format(auth_provider.device_id, auth_provider.module_id)
+        self.executors = pipeline_thread.get_executors(
+            pipeline_configuration.executor_scope,
+            key=client_key,
+            shard_count=pipeline_configuration.executor_shards,
+        )
+        # The callback_dispatcher.CallbackDispatcher which runs callbacks into the client, or None
+        # for the callback thread.  Its get_stats shows how far behind the callbacks are.
+        self.callback_dispatcher = callback_dispatcher.create_callback_dispatcher(
+            pipeline_configuration.callback_dispatch,
+            name=client_key,
+            workers=pipeline_configuration.callback_workers,
+        )
 
         self._pipeline = (
-            pipeline_stages_base.PipelineRootStage()
+            pipeline_stages_base.PipelineRootStage(
+                executors=self.executors,
+                callback_dispatcher=self.callback_dispatcher,
+                instrumentation=pipeline_configuration.instrumentation,
+            )
             .append_stage(pipeline_stages_iothub.UseAuthProviderStage())
-            .append_stage(pipeline_stages_iothub.HandleTwinOperationsStage())
-            .append_stage(pipeline_stages_base.CoordinateRequestAndResponseStage())
-            .append_stage(pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage())
-            .append_stage(pipeline_stages_base.EnsureConnectionStage())
+            .append_stage(pipeline_stages_iothub.HandleD2CMessageBatchStage())
+        )
+        if pipeline_configuration.outbox_path:
+            self._pipeline.append_stage(
+                pipeline_stages_iothub.StoreAndForwardStage(
+                    outbox=outbox.SqliteOutbox(
+                        pipeline_configuration.outbox_path,
+                        max_bytes=pipeline_configuration.outbox_max_bytes,
+                    ),
+                    drain_window=pipeline_configuration.max_inflight_publishes
+                    or constant.DEFAULT_BATCH_MAX_INFLIGHT,
+                )
+            )
+        self._pipeline.append_stage(
+            pipeline_stages_iothub.HandleTwinOperationsStage(serializer=serializer)
+        )
+        self._pipeline.append_stage(pipeline_stages_base.CoordinateRequestAndResponseStage())
+        if pipeline_configuration.aggregation_max_messages:
+            self._pipeline.append_stage(
+                pipeline_stages_iothub.AggregateMessagesStage(
+                    max_messages=pipeline_configuration.aggregation_max_messages,
+                    max_bytes=pipeline_configuration.aggregation_max_bytes,
+                    linger=pipeline_configuration.aggregation_linger,
+                )
+            )
+        if pipeline_configuration.compression or pipeline_configuration.decompress_received:
+            self._pipeline.append_stage(
+                pipeline_stages_iothub.CompressMessagesStage(
+                    algorithm=pipeline_configuration.compression,
+                    threshold=pipeline_configuration.compression_threshold,
+                    decompress=pipeline_configuration.decompress_received,
+                )
+            )
+        self._pipeline.append_stage(
+            pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage(
+                telemetry_qos=pipeline_configuration.telemetry_qos,
+                memoryview_payloads=pipeline_configuration.memoryview_payloads,
+                serializer=serializer,
+            )
+        )
+        if pipeline_configuration.auto_reconnect:
+            self._pipeline.append_stage(
+                pipeline_stages_base.ReconnectStage(
+                    initial_delay=pipeline_configuration.reconnect_initial_delay,
+                    max_delay=pipeline_configuration.reconnect_max_delay,
+                    max_attempts=pipeline_configuration.reconnect_max_attempts,
+                )
+            )
+        (
+            self._pipeline.append_stage(pipeline_stages_base.EnsureConnectionStage())
             .append_stage(pipeline_stages_base.SerializeConnectOpsStage())
-            .append_stage(pipeline_stages_mqtt.MQTTTransportStage())
+            .append_stage(
+                pipeline_stages_mqtt.MQTTTransportStage(
+                    max_inflight_publishes=pipeline_configuration.max_inflight_publishes,
+                    port=pipeline_configuration.port,
+                    ack_timeout=pipeline_configuration.ack_timeout,
+                )
+            )
         )
 
         def _on_pipeline_event(event):
@@ -111,142 +221,307 @@ class IoTHubPipeline(object):
 
         self._pipeline.run_op(op)
 
-    def connect(self, callback=None):
+    def _acquire_publish_slot(self, name):
+        """
+        Take a slot for a telemetry message that is about to enter the pipeline.  Depending on the
+        queue_full_policy, this either blocks until a slot is free or raises.  If the pipeline is
+        instrumented, the time spent waiting is recorded under name, the name of the operation.
+
+        :raises: PipelineQueueFullError if there is no free slot and the policy is QUEUE_FULL_ERROR
+        """
+        if self._publish_slots is None:
+            return
+        if self.pipeline_configuration.queue_full_policy == config.QUEUE_FULL_ERROR:
+            if not self._publish_slots.acquire(False):
+                raise errors.PipelineQueueFullError(
+                    "Too many messages are waiting to be sent ({})".format(
+                        self.pipeline_configuration.max_outstanding_publishes
+                    )
+                )
+        elif self.pipeline_configuration.instrumentation is not None:
+            start = pipeline_instrumentation.clock()
+            self._publish_slots.acquire()
+            self.pipeline_configuration.instrumentation.record(
+                pipeline_instrumentation.PHASE_PUBLISH_QUEUE,
+                name,
+                pipeline_instrumentation.clock() - start,
+            )
+        else:
+            self._publish_slots.acquire()
+
+    def publish_would_block(self):
+        """
+        Return True if sending a telemetry message right now would block the caller until there is
+        room in the publish queue.
+        """
+        if (
+            self._publish_slots is None
+            or self.pipeline_configuration.queue_full_policy == config.QUEUE_FULL_ERROR
+        ):
+            return False
+        if self._publish_slots.acquire(False):
+            self._publish_slots.release()
+            return False
+        return True
+
+    def _on_publish_finished(self, op):
+        # The slot is only given back once the pipeline lets go of the op.  An op which reached its
+        # deadline may still be waiting for its PUBACK, and still be counted in the publish window.
+        self._release_publish_slot()
+
+    def _release_publish_slot(self):
+        if self._publish_slots is not None:
+            self._publish_slots.release()
+            if self.on_publish_slot_released:
+                self.on_publish_slot_released()
+
+    def _run_op(self, op, timeout, on_finished=None):
+        """
+        Run an operation on the pipeline with a deadline.
+
+        :param op: The operation to run.
+        :param timeout: The number of seconds the operation is allowed to take.  If this is None,
+        the operation_timeout from the pipeline configuration is used.
+        :param on_finished: (Optional) Function called when the pipeline is done with the operation.
+        See PipelineRootStage.run_op.
+        """
+        if timeout is None:
+            timeout = self.pipeline_configuration.operation_timeout
+        operation_flow.set_timeout(op, timeout)
+        if self.submit_nowait:
+            self._pipeline.run_op_nowait(op, on_finished=on_finished)
+        else:
+            self._pipeline.run_op(op, on_finished=on_finished)
+
+    def connect(self, callback=None, timeout=None):
         """
         Connect to the service.
 
         :param callback: callback which is called when the connection to the service is complete.
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
         """
         logger.info("Starting ConnectOperation on the pipeline")
 
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)  # TODO: raise an error instead
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(pipeline_ops_base.ConnectOperation(callback=on_complete))
+        self._run_op(pipeline_ops_base.ConnectOperation(callback=on_complete), timeout)
 
-    def disconnect(self, callback=None):
+    def disconnect(self, callback=None, timeout=None):
         """
         Disconnect from the service.
 
         :param callback: callback which is called when the connection to the service has been disconnected
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
         """
         logger.info("Starting DisconnectOperation on the pipeline")
 
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(pipeline_ops_base.DisconnectOperation(callback=on_complete))
+        self._run_op(pipeline_ops_base.DisconnectOperation(callback=on_complete), timeout)
 
-    def send_d2c_message(self, message, callback=None):
+    def send_d2c_message(self, message, callback=None, timeout=None):
         """
         Send a telemetry message to the service.
 
         :param message: message to send.
         :param callback: callback which is called when the message publish has been acknowledged by the service.
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
+
+        :raises: PipelineQueueFullError if the publish queue is full and the pipeline is configured
+        with the QUEUE_FULL_ERROR policy.
         """
 
+        self._acquire_publish_slot("SendD2CMessageOperation")
+
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(
-            pipeline_ops_iothub.SendD2CMessageOperation(message=message, callback=on_complete)
+        try:
+            self._run_op(
+                pipeline_ops_iothub.SendD2CMessageOperation(message=message, callback=on_complete),
+                timeout,
+                on_finished=self._on_publish_finished,
+            )
+        except Exception:
+            self._release_publish_slot()
+            raise
+
+    def send_d2c_messages(self, messages, max_inflight=None, callback=None, timeout=None):
+        """
+        Send a batch of telemetry messages to the service.
+
+        :param messages: list of messages to send.
+        :param max_inflight: (Optional) maximum number of messages which can be waiting for an
+        acknowledgement from the service at the same time.
+        :param callback: callback which is called when every message in the batch has either been
+        acknowledged by the service or failed.  This callback should have one parameter, which will
+        contain a list with one entry per message: None on success, or the error which caused that
+        message to fail.
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
+
+        Batches do not take slots in the publish queue, so they never block or raise a
+        PipelineQueueFullError.  A batch already bounds itself: no more than max_inflight of its
+        messages are in the pipeline at once.
+        """
+        if max_inflight is None:
+            max_inflight = constant.DEFAULT_BATCH_MAX_INFLIGHT
+
+        def on_complete(call):
+            if call.error:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
+                callback(call.results)
+
+        self._run_op(
+            pipeline_ops_iothub.SendD2CMessageBatchOperation(
+                messages=messages, max_inflight=max_inflight, callback=on_complete
+            ),
+            timeout,
         )
 
-    def send_output_event(self, message, callback=None):
+    def send_output_event(self, message, callback=None, timeout=None):
         """
         Send an output message to the service.
 
         :param message: message to send.
         :param callback: callback which is called when the message publish has been acknowledged by the service.
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
+
+        :raises: PipelineQueueFullError if the publish queue is full and the pipeline is configured
+        with the QUEUE_FULL_ERROR policy.
         """
 
+        self._acquire_publish_slot("SendOutputEventOperation")
+
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(
-            pipeline_ops_iothub.SendOutputEventOperation(message=message, callback=on_complete)
-        )
+        try:
+            self._run_op(
+                pipeline_ops_iothub.SendOutputEventOperation(message=message, callback=on_complete),
+                timeout,
+                on_finished=self._on_publish_finished,
+            )
+        except Exception:
+            self._release_publish_slot()
+            raise
 
-    def send_method_response(self, method_response, callback=None):
+    def send_method_response(self, method_response, callback=None, timeout=None):
         """
         Send a method response to the service.
 
         :param method_response: the method response to send
         :param callback: callback which is called when response has been acknowledged by the service
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
         """
         logger.info("IoTHubPipeline send_method_response called")
 
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(
+        self._run_op(
             pipeline_ops_iothub.SendMethodResponseOperation(
                 method_response=method_response, callback=on_complete
-            )
+            ),
+            timeout,
         )
 
-    def get_twin(self, callback):
+    def get_twin(self, callback, timeout=None):
         """
         Send a request for a full twin to the service.
 
         :param callback: callback which is called when request has been acknowledged by the service.
         This callback should have one parameter, which will contain the requested twin when called.
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
         """
 
         def on_complete(call):
             if call.error:
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback(call.twin)
 
-        self._pipeline.run_op(pipeline_ops_iothub.GetTwinOperation(callback=on_complete))
+        self._run_op(pipeline_ops_iothub.GetTwinOperation(callback=on_complete), timeout)
 
-    def patch_twin_reported_properties(self, patch, callback=None):
+    def patch_twin_reported_properties(self, patch, callback=None, timeout=None):
         """
         Send a patch for a twin's reported properties to the service.
 
         :param patch: the reported properties patch to send
         :param callback: callback which is called when request has been acknowledged by the service.
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
         """
 
         def on_complete(call):
             if call.error:
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(
+        self._run_op(
             pipeline_ops_iothub.PatchTwinReportedPropertiesOperation(
                 patch=patch, callback=on_complete
-            )
+            ),
+            timeout,
         )
 
-    def enable_feature(self, feature_name, callback=None):
+    def enable_feature(self, feature_name, callback=None, timeout=None):
         """
         Enable the given feature by subscribing to the appropriate topics.
 
         :param feature_name: one of the feature name constants from constant.py
         :param callback: callback which is called when the feature is enabled
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
 
         :raises: ValueError if feature_name is invalid
         """
@@ -257,23 +532,28 @@ class IoTHubPipeline(object):
 
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(
+        self._run_op(
             pipeline_ops_base.EnableFeatureOperation(
                 feature_name=feature_name, callback=on_complete
-            )
+            ),
+            timeout,
         )
 
-    def disable_feature(self, feature_name, callback=None):
+    def disable_feature(self, feature_name, callback=None, timeout=None):
         """
         Disable the given feature by subscribing to the appropriate topics.
         :param callback: callback which is called when the feature is disabled
 
         :param feature_name: one of the feature name constants from constant.py
+        :param timeout: (Optional) number of seconds the operation can take before it fails with a
+        TimeoutError.  If this is not provided, the operation_timeout from the pipeline configuration is used.
 
         :raises: ValueError if feature_name is invalid
         """
@@ -284,13 +564,16 @@ class IoTHubPipeline(object):
 
         def on_complete(call):
             if call.error:
-                # TODO we need error semantics on the client
-                sys.exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
-        self._pipeline.run_op(
+        self._run_op(
             pipeline_ops_base.DisableFeatureOperation(
                 feature_name=feature_name, callback=on_complete
-            )
+            ),
+            timeout,
         )
@@ -0,0 +1,132 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains versions of the models for received messages and method requests which
+only decode their properties and payload the first time they're used.
+
+Incoming messages are converted on the pipeline thread, one at a time, so anything which is
+decoded there limits how fast messages can be received.  Handlers often only look at one property
+of a message to route or drop it, and never look at the rest.  The objects in this module keep the
+encoded properties and payload they were received with, and decode them on whichever thread first
+reads them.  The decoded values are kept, so they are only decoded once.
+"""
+
+import six.moves.urllib as urllib
+from azure.iot.device.iothub.models import Message, MethodRequest
+from . import mqtt_topic_iothub, serializers
+
+# Topic keys of the system properties, by the Message attribute they're set on
+_system_property_keys = dict(
+    (attribute, key) for key, attribute in mqtt_topic_iothub.RECEIVED_SYSTEM_PROPERTIES.items()
+)
+
+
+def _lazy_property(attribute):
+    """
+    Return a property which decodes the properties of a LazyMessage before getting or setting the
+    given attribute of the underlying Message.
+    """
+    descriptor = Message.__dict__[attribute]
+
+    def get(self):
+        self._decode_properties()
+        return descriptor.__get__(self, Message)
+
+    def set(self, value):
+        self._decode_properties()
+        descriptor.__set__(self, value)
+
+    return property(get, set)
+
+
+class LazyMessage(Message):
+    """A Message received on a C2D or input topic, which decodes the properties from the topic the
+    first time any of them is read or set.
+
+    The payload is the same as for any other received message.
+    """
+
+    __slots__ = ("_encoded_properties",)
+
+    message_id = _lazy_property("message_id")
+    correlation_id = _lazy_property("correlation_id")
+    user_id = _lazy_property("user_id")
+    to = _lazy_property("to")
+    content_type = _lazy_property("content_type")
+    content_encoding = _lazy_property("content_encoding")
+    custom_properties = _lazy_property("custom_properties")
+
+    def __init__(self, data, encoded_properties=None):
+        """
+        Initializer for LazyMessage
+
+        :param data: The payload of the message.
+        :param str encoded_properties: The uri-encoded properties part of the topic the message was
+          received on, if any.
+        """
+        self._encoded_properties = None
+        super(LazyMessage, self).__init__(data)
+        self._encoded_properties = encoded_properties or None
+
+    def _decode_properties(self):
+        # Another thread may finish decoding, and clear _encoded_properties, at any time, so it is
+        # only read once.  If two threads both decode, they store the same values.
+        encoded_properties = self._encoded_properties
+        if encoded_properties is None:
+            return
+        system_properties, custom_properties = mqtt_topic_iothub.decode_message_properties(
+            encoded_properties
+        )
+        # The values are stored straight into the slots, so that a property read on another thread
+        # never sees them half set.
+        for attribute, value in system_properties.items():
+            Message.__dict__[attribute].__set__(self, value)
+        if custom_properties:
+            self._custom_properties = custom_properties
+        self._encoded_properties = None
+
+    def may_have_property(self, name):
+        """
+        Return False if the message certainly doesn't have a property, without decoding its
+        properties.  True means the property should be checked.
+
+        :param str name: The name of a system property attribute, such as "content_encoding", or the
+          key of a custom property.
+        """
+        encoded_properties = self._encoded_properties
+        if encoded_properties is None:
+            return True
+        key = _system_property_keys.get(name, name)
+        encoded_key = urllib.parse.quote_plus(key)
+        return encoded_key + "=" in encoded_properties or key + "=" in encoded_properties
+
+
+class LazyMethodRequest(MethodRequest):
+    """A MethodRequest which deserializes its JSON payload the first time it's read."""
+
+    __slots__ = ("_encoded_payload", "_serializer")
+
+    def __init__(self, request_id, name, encoded_payload, serializer=None):
+        """
+        Initializer for LazyMethodRequest
+
+        :param str request_id: The request id.
+        :param str name: The name of the method to be invoked.
+        :param bytes encoded_payload: The UTF-8 encoded JSON payload of the request.
+        :param serializer: The Serializer used to deserialize the payload.  Defaults to the
+          standard library one.
+        """
+        super(LazyMethodRequest, self).__init__(request_id=request_id, name=name, payload=None)
+        self._encoded_payload = encoded_payload
+        self._serializer = serializer or serializers.standard_serializer
+
+    @property
+    def payload(self):
+        # Read once, as another thread may finish deserializing and clear it at any time
+        encoded_payload = self._encoded_payload
+        if encoded_payload is not None:
+            self._payload = self._serializer.loads(encoded_payload)
+            self._encoded_payload = None
+        return self._payload
@@ -5,11 +5,16 @@
 # --------------------------------------------------------------------------
 
 import logging
+import weakref
 from datetime import date
 import six.moves.urllib as urllib
 
 logger = logging.getLogger(__name__)
 
+# The encoded properties of every MessageTemplate which has been sent, so that each template is only
+# encoded once.  Templates are dropped from here when the application is done with them.
+_encoded_template_properties = weakref.WeakKeyDictionary()
+
 
 def _get_topic_base(device_id, module_id):
     """
@@ -186,27 +191,57 @@ def extract_properties_from_topic(topic, message_received):
         raise ValueError("topic has incorrect format")
 
     if properties:
-        key_value_pairs = properties.split("&")
-
-        for entry in key_value_pairs:
-            pair = entry.split("=")
-            key = urllib.parse.unquote_plus(pair[0])
-            value = urllib.parse.unquote_plus(pair[1])
-
-            if key == "$.mid":
-                message_received.message_id = value
-            elif key == "$.cid":
-                message_received.correlation_id = value
-            elif key == "$.uid":
-                message_received.user_id = value
-            elif key == "$.to":
-                message_received.to = value
-            elif key == "$.ct":
-                message_received.content_type = value
-            elif key == "$.ce":
-                message_received.content_encoding = value
-            else:
-                message_received.custom_properties[key] = value
+        apply_message_properties(properties, message_received)
+
+
+# Keys of the system properties of a received C2D or input message, and the Message attributes
+# they're set on
+RECEIVED_SYSTEM_PROPERTIES = {
+    "$.mid": "message_id",
+    "$.cid": "correlation_id",
+    "$.uid": "user_id",
+    "$.to": "to",
+    "$.ct": "content_type",
+    "$.ce": "content_encoding",
+}
+
+
+def decode_message_properties(properties):
+    """
+    Decode the key=value pairs from the properties part of a C2D or input topic.
+    :param str properties: The uri-encoded properties, in the format <key1>=<value1>&<key2>=<value2>
+    :returns: A tuple of a dictionary of system properties, keyed by the name of the Message attribute
+      they're set on, and a dictionary of custom properties.
+    """
+    system_properties = {}
+    custom_properties = {}
+    key_value_pairs = properties.split("&")
+
+    for entry in key_value_pairs:
+        pair = entry.split("=")
+        key = urllib.parse.unquote_plus(pair[0])
+        value = urllib.parse.unquote_plus(pair[1])
+
+        attribute = RECEIVED_SYSTEM_PROPERTIES.get(key)
+        if attribute:
+            system_properties[attribute] = value
+        else:
+            custom_properties[key] = value
+
+    return system_properties, custom_properties
+
+
+def apply_message_properties(properties, message_received):
+    """
+    Set the key=value pairs from the properties part of a C2D or input topic on a received message.
+    :param str properties: The uri-encoded properties, in the format <key1>=<value1>&<key2>=<value2>
+    :param message_received: The message received with the payload in bytes
+    """
+    system_properties, custom_properties = decode_message_properties(properties)
+    for attribute, value in system_properties.items():
+        setattr(message_received, attribute, value)
+    if custom_properties:
+        message_received.custom_properties.update(custom_properties)
 
 
 # TODO: this has too generic a name, given that it's only for messages
@@ -222,6 +257,14 @@ def encode_properties(message_to_send, topic):
     "devices/<deviceId>/modules/<moduleId>/messages/events/
     :return: The topic which has been uri-encoded
     """
+    template = message_to_send.template
+    if template is not None and template.matches(message_to_send):
+        message_properties_encoded = _encode_message_properties(message_to_send)
+        template_properties_encoded = _encode_template_properties(template)
+        if message_properties_encoded and template_properties_encoded:
+            return topic + message_properties_encoded + "&" + template_properties_encoded
+        return topic + (message_properties_encoded or template_properties_encoded)
+
     system_properties = []
     if message_to_send.output_name:
         system_properties.append(("$.on", message_to_send.output_name))
@@ -256,15 +299,68 @@ def encode_properties(message_to_send, topic):
     system_properties_encoded = urllib.parse.urlencode(system_properties)
     topic += system_properties_encoded
 
-    if message_to_send.custom_properties and len(message_to_send.custom_properties) > 0:
-        if system_properties and len(system_properties) > 0:
+    # Read the slot instead of the property, which would give every message a dict of its own.
+    # This comes after the other attributes because reading any of them fills in the slot of a
+    # LazyMessage.
+    custom_properties = message_to_send._custom_properties
+    if custom_properties:
+        if system_properties:
             topic += "&"
-        user_properties_encoded = urllib.parse.urlencode(message_to_send.custom_properties)
+        user_properties_encoded = urllib.parse.urlencode(custom_properties)
         topic += user_properties_encoded
 
     return topic
 
 
+def _encode_message_properties(message):
+    """
+    uri-encode the system properties of a message which aren't part of its MessageTemplate
+    """
+    system_properties = []
+    if message.message_id:
+        system_properties.append(("$.mid", message.message_id))
+    if message.correlation_id:
+        system_properties.append(("$.cid", message.correlation_id))
+    if message.user_id:
+        system_properties.append(("$.uid", message.user_id))
+    if message.to:
+        system_properties.append(("$.to", message.to))
+    if message.expiry_time_utc:
+        system_properties.append(
+            (
+                "$.exp",
+                message.expiry_time_utc.isoformat()
+                if isinstance(message.expiry_time_utc, date)
+                else message.expiry_time_utc,
+            )
+        )
+    return urllib.parse.urlencode(system_properties)
+
+
+def _encode_template_properties(template):
+    """
+    uri-encode the properties of a MessageTemplate, or return them from the cache if the template
+    has been encoded before
+    """
+    encoded = _encoded_template_properties.get(template)
+    if encoded is None:
+        system_properties = []
+        if template.output_name:
+            system_properties.append(("$.on", template.output_name))
+        if template.content_type:
+            system_properties.append(("$.ct", template.content_type))
+        if template.content_encoding:
+            system_properties.append(("$.ce", template.content_encoding))
+        encoded = urllib.parse.urlencode(system_properties)
+        custom_properties = template.custom_properties
+        if custom_properties:
+            if encoded:
+                encoded += "&"
+            encoded += urllib.parse.urlencode(custom_properties)
+        _encoded_template_properties[template] = encoded
+    return encoded
+
+
 def get_twin_response_topic_for_subscribe():
     return "$iothub/twin/res/#"
 
@@ -300,3 +396,125 @@ def get_twin_status_code_from_topic(topic):
 
 def is_twin_desired_property_patch_topic(topic):
     return topic.startswith("$iothub/twin/PATCH/properties/desired")
+
+
+# Kinds of incoming topics recognized by TopicParser
+C2D_TOPIC = "c2d"
+INPUT_TOPIC = "input"
+METHOD_TOPIC = "method"
+TWIN_RESPONSE_TOPIC = "twin_response"
+TWIN_PATCH_TOPIC = "twin_patch"
+
+
+class ParsedTopic(object):
+    """
+    The result of parsing the topic of an incoming message.  Only the attributes which apply to the
+    kind of topic are set; the others are None.
+
+    :ivar str kind: One of C2D_TOPIC, INPUT_TOPIC, METHOD_TOPIC, TWIN_RESPONSE_TOPIC or
+      TWIN_PATCH_TOPIC.
+    :ivar str properties: The uri-encoded message properties of a C2D or input topic, if any.
+    :ivar str input_name: The name of the input of an input topic.
+    :ivar str method_name: The name of the method of a method topic.
+    :ivar str request_id: The request id of a method or twin response topic.
+    :ivar int status_code: The status code of a twin response topic.
+    """
+
+    __slots__ = ("kind", "properties", "input_name", "method_name", "request_id", "status_code")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.properties = None
+        self.input_name = None
+        self.method_name = None
+        self.request_id = None
+        self.status_code = None
+
+
+def _split_request_id(rest):
+    """
+    Split "<segment>/?$rid=<request id>" into the segment and the request id.
+    """
+    parts = rest.split("?", 1)
+    return parts[0].rstrip("/"), _extract_properties(parts[1])["rid"]
+
+
+class TopicParser(object):
+    """
+    Parser for the topics of the messages received by one device or module.  Every topic it knows
+    about is registered in a table indexed by the first segment of the topic, so that a topic is
+    recognized with a dictionary lookup and a few prefix checks, and then taken apart in a single
+    pass.
+    """
+
+    def __init__(self, device_id, module_id):
+        """
+        Initializer for TopicParser objects.
+
+        :param str device_id: The id of the device the messages are received by, or None if it
+          isn't known yet, in which case only method and twin topics are recognized.
+        :param str module_id: The id of the module the messages are received by, or None.
+        """
+        prefixes = [
+            ("$iothub/methods/POST/", self._parse_method),
+            ("$iothub/twin/res/", self._parse_twin_response),
+            ("$iothub/twin/PATCH/properties/desired", self._parse_twin_patch),
+        ]
+        if device_id:
+            prefixes.append(("devices/{}/messages/devicebound".format(device_id), self._parse_c2d))
+        if device_id and module_id:
+            prefixes.append(
+                ("devices/{}/modules/{}/inputs/".format(device_id, module_id), self._parse_input)
+            )
+        self._table = {}
+        for prefix, parse in prefixes:
+            self._table.setdefault(prefix.partition("/")[0], []).append(
+                (prefix, len(prefix), parse)
+            )
+
+    def parse(self, topic):
+        """
+        Parse the topic of an incoming message.
+
+        :param str topic: The topic string.
+        :returns: A ParsedTopic, or None if the topic isn't one this parser knows about.
+        :raises: ValueError or IndexError if the topic is a known kind of topic, but is malformed.
+        """
+        for prefix, length, parse in self._table.get(topic.partition("/")[0], ()):
+            if topic.startswith(prefix):
+                return parse(topic[length:])
+        return None
+
+    def _parse_c2d(self, rest):
+        # devices/<deviceId>/messages/devicebound/<properties>
+        if rest and not rest.startswith("/"):
+            raise ValueError("topic has incorrect format")
+        parsed = ParsedTopic(C2D_TOPIC)
+        parsed.properties = rest[1:] or None
+        return parsed
+
+    def _parse_input(self, rest):
+        # devices/<deviceId>/modules/<moduleId>/inputs/<inputName>/<properties>
+        parsed = ParsedTopic(INPUT_TOPIC)
+        parsed.input_name, _, properties = rest.partition("/")
+        if not parsed.input_name:
+            raise ValueError("topic has incorrect format")
+        parsed.properties = properties or None
+        return parsed
+
+    def _parse_method(self, rest):
+        # $iothub/methods/POST/<method name>/?$rid=<request id>
+        parsed = ParsedTopic(METHOD_TOPIC)
+        parsed.method_name, parsed.request_id = _split_request_id(rest)
+        return parsed
+
+    def _parse_twin_response(self, rest):
+        # $iothub/twin/res/<status code>/?$rid=<request id>
+        parsed = ParsedTopic(TWIN_RESPONSE_TOPIC)
+        status_code, parsed.request_id = _split_request_id(rest)
+        parsed.status_code = int(status_code)
+        return parsed
+
+    def _parse_twin_patch(self, rest):
+        # $iothub/twin/PATCH/properties/desired/?$version=<version>
+        return ParsedTopic(TWIN_PATCH_TOPIC)
@@ -0,0 +1,297 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains a persistent outbox used to store telemetry messages while the
+client is unable to send them.
+"""
+
+import calendar
+import json
+import logging
+import sqlite3
+import time
+from datetime import date, datetime
+import six
+from azure.iot.device.common import buffers
+from azure.iot.device.iothub.models import Message
+
+logger = logging.getLogger(__name__)
+
+# Kinds of messages which can be stored in the outbox
+D2C_MESSAGE = "d2c"
+OUTPUT_EVENT = "output"
+
+_ISO_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]
+
+# Message attributes which are stored alongside the payload
+_message_attributes = [
+    "lock_token",
+    "message_id",
+    "sequence_number",
+    "to",
+    "expiry_time_utc",
+    "enqueued_time",
+    "correlation_id",
+    "user_id",
+    "ack",
+    "content_encoding",
+    "content_type",
+    "output_name",
+    "qos",
+]
+
+
+def _get_expiry_timestamp(expiry_time_utc):
+    """
+    Convert a Message.expiry_time_utc value into seconds since the epoch, or None if the message
+    never expires or the value can't be understood.  Naive datetimes are treated as UTC.
+    """
+    if not expiry_time_utc:
+        return None
+    if isinstance(expiry_time_utc, (int, float)) and not isinstance(expiry_time_utc, bool):
+        return float(expiry_time_utc)
+    if isinstance(expiry_time_utc, datetime):
+        if expiry_time_utc.utcoffset() is not None:
+            expiry_time_utc = expiry_time_utc.replace(tzinfo=None) - expiry_time_utc.utcoffset()
+        return calendar.timegm(expiry_time_utc.timetuple()) + expiry_time_utc.microsecond / 1e6
+    if isinstance(expiry_time_utc, date):
+        return float(calendar.timegm(expiry_time_utc.timetuple()))
+    if isinstance(expiry_time_utc, six.string_types):
+        value = expiry_time_utc.strip()
+        if value.endswith("Z"):
+            value = value[:-1]
+        elif value.endswith("+00:00"):
+            value = value[:-6]
+        for fmt in _ISO_FORMATS:
+            try:
+                return _get_expiry_timestamp(datetime.strptime(value, fmt))
+            except ValueError:
+                pass
+    logger.warning(
+        "Unable to parse expiry_time_utc {}.  Message will not expire.".format(expiry_time_utc)
+    )
+    return None
+
+
+def _encode_properties(message):
+    properties = {}
+    for key in _message_attributes:
+        value = getattr(message, key)
+        if value is None:
+            continue
+        if isinstance(value, date):
+            value = value.isoformat()
+        properties[key] = value
+    # Read the slot instead of the property, which would give every message a dict of its own.
+    # This comes after the other attributes because reading any of them fills in the slot of a
+    # LazyMessage.
+    if message._custom_properties:
+        properties["custom_properties"] = message._custom_properties
+    return json.dumps(properties)
+
+
+def _decode_message(data, properties):
+    message = Message(bytes(data))
+    for key, value in json.loads(properties).items():
+        setattr(message, key, value)
+    return message
+
+
+class OutboxEntry(object):
+    """
+    A message which was read back from the outbox.
+
+    :ivar id: The identifier of the entry inside the outbox.
+    :ivar kind: Either D2C_MESSAGE or OUTPUT_EVENT.
+    :ivar message: The Message object to send.
+    """
+
+    def __init__(self, id, kind, message):
+        self.id = id
+        self.kind = kind
+        self.message = message
+
+
+class SqliteOutbox(object):
+    """
+    Persistent first-in-first-out store for outgoing telemetry, backed by a SQLite database.
+
+    The payload is stored as the bytes that would be sent on the wire, and the remaining message
+    properties are stored as JSON.  The total size of the stored messages is bounded by max_bytes.
+    When that bound is exceeded, the oldest messages are evicted.  The number of entries and their
+    total size are read from the database when it is opened, and then kept up to date as entries
+    are added and removed, so that neither needs a scan of the table.
+
+    This object is not thread-safe.  It is expected to only be used from the pipeline thread.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        """
+        Initializer for SqliteOutbox objects.
+
+        :param str path: The path of the SQLite database file.  It is created if it does not exist.
+        :param int max_bytes: (Optional) The maximum number of bytes of message data and properties
+          to keep in the outbox.  None means no limit.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        # The connection is created on the caller's thread and then used on the pipeline thread.
+        # Access is serialized by the pipeline, so it is safe to share.
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "kind TEXT NOT NULL, "
+            "data BLOB NOT NULL, "
+            "properties TEXT NOT NULL, "
+            "expiry REAL, "
+            "size INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_expiry ON outbox (expiry)")
+        self._count, self._size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outbox"
+        ).fetchone()
+
+    def put(self, kind, message):
+        """
+        Add a message to the end of the outbox.
+
+        :param str kind: Either D2C_MESSAGE or OUTPUT_EVENT.
+        :param message: The Message object to store.
+
+        :returns: The id of the new entry.
+        :raises: TypeError if the message data cannot be stored.
+        :raises: ValueError if the message is larger than max_bytes.
+        """
+        data = buffers.get_bytes_like(message.data)
+        properties = _encode_properties(message)
+        expiry = _get_expiry_timestamp(message.expiry_time_utc)
+        size = buffers.get_size(data) + len(properties)
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError(
+                "Message of {} bytes is larger than the outbox, which holds {} bytes".format(
+                    size, self.max_bytes
+                )
+            )
+        # The insert and any evictions it causes are committed together
+        self._db.execute("BEGIN")
+        try:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (kind, data, properties, expiry, size) VALUES (?, ?, ?, ?, ?)",
+                (kind, sqlite3.Binary(data), properties, expiry, size),
+            )
+            entry_id = cursor.lastrowid
+            evicted_count, evicted_size = self._evict(
+                self._size + size - (self.max_bytes or 0), before_id=entry_id
+            )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._count += 1 - evicted_count
+        self._size += size - evicted_size
+        if evicted_count:
+            logger.warning(
+                "Outbox is larger than {} bytes.  Evicted {} oldest messages".format(
+                    self.max_bytes, evicted_count
+                )
+            )
+        return entry_id
+
+    def peek(self, limit, exclude=()):
+        """
+        Return the oldest unexpired entries in the outbox without removing them.  Expired entries
+        are removed.
+
+        :param int limit: The maximum number of entries to return.
+        :param exclude: Ids of entries which should be skipped (e.g. because they're being sent).
+
+        :returns: A list of OutboxEntry objects, oldest first.
+        """
+        self.remove_expired()
+        exclude = set(exclude)
+        rows = self._db.execute(
+            "SELECT id, kind, data, properties FROM outbox ORDER BY id LIMIT ?",
+            (limit + len(exclude),),
+        ).fetchall()
+        entries = [
+            OutboxEntry(id=row[0], kind=row[1], message=_decode_message(row[2], row[3]))
+            for row in rows
+            if row[0] not in exclude
+        ]
+        return entries[:limit]
+
+    def remove(self, entry_id):
+        """
+        Remove an entry from the outbox.  Removing an entry which is not in the outbox does nothing.
+        """
+        row = self._db.execute("SELECT size FROM outbox WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return
+        self._db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+        self._count -= 1
+        self._size -= row[0]
+
+    def remove_expired(self, now=None):
+        """
+        Remove every entry whose message has expired.
+
+        :returns: The number of entries removed.
+        """
+        if now is None:
+            now = time.time()
+        # The index on expiry keeps this from scanning the table
+        count, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outbox WHERE expiry <= ?", (now,)
+        ).fetchone()
+        if not count:
+            return 0
+        self._db.execute("DELETE FROM outbox WHERE expiry <= ?", (now,))
+        self._count -= count
+        self._size -= size
+        logger.warning("Dropped {} expired messages from the outbox".format(count))
+        return count
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        """
+        The number of bytes of message data and properties currently stored.
+        """
+        return self._size
+
+    def close(self):
+        self._db.close()
+
+    def _evict(self, excess, before_id):
+        """
+        Delete the oldest entries until their sizes add up to at least excess bytes.  Only entries
+        older than before_id are deleted, so a new entry never evicts itself.  This does not update
+        the running totals, so it can be done inside a transaction.
+
+        :returns: The number of entries deleted and their total size.
+        """
+        if self.max_bytes is None or excess <= 0:
+            return 0, 0
+        count = 0
+        size = 0
+        last_id = None
+        cursor = self._db.execute(
+            "SELECT id, size FROM outbox WHERE id < ? ORDER BY id", (before_id,)
+        )
+        for entry_id, entry_size in cursor:
+            last_id = entry_id
+            count += 1
+            size += entry_size
+            if size >= excess:
+                break
+        cursor.close()
+        if last_id is not None:
+            self._db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+        return count, size
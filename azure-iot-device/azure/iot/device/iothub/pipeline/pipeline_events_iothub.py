@@ -3,6 +3,7 @@
 # license information.
 # --------------------------------------------------------------------------
 from azure.iot.device.common.pipeline import PipelineEvent
+from . import serializers
 
 
 class C2DMessageEvent(PipelineEvent):
@@ -11,6 +12,8 @@ class C2DMessageEvent(PipelineEvent):
     created by some converter stage based on a protocol-specific event
     """
 
+    __slots__ = ("message",)
+
     def __init__(self, message):
         """
         Initializer for C2DMessageEvent objects.
@@ -27,6 +30,8 @@ class InputMessageEvent(PipelineEvent):
     created by some converter stage based on a protocol-specific event
     """
 
+    __slots__ = ("input_name", "message")
+
     def __init__(self, input_name, message):
         """
         Initializer for InputMessageEvent objects.
@@ -46,6 +51,8 @@ class MethodRequestEvent(PipelineEvent):
     This object is probably created by some converter stage based on a protocol-specific event.
     """
 
+    __slots__ = ("method_request",)
+
     def __init__(self, method_request):
         super(MethodRequestEvent, self).__init__()
         self.method_request = method_request
@@ -55,8 +62,36 @@ class TwinDesiredPropertiesPatchEvent(PipelineEvent):
     """
     A PipelineEvent object which represents an incoming twin desired properties patch.  This
     object is probably created by some converter stage based on a protocol-specific event.
+
+    The patch can be given as the JSON payload it was received in instead, in which case it's only
+    deserialized the first time it's read.  The root stage hands events to the client on the
+    callback thread, so this keeps the work off the pipeline thread.
     """
 
-    def __init__(self, patch):
+    __slots__ = ("_patch", "_payload", "_serializer")
+
+    def __init__(self, patch=None, payload=None, serializer=None):
+        """
+        Initializer for TwinDesiredPropertiesPatchEvent objects.
+
+        :param dict patch: The patch, or None if the payload is given instead.
+        :param bytes payload: The UTF-8 encoded JSON payload the patch was received in.
+        :param serializer: The Serializer used to deserialize the payload.  Defaults to the
+          standard library one.
+        """
         super(TwinDesiredPropertiesPatchEvent, self).__init__()
-        self.patch = patch
+        self._patch = patch
+        self._payload = payload
+        self._serializer = serializer or serializers.standard_serializer
+
+    @property
+    def patch(self):
+        if self._payload is not None:
+            self._patch = self._serializer.loads(self._payload)
+            self._payload = None
+        return self._patch
+
+    @patch.setter
+    def patch(self, value):
+        self._patch = value
+        self._payload = None
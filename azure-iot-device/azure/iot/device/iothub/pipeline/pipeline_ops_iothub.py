@@ -18,6 +18,8 @@ class SetX509AuthProviderOperation(PipelineOperation):
     very IoTHub-specific
     """
 
+    __slots__ = ("auth_provider",)
+
     def __init__(self, auth_provider, callback=None):
         """
         Initializer for SetAuthProviderOperation objects.
@@ -42,6 +44,8 @@ class SetAuthProviderOperation(PipelineOperation):
     very IoTHub-specific
     """
 
+    __slots__ = ("auth_provider",)
+
     def __init__(self, auth_provider, callback=None):
         """
         Initializer for SetAuthProviderOperation objects.
@@ -65,6 +69,16 @@ class SetIoTHubConnectionArgsOperation(PipelineOperation):
     IoTHub connections and would not apply to other types of client connections (such as a DPS client).
     """
 
+    __slots__ = (
+        "device_id",
+        "module_id",
+        "hostname",
+        "gateway_hostname",
+        "ca_cert",
+        "client_cert",
+        "sas_token",
+    )
+
     def __init__(
         self,
         device_id,
@@ -111,6 +125,8 @@ class SendD2CMessageOperation(PipelineOperation):
     This operation is in the group of IoTHub operations because it is very specific to the IoTHub client
     """
 
+    __slots__ = ("message",)
+
     def __init__(self, message, callback=None):
         """
         Initializer for SendD2CMessageOperation objects.
@@ -124,6 +140,39 @@ class SendD2CMessageOperation(PipelineOperation):
         self.message = message
 
 
+class SendD2CMessageBatchOperation(PipelineOperation):
+    """
+    A PipelineOperation object which contains a collection of telemetry messages to send to an IoTHub or EdgeHub
+    server as a single pipeline operation.
+
+    This operation is in the group of IoTHub operations because it is very specific to the IoTHub client
+
+    :ivar results: Upon completion, this contains one entry for every message in the batch, in the same order
+      as the messages.  Each entry is None if the message was sent successfully, or the error which caused that
+      message to fail.
+    :type results: list
+    """
+
+    __slots__ = ("messages", "max_inflight", "results")
+
+    def __init__(self, messages, max_inflight=None, callback=None):
+        """
+        Initializer for SendD2CMessageBatchOperation objects.
+
+        :param list messages: The Message objects that we're sending to the service
+        :param int max_inflight: (Optional) The maximum number of messages from this batch that can be waiting
+          for an acknowledgement from the service at any one time.  If this is None, every message in the batch
+          is sent without waiting for any acknowledgements.
+        :param Function callback: The function that gets called when this operation is complete or has failed.
+         The callback function must accept A PipelineOperation object which indicates the specific operation which
+         has completed or failed.
+        """
+        super(SendD2CMessageBatchOperation, self).__init__(callback=callback)
+        self.messages = messages
+        self.max_inflight = max_inflight
+        self.results = None
+
+
 class SendOutputEventOperation(PipelineOperation):
     """
     A PipelineOperation object which contains arguments used to send an output message to an EdgeHub server.
@@ -131,6 +180,8 @@ class SendOutputEventOperation(PipelineOperation):
     This operation is in the group of IoTHub operations because it is very specific to the IoTHub client
     """
 
+    __slots__ = ("message",)
+
     def __init__(self, message, callback=None):
         """
         Initializer for SendOutputEventOperation objects.
@@ -152,6 +203,8 @@ class SendMethodResponseOperation(PipelineOperation):
     This operation is in the group of IoTHub operations because it is very specific to the IoTHub client.
     """
 
+    __slots__ = ("method_response",)
+
     def __init__(self, method_response, callback=None):
         """
         Initializer for SendMethodResponseOperation objects.
@@ -176,6 +229,8 @@ class GetTwinOperation(PipelineOperation):
     :type twin: Twin
     """
 
+    __slots__ = ("twin",)
+
     def __init__(self, callback=None):
         """
         Initializer for GetTwinOperation objects.
@@ -190,6 +245,8 @@ class PatchTwinReportedPropertiesOperation(PipelineOperation):
     IoT Hub or Azure IoT Edge Hub service.
     """
 
+    __slots__ = ("patch",)
+
     def __init__(self, patch, callback=None):
         """
         Initializer for PatchTwinReportedPropertiesOperation object
@@ -4,16 +4,25 @@
 # license information.
 # --------------------------------------------------------------------------
 
-import json
+import copy
 import logging
+import threading
 from azure.iot.device.common.pipeline import (
     pipeline_ops_base,
+    pipeline_stages_base,
     PipelineStage,
     operation_flow,
     pipeline_thread,
 )
+from azure.iot.device.common import errors, buffers
 from . import pipeline_ops_iothub
+from . import pipeline_events_iothub
 from . import constant
+from . import outbox
+from . import compression
+from . import aggregation
+from . import lazy_models
+from . import serializers
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +69,555 @@ class UseAuthProviderStage(PipelineStage):
             operation_flow.pass_op_to_next_stage(self, op)
 
 
+class HandleD2CMessageBatchStage(PipelineStage):
+    """
+    PipelineStage which handles SendD2CMessageBatchOperation operations.  It converts a single batch
+    operation into a series of SendD2CMessageOperation operations, one per message, and keeps up to
+    max_inflight of those operations outstanding at any one time.  When every message in the batch has
+    been completed, the batch operation is completed with one result per message.
+
+    All other operations are passed down.
+    """
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _execute_op(self, op):
+        if isinstance(op, pipeline_ops_iothub.SendD2CMessageBatchOperation):
+            self._send_batch(op)
+        else:
+            operation_flow.pass_op_to_next_stage(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _send_batch(self, op):
+        messages = list(op.messages)
+        max_inflight = op.max_inflight or len(messages)
+        op.results = [None] * len(messages)
+
+        # The state for this batch is kept in a dict because Python 2.7 doesn't have nonlocal.
+        # "pumping" keeps us from recursing when a lower stage completes a message op synchronously.
+        state = {"next_index": 0, "inflight": 0, "completed": 0, "pumping": False}
+
+        logger.info(
+            "{}({}): sending {} messages with max_inflight={}".format(
+                self.name, op.name, len(messages), max_inflight
+            )
+        )
+
+        if not messages:
+            operation_flow.complete_op(self, op)
+            return
+
+        def make_callback(index):
+            @pipeline_thread.runs_on_pipeline_thread
+            def on_message_complete(message_op):
+                if message_op.error:
+                    logger.error(
+                        "{}({}): message {} failed: {}".format(
+                            self.name, op.name, index, message_op.error
+                        )
+                    )
+                op.results[index] = message_op.error
+                state["inflight"] -= 1
+                state["completed"] += 1
+                if state["completed"] == len(messages):
+                    operation_flow.complete_op(self, op)
+                else:
+                    pump()
+
+            return on_message_complete
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def pump():
+            if state["pumping"]:
+                return
+            state["pumping"] = True
+            try:
+                while state["inflight"] < max_inflight and state["next_index"] < len(messages):
+                    index = state["next_index"]
+                    state["next_index"] += 1
+                    state["inflight"] += 1
+                    message_op = pipeline_ops_iothub.SendD2CMessageOperation(
+                        message=messages[index], callback=make_callback(index)
+                    )
+                    message_op.deadline = op.deadline
+                    operation_flow.pass_op_to_next_stage(self, message_op)
+            finally:
+                state["pumping"] = False
+
+        pump()
+
+
+class StoreAndForwardStage(PipelineStage):
+    """
+    PipelineStage which stores telemetry in a persistent outbox while it can't be sent, and forwards it
+    once the pipeline is connected again.
+
+    SendD2CMessageOperation and SendOutputEventOperation operations are passed down as usual while the
+    pipeline is connected and the outbox is empty.  If the pipeline is not connected, if there are
+    already messages waiting in the outbox, or if sending fails because of a connection error, the
+    message is written to the outbox and the operation is completed successfully.  When the pipeline
+    connects, the outbox is drained, oldest message first, with up to drain_window messages in flight.
+
+    Storing a message while the pipeline is not connected starts a connect, unless a ReconnectStage
+    further down is already reconnecting after the connection dropped.  The outbox then waits for
+    that stage, so that its backoff is respected, and is drained when the connection comes back.
+
+    All other operations are passed down.
+    """
+
+    _connection_errors = (errors.ConnectionDroppedError, errors.ConnectionFailedError)
+
+    def __init__(self, outbox, drain_window=constant.DEFAULT_BATCH_MAX_INFLIGHT):
+        """
+        Initializer for StoreAndForwardStage objects.
+
+        :param outbox: The SqliteOutbox object used to store messages.
+        :param int drain_window: The maximum number of stored messages to have in flight at once
+          while draining the outbox.
+        """
+        super(StoreAndForwardStage, self).__init__()
+        self.outbox = outbox
+        self.drain_window = drain_window
+        self._inflight_ids = set()
+        self._draining = False
+        self._connecting = False
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _execute_op(self, op):
+        if isinstance(op, pipeline_ops_iothub.SendD2CMessageOperation):
+            self._send_or_store(op, outbox.D2C_MESSAGE)
+        elif isinstance(op, pipeline_ops_iothub.SendOutputEventOperation):
+            self._send_or_store(op, outbox.OUTPUT_EVENT)
+        else:
+            operation_flow.pass_op_to_next_stage(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _send_or_store(self, op, kind):
+        if not self.pipeline_root.connected or len(self.outbox):
+            self._store(op, kind)
+            if self.pipeline_root.connected:
+                self._drain()
+            else:
+                self._connect()
+            return
+
+        original_callback = op.callback
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_send_complete(op):
+            op.callback = original_callback
+            if isinstance(op.error, self._connection_errors):
+                logger.info(
+                    "{}({}): send failed with {}.  storing in outbox".format(
+                        self.name, op.name, op.error
+                    )
+                )
+                op.error = None
+                self._store(op, kind)
+            else:
+                operation_flow.complete_op(self, op)
+
+        op.callback = on_send_complete
+        operation_flow.pass_op_to_next_stage(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _store(self, op, kind):
+        """
+        Write the message for an op into the outbox and complete the op.
+        """
+        try:
+            self.outbox.put(kind, op.message)
+        except Exception as e:
+            logger.error(
+                msg="{}({}): unable to store message in outbox".format(self.name, op.name),
+                exc_info=e,
+            )
+            op.error = e
+        else:
+            logger.info("{}({}): stored message in outbox".format(self.name, op.name))
+        operation_flow.complete_op(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _connect(self):
+        """
+        Start connecting so the outbox can be drained.
+        """
+        if self._connecting:
+            return
+        reconnect_stage = self._find_reconnect_stage()
+        if reconnect_stage is not None and reconnect_stage.reconnecting:
+            logger.info(
+                "{}: {} is reconnecting.  waiting for it to drain outbox".format(
+                    self.name, reconnect_stage.name
+                )
+            )
+            return
+        self._connecting = True
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_connect_complete(op):
+            self._connecting = False
+            if op.error:
+                logger.info(
+                    "{}: connect failed.  messages will stay in outbox: {}".format(
+                        self.name, op.error
+                    )
+                )
+
+        operation_flow.pass_op_to_next_stage(
+            self, pipeline_ops_base.ConnectOperation(callback=on_connect_complete)
+        )
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _find_reconnect_stage(self):
+        """
+        Return the first ReconnectStage below this stage, or None if there isn't one.
+        """
+        stage = self.next
+        while stage is not None:
+            if isinstance(stage, pipeline_stages_base.ReconnectStage):
+                return stage
+            stage = stage.next
+        return None
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _drain(self):
+        """
+        Send stored messages, oldest first, until the outbox is empty or drain_window messages
+        are in flight.
+        """
+        # Completions can arrive synchronously while we're still in this loop.  They call back
+        # into this function, so make sure we don't recurse.
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self.pipeline_root.connected and len(self._inflight_ids) < self.drain_window:
+                entries = self.outbox.peek(
+                    limit=self.drain_window - len(self._inflight_ids), exclude=self._inflight_ids
+                )
+                if not entries:
+                    break
+                for entry in entries:
+                    self._forward(entry)
+        finally:
+            self._draining = False
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _forward(self, entry):
+        logger.info("{}: forwarding stored message {}".format(self.name, entry.id))
+        self._inflight_ids.add(entry.id)
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_forward_complete(op):
+            self._inflight_ids.discard(entry.id)
+            if isinstance(op.error, self._connection_errors):
+                logger.info(
+                    "{}: stored message {} not sent: {}.  keeping in outbox".format(
+                        self.name, entry.id, op.error
+                    )
+                )
+                return
+            if op.error:
+                # Anything other than a connection error will fail again if we retry, so drop it.
+                logger.error(
+                    "{}: dropping stored message {} because of error: {}".format(
+                        self.name, entry.id, op.error
+                    )
+                )
+            self.outbox.remove(entry.id)
+            self._drain()
+
+        if entry.kind == outbox.OUTPUT_EVENT:
+            new_op = pipeline_ops_iothub.SendOutputEventOperation(
+                message=entry.message, callback=on_forward_complete
+            )
+        else:
+            new_op = pipeline_ops_iothub.SendD2CMessageOperation(
+                message=entry.message, callback=on_forward_complete
+            )
+        operation_flow.pass_op_to_next_stage(self, new_op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def on_connected(self):
+        super(StoreAndForwardStage, self).on_connected()
+        self._drain()
+
+
+class AggregateMessagesStage(PipelineStage):
+    """
+    PipelineStage which packs many SendD2CMessageOperation operations into a single message, so that
+    they are sent with one publish and acknowledged with one PUBACK.
+
+    Messages are collected until max_messages messages are waiting, until the aggregated body would
+    reach max_bytes bytes, or until linger seconds have passed since the first one arrived,
+    whichever comes first.  The collected messages are then sent as one message in the format
+    described in the aggregation module, and every collected op is completed with the result of that
+    send.  The size of the body is counted after encoding, including the base64 encoding of binary
+    payloads and the properties, so an aggregated body is never larger than max_bytes.  When only one
+    message is waiting, its op is passed down as it is.  Waiting messages are also sent before a
+    DisconnectOperation is passed down, and messages which pass their deadline while waiting fail
+    with a TimeoutError instead of being sent.
+
+    Messages with an expiry_time_utc are never aggregated, because IoTHub can't expire them inside
+    an aggregated message.  The waiting messages are sent first, and then the op is passed down as
+    it is.
+
+    All other operations are passed down.
+    """
+
+    def __init__(
+        self,
+        max_messages=constant.DEFAULT_AGGREGATION_MAX_MESSAGES,
+        max_bytes=constant.DEFAULT_AGGREGATION_MAX_BYTES,
+        linger=constant.DEFAULT_AGGREGATION_LINGER,
+    ):
+        """
+        Initializer for AggregateMessagesStage objects.
+
+        :param int max_messages: The largest number of messages to send in one publish.
+        :param int max_bytes: The largest size, in bytes, of an aggregated body.
+        :param float linger: The longest time, in seconds, that a message waits for others to be
+          sent along with it.
+        """
+        super(AggregateMessagesStage, self).__init__()
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.waiting_ops = []
+        # The encoded entries of the waiting messages, and the size of the body they would make
+        self.waiting_items = []
+        self.waiting_bytes = 0
+        self._timer = None
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _execute_op(self, op):
+        if isinstance(op, pipeline_ops_iothub.SendD2CMessageOperation):
+            self._add(op)
+        elif isinstance(op, pipeline_ops_base.DisconnectOperation):
+            self._flush()
+            operation_flow.pass_op_to_next_stage(self, op)
+        else:
+            operation_flow.pass_op_to_next_stage(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _add(self, op):
+        if op.message.expiry_time_utc is not None:
+            # Send it on its own, after the waiting messages so that the order is kept
+            self._flush()
+            operation_flow.pass_op_to_next_stage(self, op)
+            return
+
+        item = aggregation.encode_item(op.message)
+        # The entry, plus the comma or bracket after it
+        size = len(item) + 1
+        if self.waiting_ops and self.waiting_bytes + size > self.max_bytes:
+            # Don't let this message push the waiting ones over the limit
+            self._flush()
+
+        if not self.waiting_ops:
+            # The opening bracket
+            self.waiting_bytes = 1
+        self.waiting_ops.append(op)
+        self.waiting_items.append(item)
+        self.waiting_bytes += size
+        if len(self.waiting_ops) >= self.max_messages or self.waiting_bytes >= self.max_bytes:
+            self._flush()
+        elif not self._timer:
+            self._timer = threading.Timer(self.linger, self._on_timer_expired)
+            self._timer.daemon = True
+            self._timer.start()
+
+    @pipeline_thread.invoke_on_pipeline_thread_nowait
+    def _on_timer_expired(self):
+        self._timer = None
+        self._flush()
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _flush(self):
+        """
+        Send the waiting messages.
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        ops = []
+        items = []
+        for op, item in zip(self.waiting_ops, self.waiting_items):
+            if operation_flow.has_expired(op):
+                op.error = operation_flow.timeout_error(op)
+                operation_flow.complete_op(self, op)
+            else:
+                ops.append(op)
+                items.append(item)
+        self.waiting_ops = []
+        self.waiting_items = []
+        self.waiting_bytes = 0
+
+        if not ops:
+            return
+        if len(ops) == 1:
+            operation_flow.pass_op_to_next_stage(self, ops[0])
+            return
+
+        logger.info("{}: sending {} messages in one publish".format(self.name, len(ops)))
+
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_send_complete(aggregated_op):
+            if aggregated_op.error:
+                logger.error(
+                    "{}({}): sending {} messages failed: {}".format(
+                        self.name, aggregated_op.name, len(ops), aggregated_op.error
+                    )
+                )
+            for op in ops:
+                op.error = aggregated_op.error
+                operation_flow.complete_op(self, op)
+
+        operation_flow.pass_op_to_next_stage(
+            self,
+            pipeline_ops_iothub.SendD2CMessageOperation(
+                message=aggregation.encode_messages([op.message for op in ops], items=items),
+                callback=on_send_complete,
+            ),
+        )
+
+
+class CompressMessagesStage(PipelineStage):
+    """
+    PipelineStage which compresses the payload of outgoing telemetry and decompresses the payload of
+    incoming messages.
+
+    When an algorithm is given and the payload of a SendD2CMessageOperation or SendOutputEventOperation is at least threshold
+    bytes long, it is replaced with a compressed copy of the message which has its content_encoding
+    and the compression custom property set to the name of the algorithm.  The message which was
+    passed in is never changed, and the op gets it back when it completes, so stages above this one
+    (such as StoreAndForwardStage) only ever see the uncompressed message.  Payloads which don't get
+    any smaller are sent as they are.
+
+    When decompress is set, C2DMessageEvent and InputMessageEvent events with a compressed payload
+    are decompressed before being passed up.
+
+    All other operations and events are passed through.
+    """
+
+    def __init__(
+        self, algorithm=None, threshold=constant.DEFAULT_COMPRESSION_THRESHOLD, decompress=False
+    ):
+        """
+        Initializer for CompressMessagesStage objects.
+
+        :param str algorithm: The algorithm used to compress outgoing payloads, or None to leave
+          them as they are.
+        :param int threshold: The size, in bytes, of the smallest payload which is compressed.
+        :param bool decompress: Whether to decompress the payload of incoming messages.
+
+        :raises: ValueError if the algorithm is not available
+        """
+        super(CompressMessagesStage, self).__init__()
+        if algorithm is not None and not compression.is_available(algorithm):
+            raise ValueError("Unsupported compression algorithm: {}".format(algorithm))
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.decompress = decompress
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _execute_op(self, op):
+        if isinstance(
+            op,
+            (
+                pipeline_ops_iothub.SendD2CMessageOperation,
+                pipeline_ops_iothub.SendOutputEventOperation,
+            ),
+        ):
+            compressed_message = self._compress_message(op.message)
+            if compressed_message is not None:
+                original_message = op.message
+                original_callback = op.callback
+
+                @pipeline_thread.runs_on_pipeline_thread
+                def on_send_complete(op):
+                    op.message = original_message
+                    op.callback = original_callback
+                    operation_flow.complete_op(self, op)
+
+                op.message = compressed_message
+                op.callback = on_send_complete
+        operation_flow.pass_op_to_next_stage(self, op)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _compress_message(self, message):
+        """
+        Return a compressed copy of a message, or None if the message should be sent as it is.
+        """
+        if self.algorithm is None:
+            return None
+        if message.content_encoding in (compression.GZIP, compression.DEFLATE, compression.ZSTD):
+            # Already compressed by the application
+            return None
+        data = compression.get_payload_bytes(message.data)
+        if data is None:
+            return None
+        size = buffers.get_size(data)
+        if size < self.threshold:
+            return None
+        compressed_data = compression.compress(self.algorithm, data)
+        if len(compressed_data) >= size:
+            return None
+
+        logger.debug(
+            "{}: compressed payload from {} to {} bytes with {}".format(
+                self.name, size, len(compressed_data), self.algorithm
+            )
+        )
+        compressed_message = copy.copy(message)
+        compressed_message.data = compressed_data
+        compressed_message.content_encoding = self.algorithm
+        compressed_message.custom_properties = dict(message.custom_properties)
+        compressed_message.custom_properties[compression.COMPRESSION_PROPERTY] = self.algorithm
+        return compressed_message
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _handle_pipeline_event(self, event):
+        if self.decompress and isinstance(
+            event,
+            (pipeline_events_iothub.C2DMessageEvent, pipeline_events_iothub.InputMessageEvent),
+        ):
+            self._decompress_message(event.message)
+        operation_flow.pass_event_to_previous_stage(self, event)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _decompress_message(self, message):
+        if isinstance(message, lazy_models.LazyMessage) and not (
+            message.may_have_property(compression.COMPRESSION_PROPERTY)
+            or message.may_have_property("content_encoding")
+        ):
+            # Don't decode the properties of every received message just to find out that it isn't
+            # compressed
+            return
+        algorithm = message.custom_properties.get(
+            compression.COMPRESSION_PROPERTY, message.content_encoding
+        )
+        if algorithm not in (compression.GZIP, compression.DEFLATE, compression.ZSTD):
+            return
+        try:
+            data = compression.decompress(algorithm, message.data)
+        except Exception as e:
+            # Better to hand the application the payload as it arrived than to drop the message
+            logger.error(
+                msg="{}: unable to decompress {} payload.  passing it up as is".format(
+                    self.name, algorithm
+                ),
+                exc_info=e,
+            )
+            return
+        if isinstance(message.data, memoryview):
+            # The pipeline was asked for memoryview payloads, so keep giving it one
+            data = memoryview(data)
+        message.data = data
+        message.content_encoding = None
+        message.custom_properties.pop(compression.COMPRESSION_PROPERTY, None)
+
+
 class HandleTwinOperationsStage(PipelineStage):
     """
     PipelineStage which handles twin operations. In particular, it converts twin GET and PATCH
@@ -70,6 +628,16 @@ class HandleTwinOperationsStage(PipelineStage):
     protocol-specific receive event into an IotResponseEvent event.
     """
 
+    def __init__(self, serializer=None):
+        """
+        Initializer for HandleTwinOperationsStage objects.
+
+        :param serializer: (Optional) The Serializer used to deserialize twins and serialize
+          reported property patches.  Defaults to the standard library one.
+        """
+        super(HandleTwinOperationsStage, self).__init__()
+        self.serializer = serializer or serializers.standard_serializer
+
     @pipeline_thread.runs_on_pipeline_thread
     def _execute_op(self, op):
         def map_twin_error(original_op, twin_op):
@@ -89,19 +657,18 @@ class HandleTwinOperationsStage(PipelineStage):
                 logger.info("{}({}): Got response for GetTwinOperation".format(self.name, op.name))
                 map_twin_error(original_op=op, twin_op=twin_op)
                 if not twin_op.error:
-                    op.twin = json.loads(twin_op.response_body.decode("utf-8"))
+                    op.twin = self.serializer.loads(twin_op.response_body)
                 operation_flow.complete_op(self, op)
 
-            operation_flow.pass_op_to_next_stage(
-                self,
-                pipeline_ops_base.SendIotRequestAndWaitForResponseOperation(
-                    request_type=constant.TWIN,
-                    method="GET",
-                    resource_location="/",
-                    request_body=" ",
-                    callback=on_twin_response,
-                ),
+            twin_op = pipeline_ops_base.SendIotRequestAndWaitForResponseOperation(
+                request_type=constant.TWIN,
+                method="GET",
+                resource_location="/",
+                request_body=" ",
+                callback=on_twin_response,
             )
+            twin_op.deadline = op.deadline
+            operation_flow.pass_op_to_next_stage(self, twin_op)
 
         elif isinstance(op, pipeline_ops_iothub.PatchTwinReportedPropertiesOperation):
 
@@ -118,18 +685,15 @@ class HandleTwinOperationsStage(PipelineStage):
                 "{}({}): Sending reported properties patch: {}".format(self.name, op.name, op.patch)
             )
 
-            operation_flow.pass_op_to_next_stage(
-                self,
-                (
-                    pipeline_ops_base.SendIotRequestAndWaitForResponseOperation(
-                        request_type=constant.TWIN,
-                        method="PATCH",
-                        resource_location="/properties/reported/",
-                        request_body=json.dumps(op.patch),
-                        callback=on_twin_response,
-                    )
-                ),
+            twin_op = pipeline_ops_base.SendIotRequestAndWaitForResponseOperation(
+                request_type=constant.TWIN,
+                method="PATCH",
+                resource_location="/properties/reported/",
+                request_body=self.serializer.dumps(op.patch),
+                callback=on_twin_response,
             )
+            twin_op.deadline = op.deadline
+            operation_flow.pass_op_to_next_stage(self, twin_op)
 
         else:
             operation_flow.pass_op_to_next_stage(self, op)
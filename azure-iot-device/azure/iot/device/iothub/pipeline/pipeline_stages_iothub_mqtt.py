@@ -5,7 +5,6 @@
 # --------------------------------------------------------------------------
 
 import logging
-import json
 import six.moves.urllib as urllib
 from azure.iot.device.common.pipeline import (
     pipeline_events_base,
@@ -16,8 +15,8 @@ from azure.iot.device.common.pipeline import (
     operation_flow,
     pipeline_thread,
 )
-from azure.iot.device.iothub.models import Message, MethodRequest
-from . import pipeline_ops_iothub, pipeline_events_iothub, mqtt_topic_iothub
+from . import pipeline_ops_iothub, pipeline_events_iothub, mqtt_topic_iothub, lazy_models
+from . import serializers
 from . import constant as pipeline_constant
 from azure.iot.device import constant as pkg_constant
 
@@ -28,11 +27,35 @@ class IoTHubMQTTConverterStage(PipelineStage):
     """
     PipelineStage which converts other Iot and IoTHub operations into MQTT operations.  This stage also
     converts mqtt pipeline events into Iot and IoTHub pipeline events.
+
+    Telemetry is published with the qos of its message, or with telemetry_qos if the message
+    doesn't have one.  The payload of a message is handed to the transport as it is, so buffers such
+    as bytearrays and memoryviews aren't copied.  The payload of received C2D and input messages is
+    bytes, or a read-only memoryview over those bytes if memoryview_payloads is set.
+
+    The properties of received messages, and the JSON payloads of method requests and twin patches,
+    aren't decoded here.  They're decoded the first time they're read, which is normally on another
+    thread (see lazy_models).
     """
 
-    def __init__(self):
+    def __init__(self, telemetry_qos=1, memoryview_payloads=False, serializer=None):
+        """
+        Initializer for IoTHubMQTTConverterStage objects.
+
+        :param int telemetry_qos: (Optional) The MQTT quality of service used to publish telemetry
+          messages which don't set their own.  Defaults to 1.
+        :param bool memoryview_payloads: (Optional) Whether received C2D and input messages get
+          their payload as a read-only memoryview instead of bytes.  Defaults to False.
+        :param serializer: (Optional) The Serializer used for method payloads and twin patches.
+          Defaults to the standard library one.
+        """
         super(IoTHubMQTTConverterStage, self).__init__()
+        self.telemetry_qos = telemetry_qos
+        self.memoryview_payloads = memoryview_payloads
+        self.serializer = serializer or serializers.standard_serializer
         self.feature_to_topic = {}
+        # Until the device and module ids are known, only method and twin topics are recognized
+        self.topic_parser = mqtt_topic_iothub.TopicParser(None, None)
 
     @pipeline_thread.runs_on_pipeline_thread
     def _execute_op(self, op):
@@ -85,10 +108,15 @@ class IoTHubMQTTConverterStage(PipelineStage):
         ):
             # Convert SendTelementry and SendOutputEventOperation operations into MQTT Publish operations
             topic = mqtt_topic_iothub.encode_properties(op.message, self.telemetry_topic)
+            qos = op.message.qos
+            if qos is None:
+                qos = self.telemetry_qos
             operation_flow.delegate_to_different_op(
                 stage=self,
                 original_op=op,
-                new_op=pipeline_ops_mqtt.MQTTPublishOperation(topic=topic, payload=op.message.data),
+                new_op=pipeline_ops_mqtt.MQTTPublishOperation(
+                    topic=topic, payload=op.message.data, qos=qos
+                ),
             )
 
         elif isinstance(op, pipeline_ops_iothub.SendMethodResponseOperation):
@@ -96,7 +124,7 @@ class IoTHubMQTTConverterStage(PipelineStage):
             topic = mqtt_topic_iothub.get_method_topic_for_publish(
                 op.method_response.request_id, str(op.method_response.status)
             )
-            payload = json.dumps(op.method_response.payload)
+            payload = self.serializer.dumps(op.method_response.payload)
             operation_flow.delegate_to_different_op(
                 stage=self,
                 original_op=op,
@@ -165,6 +193,14 @@ class IoTHubMQTTConverterStage(PipelineStage):
                 mqtt_topic_iothub.get_twin_patch_topic_for_subscribe()
             ),
         }
+        self.topic_parser = mqtt_topic_iothub.TopicParser(device_id, module_id)
+
+    @pipeline_thread.runs_on_pipeline_thread
+    def _get_message_payload(self, payload):
+        if self.memoryview_payloads:
+            # A memoryview over bytes is read-only, and slicing it doesn't copy the payload
+            return memoryview(payload)
+        return payload
 
     @pipeline_thread.runs_on_pipeline_thread
     def _handle_pipeline_event(self, event):
@@ -174,49 +210,51 @@ class IoTHubMQTTConverterStage(PipelineStage):
         """
         if isinstance(event, pipeline_events_mqtt.IncomingMQTTMessageEvent):
             topic = event.topic
+            parsed = self.topic_parser.parse(topic)
+            kind = parsed.kind if parsed else None
 
-            if mqtt_topic_iothub.is_c2d_topic(topic, self.device_id):
-                message = Message(event.payload)
-                mqtt_topic_iothub.extract_properties_from_topic(topic, message)
+            if kind == mqtt_topic_iothub.C2D_TOPIC:
+                message = lazy_models.LazyMessage(
+                    self._get_message_payload(event.payload), parsed.properties
+                )
                 operation_flow.pass_event_to_previous_stage(
                     self, pipeline_events_iothub.C2DMessageEvent(message)
                 )
 
-            elif mqtt_topic_iothub.is_input_topic(topic, self.device_id, self.module_id):
-                message = Message(event.payload)
-                mqtt_topic_iothub.extract_properties_from_topic(topic, message)
-                input_name = mqtt_topic_iothub.get_input_name_from_topic(topic)
+            elif kind == mqtt_topic_iothub.INPUT_TOPIC:
+                message = lazy_models.LazyMessage(
+                    self._get_message_payload(event.payload), parsed.properties
+                )
                 operation_flow.pass_event_to_previous_stage(
-                    self, pipeline_events_iothub.InputMessageEvent(input_name, message)
+                    self, pipeline_events_iothub.InputMessageEvent(parsed.input_name, message)
                 )
 
-            elif mqtt_topic_iothub.is_method_topic(topic):
-                request_id = mqtt_topic_iothub.get_method_request_id_from_topic(topic)
-                method_name = mqtt_topic_iothub.get_method_name_from_topic(topic)
-                method_received = MethodRequest(
-                    request_id=request_id,
-                    name=method_name,
-                    payload=json.loads(event.payload.decode("utf-8")),
+            elif kind == mqtt_topic_iothub.METHOD_TOPIC:
+                method_received = lazy_models.LazyMethodRequest(
+                    request_id=parsed.request_id,
+                    name=parsed.method_name,
+                    encoded_payload=event.payload,
+                    serializer=self.serializer,
                 )
                 operation_flow.pass_event_to_previous_stage(
                     self, pipeline_events_iothub.MethodRequestEvent(method_received)
                 )
 
-            elif mqtt_topic_iothub.is_twin_response_topic(topic):
-                request_id = mqtt_topic_iothub.get_twin_request_id_from_topic(topic)
-                status_code = int(mqtt_topic_iothub.get_twin_status_code_from_topic(topic))
+            elif kind == mqtt_topic_iothub.TWIN_RESPONSE_TOPIC:
                 operation_flow.pass_event_to_previous_stage(
                     self,
                     pipeline_events_base.IotResponseEvent(
-                        request_id=request_id, status_code=status_code, response_body=event.payload
+                        request_id=parsed.request_id,
+                        status_code=parsed.status_code,
+                        response_body=event.payload,
                     ),
                 )
 
-            elif mqtt_topic_iothub.is_twin_desired_property_patch_topic(topic):
+            elif kind == mqtt_topic_iothub.TWIN_PATCH_TOPIC:
                 operation_flow.pass_event_to_previous_stage(
                     self,
                     pipeline_events_iothub.TwinDesiredPropertiesPatchEvent(
-                        patch=json.loads(event.payload.decode("utf-8"))
+                        payload=event.payload, serializer=self.serializer
                     ),
                 )
 
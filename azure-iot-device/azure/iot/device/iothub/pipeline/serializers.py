@@ -0,0 +1,148 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the serializers used to convert twins, twin patches and method payloads to
+and from JSON.
+
+The standard library json module is always available.  orjson and ujson are used instead if they
+are installed, because they parse and produce large documents many times faster.  The service
+only speaks JSON on these topics, so only JSON libraries can be used.
+"""
+
+import json
+import sys
+import six
+from azure.iot.device.common import buffers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Supported JSON libraries
+JSON = "json"
+ORJSON = "orjson"
+UJSON = "ujson"
+
+# The libraries to use when none is asked for, fastest first
+_preferred = [ORJSON, UJSON, JSON]
+
+# json.loads only accepts bytes on Python 2.7 and 3.6+.  On 3.4 and 3.5, payloads have to be decoded
+# into a str first.
+_json_loads_bytes = sys.version_info < (3,) or sys.version_info >= (3, 6)
+
+
+def _json_loads(data):
+    if isinstance(data, six.text_type) or (_json_loads_bytes and isinstance(data, bytes)):
+        return json.loads(data)
+    return json.loads(buffers.to_text(data))
+
+
+def _orjson_loads(data):
+    return orjson.loads(data)
+
+
+def _orjson_dumps(value):
+    return orjson.dumps(value)
+
+
+def _ujson_loads(data):
+    if not isinstance(data, (six.text_type, bytes)):
+        data = buffers.to_text(data)
+    return ujson.loads(data)
+
+
+def _ujson_dumps(value):
+    return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+
+
+_codecs = {
+    JSON: (_json_loads, json.dumps),
+    ORJSON: (_orjson_loads, _orjson_dumps),
+    UJSON: (_ujson_loads, _ujson_dumps),
+}
+
+
+def is_available(name):
+    """
+    Return True if the JSON library with the given name can be used.
+    """
+    if name == ORJSON:
+        return orjson is not None
+    if name == UJSON:
+        return ujson is not None
+    return name in _codecs
+
+
+def get_serializer(name=None):
+    """
+    Return a Serializer for the JSON library with the given name, or for the fastest library which
+    is installed if no name is given.
+
+    :raises: ValueError if the library is not available.
+    """
+    if name is None:
+        name = next(name for name in _preferred if is_available(name))
+    return Serializer(name)
+
+
+class Serializer(object):
+    """
+    Converts values to and from JSON with one JSON library.
+
+    :ivar str name: The name of the JSON library.
+    """
+
+    __slots__ = ("name", "_loads", "_dumps")
+
+    def __init__(self, name=JSON):
+        """
+        Initializer for Serializer objects.
+
+        :param str name: One of JSON, ORJSON or UJSON.
+
+        :raises: ValueError if the library is not available.
+        """
+        if not is_available(name):
+            raise ValueError("Unsupported serializer: {}".format(name))
+        self.name = name
+        self._loads, self._dumps = _codecs[name]
+
+    def loads(self, data):
+        """
+        Deserialize a JSON document.
+
+        :param data: The document, as text or as UTF-8 encoded bytes or any other buffer.
+
+        :raises: ValueError if the document isn't valid JSON.
+        """
+        return self._loads(data)
+
+    def dumps(self, value):
+        """
+        Serialize a value as a JSON document.  The document is returned as text or as UTF-8
+        encoded bytes, depending on the library.  Either can be published as it is.
+
+        Values which the library can't serialize, but the standard library can, such as integers
+        which don't fit in 64 bits or dictionaries with integer keys, are serialized with the
+        standard library instead.
+
+        :raises: TypeError if the value can't be serialized.
+        """
+        try:
+            return self._dumps(value)
+        except (TypeError, OverflowError):
+            if self._dumps is json.dumps:
+                raise
+            return json.dumps(value)
+
+
+# Serializer used by stages which aren't given one
+standard_serializer = Serializer(JSON)
@@ -8,7 +8,6 @@ Azure IoTHub Device SDK for Python.
 """
 
 import logging
-import threading
 from .abstract_clients import (
     AbstractIoTHubClient,
     AbstractIoTHubDeviceClient,
@@ -18,6 +17,8 @@ from .models import Message
 from .inbox_manager import InboxManager
 from .sync_inbox import SyncClientInbox
 from .pipeline import constant
+from azure.iot.device.common.evented_callback import EventedCallback, FutureCallback
+from azure.iot.device.common.pipeline import pipeline_thread
 
 logger = logging.getLogger(__name__)
 
@@ -41,11 +42,16 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         # in the class hierarchies of different clients. Thus, args here must be passed along as
         # **kwargs.
         super(GenericIoTHubClient, self).__init__(**kwargs)
+        if isinstance(self._iothub_pipeline.executors, pipeline_thread.EventLoopExecutors):
+            raise ValueError("The event_loop executor_scope can only be used by asyncio clients")
         self._inbox_manager = InboxManager(inbox_type=SyncClientInbox)
         self._iothub_pipeline.on_connected = self._on_connected
         self._iothub_pipeline.on_disconnected = self._on_disconnected
         self._iothub_pipeline.on_method_request_received = self._inbox_manager.route_method_request
         self._iothub_pipeline.on_twin_patch_received = self._inbox_manager.route_twin_patch
+        # Every call waits for its operation to complete, or hands back a future for it, so there is
+        # no need to also wait for the pipeline thread to start running the operation
+        self._iothub_pipeline.submit_nowait = True
 
     def _on_connected(self):
         """Helper handler that is called upon an iothub pipeline connect"""
@@ -57,7 +63,7 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         self._inbox_manager.clear_all_method_requests()
         logger.info("Cleared all pending method requests due to disconnect")
 
-    def connect(self):
+    def connect(self, timeout=None):
         """Connects the client to an Azure IoT Hub or Azure IoT Edge Hub instance.
 
         The destination is chosen based on the credentials passed via the auth_provider parameter
@@ -65,36 +71,36 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         This is a synchronous call, meaning that this function will not return until the connection
         to the service has been completely established.
+
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Connecting to Hub...")
 
-        connect_complete = threading.Event()
-
-        def callback():
-            connect_complete.set()
-            logger.info("Successfully connected to Hub")
+        callback = EventedCallback()
+        self._iothub_pipeline.connect(callback=callback, timeout=timeout)
+        callback.wait_for_completion()
 
-        self._iothub_pipeline.connect(callback=callback)
-        connect_complete.wait()
+        logger.info("Successfully connected to Hub")
 
-    def disconnect(self):
+    def disconnect(self, timeout=None):
         """Disconnect the client from the Azure IoT Hub or Azure IoT Edge Hub instance.
 
         This is a synchronous call, meaning that this function will not return until the connection
         to the service has been completely closed.
+
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Disconnecting from Hub...")
 
-        disconnect_complete = threading.Event()
+        callback = EventedCallback()
+        self._iothub_pipeline.disconnect(callback=callback, timeout=timeout)
+        callback.wait_for_completion()
 
-        def callback():
-            disconnect_complete.set()
-            logger.info("Successfully disconnected from Hub")
+        logger.info("Successfully disconnected from Hub")
 
-        self._iothub_pipeline.disconnect(callback=callback)
-        disconnect_complete.wait()
-
-    def send_d2c_message(self, message):
+    def send_d2c_message(self, message, timeout=None):
         """Sends a message to the default events endpoint on the Azure IoT Hub or Azure IoT Edge Hub instance.
 
         This is a synchronous event, meaning that this function will not return until the event
@@ -105,19 +111,84 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         :param message: The actual message to send. Anything passed that is not an instance of the
         Message class will be converted to Message object.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         if not isinstance(message, Message):
             message = Message(message)
 
         logger.info("Sending message to Hub...")
-        send_complete = threading.Event()
+        callback = EventedCallback()
+        self._iothub_pipeline.send_d2c_message(message, callback=callback, timeout=timeout)
+        callback.wait_for_completion()
+
+        logger.info("Successfully sent message to Hub")
+
+    def send_d2c_message_nowait(self, message, timeout=None):
+        """Sends a message to the default events endpoint on the Azure IoT Hub or Azure IoT Edge Hub
+        instance, without waiting for the service to acknowledge it.
+
+        This function returns as soon as the message has been handed to the pipeline.  The Future it
+        returns completes when the service has acknowledged receipt of the message, or fails with
+        the error that caused the send to fail.  Many messages can be waiting for an acknowledgement
+        at the same time this way, without a thread for each of them.  Use
+        concurrent.futures.wait() to wait for several of them at once.
+
+        If the publish queue is full, this function either blocks until there is room in the queue
+        or raises a PipelineQueueFullError, depending on the queue_full_policy of the pipeline.
+
+        If the connection to the service has not previously been opened by a call to connect, the
+        connection is opened before the message is sent.
+
+        :param message: The actual message to send. Anything passed that is not an instance of the
+        Message class will be converted to Message object.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
+
+        :returns: A concurrent.futures.Future whose result is None once the message has been sent.
+        """
+        if not isinstance(message, Message):
+            message = Message(message)
+
+        logger.info("Sending message to Hub without waiting...")
+        callback = FutureCallback()
+        self._iothub_pipeline.send_d2c_message(message, callback=callback, timeout=timeout)
+        return callback.future
+
+    def send_d2c_messages(self, messages, max_inflight=None, timeout=None):
+        """Sends a batch of messages to the default events endpoint on the Azure IoT Hub or Azure IoT
+        Edge Hub instance.
+
+        All of the messages are submitted to the pipeline at once, and up to max_inflight of them
+        can be waiting for an acknowledgement from the service at any one time.  This is a
+        synchronous call, meaning that this function will not return until every message in the
+        batch has either been acknowledged by the service or has failed.
+
+        If the connection to the service has not previously been opened by a call to connect, this
+        function will open the connection before sending the messages.
+
+        :param messages: An iterable of messages to send. Anything passed that is not an instance of
+        the Message class will be converted to Message object.
+        :param int max_inflight: Optionally provide the maximum number of messages which can be
+        waiting for an acknowledgement at the same time.
+        :param float timeout: Optionally provide a number of seconds after which the messages which
+        haven't been acknowledged yet fail with a TimeoutError.
+
+        :returns: A list with one entry per message, in the same order as the messages. Each entry
+        is None if that message was sent successfully, or the error which caused it to fail.
+        """
+        messages = [m if isinstance(m, Message) else Message(m) for m in messages]
+
+        logger.info("Sending batch of {} messages to Hub...".format(len(messages)))
 
-        def callback():
-            send_complete.set()
-            logger.info("Successfully sent message to Hub")
+        callback = EventedCallback()
+        self._iothub_pipeline.send_d2c_messages(
+            messages, max_inflight=max_inflight, callback=callback, timeout=timeout
+        )
+        results = callback.wait_for_completion()
 
-        self._iothub_pipeline.send_d2c_message(message, callback=callback)
-        send_complete.wait()
+        logger.info("Finished sending batch of messages to Hub")
+        return results
 
     def receive_method_request(self, method_name=None, block=True, timeout=None):
         """Receive a method request via the Azure IoT Hub or Azure IoT Edge Hub.
@@ -144,7 +215,7 @@ class GenericIoTHubClient(AbstractIoTHubClient):
         logger.info("Received method request")
         return method_request
 
-    def send_method_response(self, method_response):
+    def send_method_response(self, method_response, timeout=None):
         """Send a response to a method request via the Azure IoT Hub or Azure IoT Edge Hub.
 
         This is a synchronous event, meaning that this function will not return until the event
@@ -155,18 +226,19 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         :param method_response: The MethodResponse to send.
         :type method_response: MethodResponse
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Sending method response to Hub...")
-        send_complete = threading.Event()
-
-        def callback():
-            send_complete.set()
-            logger.info("Successfully sent method response to Hub")
+        callback = EventedCallback()
+        self._iothub_pipeline.send_method_response(
+            method_response, callback=callback, timeout=timeout
+        )
+        callback.wait_for_completion()
 
-        self._iothub_pipeline.send_method_response(method_response, callback=callback)
-        send_complete.wait()
+        logger.info("Successfully sent method response to Hub")
 
-    def _enable_feature(self, feature_name):
+    def _enable_feature(self, feature_name, timeout=None):
         """Enable an Azure IoT Hub feature.
 
         This is a synchronous call, meaning that this function will not return until the feature
@@ -174,46 +246,40 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         :param feature_name: The name of the feature to enable.
         See azure.iot.device.common.pipeline.constant for possible values
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         logger.info("Enabling feature:" + feature_name + "...")
-        enable_complete = threading.Event()
-
-        def callback():
-            enable_complete.set()
-            logger.info("Successfully enabled feature:" + feature_name)
+        callback = EventedCallback()
+        self._iothub_pipeline.enable_feature(feature_name, callback=callback, timeout=timeout)
+        callback.wait_for_completion()
 
-        self._iothub_pipeline.enable_feature(feature_name, callback=callback)
-        enable_complete.wait()
+        logger.info("Successfully enabled feature:" + feature_name)
 
-    def get_twin(self):
+    def get_twin(self, timeout=None):
         """
         Gets the device or module twin from the Azure IoT Hub or Azure IoT Edge Hub service.
 
         This is a synchronous call, meaning that this function will not return until the twin
         has been retrieved from the service.
 
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.  If the twin feature has to be enabled first, enabling it gets the same
+        timeout.
+
         :returns: Twin object which was retrieved from the hub
         """
         if not self._iothub_pipeline.feature_enabled[constant.TWIN]:
-            self._enable_feature(constant.TWIN)
-
-        # hack to work aroud lack of the "nonlocal" keyword in 2.7.  The non-local "context"
-        # object can be read and modified inside the inner function.
-        # (https://stackoverflow.com/a/28433571)
-        class context:
-            twin = None
-
-        op_complete = threading.Event()
+            self._enable_feature(constant.TWIN, timeout=timeout)
 
-        def on_pipeline_op_complete(retrieved_twin):
-            context.twin = retrieved_twin
-            op_complete.set()
+        callback = EventedCallback()
+        self._iothub_pipeline.get_twin(callback=callback, timeout=timeout)
+        twin = callback.wait_for_completion()
 
-        self._iothub_pipeline.get_twin(callback=on_pipeline_op_complete)
-        op_complete.wait()
-        return context.twin
+        logger.info("Successfully retrieved twin")
+        return twin
 
-    def patch_twin_reported_properties(self, reported_properties_patch):
+    def patch_twin_reported_properties(self, reported_properties_patch, timeout=None):
         """
         Update reported properties with the Azure IoT Hub or Azure IoT Edge Hub service.
 
@@ -225,20 +291,19 @@ class GenericIoTHubClient(AbstractIoTHubClient):
 
         :param reported_properties_patch:
         :type reported_properties_patch: dict, str, int, float, bool, or None (JSON compatible values)
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.  If the twin feature has to be enabled first, enabling it gets the same
+        timeout.
         """
         if not self._iothub_pipeline.feature_enabled[constant.TWIN]:
-            self._enable_feature(constant.TWIN)
-
-        op_complete = threading.Event()
-
-        def on_pipeline_op_complete():
-            op_complete.set()
+            self._enable_feature(constant.TWIN, timeout=timeout)
 
+        callback = EventedCallback()
         self._iothub_pipeline.patch_twin_reported_properties(
-            patch=reported_properties_patch, callback=on_pipeline_op_complete
+            patch=reported_properties_patch, callback=callback, timeout=timeout
         )
-        op_complete.wait()
-        print("Done with patch")
+        callback.wait_for_completion()
+        logger.info("Successfully sent twin patch")
 
     def receive_twin_desired_properties_patch(self, block=True, timeout=None):
         """
@@ -335,7 +400,7 @@ class IoTHubModuleClient(GenericIoTHubClient, AbstractIoTHubModuleClient):
         )
         self._iothub_pipeline.on_input_message_received = self._inbox_manager.route_input_message
 
-    def send_to_output(self, message, output_name):
+    def send_to_output(self, message, output_name, timeout=None):
         """Sends an event/message to the given module output.
 
         These are outgoing events and are meant to be "output events".
@@ -349,20 +414,47 @@ class IoTHubModuleClient(GenericIoTHubClient, AbstractIoTHubModuleClient):
         :param message: message to send to the given output. Anything passed that is not an instance of the
         Message class will be converted to Message object.
         :param output_name: Name of the output to send the event to.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
         """
         if not isinstance(message, Message):
             message = Message(message)
         message.output_name = output_name
 
         logger.info("Sending message to output:" + output_name + "...")
-        send_complete = threading.Event()
+        callback = EventedCallback()
+        self._iothub_pipeline.send_output_event(message, callback=callback, timeout=timeout)
+        callback.wait_for_completion()
+
+        logger.info("Successfully sent message to output: " + output_name)
 
-        def callback():
-            logger.info("Successfully sent message to output: " + output_name)
-            send_complete.set()
+    def send_to_output_nowait(self, message, output_name, timeout=None):
+        """Sends an event/message to the given module output, without waiting for the service to
+        acknowledge it.
+
+        This function returns as soon as the message has been handed to the pipeline.  The Future it
+        returns completes when the service has acknowledged receipt of the message, or fails with
+        the error that caused the send to fail.
+
+        If the publish queue is full, this function either blocks until there is room in the queue
+        or raises a PipelineQueueFullError, depending on the queue_full_policy of the pipeline.
+
+        :param message: message to send to the given output. Anything passed that is not an instance of the
+        Message class will be converted to Message object.
+        :param output_name: Name of the output to send the event to.
+        :param float timeout: Optionally provide a number of seconds after which the operation fails
+        with a TimeoutError.
+
+        :returns: A concurrent.futures.Future whose result is None once the message has been sent.
+        """
+        if not isinstance(message, Message):
+            message = Message(message)
+        message.output_name = output_name
 
-        self._iothub_pipeline.send_output_event(message, callback=callback)
-        send_complete.wait()
+        logger.info("Sending message to output without waiting:" + output_name + "...")
+        callback = FutureCallback()
+        self._iothub_pipeline.send_output_event(message, callback=callback, timeout=timeout)
+        return callback.future
 
     def receive_input_message(self, input_name, block=True, timeout=None):
         """Receive an input message that has been sent from another Module to a specific input.
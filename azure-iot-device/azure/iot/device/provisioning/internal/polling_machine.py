@@ -113,7 +113,7 @@ class PollingMachine(object):
             },
             {
                 "trigger": "_trig_error",
-                "source": ["registering", "waiting_to_poll", "polling"],
+                "source": ["initializing", "registering", "waiting_to_poll", "polling"],
                 "dest": "error",
                 "after": "_call_error",
             },
@@ -414,8 +414,12 @@ class PollingMachine(object):
 
         return RegistrationQueryStatusResult(request_id, retry_after, operation_id, status)
 
-    def _on_disconnect_completed_error(self):
+    def _on_disconnect_completed_error(self, error=None):
         logger.info("on_disconnect_completed for Device Provisioning Service")
+        if error:
+            logger.error(
+                "Error while disconnecting from Device Provisioning Service: {}".format(error)
+            )
         callback = self._register_callback
         if callback:
             self._register_callback = None
@@ -425,16 +429,24 @@ class PollingMachine(object):
                 logger.error("Unexpected error calling callback supplied to register")
                 logger.error(traceback.format_exc())
 
-    def _on_disconnect_completed_cancel(self):
+    def _on_disconnect_completed_cancel(self, error=None):
         logger.info("on_disconnect_completed after cancelling current Device Provisioning Service")
+        if error:
+            logger.error(
+                "Error while disconnecting from Device Provisioning Service: {}".format(error)
+            )
         callback = self._cancel_callback
 
         if callback:
             self._cancel_callback = None
             callback()
 
-    def _on_disconnect_completed_register(self):
+    def _on_disconnect_completed_register(self, error=None):
         logger.info("on_disconnect_completed after registration to Device Provisioning Service")
+        if error:
+            logger.error(
+                "Error while disconnecting from Device Provisioning Service: {}".format(error)
+            )
         callback = self._register_callback
 
         if callback:
@@ -445,6 +457,13 @@ class PollingMachine(object):
                 logger.error("Unexpected error calling callback supplied to register")
                 logger.error(traceback.format_exc())
 
-    def _on_subscribe_completed(self):
+    def _on_subscribe_completed(self, error=None):
+        if error:
+            logger.error(
+                "Unable to subscribe to Device Provisioning Service responses: {}".format(error)
+            )
+            self._registration_error = error
+            self._trig_error()
+            return
         logger.info("on_subscribe_completed for Device Provisioning Service")
         self._trig_send_register_request()
@@ -91,11 +91,20 @@ class RequestResponseProvider(object):
         """Handler to be called by the pipeline upon a connection state change."""
         logger.info("Connection State - {}".format(new_state))
 
-    def _on_publish_completed(self):
-        logger.info("publish completed for request response provider")
-
-    def _on_subscribe_completed(self):
-        logger.info("subscribe completed for request response provider")
-
-    def _on_unsubscribe_completed(self):
-        logger.info("on_unsubscribe_completed for request response provider")
+    def _on_publish_completed(self, error=None):
+        if error:
+            logger.error("publish failed for request response provider: {}".format(error))
+        else:
+            logger.info("publish completed for request response provider")
+
+    def _on_subscribe_completed(self, error=None):
+        if error:
+            logger.error("subscribe failed for request response provider: {}".format(error))
+        else:
+            logger.info("subscribe completed for request response provider")
+
+    def _on_unsubscribe_completed(self, error=None):
+        if error:
+            logger.error("unsubscribe failed for request response provider: {}".format(error))
+        else:
+            logger.info("on_unsubscribe_completed for request response provider")
@@ -11,6 +11,8 @@ class RegistrationResponseEvent(PipelineEvent):
     created by some converter stage based on a pipeline-specific event
     """
 
+    __slots__ = ("request_id", "status_code", "key_values", "response_payload")
+
     def __init__(self, request_id, status_code, key_values, response_payload):
         """
         Initializer for RegistrationResponse objects.
@@ -5,6 +5,7 @@
 # --------------------------------------------------------------------------
 
 import logging
+from azure.iot.device.common import unhandled_exceptions
 from azure.iot.device.common.pipeline import pipeline_stages_base
 from azure.iot.device.common.pipeline import pipeline_ops_base
 from azure.iot.device.common.pipeline import pipeline_stages_mqtt
@@ -20,6 +21,13 @@ logger = logging.getLogger(__name__)
 
 
 class ProvisioningPipeline(object):
+    """
+    Adapter between the provisioning client and the pipeline.
+
+    When an operation fails, its callback is called with a single keyword argument, error, which
+    contains the cause of the failure.
+    """
+
     def __init__(self, security_client):
         """
         Constructor for instantiating a pipeline
@@ -93,9 +101,11 @@ class ProvisioningPipeline(object):
 
         def pipeline_callback(call):
             if call.error:
-                # TODO we need error semantics on the client
-                exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
         self._pipeline.run_op(pipeline_ops_base.ConnectOperation(callback=pipeline_callback))
@@ -110,9 +120,11 @@ class ProvisioningPipeline(object):
 
         def pipeline_callback(call):
             if call.error:
-                # TODO we need error semantics on the client
-                exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
         self._pipeline.run_op(pipeline_ops_base.DisconnectOperation(callback=pipeline_callback))
@@ -128,9 +140,11 @@ class ProvisioningPipeline(object):
 
         def pipeline_callback(call):
             if call.error:
-                # TODO we need error semantics on the client
-                exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
         op = None
@@ -158,9 +172,11 @@ class ProvisioningPipeline(object):
 
         def pipeline_callback(call):
             if call.error:
-                # TODO we need error semantics on the client
-                exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
         self._pipeline.run_op(
@@ -177,9 +193,11 @@ class ProvisioningPipeline(object):
 
         def pipeline_callback(call):
             if call.error:
-                # TODO we need error semantics on the client
-                exit(1)
-            if callback:
+                if callback:
+                    callback(error=call.error)
+                else:
+                    unhandled_exceptions.exception_caught_in_background_thread(call.error)
+            elif callback:
                 callback()
 
         self._pipeline.run_op(
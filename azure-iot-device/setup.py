@@ -68,7 +68,14 @@ setup(
         "janus>=0.4.0,<1.0.0;python_version>='3.5'",
         "futures;python_version == '2.7'",
     ],
-    extras_require={":python_version<'3.0'": ["azure-iot-nspkg>=1.0.1"]},
+    extras_require={
+        ":python_version<'3.0'": ["azure-iot-nspkg>=1.0.1"],
+        # zstd payload compression
+        "zstd": ["zstandard"],
+        # Faster JSON for twins and method payloads
+        "orjson": ["orjson;python_version>='3.6'"],
+        "ujson": ["ujson"],
+    },
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3*, <4",
     packages=find_packages(
         exclude=[
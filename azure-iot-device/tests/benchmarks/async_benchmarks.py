@@ -0,0 +1,123 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the benchmarks for the asynchronous clients.  It requires Python 3.5+."""
+
+import asyncio
+import threading
+from azure.iot.device.aio import IoTHubDeviceClient
+from . import harness
+from .sync_benchmarks import connection_string, create_client, make_message
+
+
+async def time_operations(name, operation, iterations, warmup=0, params=None):
+    """
+    Await operation() iterations times and time every call.  See harness.time_operations.
+    """
+    for _ in range(warmup):
+        await operation()
+    latencies = []
+    start = harness.timer()
+    for _ in range(iterations):
+        operation_start = harness.timer()
+        await operation()
+        latencies.append(harness.timer() - operation_start)
+    return harness.make_result(
+        name, iterations, harness.timer() - start, latencies=latencies, params=params
+    )
+
+
+async def shutdown_client(client):
+    await client.disconnect()
+    client._iothub_pipeline._pipeline.transport.stop()
+
+
+async def bench_connect(iterations, latency, payload_size):
+    client = create_client(IoTHubDeviceClient, connection_string, latency)
+    latencies = []
+    start = harness.timer()
+    for _ in range(iterations):
+        connect_start = harness.timer()
+        await client.connect()
+        latencies.append(harness.timer() - connect_start)
+        await client.disconnect()
+    total = harness.timer() - start
+    await shutdown_client(client)
+    return [
+        harness.make_result(
+            "connect_async", iterations, total, latencies=latencies, params={"latency": latency}
+        )
+    ]
+
+
+async def bench_d2c_send(iterations, latency, payload_size):
+    results = []
+    # The default pipeline threads, and the pipeline running on the client's own event loop
+    for scope, prefix in (("global", "d2c_send"), ("event_loop", "d2c_send_event_loop")):
+        client = create_client(IoTHubDeviceClient, connection_string, latency, executor_scope=scope)
+        await client.connect()
+        params = {"latency": latency, "payload_size": payload_size, "executor_scope": scope}
+        results.append(
+            await time_operations(
+                prefix + "_async",
+                lambda: client.send_d2c_message(make_message(payload_size)),
+                iterations,
+                warmup=min(iterations, 10),
+                params=params,
+            )
+        )
+
+        # Many sends in flight at once, which is how an async application would send a burst
+        messages = [make_message(payload_size) for _ in range(iterations)]
+        start = harness.timer()
+        await asyncio.gather(*[client.send_d2c_message(message) for message in messages])
+        total = harness.timer() - start
+        # Executor threads stay alive once they're started, so this counts every thread the sends
+        # needed
+        concurrent_params = dict(params, threads=threading.active_count())
+        results.append(
+            harness.make_result(
+                prefix + "_concurrent_async", iterations, total, params=concurrent_params
+            )
+        )
+
+        await shutdown_client(client)
+    return results
+
+
+async def bench_twin(iterations, latency, payload_size):
+    client = create_client(IoTHubDeviceClient, connection_string, latency)
+    await client.connect()
+    params = {"latency": latency}
+    results = [
+        await time_operations(
+            "twin_get_async", client.get_twin, iterations, warmup=min(iterations, 10), params=params
+        ),
+        await time_operations(
+            "twin_patch_async",
+            lambda: client.patch_twin_reported_properties({"status": "ok", "count": 1}),
+            iterations,
+            warmup=min(iterations, 10),
+            params=params,
+        ),
+    ]
+    await shutdown_client(client)
+    return results
+
+
+benchmarks = [bench_connect, bench_d2c_send, bench_twin]
+
+
+def run(benchmark, iterations, latency, payload_size):
+    """
+    Run an async benchmark to completion on a new event loop.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(benchmark(iterations, latency, payload_size))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
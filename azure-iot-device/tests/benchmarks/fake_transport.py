@@ -0,0 +1,160 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains an in-memory replacement for MQTTTransport.  It acknowledges every
+operation from its own "network" thread, like paho does, and answers twin requests, so that the
+cost of the pipeline can be measured without a socket, TLS or a broker getting in the way.
+"""
+
+import contextlib
+import heapq
+import itertools
+import json
+import threading
+import timeit
+from azure.iot.device.common.pipeline import pipeline_stages_mqtt
+from azure.iot.device.iothub.pipeline import mqtt_topic_iothub
+
+_TWIN_GET_PREFIX = "$iothub/twin/GET/"
+_TWIN_PATCH_PREFIX = "$iothub/twin/PATCH/properties/reported/"
+_TWIN_RESPONSE_TOPIC = "$iothub/twin/res/{status}/?$rid={request_id}"
+_FAKE_TWIN = {"desired": {"$version": 1}, "reported": {"$version": 1}}
+
+
+class FakeMQTTTransport(object):
+    """
+    Stand-in for MQTTTransport which never touches the network.
+
+    :ivar float latency: The delay, in seconds, between a request and its acknowledgement.
+    :ivar list published: Every (topic, payload) tuple published, if record_publishes is set.
+    """
+
+    latency = 0.0
+    record_publishes = False
+
+    def __init__(
+        self,
+        client_id,
+        hostname,
+        username,
+        ca_cert=None,
+        x509_cert=None,
+        port=None,
+        ack_timeout=None,
+    ):
+        self._client_id = client_id
+        self._hostname = hostname
+        self._username = username
+        self.published = []
+        self.tls_session_reused = False
+
+        self.on_mqtt_connected_handler = None
+        self.on_mqtt_disconnected_handler = None
+        self.on_mqtt_message_received_handler = None
+        self.on_mqtt_connection_failure_handler = None
+
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._running = True
+        self._thread = threading.Thread(target=self._network_loop, name="fake-transport")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _network_loop(self):
+        while True:
+            with self._condition:
+                while self._running and (
+                    not self._queue or self._queue[0][0] > timeit.default_timer()
+                ):
+                    if self._queue:
+                        self._condition.wait(self._queue[0][0] - timeit.default_timer())
+                    else:
+                        self._condition.wait()
+                if not self._running:
+                    return
+                _, _, fn, args = heapq.heappop(self._queue)
+            fn(*args)
+
+    def _schedule(self, fn, *args):
+        if fn is None:
+            return
+        with self._condition:
+            due = timeit.default_timer() + self.latency
+            heapq.heappush(self._queue, (due, next(self._sequence), fn, args))
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Stop the network thread.  Anything which has not been acknowledged yet is dropped.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def set_max_inflight_messages(self, max_inflight_messages):
+        pass
+
+    def connect(self, password=None):
+        self._schedule(self.on_mqtt_connected_handler)
+
+    def reconnect(self, password=None):
+        self._schedule(self.on_mqtt_connected_handler)
+
+    def disconnect(self):
+        self._schedule(self.on_mqtt_disconnected_handler)
+
+    def subscribe(self, topic, qos=1, callback=None):
+        self._schedule(callback)
+
+    def unsubscribe(self, topic, callback=None):
+        self._schedule(callback)
+
+    def publish(self, topic, payload, qos=1, callback=None):
+        if self.record_publishes:
+            self.published.append((topic, payload))
+        self._schedule(callback)
+        if topic.startswith(_TWIN_GET_PREFIX):
+            self._respond_to_twin_request(topic, 200, json.dumps(_FAKE_TWIN))
+        elif topic.startswith(_TWIN_PATCH_PREFIX):
+            self._respond_to_twin_request(topic, 204, "")
+
+    def _respond_to_twin_request(self, topic, status, body):
+        request_id = mqtt_topic_iothub._extract_properties(topic.split("?")[1])["rid"]
+        self.deliver_message(
+            _TWIN_RESPONSE_TOPIC.format(status=status, request_id=request_id),
+            body.encode("utf-8"),
+        )
+
+    def deliver_message(self, topic, payload):
+        """
+        Deliver an incoming message to the pipeline, as if it arrived from the hub.
+        """
+        self._schedule(self.on_mqtt_message_received_handler, topic, payload)
+
+
+@contextlib.contextmanager
+def fake_transport(latency=0.0, record_publishes=False):
+    """
+    Make every pipeline created inside the block use a FakeMQTTTransport instead of an
+    MQTTTransport.  Clients keep using the fake transport after the block is left.
+
+    :param float latency: The delay, in seconds, between a request and its acknowledgement.
+    :param bool record_publishes: Whether to keep every published (topic, payload) tuple.
+    """
+
+    class ConfiguredFakeMQTTTransport(FakeMQTTTransport):
+        pass
+
+    ConfiguredFakeMQTTTransport.latency = latency
+    ConfiguredFakeMQTTTransport.record_publishes = record_publishes
+
+    original = pipeline_stages_mqtt.MQTTTransport
+    pipeline_stages_mqtt.MQTTTransport = ConfiguredFakeMQTTTransport
+    try:
+        yield
+    finally:
+        pipeline_stages_mqtt.MQTTTransport = original
@@ -0,0 +1,162 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the helpers used to time benchmarks and to report their results."""
+
+import datetime
+import math
+import platform
+import sys
+import timeit
+from azure.iot.device.constant import VERSION
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.7 doesn't have tracemalloc, so memory can't be measured there
+    tracemalloc = None
+
+timer = timeit.default_timer
+
+# Bump this whenever the layout of the results changes in a way that breaks consumers
+SCHEMA_VERSION = 1
+
+
+def _percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarize_latencies(latencies):
+    """
+    :param list latencies: The duration of every operation, in seconds.
+    :returns: A dict with the min, mean, median, p90, p99 and max of the latencies, in seconds.
+    """
+    values = sorted(latencies)
+    return {
+        "min": values[0],
+        "mean": sum(values) / len(values),
+        "median": _percentile(values, 50),
+        "p90": _percentile(values, 90),
+        "p99": _percentile(values, 99),
+        "max": values[-1],
+    }
+
+
+def make_result(
+    name, operations, total_seconds, latencies=None, params=None, bytes_per_operation=None
+):
+    """
+    Build the result of a single benchmark.
+
+    :param str name: The name of the benchmark.
+    :param int operations: The number of operations which were completed.
+    :param float total_seconds: The wall clock time it took to complete all of the operations.
+    :param list latencies: (Optional) The duration of every operation, in seconds.
+    :param dict params: (Optional) The parameters the benchmark was run with.
+    :param float bytes_per_operation: (Optional) The memory held on to by each operation.
+    """
+    return {
+        "name": name,
+        "operations": operations,
+        "total_seconds": total_seconds,
+        "ops_per_second": operations / total_seconds if total_seconds else None,
+        "latency_seconds": summarize_latencies(latencies) if latencies else None,
+        "bytes_per_operation": bytes_per_operation,
+        "params": params or {},
+    }
+
+
+def time_operations(name, operation, iterations, warmup=0, params=None):
+    """
+    Call operation iterations times and time every call.
+
+    :param str name: The name of the benchmark.
+    :param operation: A function which performs a single operation.
+    :param int iterations: The number of operations to time.
+    :param int warmup: The number of operations to perform before timing starts.
+    :param dict params: (Optional) The parameters the benchmark was run with.
+    """
+    for _ in range(warmup):
+        operation()
+    latencies = []
+    start = timer()
+    for _ in range(iterations):
+        operation_start = timer()
+        operation()
+        latencies.append(timer() - operation_start)
+    return make_result(name, iterations, timer() - start, latencies=latencies, params=params)
+
+
+def time_loop(name, function, iterations, repeat=5, params=None):
+    """
+    Time a tight loop of calls to a cheap function.  Timing every call would cost more than the
+    call itself, so only the loop is timed.  The loop runs repeat times and the fastest run is
+    reported, since the slower runs only measure interference from the rest of the system.
+
+    :param str name: The name of the benchmark.
+    :param function: A function which performs a single operation.
+    :param int iterations: The number of calls in each loop.
+    :param int repeat: The number of times to run the loop.
+    :param dict params: (Optional) The parameters the benchmark was run with.
+    """
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        for _ in range(iterations):
+            function()
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    params = dict(params or {}, repeat=repeat)
+    return make_result(name, iterations, best, params=params)
+
+
+def measure_memory(name, make_object, count, params=None):
+    """
+    Create count objects, keep all of them alive, and measure how much memory each one holds on
+    to, like a queue or inbox full of them would.  Memory is only measured where tracemalloc is
+    available; elsewhere bytes_per_operation is None.
+
+    :param str name: The name of the benchmark.
+    :param make_object: A function which returns a new object.
+    :param int count: The number of objects to create.
+    :param dict params: (Optional) The parameters the benchmark was run with.
+    """
+    started_tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0] if tracemalloc else None
+        start = timer()
+        objects = [make_object() for _ in range(count)]
+        elapsed = timer() - start
+        after = tracemalloc.get_traced_memory()[0] if tracemalloc else None
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    bytes_per_operation = (after - before) / float(len(objects)) if tracemalloc else None
+    return make_result(name, count, elapsed, params=params, bytes_per_operation=bytes_per_operation)
+
+
+def make_report(results):
+    """
+    Wrap benchmark results with a description of the environment they were measured in.
+    """
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+        "environment": {
+            "sdk_version": VERSION,
+            "python_version": platform.python_version(),
+            "python_implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "argv": sys.argv,
+        },
+        "results": results,
+    }
@@ -0,0 +1,108 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""Run the benchmarks and write the results as JSON.
+
+Run from the azure-iot-device directory:
+
+    python -m tests.benchmarks --iterations 1000 --output results.json
+"""
+
+import argparse
+import json
+import logging
+import sys
+from . import harness, sync_benchmarks
+
+if sys.version_info >= (3, 5):
+    from . import async_benchmarks
+else:
+    async_benchmarks = None
+
+
+def _named_benchmarks():
+    benchmarks = [
+        (benchmark.__name__[len("bench_") :] + "_sync", benchmark, False)
+        for benchmark in sync_benchmarks.benchmarks
+    ]
+    if async_benchmarks:
+        benchmarks += [
+            (benchmark.__name__[len("bench_") :] + "_async", benchmark, True)
+            for benchmark in async_benchmarks.benchmarks
+        ]
+    return benchmarks
+
+
+def run_benchmarks(iterations=1000, latency=0.0, payload_size=256, only=None):
+    """
+    Run the benchmarks and return a report of the results.
+
+    :param int iterations: The number of operations to time in each benchmark.
+    :param float latency: The simulated network round trip, in seconds.
+    :param int payload_size: The size of the telemetry payloads, in bytes.
+    :param list only: (Optional) Only run the benchmarks whose name contains one of these strings.
+
+    :returns: A dict which can be serialized as JSON.
+    """
+    results = []
+    for name, benchmark, is_async in _named_benchmarks():
+        if only and not any(pattern in name for pattern in only):
+            continue
+        if is_async:
+            results += async_benchmarks.run(benchmark, iterations, latency, payload_size)
+        else:
+            results += benchmark(iterations, latency, payload_size)
+    return harness.make_report(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the device client pipeline against an in-memory fake transport."
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=1000, help="operations to time in each benchmark"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="simulated network round trip in seconds (default: 0)",
+    )
+    parser.add_argument(
+        "--payload-size", type=int, default=256, help="telemetry payload size in bytes"
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        help="only run benchmarks whose name contains this string (can be repeated)",
+    )
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the warnings and errors logged by the SDK"
+    )
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        # Every disconnect is logged as an error, which would drown out the results
+        logging.getLogger("azure.iot.device").setLevel(logging.CRITICAL)
+
+    if args.list:
+        for name, _, _ in _named_benchmarks():
+            print(name)
+        return
+
+    report = run_benchmarks(
+        iterations=args.iterations,
+        latency=args.latency,
+        payload_size=args.payload_size,
+        only=args.only,
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,478 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the benchmarks for the synchronous clients and for the pipeline code which
+is shared by all clients.
+"""
+
+import base64
+import threading
+import time
+from concurrent import futures
+from azure.iot.device import IoTHubDeviceClient, Message, MessageTemplate
+from azure.iot.device.common.pipeline import (
+    callback_dispatcher,
+    pipeline_events_mqtt,
+    pipeline_instrumentation,
+    pipeline_stages_base,
+    pipeline_thread,
+)
+from azure.iot.device.iothub.pipeline import (
+    mqtt_topic_iothub,
+    pipeline_ops_iothub,
+    pipeline_stages_iothub_mqtt,
+    serializers,
+)
+from . import harness
+from .fake_transport import fake_transport
+
+device_id = "bench_device"
+module_id = "bench_module"
+shared_access_key = base64.b64encode(b"bench shared access key").decode("utf-8")
+connection_string = "HostName=bench.azure-devices.net;DeviceId={};SharedAccessKey={}".format(
+    device_id, shared_access_key
+)
+
+# Topics of the incoming messages used by the dispatch benchmarks, along with their payloads
+incoming_messages = {
+    "c2d": (
+        "devices/{}/messages/devicebound/%24.mid=mid&%24.cid=cid&key=value".format(device_id),
+        b"c2d payload",
+    ),
+    "input": (
+        "devices/{}/modules/{}/inputs/input1/%24.mid=mid&key=value".format(device_id, module_id),
+        b"input payload",
+    ),
+    "method": ("$iothub/methods/POST/reboot/?$rid=1", b'{"delay": 1}'),
+    "twin_patch": ("$iothub/twin/PATCH/properties/desired/?$version=2", b'{"interval": 5}'),
+}
+
+
+def make_message(payload_size, payload=None):
+    """
+    Create a telemetry message with a few system and custom properties, like a typical device
+    would send.
+    """
+    if payload is None:
+        payload = "x" * payload_size
+    message = Message(payload, message_id="mid", content_type="application/json")
+    message.custom_properties["temperature_alert"] = "false"
+    message.custom_properties["sensor"] = "sensor 1"
+    return message
+
+
+def create_client(client_class, connection_string, latency, **kwargs):
+    with fake_transport(latency=latency):
+        return client_class.create_from_connection_string(connection_string, **kwargs)
+
+
+def shutdown_client(client):
+    client.disconnect()
+    client._iothub_pipeline._pipeline.transport.stop()
+
+
+def bench_connect(iterations, latency, payload_size):
+    client = create_client(IoTHubDeviceClient, connection_string, latency)
+    latencies = []
+    start = harness.timer()
+    for _ in range(iterations):
+        connect_start = harness.timer()
+        client.connect()
+        latencies.append(harness.timer() - connect_start)
+        client.disconnect()
+    total = harness.timer() - start
+    shutdown_client(client)
+    return [
+        harness.make_result(
+            "connect_sync", iterations, total, latencies=latencies, params={"latency": latency}
+        )
+    ]
+
+
+def bench_d2c_send(iterations, latency, payload_size):
+    client = create_client(IoTHubDeviceClient, connection_string, latency)
+    client.connect()
+    params = {"latency": latency, "payload_size": payload_size}
+    results = [
+        harness.time_operations(
+            "d2c_send_sync",
+            lambda: client.send_d2c_message(make_message(payload_size)),
+            iterations,
+            warmup=min(iterations, 10),
+            params=params,
+        )
+    ]
+
+    batch_size = min(iterations, 100)
+    batch_count = max(iterations // batch_size, 1)
+    batch_latencies = []
+    start = harness.timer()
+    for _ in range(batch_count):
+        messages = [make_message(payload_size) for _ in range(batch_size)]
+        batch_start = harness.timer()
+        client.send_d2c_messages(messages)
+        batch_latencies.append(harness.timer() - batch_start)
+    results.append(
+        harness.make_result(
+            "d2c_send_batch_sync",
+            batch_count * batch_size,
+            harness.timer() - start,
+            latencies=batch_latencies,
+            params=dict(params, batch_size=batch_size),
+        )
+    )
+
+    # Every message in flight at once from this thread, waited for in bulk
+    messages = [make_message(payload_size) for _ in range(iterations)]
+    start = harness.timer()
+    futures.wait([client.send_d2c_message_nowait(message) for message in messages])
+    results.append(
+        harness.make_result(
+            "d2c_send_nowait_sync", iterations, harness.timer() - start, params=params
+        )
+    )
+
+    shutdown_client(client)
+    return results
+
+
+def bench_twin(iterations, latency, payload_size):
+    client = create_client(IoTHubDeviceClient, connection_string, latency)
+    client.connect()
+    params = {"latency": latency}
+    results = [
+        harness.time_operations(
+            "twin_get_sync", client.get_twin, iterations, warmup=min(iterations, 10), params=params
+        ),
+        harness.time_operations(
+            "twin_patch_sync",
+            lambda: client.patch_twin_reported_properties({"status": "ok", "count": 1}),
+            iterations,
+            warmup=min(iterations, 10),
+            params=params,
+        ),
+    ]
+    shutdown_client(client)
+    return results
+
+
+def _dispatch_incoming_messages(kind, iterations):
+    """
+    Push incoming MQTT messages through IoTHubMQTTConverterStage and time how long it takes until
+    the resulting events are handed to the event handler on the callback thread.
+    """
+    root = pipeline_stages_base.PipelineRootStage().append_stage(
+        pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage()
+    )
+    converter = root.next
+    converter.device_id = device_id
+    converter.module_id = module_id
+
+    done = threading.Event()
+    received = [0]
+
+    def on_pipeline_event(event):
+        received[0] += 1
+        if received[0] == iterations:
+            done.set()
+
+    root.on_pipeline_event_handler = on_pipeline_event
+
+    topic, payload = incoming_messages[kind]
+
+    @pipeline_thread.invoke_on_pipeline_thread
+    def dispatch():
+        for _ in range(iterations):
+            converter.handle_pipeline_event(
+                pipeline_events_mqtt.IncomingMQTTMessageEvent(topic=topic, payload=payload)
+            )
+
+    start = harness.timer()
+    dispatch()
+    done.wait()
+    return harness.make_result(
+        "incoming_{}_dispatch".format(kind), iterations, harness.timer() - start
+    )
+
+
+def bench_incoming_dispatch(iterations, latency, payload_size):
+    return [_dispatch_incoming_messages(kind, iterations) for kind in sorted(incoming_messages)]
+
+
+def bench_topic_properties(iterations, latency, payload_size):
+    message = make_message(payload_size)
+    template = MessageTemplate(
+        content_type=message.content_type, custom_properties=message.custom_properties
+    )
+    templated_message = template.create_message(message.data, message_id=message.message_id)
+    telemetry_topic = mqtt_topic_iothub.get_telemetry_topic_for_publish(device_id, None)
+    c2d_topic = incoming_messages["c2d"][0]
+    received = Message(b"")
+    # These are cheap enough for the loop overhead to matter, so they run more often
+    loop_iterations = iterations * 10
+    return [
+        harness.time_loop(
+            "encode_properties",
+            lambda: mqtt_topic_iothub.encode_properties(message, telemetry_topic),
+            loop_iterations,
+        ),
+        harness.time_loop(
+            "encode_properties_templated",
+            lambda: mqtt_topic_iothub.encode_properties(templated_message, telemetry_topic),
+            loop_iterations,
+        ),
+        harness.time_loop(
+            "extract_properties_from_topic",
+            lambda: mqtt_topic_iothub.extract_properties_from_topic(c2d_topic, received),
+            loop_iterations,
+        ),
+    ]
+
+
+def bench_message_memory(iterations, latency, payload_size):
+    # Every object shares one payload, so that only the per-message overhead is measured
+    payload = b"x" * payload_size
+    c2d_topic = incoming_messages["c2d"][0]
+    params = {"payload_size": payload_size}
+
+    def make_queued_message():
+        return pipeline_ops_iothub.SendD2CMessageOperation(
+            message=make_message(payload_size, payload), callback=shutdown_client
+        )
+
+    def make_received_message():
+        message = Message(payload)
+        mqtt_topic_iothub.extract_properties_from_topic(c2d_topic, message)
+        return message
+
+    # Small counts are dominated by allocator noise, so always measure a decent number
+    count = max(iterations, 1000)
+    return [
+        harness.measure_memory("queued_d2c_message_memory", make_queued_message, count, params),
+        harness.measure_memory("received_c2d_message_memory", make_received_message, count, params),
+    ]
+
+
+def make_large_twin(device_count):
+    """
+    Make a twin like the ones gateways keep the settings of their downstream devices in.  Each
+    device adds roughly 170 bytes to the JSON document.
+    """
+    devices = {}
+    for i in range(device_count):
+        devices["device{:05d}".format(i)] = {
+            "enabled": i % 3 != 0,
+            "interval": 30 + i % 60,
+            "threshold": 21.5 + i / 100.0,
+            "tags": ["building-{}".format(i % 10), "floor-{}".format(i % 7)],
+            "firmware": {"version": "1.{}.{}".format(i % 5, i % 11), "url": "https://example/fw"},
+        }
+    return {
+        "desired": {"devices": devices, "$version": 42},
+        "reported": {"devices": {"count": device_count}, "$version": 7},
+    }
+
+
+def bench_serializers(iterations, latency, payload_size):
+    twin = make_large_twin(2000)
+    encoded_twin = serializers.standard_serializer.dumps(twin).encode("utf-8")
+    # Each operation handles a few hundred KB, so fewer of them are needed
+    loop_iterations = max(iterations // 50, min(iterations, 10))
+    results = []
+    for name in (serializers.JSON, serializers.ORJSON, serializers.UJSON):
+        if not serializers.is_available(name):
+            continue
+        serializer = serializers.Serializer(name)
+        params = {"serializer": name, "twin_bytes": len(encoded_twin)}
+        results.append(
+            harness.time_loop(
+                "large_twin_loads_{}".format(name),
+                lambda: serializer.loads(encoded_twin),
+                loop_iterations,
+                params=params,
+            )
+        )
+        results.append(
+            harness.time_loop(
+                "large_twin_dumps_{}".format(name),
+                lambda: serializer.dumps(twin),
+                loop_iterations,
+                params=params,
+            )
+        )
+    return results
+
+
+def _dispatch_to_clients(scope, client_count, messages_per_client, handler_seconds):
+    """
+    Push incoming C2D messages through the pipelines of client_count clients at once, and time
+    how long it takes until every handler has returned.  Each handler blocks for handler_seconds,
+    like one which writes the message to a database or forwards it over the network would.
+    """
+    done = threading.Event()
+    remaining = [client_count * messages_per_client]
+    lock = threading.Lock()
+
+    def on_pipeline_event(event):
+        time.sleep(handler_seconds)
+        with lock:
+            remaining[0] -= 1
+            if not remaining[0]:
+                done.set()
+
+    converters = []
+    for i in range(client_count):
+        executors = pipeline_thread.get_executors(scope, key="{}{}".format(device_id, i))
+        root = pipeline_stages_base.PipelineRootStage(executors=executors).append_stage(
+            pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage()
+        )
+        root.on_pipeline_event_handler = on_pipeline_event
+        root.next.device_id = device_id
+        converters.append(root.next)
+
+    topic, payload = incoming_messages["c2d"]
+
+    def dispatch(converter):
+        for _ in range(messages_per_client):
+            converter.handle_pipeline_event(
+                pipeline_events_mqtt.IncomingMQTTMessageEvent(topic=topic, payload=payload)
+            )
+
+    start = harness.timer()
+    for converter in converters:
+        pipeline_thread.invoke_on_pipeline_thread_nowait(
+            dispatch, executors=converter.pipeline_root.executors
+        )(converter)
+    done.wait()
+    return harness.make_result(
+        "client_scaling_{}_{}".format(scope, client_count),
+        client_count * messages_per_client,
+        harness.timer() - start,
+        params={
+            "scope": scope,
+            "clients": client_count,
+            "handler_seconds": handler_seconds,
+            "shards": pipeline_thread.DEFAULT_SHARD_COUNT,
+        },
+    )
+
+
+def bench_client_scaling(iterations, latency, payload_size):
+    # Every message costs a millisecond in its handler, so fewer of them are needed
+    messages_per_client = max(iterations // 20, min(iterations, 10))
+    return [
+        _dispatch_to_clients(scope, client_count, messages_per_client, 0.001)
+        for scope in (
+            pipeline_thread.SCOPE_GLOBAL,
+            pipeline_thread.SCOPE_SHARDED,
+            pipeline_thread.SCOPE_CLIENT,
+        )
+        for client_count in (1, 4, 16)
+    ]
+
+
+def bench_instrumentation(iterations, latency, payload_size):
+    instrumentation = pipeline_instrumentation.PipelineInstrumentation()
+    client = create_client(
+        IoTHubDeviceClient, connection_string, latency, instrumentation=instrumentation
+    )
+    client.connect()
+    result = harness.time_operations(
+        "d2c_send_instrumented_sync",
+        lambda: client.send_d2c_message(make_message(payload_size)),
+        iterations,
+        warmup=min(iterations, 10),
+        params={"latency": latency, "payload_size": payload_size},
+    )
+    shutdown_client(client)
+
+    # The mean time a send spent in each phase, and in each stage, to show where the time goes
+    stats = instrumentation.get_stats()
+    name = "SendD2CMessageOperation"
+    result["params"]["mean_seconds"] = dict(
+        (phase, stats[phase][name]["mean"])
+        for phase in (
+            pipeline_instrumentation.PHASE_PIPELINE_QUEUE,
+            pipeline_instrumentation.PHASE_CALLBACK_QUEUE,
+            pipeline_instrumentation.PHASE_END_TO_END,
+        )
+    )
+    result["params"]["mean_stage_seconds"] = dict(
+        (stage, by_name[name]["mean"])
+        for stage, by_name in stats[pipeline_instrumentation.PHASE_STAGE].items()
+        if name in by_name
+    )
+    return [result]
+
+
+def _send_behind_slow_callbacks(mode, iterations, latency, payload_size, callback_seconds):
+    """
+    Time sends from one client while another client, sharing the same threads, has a backlog of
+    sends whose done callbacks each block for callback_seconds.  With the callback thread, the
+    completions of the first client queue up behind those callbacks.
+    """
+    slow_client = create_client(
+        IoTHubDeviceClient,
+        connection_string.replace(device_id, device_id + "_slow"),
+        latency,
+        callback_dispatch=mode,
+    )
+    client = create_client(IoTHubDeviceClient, connection_string, latency, callback_dispatch=mode)
+    slow_client.connect()
+    client.connect()
+
+    def slow_callback(future):
+        time.sleep(callback_seconds)
+
+    backlog = []
+    for _ in range(iterations):
+        future = slow_client.send_d2c_message_nowait(make_message(payload_size))
+        future.add_done_callback(slow_callback)
+        backlog.append(future)
+
+    result = harness.time_operations(
+        "callback_hol_{}".format(mode),
+        lambda: client.send_d2c_message(make_message(payload_size)),
+        iterations,
+        params={
+            "latency": latency,
+            "callback_dispatch": mode,
+            "callback_seconds": callback_seconds,
+        },
+    )
+    dispatcher = slow_client._iothub_pipeline.callback_dispatcher
+    result["params"]["slow_client_callbacks"] = dispatcher.get_stats() if dispatcher else None
+
+    futures.wait(backlog)
+    shutdown_client(slow_client)
+    shutdown_client(client)
+    return result
+
+
+def bench_callback_head_of_line(iterations, latency, payload_size):
+    # Every slow callback costs 2 milliseconds, so fewer of them are needed
+    count = max(iterations // 20, min(iterations, 10))
+    return [
+        _send_behind_slow_callbacks(mode, count, latency, payload_size, 0.002)
+        for mode in (
+            callback_dispatcher.DISPATCH_THREAD,
+            callback_dispatcher.DISPATCH_POOL,
+            callback_dispatcher.DISPATCH_ORDERED,
+        )
+    ]
+
+
+benchmarks = [
+    bench_connect,
+    bench_d2c_send,
+    bench_twin,
+    bench_incoming_dispatch,
+    bench_topic_properties,
+    bench_message_memory,
+    bench_serializers,
+    bench_client_scaling,
+    bench_callback_head_of_line,
+    bench_instrumentation,
+]
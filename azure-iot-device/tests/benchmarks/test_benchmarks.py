@@ -0,0 +1,149 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import json
+import logging
+import sys
+import threading
+from tests.benchmarks import harness, run
+from tests.benchmarks.fake_transport import FakeMQTTTransport
+from azure.iot.device.iothub.pipeline import serializers
+
+logging.basicConfig(level=logging.INFO)
+
+expected_benchmarks = [
+    "connect_sync",
+    "d2c_send_sync",
+    "d2c_send_batch_sync",
+    "d2c_send_nowait_sync",
+    "twin_get_sync",
+    "twin_patch_sync",
+    "incoming_c2d_dispatch",
+    "incoming_input_dispatch",
+    "incoming_method_dispatch",
+    "incoming_twin_patch_dispatch",
+    "encode_properties",
+    "encode_properties_templated",
+    "extract_properties_from_topic",
+    "queued_d2c_message_memory",
+    "received_c2d_message_memory",
+]
+for name in (serializers.JSON, serializers.ORJSON, serializers.UJSON):
+    if serializers.is_available(name):
+        expected_benchmarks += ["large_twin_loads_" + name, "large_twin_dumps_" + name]
+for scope in ("global", "sharded", "client"):
+    expected_benchmarks += ["client_scaling_{}_{}".format(scope, count) for count in (1, 4, 16)]
+expected_benchmarks += ["callback_hol_{}".format(mode) for mode in ("thread", "pool", "ordered")]
+expected_benchmarks += ["d2c_send_instrumented_sync"]
+if sys.version_info >= (3, 5):
+    expected_benchmarks += [
+        "connect_async",
+        "d2c_send_async",
+        "d2c_send_concurrent_async",
+        "d2c_send_event_loop_async",
+        "d2c_send_event_loop_concurrent_async",
+        "twin_get_async",
+        "twin_patch_async",
+    ]
+
+
+@pytest.mark.describe("Benchmarks - .run_benchmarks()")
+class TestRunBenchmarks(object):
+    @pytest.mark.it("Runs every benchmark and reports the results as JSON-serializable data")
+    def test_runs_all_benchmarks(self):
+        report = run.run_benchmarks(iterations=3)
+        assert sorted(result["name"] for result in report["results"]) == sorted(expected_benchmarks)
+        for result in report["results"]:
+            assert result["operations"] >= 3
+            assert result["ops_per_second"] > 0
+        assert json.loads(json.dumps(report)) == report
+
+    @pytest.mark.it("Only runs the benchmarks matching the filter")
+    def test_only(self):
+        report = run.run_benchmarks(iterations=3, only=["twin_sync"])
+        assert [result["name"] for result in report["results"]] == [
+            "twin_get_sync",
+            "twin_patch_sync",
+        ]
+
+    @pytest.mark.it("Describes the environment the results were measured in")
+    def test_environment(self):
+        report = run.run_benchmarks(iterations=1, only=["topic_properties"])
+        assert report["schema_version"] == harness.SCHEMA_VERSION
+        assert set(report["environment"]) >= set(
+            ["sdk_version", "python_version", "python_implementation", "platform"]
+        )
+
+
+@pytest.mark.describe("Benchmarks - harness")
+class TestHarness(object):
+    @pytest.mark.it("Summarizes latencies using nearest-rank percentiles")
+    def test_summarize_latencies(self):
+        summary = harness.summarize_latencies([float(i) for i in range(100, 0, -1)])
+        assert summary == {
+            "min": 1.0,
+            "mean": 50.5,
+            "median": 50.0,
+            "p90": 90.0,
+            "p99": 99.0,
+            "max": 100.0,
+        }
+
+    @pytest.mark.it("Measures the memory held on to by each object, where tracemalloc is available")
+    def test_measure_memory(self):
+        result = harness.measure_memory("name", lambda: bytearray(1000), 100)
+        assert result["operations"] == 100
+        if harness.tracemalloc:
+            assert result["bytes_per_operation"] >= 1000
+        else:
+            assert result["bytes_per_operation"] is None
+
+    @pytest.mark.it("Calls the operation for every warmup and timed iteration")
+    def test_time_operations(self, mocker):
+        operation = mocker.MagicMock()
+        result = harness.time_operations("name", operation, 5, warmup=2, params={"a": 1})
+        assert operation.call_count == 7
+        assert result["name"] == "name"
+        assert result["operations"] == 5
+        assert result["params"] == {"a": 1}
+        assert result["latency_seconds"]["max"] >= result["latency_seconds"]["min"]
+
+
+@pytest.mark.describe("Benchmarks - FakeMQTTTransport")
+class TestFakeMQTTTransport(object):
+    @pytest.fixture
+    def transport(self):
+        transport = FakeMQTTTransport("client_id", "hostname", "username")
+        yield transport
+        transport.stop()
+
+    @pytest.mark.it("Acknowledges a publish from its network thread")
+    def test_publish(self, transport):
+        acked = threading.Event()
+        threads = []
+
+        def on_published():
+            threads.append(threading.current_thread().name)
+            acked.set()
+
+        transport.publish("topic", "payload", callback=on_published)
+        assert acked.wait(5)
+        assert threads == ["fake-transport"]
+
+    @pytest.mark.it("Answers twin GET requests with a twin")
+    def test_twin_get(self, transport):
+        received = []
+        done = threading.Event()
+
+        def on_message(topic, payload):
+            received.append((topic, payload))
+            done.set()
+
+        transport.on_mqtt_message_received_handler = on_message
+        transport.publish("$iothub/twin/GET/?$rid=42", " ")
+        assert done.wait(5)
+        assert received[0][0] == "$iothub/twin/res/200/?$rid=42"
+        assert "desired" in json.loads(received[0][1].decode("utf-8"))
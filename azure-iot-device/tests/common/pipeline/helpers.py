@@ -153,8 +153,11 @@ def get_arg_count(fn):
 
 
 def make_mock_op_or_event(cls):
+    # Ops and events use __slots__.  Tests hang extra attributes (like action) on the objects
+    # they make, so give them an instance of a subclass which has a __dict__.
+    test_cls = type(cls.__name__, (cls,), {})
     args = [None for i in (range(get_arg_count(cls.__init__) - 1))]
-    return cls(*args)
+    return test_cls(*args)
 
 
 def add_mock_method_waiter(obj, method_name):
@@ -21,7 +21,7 @@ def get_next_fake_value():
     return "__fake_value_{}__".format(fake_count)
 
 
-base_operation_defaults = {"needs_connection": False, "error": None}
+base_operation_defaults = {"needs_connection": False, "error": None, "deadline": None}
 base_event_defaults = {}
 
 
@@ -43,6 +43,7 @@ def add_operation_test(
         extra_defaults=all_extra_defaults,
         positional_arguments=positional_arguments,
         keyword_arguments=keyword_arguments,
+        slotted=True,
     )
 
 
@@ -62,11 +63,18 @@ def add_event_test(cls, module, extra_defaults={}, positional_arguments=[], keyw
         extra_defaults=all_extra_defaults,
         positional_arguments=positional_arguments,
         keyword_arguments=keyword_arguments,
+        slotted=True,
     )
 
 
 def add_instantiation_test(
-    cls, module, defaults, extra_defaults={}, positional_arguments=[], keyword_arguments={}
+    cls,
+    module,
+    defaults,
+    extra_defaults={},
+    positional_arguments=[],
+    keyword_arguments={},
+    slotted=False,
 ):
     """
     internal function that takes the class and attribute details and adds a test class which
@@ -135,6 +143,13 @@ def add_instantiation_test(
                 else:
                     assert getattr(instance, key) == all_defaults[key]
 
+        if slotted:
+
+            @pytest.mark.it("Does not have a __dict__")
+            def test_no_dict(self):
+                instance = cls(*args)
+                assert not hasattr(instance, "__dict__")
+
     # Adding this object to the namespace of the module that was passed in (using a name that starts with "Test")
     # will cause pytest to pick it up.
     setattr(module, "Test{}Instantiation".format(cls.__name__), LocalTestObject)
@@ -0,0 +1,196 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+import threading
+from azure.iot.device.common import unhandled_exceptions
+from azure.iot.device.common.pipeline import callback_dispatcher
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.mark.describe("callback_dispatcher - .create_callback_dispatcher()")
+class TestCreateCallbackDispatcher(object):
+    @pytest.mark.it("Returns None for the callback thread")
+    def test_thread(self):
+        assert (
+            callback_dispatcher.create_callback_dispatcher(callback_dispatcher.DISPATCH_THREAD)
+            is None
+        )
+
+    @pytest.mark.it("Returns a CallbackDispatcher for the other modes")
+    @pytest.mark.parametrize(
+        "mode",
+        [
+            callback_dispatcher.DISPATCH_POOL,
+            callback_dispatcher.DISPATCH_ORDERED,
+            callback_dispatcher.DISPATCH_INLINE,
+        ],
+    )
+    def test_other_modes(self, mode):
+        dispatcher = callback_dispatcher.create_callback_dispatcher(mode, name="device")
+        assert isinstance(dispatcher, callback_dispatcher.CallbackDispatcher)
+        assert dispatcher.mode == mode
+        assert dispatcher.name == "device"
+
+    @pytest.mark.it("Raises a ValueError for an unknown mode or fewer than 1 worker")
+    @pytest.mark.parametrize(
+        "mode, workers",
+        [
+            pytest.param("threads", 1, id="Unknown mode"),
+            pytest.param(callback_dispatcher.DISPATCH_POOL, 0, id="No workers"),
+        ],
+    )
+    def test_invalid(self, mode, workers):
+        with pytest.raises(ValueError):
+            callback_dispatcher.create_callback_dispatcher(mode, workers=workers)
+
+
+@pytest.mark.describe("callback_dispatcher - CallbackDispatcher")
+class TestCallbackDispatcher(object):
+    @pytest.mark.it("Runs callbacks on the calling thread in inline mode")
+    def test_inline(self):
+        dispatcher = callback_dispatcher.CallbackDispatcher(callback_dispatcher.DISPATCH_INLINE)
+        future = dispatcher.dispatch(threading.current_thread)()
+        assert future.result() is threading.current_thread()
+
+    @pytest.mark.it("Passes arguments to the callback and returns its result in the Future")
+    @pytest.mark.parametrize(
+        "mode",
+        [
+            callback_dispatcher.DISPATCH_POOL,
+            callback_dispatcher.DISPATCH_ORDERED,
+            callback_dispatcher.DISPATCH_INLINE,
+        ],
+    )
+    def test_arguments(self, mode):
+        dispatcher = callback_dispatcher.CallbackDispatcher(mode)
+        future = dispatcher.dispatch(lambda a, b=None: (a, b))(1, b=2)
+        assert future.result(5) == (1, 2)
+
+    @pytest.mark.it("Runs callbacks at the same time in pool mode")
+    def test_pool_concurrent(self):
+        dispatcher = callback_dispatcher.CallbackDispatcher(
+            callback_dispatcher.DISPATCH_POOL, workers=2
+        )
+        barrier = threading.Event()
+        waiting = dispatcher.dispatch(lambda: barrier.wait(5))()
+        dispatcher.dispatch(barrier.set)().result(5)
+        assert waiting.result(5) is True
+
+    @pytest.mark.it("Runs the callbacks of one dispatcher in order, one at a time, in ordered mode")
+    def test_ordered(self):
+        dispatcher = callback_dispatcher.CallbackDispatcher(
+            callback_dispatcher.DISPATCH_ORDERED, workers=4
+        )
+        running = []
+        results = []
+
+        def callback(i):
+            running.append(i)
+            assert len(running) == 1
+            results.append(i)
+            running.remove(i)
+
+        futures = [dispatcher.dispatch(callback)(i) for i in range(100)]
+        for future in futures:
+            future.result(5)
+        assert results == list(range(100))
+
+    @pytest.mark.it("Doesn't hold up other dispatchers while a callback blocks in ordered mode")
+    def test_ordered_independent(self):
+        blocked = callback_dispatcher.CallbackDispatcher(
+            callback_dispatcher.DISPATCH_ORDERED, workers=2
+        )
+        other = callback_dispatcher.CallbackDispatcher(
+            callback_dispatcher.DISPATCH_ORDERED, workers=2
+        )
+        release = threading.Event()
+        waiting = blocked.dispatch(lambda: release.wait(5))()
+        behind = blocked.dispatch(lambda: "behind")()
+
+        assert other.dispatch(lambda: "other")().result(5) == "other"
+        assert not behind.done()
+        release.set()
+        assert waiting.result(5) is True
+        assert behind.result(5) == "behind"
+
+    @pytest.mark.it(
+        "Reports an exception raised by a callback as an unhandled background exception"
+    )
+    @pytest.mark.parametrize(
+        "mode",
+        [
+            callback_dispatcher.DISPATCH_POOL,
+            callback_dispatcher.DISPATCH_ORDERED,
+            callback_dispatcher.DISPATCH_INLINE,
+        ],
+    )
+    def test_exception(self, mocker, mode):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
+        error = ValueError()
+
+        def raise_error():
+            raise error
+
+        dispatcher = callback_dispatcher.CallbackDispatcher(mode)
+        dispatcher.dispatch(raise_error)().result(5)
+        assert mock_handler.call_args == mocker.call(error)
+
+
+@pytest.mark.describe("callback_dispatcher - CallbackDispatcher.get_stats()")
+class TestCallbackDispatcherGetStats(object):
+    @pytest.mark.it("Reports no wait time before any callback has run")
+    def test_empty(self):
+        dispatcher = callback_dispatcher.CallbackDispatcher(callback_dispatcher.DISPATCH_POOL)
+        assert dispatcher.get_stats() == {
+            "mode": callback_dispatcher.DISPATCH_POOL,
+            "queue_depth": 0,
+            "dispatched": 0,
+            "wait_time": None,
+        }
+
+    @pytest.mark.it("Counts the callbacks waiting behind a blocked callback in the queue depth")
+    def test_queue_depth(self):
+        dispatcher = callback_dispatcher.CallbackDispatcher(
+            callback_dispatcher.DISPATCH_ORDERED, workers=1
+        )
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        first = dispatcher.dispatch(block)()
+        assert started.wait(5)
+        queued = [dispatcher.dispatch(lambda: None)() for _ in range(3)]
+        stats = dispatcher.get_stats()
+        assert stats["queue_depth"] == 3
+        assert stats["dispatched"] == 1
+
+        release.set()
+        first.result(5)
+        for future in queued:
+            future.result(5)
+        assert dispatcher.get_stats()["queue_depth"] == 0
+        assert dispatcher.get_stats()["dispatched"] == 4
+
+    @pytest.mark.it("Reports the count, min, max and mean of the time callbacks waited to run")
+    def test_wait_time(self, mocker):
+        times = iter([10.0, 10.5, 20.0, 21.5])
+        mocker.patch.object(callback_dispatcher, "clock", side_effect=lambda: next(times))
+        dispatcher = callback_dispatcher.CallbackDispatcher(callback_dispatcher.DISPATCH_INLINE)
+        dispatcher.dispatch(lambda: None)()
+        dispatcher.dispatch(lambda: None)()
+        assert dispatcher.get_stats()["wait_time"] == {
+            "count": 2,
+            "min": 0.5,
+            "max": 1.5,
+            "mean": 1.0,
+        }
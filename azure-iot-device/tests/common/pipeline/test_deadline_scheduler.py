@@ -0,0 +1,114 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+import threading
+from azure.iot.device.common import unhandled_exceptions
+from azure.iot.device.common.pipeline import deadline_scheduler, operation_flow
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def scheduler():
+    return deadline_scheduler.DeadlineScheduler()
+
+
+def soon(seconds=0.01):
+    return operation_flow.clock() + seconds
+
+
+@pytest.mark.describe("DeadlineScheduler - .call_at()")
+class TestDeadlineSchedulerCallAt(object):
+    @pytest.mark.it("Calls the function once its time is reached")
+    def test_calls_function(self, scheduler):
+        called = threading.Event()
+        scheduler.call_at(soon(), called.set)
+        assert called.wait(5)
+        assert scheduler.pending_count == 0
+
+    @pytest.mark.it("Calls functions in order of their times, not the order they were scheduled")
+    def test_order(self, scheduler):
+        calls = []
+        done = threading.Event()
+        scheduler.call_at(soon(0.2), lambda: (calls.append("last"), done.set()))
+        scheduler.call_at(soon(0.1), lambda: calls.append("second"))
+        scheduler.call_at(soon(0.05), lambda: calls.append("first"))
+        assert done.wait(5)
+        assert calls == ["first", "second", "last"]
+
+    @pytest.mark.it("Calls functions with the same time in the order they were scheduled")
+    def test_same_time(self, scheduler):
+        calls = []
+        done = threading.Event()
+        when = soon(0.05)
+        for i in range(5):
+            scheduler.call_at(when, lambda i=i: calls.append(i))
+        scheduler.call_at(when, done.set)
+        assert done.wait(5)
+        assert calls == [0, 1, 2, 3, 4]
+
+    @pytest.mark.it("Calls a function whose time has already passed straight away")
+    def test_past_time(self, scheduler):
+        called = threading.Event()
+        scheduler.call_at(operation_flow.clock() - 10, called.set)
+        assert called.wait(5)
+
+    @pytest.mark.it("Uses a single thread for every call")
+    def test_single_thread(self, scheduler):
+        threads = set()
+        done = threading.Event()
+        for i in range(20):
+            scheduler.call_at(soon(0.01), lambda: threads.add(threading.current_thread()))
+        scheduler.call_at(soon(0.02), done.set)
+        assert done.wait(5)
+        assert len(threads) == 1
+
+    @pytest.mark.it("Reports an exception raised by a function as unhandled and carries on")
+    def test_exception(self, mocker, scheduler):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
+        error = ValueError()
+        called = threading.Event()
+
+        def raise_error():
+            raise error
+
+        scheduler.call_at(soon(), raise_error)
+        scheduler.call_at(soon(0.02), called.set)
+        assert called.wait(5)
+        assert mock_handler.call_args == mocker.call(error)
+
+
+@pytest.mark.describe("DeadlineScheduler - ScheduledCall.cancel()")
+class TestScheduledCallCancel(object):
+    @pytest.mark.it("Stops the function from being called")
+    def test_cancel(self, scheduler):
+        calls = []
+        done = threading.Event()
+        scheduler.call_at(soon(0.01), lambda: calls.append("cancelled")).cancel()
+        scheduler.call_at(soon(0.05), done.set)
+        assert done.wait(5)
+        assert calls == []
+
+    @pytest.mark.it("Does nothing once the function has been called, or if called twice")
+    def test_cancel_after_call(self, scheduler):
+        called = threading.Event()
+        scheduled_call = scheduler.call_at(soon(), called.set)
+        assert called.wait(5)
+        scheduled_call.cancel()
+        scheduled_call.cancel()
+        assert scheduler.pending_count == 0
+
+    @pytest.mark.it("Removes cancelled calls from the heap once there are many of them")
+    def test_compacts(self, scheduler):
+        far = soon(3600)
+        scheduled_calls = [scheduler.call_at(far, lambda: None) for _ in range(200)]
+        for scheduled_call in scheduled_calls[:150]:
+            scheduled_call.cancel()
+        assert len(scheduler._heap) < 200
+        assert scheduler.pending_count == 50
@@ -5,7 +5,9 @@
 # --------------------------------------------------------------------------
 import logging
 import pytest
+from azure.iot.device.common import errors
 from azure.iot.device.common.pipeline import (
+    operation_flow,
     pipeline_thread,
     pipeline_stages_base,
     pipeline_ops_base,
@@ -15,6 +17,9 @@ from azure.iot.device.common.pipeline.operation_flow import (
     delegate_to_different_op,
     complete_op,
     pass_op_to_next_stage,
+    set_timeout,
+    time_remaining,
+    has_expired,
 )
 from tests.common.pipeline.helpers import (
     make_mock_stage,
@@ -46,6 +51,21 @@ def stage(mocker):
     return make_mock_stage(mocker, MockPipelineStage)
 
 
+@pytest.fixture
+def clock(mocker):
+    """
+    Replace the clock used for operation deadlines with one which only moves when told to.
+    """
+    now = [1000.0]
+    mocker.patch.object(operation_flow, "clock", side_effect=lambda: now[0])
+
+    class Clock(object):
+        def advance(self, seconds):
+            now[0] += seconds
+
+    return Clock()
+
+
 @pytest.mark.describe("delegate_to_different_op()")
 class TestContineWithDifferntOp(object):
     @pytest.mark.it("Runs the new op and does not continue running the original op")
@@ -72,6 +92,19 @@ class TestContineWithDifferntOp(object):
         delegate_to_different_op(stage, original_op=op, new_op=new_op)
         assert_callback_failed(op=op, error=new_op.error)
 
+    @pytest.mark.it("Gives the new op the deadline of the original op")
+    def test_copies_deadline(self, stage, op, new_op):
+        op.deadline = 1234.0
+        delegate_to_different_op(stage, original_op=op, new_op=new_op)
+        assert new_op.deadline == 1234.0
+
+    @pytest.mark.it("Keeps the deadline of the new op if it already has one")
+    def test_keeps_new_op_deadline(self, stage, op, new_op):
+        op.deadline = 1234.0
+        new_op.deadline = 5.0
+        delegate_to_different_op(stage, original_op=op, new_op=new_op)
+        assert new_op.deadline == 5.0
+
 
 @pytest.mark.describe("pass_op_to_next_stage()")
 class TestContinueOp(object):
@@ -97,6 +130,21 @@ class TestContinueOp(object):
         assert stage.next.run_op.call_count == 1
         assert stage.next.run_op.call_args == mocker.call(op)
 
+    @pytest.mark.it("Fails the op with a TimeoutError without continuing if the op has expired")
+    def test_fails_expired_op(self, stage, op, callback, clock):
+        set_timeout(op, 5)
+        clock.advance(5)
+        pass_op_to_next_stage(stage, op)
+        assert_callback_failed(op=op, error=errors.TimeoutError)
+        assert stage.next.run_op.call_count == 0
+
+    @pytest.mark.it("Passes the op to the next stage if the op has not expired yet")
+    def test_passes_unexpired_op(self, mocker, stage, op, clock):
+        set_timeout(op, 5)
+        clock.advance(4)
+        pass_op_to_next_stage(stage, op)
+        assert stage.next.run_op.call_args == mocker.call(op)
+
 
 @pytest.mark.describe("complete_op()")
 class TestCompleteOp(object):
@@ -131,3 +179,40 @@ class TestCompleteOp(object):
         op.callback = mocker.Mock(side_effect=fake_base_exception)
         with pytest.raises(UnhandledException):
             complete_op(stage, op)
+
+
+@pytest.mark.describe("set_timeout(), time_remaining() and has_expired()")
+class TestDeadlines(object):
+    @pytest.mark.it("Sets the deadline of the op to timeout seconds from now")
+    def test_set_timeout(self, op, clock):
+        set_timeout(op, 5)
+        assert op.deadline == 1005.0
+
+    @pytest.mark.it("Leaves the deadline unchanged if the timeout is None")
+    def test_set_timeout_none(self, op, clock):
+        op.deadline = 1234.0
+        set_timeout(op, None)
+        assert op.deadline == 1234.0
+
+    @pytest.mark.it("Counts down the time remaining until the deadline, stopping at 0")
+    def test_time_remaining(self, op, clock):
+        set_timeout(op, 5)
+        assert time_remaining(op) == 5.0
+        clock.advance(3)
+        assert time_remaining(op) == 2.0
+        clock.advance(3)
+        assert time_remaining(op) == 0.0
+
+    @pytest.mark.it("Reports that an op without a deadline has no time remaining and never expires")
+    def test_no_deadline(self, op, clock):
+        clock.advance(1000000)
+        assert time_remaining(op) is None
+        assert not has_expired(op)
+
+    @pytest.mark.it("Reports that the op has expired once the deadline is reached")
+    def test_has_expired(self, op, clock):
+        set_timeout(op, 5)
+        clock.advance(4)
+        assert not has_expired(op)
+        clock.advance(1)
+        assert has_expired(op)
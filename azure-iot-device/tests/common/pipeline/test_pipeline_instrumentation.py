@@ -0,0 +1,236 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+import threading
+from azure.iot.device.common import unhandled_exceptions
+from azure.iot.device.common.pipeline import pipeline_instrumentation, pipeline_thread
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def fake_clock(mocker):
+    """A clock which only moves when the test moves it"""
+    now = [100.0]
+    mocker.patch.object(pipeline_instrumentation, "clock", side_effect=lambda: now[0])
+
+    def advance(seconds):
+        now[0] += seconds
+
+    return advance
+
+
+@pytest.fixture
+def instrumentation():
+    return pipeline_instrumentation.PipelineInstrumentation()
+
+
+@pytest.mark.describe("pipeline_instrumentation - Histogram")
+class TestHistogram(object):
+    @pytest.mark.it("Reports nothing but a count of 0 before anything is recorded")
+    def test_empty(self):
+        assert pipeline_instrumentation.Histogram().get_stats() == {
+            "count": 0,
+            "min": None,
+            "max": None,
+            "mean": None,
+            "p50": None,
+            "p90": None,
+            "p99": None,
+            "buckets": [],
+        }
+
+    @pytest.mark.it("Counts times in buckets which double in size from 1 microsecond up")
+    def test_buckets(self):
+        histogram = pipeline_instrumentation.Histogram()
+        for seconds in (0.0, 0.000001, 0.0000015, 0.000002, 0.003, 0.003):
+            histogram.record(seconds)
+        stats = histogram.get_stats()
+        assert stats["count"] == 6
+        assert stats["min"] == 0.0
+        assert stats["max"] == 0.003
+        assert stats["mean"] == pytest.approx(0.0060045 / 6)
+        assert stats["buckets"] == [[0.000001, 2], [0.000002, 2], [0.004096, 2]]
+
+    @pytest.mark.it("Counts times of a minute and more in the last bucket")
+    def test_overflow(self):
+        histogram = pipeline_instrumentation.Histogram()
+        histogram.record(3600.0)
+        assert histogram.get_stats()["buckets"] == [[2**26 / 1000000.0, 1]]
+
+    @pytest.mark.it(
+        "Estimates percentiles as the upper bound of their bucket, but never more than the max"
+    )
+    def test_percentiles(self):
+        histogram = pipeline_instrumentation.Histogram()
+        for _ in range(90):
+            histogram.record(0.0001)
+        for _ in range(10):
+            histogram.record(0.01)
+        assert histogram.percentile(50) == 0.000128
+        assert histogram.percentile(90) == 0.000128
+        assert histogram.percentile(99) == 0.01
+
+
+@pytest.mark.describe("pipeline_instrumentation - PipelineInstrumentation")
+class TestPipelineInstrumentation(object):
+    @pytest.mark.it("Calls every hook with the phase, name, stage and time of each measurement")
+    def test_hooks(self, mocker):
+        first = mocker.MagicMock()
+        second = mocker.MagicMock()
+        instrumentation = pipeline_instrumentation.PipelineInstrumentation(hooks=[first])
+        instrumentation.add_hook(second)
+
+        instrumentation.record("stage", "op", 0.5, stage="Stage")
+
+        assert first.call_args == mocker.call("stage", "op", "Stage", 0.5)
+        assert second.call_args == mocker.call("stage", "op", "Stage", 0.5)
+
+    @pytest.mark.it("Stops calling a hook once it is removed")
+    def test_remove_hook(self, mocker, instrumentation):
+        hook = mocker.MagicMock()
+        instrumentation.add_hook(hook)
+        instrumentation.remove_hook(hook)
+        instrumentation.record("stage", "op", 0.5)
+        assert hook.call_count == 0
+        with pytest.raises(ValueError):
+            instrumentation.remove_hook(hook)
+
+    @pytest.mark.it(
+        "Reports an exception raised by a hook as an unhandled exception and carries on"
+    )
+    def test_hook_exception(self, mocker):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
+        error = ValueError()
+        later_hook = mocker.MagicMock()
+        instrumentation = pipeline_instrumentation.PipelineInstrumentation(
+            hooks=[mocker.MagicMock(side_effect=error), later_hook]
+        )
+
+        instrumentation.record("end_to_end", "op", 0.5)
+
+        assert mock_handler.call_args == mocker.call(error)
+        assert later_hook.call_count == 1
+        assert instrumentation.get_stats()["end_to_end"]["op"]["count"] == 1
+
+    @pytest.mark.it(
+        "Reports histograms by phase and name, and by stage for stage times, leaving out empty phases"
+    )
+    def test_get_stats(self, instrumentation):
+        instrumentation.record("stage", "op", 0.001, stage="First")
+        instrumentation.record("stage", "op", 0.003, stage="First")
+        instrumentation.record("stage", "event", 0.002, stage="Second")
+        instrumentation.record("end_to_end", "op", 0.01)
+
+        stats = instrumentation.get_stats()
+        assert sorted(stats) == ["end_to_end", "stage"]
+        assert sorted(stats["stage"]) == ["First", "Second"]
+        assert stats["stage"]["First"]["op"]["count"] == 2
+        assert stats["stage"]["First"]["op"]["max"] == 0.003
+        assert stats["stage"]["Second"]["event"]["count"] == 1
+        assert stats["end_to_end"]["op"]["count"] == 1
+
+    @pytest.mark.it("Throws away everything recorded when it is reset")
+    def test_reset(self, instrumentation):
+        instrumentation.record("end_to_end", "op", 0.01)
+        instrumentation.reset()
+        assert instrumentation.get_stats() == {}
+
+    @pytest.mark.it("Records the time spent in a stage, less the time spent in the stages it calls")
+    def test_stage_time(self, fake_clock, instrumentation):
+        instrumentation.enter_stage()
+        fake_clock(1.0)
+        instrumentation.enter_stage()
+        fake_clock(2.0)
+        instrumentation.enter_stage()
+        fake_clock(4.0)
+        instrumentation.exit_stage("Third", "op")
+        instrumentation.exit_stage("Second", "op")
+        fake_clock(8.0)
+        instrumentation.exit_stage("First", "op")
+
+        stats = instrumentation.get_stats()["stage"]
+        assert stats["First"]["op"]["mean"] == 9.0
+        assert stats["Second"]["op"]["mean"] == 2.0
+        assert stats["Third"]["op"]["mean"] == 4.0
+
+    @pytest.mark.it("Times the stages running on different threads separately")
+    def test_stage_time_threads(self, instrumentation):
+        instrumentation.enter_stage()
+        t = threading.Thread(target=instrumentation.enter_stage)
+        t.start()
+        t.join()
+        instrumentation.exit_stage("Stage", "op")
+        assert instrumentation.get_stats()["stage"]["Stage"]["op"]["count"] == 1
+
+    @pytest.mark.it(
+        "Records how long calls handed to another thread wait before the function starts"
+    )
+    def test_time_queued(self, fake_clock, instrumentation):
+        handed_off = []
+
+        def invoke(run):
+            # Instead of handing calls to another thread, keep them until the test runs them
+            return lambda *args: handed_off.append((run, args))
+
+        func = lambda *args, **kwargs: (args, kwargs)  # noqa: E731
+        wrapper = instrumentation.time_queued("pipeline_queue", "op", invoke, func)
+        wrapper(1, b=2)
+        fake_clock(0.25)
+        run, args = handed_off[0]
+
+        assert run(*args) == ((1,), {"b": 2})
+        assert instrumentation.get_stats()["pipeline_queue"]["op"]["mean"] == 0.25
+
+    @pytest.mark.it("Hands calls to the given decorator, and records the time they wait")
+    def test_time_queued_on_thread(self, instrumentation):
+        func_threads = []
+
+        def func(a, b=None):
+            func_threads.append(threading.current_thread().name)
+            return (a, b)
+
+        executors = pipeline_thread.Executors(name="test")
+        wrapper = instrumentation.time_queued(
+            "callback_queue",
+            "op",
+            lambda f: pipeline_thread.invoke_on_callback_thread_nowait(f, executors=executors),
+            func,
+        )
+        assert wrapper(1, b=2).result() == (1, 2)
+        assert func_threads == ["callback"]
+        assert instrumentation.get_stats()["callback_queue"]["op"]["count"] == 1
+
+    @pytest.mark.it(
+        "Records the time from wrapping a callback to it being called, and then calls it"
+    )
+    def test_time_end_to_end(self, mocker, fake_clock, instrumentation):
+        callback = mocker.MagicMock()
+        wrapper = instrumentation.time_end_to_end("op", callback)
+        fake_clock(0.5)
+        wrapper(1, error=None)
+        assert callback.call_args == mocker.call(1, error=None)
+        assert instrumentation.get_stats()["end_to_end"]["op"]["mean"] == 0.5
+
+
+@pytest.mark.describe("pipeline_instrumentation - .get_stage_instrumentation()")
+class TestGetStageInstrumentation(object):
+    @pytest.mark.it("Returns the instrumentation of the stage's pipeline_root, or of a root itself")
+    def test_root(self, mocker, instrumentation):
+        root = mocker.MagicMock(instrumentation=instrumentation, pipeline_root=None)
+        stage = mocker.MagicMock(pipeline_root=root)
+        assert pipeline_instrumentation.get_stage_instrumentation(stage) is instrumentation
+        assert pipeline_instrumentation.get_stage_instrumentation(root) is instrumentation
+
+    @pytest.mark.it("Returns None for a stage which isn't in a pipeline")
+    def test_no_root(self):
+        class Stage(object):
+            pipeline_root = None
+
+        assert pipeline_instrumentation.get_stage_instrumentation(Stage()) is None
@@ -7,9 +7,15 @@ import logging
 import pytest
 import sys
 import six
+import random
 import threading
+from collections import deque
 from six.moves import queue
+from azure.iot.device.common import errors, unhandled_exceptions
 from azure.iot.device.common.pipeline import (
+    callback_dispatcher,
+    deadline_scheduler,
+    pipeline_instrumentation,
     pipeline_stages_base,
     pipeline_ops_base,
     pipeline_ops_mqtt,
@@ -53,12 +59,23 @@ pipeline_stage_test.add_base_pipeline_stage_tests(
     handled_ops=[],
     all_events=all_common_events,
     handled_events=all_common_events,
-    methods_that_can_run_in_any_thread=["append_stage", "run_op"],
+    methods_that_can_run_in_any_thread=[
+        "append_stage",
+        "run_op",
+        "run_op_nowait",
+        "_enter_pipeline",
+        "_wrap_op_callback",
+        "_enforce_deadline",
+        "_invoke_on_callback_nowait",
+    ],
     extra_initializer_defaults={
         "on_pipeline_event_handler": None,
         "on_connected_handler": None,
         "on_disconnected_handler": None,
         "connected": False,
+        "executors": None,
+        "callback_dispatcher": None,
+        "instrumentation": None,
     },
 )
 
@@ -160,6 +177,259 @@ TestPipelineRootStagePipelineThreading.test_pipeline_root_runs_on_event_received
     _test_pipeline_root_runs_on_event_received_in_callback_thread
 )
 
+
+@pytest.mark.describe("PipelineRootStage - .run_op_nowait()")
+class TestPipelineRootStageRunOpNowait(object):
+    @pytest.fixture
+    def stage(self):
+        stage = pipeline_stages_base.PipelineRootStage()
+        stage.pipeline_root = stage
+        return stage
+
+    @pytest.mark.it("Returns without waiting for the pipeline thread to run the op")
+    def test_does_not_wait(self, stage, fake_non_pipeline_thread):
+        release = threading.Event()
+        completed = threading.Event()
+        executed = []
+
+        def execute_op(op):
+            release.wait(5)
+            executed.append(threading.current_thread().name)
+            op.callback(op)
+
+        stage._execute_op = execute_op
+        stage.run_op_nowait(pipeline_ops_base.ConnectOperation(callback=lambda op: completed.set()))
+        assert executed == []
+
+        release.set()
+        assert completed.wait(5)
+        assert executed == ["pipeline"]
+
+    @pytest.mark.it("Runs ops in the order they are given")
+    def test_order(self, stage, fake_non_pipeline_thread):
+        executed = []
+        done = threading.Event()
+
+        def execute_op(op):
+            executed.append(op)
+            if len(executed) == 20:
+                done.set()
+
+        stage._execute_op = execute_op
+        ops = [pipeline_ops_base.ConnectOperation(callback=None) for _ in range(20)]
+        for op in ops:
+            stage.run_op_nowait(op)
+        assert done.wait(5)
+        assert executed == ops
+
+    @pytest.mark.it("Enforces the deadline of the op, like run_op")
+    def test_deadline(self, mocker, stage, callback):
+        stage._execute_op = mocker.MagicMock()
+        spy = mocker.spy(stage, "_enforce_deadline")
+        op = pipeline_ops_base.ConnectOperation(callback=callback)
+        operation_flow.set_timeout(op, 10)
+        stage.run_op_nowait(op)
+        assert spy.call_count == 1
+        # Don't leave the deadline waiting after the test
+        op.callback(op)
+
+
+@pytest.mark.describe("PipelineRootStage - ._invoke_on_callback_nowait()")
+class TestPipelineRootStageInvokeOnCallbackNowait(object):
+    @pytest.mark.it("Runs callbacks on the callback thread if there is no callback_dispatcher")
+    def test_callback_thread(self):
+        stage = pipeline_stages_base.PipelineRootStage()
+        thread = stage._invoke_on_callback_nowait(threading.current_thread, "name")().result()
+        assert thread.name == "callback"
+
+    @pytest.mark.it("Runs callbacks with the callback_dispatcher if there is one")
+    def test_dispatcher(self):
+        dispatcher = callback_dispatcher.CallbackDispatcher(callback_dispatcher.DISPATCH_INLINE)
+        stage = pipeline_stages_base.PipelineRootStage(callback_dispatcher=dispatcher)
+        thread = stage._invoke_on_callback_nowait(threading.current_thread, "name")().result()
+        assert thread is threading.current_thread()
+        assert dispatcher.get_stats()["dispatched"] == 1
+
+
+@pytest.mark.describe("PipelineRootStage - instrumentation")
+class TestPipelineRootStageInstrumentation(object):
+    @pytest.fixture
+    def instrumentation(self):
+        return pipeline_instrumentation.PipelineInstrumentation()
+
+    @pytest.fixture
+    def stage(self, instrumentation):
+        class CompletingStage(pipeline_stages_base.PipelineStage):
+            def _execute_op(self, op):
+                operation_flow.complete_op(self, op)
+
+        return pipeline_stages_base.PipelineRootStage(instrumentation=instrumentation).append_stage(
+            CompletingStage()
+        )
+
+    @pytest.mark.it(
+        "Records the time an op waits for each thread, spends in each stage, and takes end to end"
+    )
+    def test_op(self, stage, instrumentation, fake_non_pipeline_thread):
+        completed = threading.Event()
+        stage.run_op(pipeline_ops_base.ConnectOperation(callback=lambda op: completed.set()))
+        assert completed.wait(5)
+
+        stats = instrumentation.get_stats()
+        for phase in ("pipeline_queue", "callback_queue", "end_to_end"):
+            assert stats[phase]["ConnectOperation"]["count"] == 1
+        assert sorted(stats["stage"]) == ["CompletingStage", "PipelineRootStage"]
+        for stage_stats in stats["stage"].values():
+            assert stage_stats["ConnectOperation"]["count"] == 1
+
+    @pytest.mark.it(
+        "Records the time an event spends in each stage and waits for the callback thread"
+    )
+    def test_event(self, stage, instrumentation):
+        received = threading.Event()
+        stage.on_pipeline_event_handler = lambda event: received.set()
+        stage.next.handle_pipeline_event(
+            pipeline_events_base.IotResponseEvent(request_id="1", status_code=200, response_body="")
+        )
+        assert received.wait(5)
+
+        stats = instrumentation.get_stats()
+        assert stats["callback_queue"]["IotResponseEvent"]["count"] == 1
+        assert stats["stage"]["PipelineRootStage"]["IotResponseEvent"]["count"] == 1
+
+    @pytest.mark.it("Doesn't record anything if the pipeline isn't instrumented")
+    def test_not_instrumented(self, mocker, fake_non_pipeline_thread):
+        record = mocker.spy(pipeline_instrumentation.PipelineInstrumentation, "record")
+        completed = threading.Event()
+        stage = pipeline_stages_base.PipelineRootStage()
+        stage._execute_op = lambda op: operation_flow.complete_op(stage, op)
+        stage.run_op(pipeline_ops_base.ConnectOperation(callback=lambda op: completed.set()))
+        assert completed.wait(5)
+        assert record.call_count == 0
+
+
+@pytest.mark.describe("PipelineRootStage - ._enforce_deadline()")
+class TestPipelineRootStageEnforceDeadline(object):
+    @pytest.fixture
+    def mock_call_at(self, mocker):
+        return mocker.patch.object(deadline_scheduler, "call_at")
+
+    @pytest.fixture
+    def stage(self):
+        return pipeline_stages_base.PipelineRootStage()
+
+    @pytest.fixture
+    def op(self, callback):
+        op = pipeline_ops_base.ConnectOperation(callback=callback)
+        operation_flow.set_timeout(op, 10)
+        return op
+
+    def expire(self, mock_call_at):
+        mock_call_at.call_args[0][1]()
+
+    @pytest.mark.it("Schedules a call at the deadline of the op")
+    def test_schedules_call(self, stage, op, callback, mock_call_at):
+        stage._enforce_deadline(op, callback)
+        assert mock_call_at.call_count == 1
+        assert mock_call_at.call_args[0][0] == op.deadline
+
+    @pytest.mark.it(
+        "Calls the callback and cancels the scheduled call when the op completes in time"
+    )
+    def test_completes_in_time(self, stage, op, callback, mock_call_at):
+        on_complete = stage._enforce_deadline(op, callback)
+        on_complete(op)
+        assert_callback_succeeded(op=op, callback=callback)
+        assert mock_call_at.return_value.cancel.call_count == 1
+
+    @pytest.mark.it(
+        "Calls the callback with a copy of the op which failed with a TimeoutError when the deadline is reached"
+    )
+    def test_times_out(self, stage, op, callback, mock_call_at):
+        stage._enforce_deadline(op, callback)
+        self.expire(mock_call_at)
+        assert callback.call_count == 1
+        timed_out_op = callback.call_args[0][0]
+        assert timed_out_op is not op
+        assert isinstance(timed_out_op, type(op))
+        assert isinstance(timed_out_op.error, errors.TimeoutError)
+
+    @pytest.mark.it("Leaves the op itself alone when the deadline is reached")
+    def test_leaves_op_alone(self, stage, op, callback, mock_call_at):
+        stage._enforce_deadline(op, callback)
+        self.expire(mock_call_at)
+        assert op.error is None
+
+    @pytest.mark.it("Ignores the completion of an op which has already timed out")
+    def test_ignores_late_completion(self, stage, op, callback, mock_call_at):
+        on_complete = stage._enforce_deadline(op, callback)
+        self.expire(mock_call_at)
+        on_complete(op)
+        assert callback.call_count == 1
+
+    @pytest.mark.it("Does nothing when the deadline is reached after the op has completed")
+    def test_ignores_deadline_after_completion(self, stage, op, callback, mock_call_at):
+        on_complete = stage._enforce_deadline(op, callback)
+        on_complete(op)
+        self.expire(mock_call_at)
+        assert_callback_succeeded(op=op, callback=callback)
+
+    @pytest.mark.it("Calls on_finished when the op completes in time")
+    def test_on_finished(self, mocker, stage, op, callback, mock_call_at):
+        on_finished = mocker.MagicMock()
+        on_complete = stage._enforce_deadline(op, callback, on_finished)
+        on_complete(op)
+        assert on_finished.call_args == mocker.call(op)
+
+    @pytest.mark.it(
+        "Calls on_finished when the op completes after the deadline, and not when the deadline is reached"
+    )
+    def test_on_finished_after_deadline(self, mocker, stage, op, callback, mock_call_at):
+        on_finished = mocker.MagicMock()
+        on_complete = stage._enforce_deadline(op, callback, on_finished)
+        self.expire(mock_call_at)
+        assert on_finished.call_count == 0
+        on_complete(op)
+        assert on_finished.call_args == mocker.call(op)
+
+    @pytest.mark.it("Is only used by run_op for ops which have a deadline")
+    def test_only_ops_with_deadline(self, mocker, stage, callback):
+        stage.append_stage(mocker.MagicMock())
+        spy = mocker.spy(stage, "_enforce_deadline")
+        stage.run_op(pipeline_ops_base.ConnectOperation(callback=callback))
+        assert spy.call_count == 0
+
+        op = pipeline_ops_base.ConnectOperation(callback=callback)
+        operation_flow.set_timeout(op, 10)
+        stage.run_op(op)
+        assert spy.call_count == 1
+        # Don't leave the deadline waiting after the test
+        op.callback(op)
+
+    @pytest.mark.it("Passes on_finished from run_op and run_op_nowait")
+    @pytest.mark.parametrize("run_function_name", ["run_op", "run_op_nowait"])
+    def test_passes_on_finished(self, mocker, stage, op, callback, run_function_name):
+        stage._enter_pipeline = mocker.MagicMock()
+        spy = mocker.spy(stage, "_enforce_deadline")
+        on_finished = mocker.MagicMock()
+        getattr(stage, run_function_name)(op, on_finished=on_finished)
+        assert spy.call_args[0][2] is on_finished
+        # Don't leave the deadline waiting after the test
+        op.callback(op)
+        assert on_finished.call_args == mocker.call(op)
+
+    @pytest.mark.it("Calls on_finished before the callback for ops without a deadline")
+    def test_on_finished_without_deadline(self, mocker, stage):
+        calls = []
+        stage.append_stage(mocker.MagicMock())
+        stage.callback_dispatcher = mocker.MagicMock()
+        stage.callback_dispatcher.dispatch.side_effect = lambda func: func
+        op = pipeline_ops_base.ConnectOperation(callback=lambda op: calls.append("callback"))
+        stage.run_op(op, on_finished=lambda op: calls.append("on_finished"))
+        op.callback(op)
+        assert calls == ["on_finished", "callback"]
+
+
 pipeline_stage_test.add_base_pipeline_stage_tests(
     cls=pipeline_stages_base.EnsureConnectionStage,
     module=this_module,
@@ -280,6 +550,247 @@ class TestEnsureConnectionStageRunOp(object):
         assert_callback_failed(op=op, error=fake_exception)
 
 
+pipeline_stage_test.add_base_pipeline_stage_tests(
+    cls=pipeline_stages_base.ReconnectStage,
+    module=this_module,
+    all_ops=all_common_ops,
+    handled_ops=[],
+    all_events=all_common_events,
+    handled_events=[],
+    methods_that_enter_pipeline_thread=["_on_timer_expired"],
+    methods_that_can_run_in_any_thread=["get_delay"],
+    extra_initializer_defaults={
+        "initial_delay": 1.0,
+        "max_delay": 60.0,
+        "max_attempts": None,
+        "reconnecting": False,
+        "attempt": 0,
+        "waiting_ops": deque,
+        "on_reconnect_abandoned_handler": None,
+    },
+)
+
+
+class ReconnectStageTestBase(object):
+    @pytest.fixture
+    def mock_timer(self, mocker):
+        return mocker.patch.object(threading, "Timer")
+
+    @pytest.fixture
+    def stage(self, mocker, mock_timer):
+        stage = make_mock_stage(mocker=mocker, stage_to_make=pipeline_stages_base.ReconnectStage)
+        stage.max_attempts = 3
+        stage.next.run_op = mocker.MagicMock()
+        return stage
+
+    @pytest.fixture
+    def publish_op(self, callback):
+        return pipeline_ops_mqtt.MQTTPublishOperation(
+            topic=fake_topic, payload=fake_payload, callback=callback
+        )
+
+    def connect(self, stage):
+        stage.pipeline_root.connected = True
+        stage.on_connected()
+
+    def drop_connection(self, stage):
+        stage.pipeline_root.connected = False
+        stage.on_disconnected()
+
+    def expire_timer(self, mock_timer):
+        mock_timer.call_args[0][1]()
+
+    def fail_reconnect(self, stage, error):
+        reconnect_op = stage.next.run_op.call_args[0][0]
+        reconnect_op.error = error
+        operation_flow.complete_op(stage=stage.next, op=reconnect_op)
+
+
+@pytest.mark.describe("ReconnectStage - .get_delay()")
+class TestReconnectStageGetDelay(object):
+    @pytest.mark.it("Returns a random delay between 0 and initial_delay * 2^attempt")
+    @pytest.mark.parametrize("attempt, expected_cap", [(0, 1.5), (1, 3.0), (3, 12.0)])
+    def test_exponential(self, mocker, attempt, expected_cap):
+        mocker.patch.object(random, "uniform", side_effect=lambda low, high: (low, high))
+        stage = pipeline_stages_base.ReconnectStage(initial_delay=1.5, max_delay=100)
+        assert stage.get_delay(attempt) == (0, expected_cap)
+
+    @pytest.mark.it("Never uses an upper bound larger than max_delay")
+    def test_capped(self, mocker):
+        mocker.patch.object(random, "uniform", side_effect=lambda low, high: (low, high))
+        stage = pipeline_stages_base.ReconnectStage(initial_delay=1, max_delay=20)
+        assert stage.get_delay(10) == (0, 20)
+
+
+@pytest.mark.describe("ReconnectStage - .on_disconnected()")
+class TestReconnectStageOnDisconnected(ReconnectStageTestBase):
+    @pytest.mark.it("Schedules a reconnect if the connection drops unexpectedly")
+    def test_unexpected_drop(self, stage, mock_timer):
+        self.connect(stage)
+        self.drop_connection(stage)
+
+        assert stage.reconnecting
+        assert mock_timer.call_count == 1
+        assert mock_timer.return_value.start.call_count == 1
+        assert stage.next.run_op.call_count == 0
+
+    @pytest.mark.it("Does not reconnect if the pipeline was never connected")
+    def test_never_connected(self, stage, mock_timer):
+        self.drop_connection(stage)
+        assert not stage.reconnecting
+        assert mock_timer.call_count == 0
+
+    @pytest.mark.it("Does not reconnect after a DisconnectOperation")
+    def test_requested_disconnect(self, stage, mock_timer):
+        self.connect(stage)
+        stage.run_op(pipeline_ops_base.DisconnectOperation())
+        self.drop_connection(stage)
+        assert not stage.reconnecting
+        assert mock_timer.call_count == 0
+
+    @pytest.mark.it("Sends a ReconnectOperation down when the backoff timer expires")
+    def test_sends_reconnect(self, stage, mock_timer):
+        self.connect(stage)
+        self.drop_connection(stage)
+        self.expire_timer(mock_timer)
+
+        assert stage.next.run_op.call_count == 1
+        assert isinstance(stage.next.run_op.call_args[0][0], pipeline_ops_base.ReconnectOperation)
+
+
+@pytest.mark.describe("ReconnectStage - .run_op() -- called while waiting to reconnect")
+class TestReconnectStageRunOpWhileReconnecting(ReconnectStageTestBase):
+    @pytest.fixture(autouse=True)
+    def start_reconnecting(self, stage):
+        self.connect(stage)
+        self.drop_connection(stage)
+
+    @pytest.mark.it("Holds operations which need a connection")
+    def test_holds_op(self, stage, publish_op):
+        stage.run_op(publish_op)
+        assert stage.next.run_op.call_count == 0
+        assert publish_op.callback.call_count == 0
+
+    @pytest.mark.it("Passes operations which don't need a connection down")
+    def test_passes_other_ops(self, stage):
+        op = pipeline_ops_base.EnableFeatureOperation(feature_name="fake")
+        stage.run_op(op)
+        assert stage.next.run_op.call_args[0][0] is op
+
+    @pytest.mark.it("Releases held operations once the connection comes back")
+    def test_releases_on_connected(self, stage, mock_timer, publish_op):
+        stage.run_op(publish_op)
+        self.expire_timer(mock_timer)
+        self.connect(stage)
+
+        assert not stage.reconnecting
+        assert stage.next.run_op.call_args[0][0] is publish_op
+
+    @pytest.mark.it(
+        "Fails held operations which have passed their deadline when holding another op"
+    )
+    def test_releases_expired_ops(self, mocker, stage, publish_op, callback):
+        now = [1000.0]
+        mocker.patch.object(operation_flow, "clock", side_effect=lambda: now[0])
+        operation_flow.set_timeout(publish_op, 5)
+        stage.run_op(publish_op)
+        now[0] += 5
+
+        second_op = pipeline_ops_mqtt.MQTTPublishOperation(
+            topic=fake_topic, payload=fake_payload, callback=mocker.MagicMock()
+        )
+        stage.run_op(second_op)
+
+        assert_callback_failed(op=publish_op, error=errors.TimeoutError)
+        assert list(stage.waiting_ops) == [second_op]
+        assert stage.next.run_op.call_count == 0
+
+    @pytest.mark.it(
+        "Stops reconnecting and fails held operations with a ConnectionDroppedError when a DisconnectOperation is run"
+    )
+    def test_disconnect(self, stage, mock_timer, publish_op):
+        stage.run_op(publish_op)
+        disconnect_op = pipeline_ops_base.DisconnectOperation()
+        stage.run_op(disconnect_op)
+
+        assert not stage.reconnecting
+        assert mock_timer.return_value.cancel.call_count == 1
+        assert_callback_failed(op=publish_op, error=errors.ConnectionDroppedError)
+        assert stage.next.run_op.call_args[0][0] is disconnect_op
+
+    @pytest.mark.it(
+        "Calls the on_reconnect_abandoned_handler with a ConnectionDroppedError when a DisconnectOperation is run"
+    )
+    def test_disconnect_handler(self, mocker, stage):
+        stage.on_reconnect_abandoned_handler = mocker.MagicMock()
+        stage.run_op(pipeline_ops_base.DisconnectOperation())
+        assert stage.on_reconnect_abandoned_handler.call_count == 1
+        assert isinstance(
+            stage.on_reconnect_abandoned_handler.call_args[0][0], errors.ConnectionDroppedError
+        )
+
+
+@pytest.mark.describe("ReconnectStage - ReconnectOperation completion")
+class TestReconnectStageReconnectComplete(ReconnectStageTestBase):
+    @pytest.fixture(autouse=True)
+    def start_reconnect_attempt(self, stage, mock_timer):
+        self.connect(stage)
+        self.drop_connection(stage)
+        self.expire_timer(mock_timer)
+
+    @pytest.mark.it("Schedules another attempt with a larger backoff if the reconnect fails")
+    def test_retries(self, mocker, stage, mock_timer, fake_exception):
+        mocker.spy(stage, "get_delay")
+        self.fail_reconnect(stage, fake_exception)
+
+        assert stage.reconnecting
+        assert mock_timer.call_count == 2
+        assert stage.get_delay.call_args == mocker.call(1)
+
+    @pytest.mark.it(
+        "Gives up and fails held operations with the last error after max_attempts failures"
+    )
+    def test_gives_up(self, mocker, stage, mock_timer, publish_op, fake_exception):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
+        stage.run_op(publish_op)
+        for i in range(stage.max_attempts - 1):
+            self.fail_reconnect(stage, fake_exception)
+            self.expire_timer(mock_timer)
+        self.fail_reconnect(stage, fake_exception)
+
+        assert not stage.reconnecting
+        assert mock_timer.call_count == stage.max_attempts
+        assert_callback_failed(op=publish_op, error=fake_exception)
+        assert mock_handler.call_args == mocker.call(fake_exception)
+
+    @pytest.mark.it(
+        "Calls the on_reconnect_abandoned_handler with the last error when it gives up, but not before"
+    )
+    def test_gives_up_handler(self, mocker, stage, mock_timer, fake_exception):
+        mocker.patch.object(unhandled_exceptions, "exception_caught_in_background_thread")
+        stage.on_reconnect_abandoned_handler = mocker.MagicMock()
+        for i in range(stage.max_attempts - 1):
+            self.fail_reconnect(stage, fake_exception)
+            self.expire_timer(mock_timer)
+        assert stage.on_reconnect_abandoned_handler.call_count == 0
+        self.fail_reconnect(stage, fake_exception)
+
+        assert stage.on_reconnect_abandoned_handler.call_args == mocker.call(fake_exception)
+
+    @pytest.mark.it("Passes held operations down if the reconnect succeeds")
+    def test_success(self, mocker, stage, publish_op):
+        stage.on_reconnect_abandoned_handler = mocker.MagicMock()
+        stage.run_op(publish_op)
+        reconnect_op = stage.next.run_op.call_args[0][0]
+        operation_flow.complete_op(stage=stage.next, op=reconnect_op)
+
+        assert not stage.reconnecting
+        assert stage.next.run_op.call_args[0][0] is publish_op
+        assert stage.on_reconnect_abandoned_handler.call_count == 0
+
+
 pipeline_stage_test.add_base_pipeline_stage_tests(
     cls=pipeline_stages_base.SerializeConnectOpsStage,
     module=this_module,
@@ -720,3 +1231,93 @@ class TestCoordinateRequestAndResponseSendIotRequestHandleEvent(object):
         operation_flow.pass_event_to_previous_stage(stage.next, iot_response)
         assert op.callback.call_count == 0
         assert unhandled_error_handler.call_count == 0
+
+
+@pytest.mark.describe(
+    "CoordinateRequestAndResponseStage - .run_op() -- called with SendIotRequestAndWaitForResponseOperation which has a deadline"
+)
+class TestCoordinateRequestAndResponseDeadline(object):
+    @pytest.fixture
+    def mock_call_at(self, mocker):
+        return mocker.patch.object(deadline_scheduler, "call_at")
+
+    @pytest.fixture
+    def op(self, mocker):
+        op = make_fake_request_and_response(mocker)
+        operation_flow.set_timeout(op, 10)
+        return op
+
+    @pytest.fixture
+    def stage(self, mocker, mock_call_at):
+        stage = make_mock_stage(mocker, pipeline_stages_base.CoordinateRequestAndResponseStage)
+        stage.next._execute_op = mocker.MagicMock()
+        return stage
+
+    @pytest.fixture
+    def iot_request(self, stage, op):
+        stage.run_op(op)
+        return stage.next.run_op.call_args[0][0]
+
+    def expire(self, mock_call_at):
+        mock_call_at.call_args[0][1]()
+
+    @pytest.mark.it("Gives the SendIotRequestOperation op the same deadline")
+    def test_passes_deadline(self, op, iot_request):
+        assert iot_request.deadline == op.deadline
+
+    @pytest.mark.it("Schedules a call at the deadline of the op")
+    def test_schedules_call(self, stage, op, iot_request, mock_call_at):
+        assert mock_call_at.call_count == 1
+        assert mock_call_at.call_args[0][0] == op.deadline
+
+    @pytest.mark.it(
+        "Fails the op with a TimeoutError and removes it from the pending list when the response doesn't arrive in time"
+    )
+    def test_times_out(self, stage, op, iot_request, mock_call_at):
+        self.expire(mock_call_at)
+        assert_callback_failed(op=op, error=errors.TimeoutError)
+        assert stage.pending_responses == {}
+        assert stage.response_timers == {}
+
+    @pytest.mark.it("Ignores a response which arrives after the deadline")
+    def test_ignores_late_response(self, stage, op, iot_request, mock_call_at):
+        self.expire(mock_call_at)
+        op.callback.reset_mock()
+        operation_flow.pass_event_to_previous_stage(
+            stage.next,
+            pipeline_events_base.IotResponseEvent(
+                request_id=iot_request.request_id,
+                status_code=fake_status_code,
+                response_body=fake_response_body,
+            ),
+        )
+        assert op.callback.call_count == 0
+
+    @pytest.mark.it("Ignores the completion of the SendIotRequestOperation op after the deadline")
+    def test_ignores_late_send_completion(
+        self, stage, op, iot_request, mock_call_at, fake_exception
+    ):
+        self.expire(mock_call_at)
+        op.callback.reset_mock()
+        iot_request.error = fake_exception
+        operation_flow.complete_op(stage.next, iot_request)
+        assert op.callback.call_count == 0
+
+    @pytest.mark.it("Cancels the scheduled call when the response arrives in time")
+    def test_cancels_scheduled_call(self, stage, op, iot_request, mock_call_at):
+        operation_flow.pass_event_to_previous_stage(
+            stage.next,
+            pipeline_events_base.IotResponseEvent(
+                request_id=iot_request.request_id,
+                status_code=fake_status_code,
+                response_body=fake_response_body,
+            ),
+        )
+        assert_callback_succeeded(op=op)
+        assert mock_call_at.return_value.cancel.call_count == 1
+        assert stage.response_timers == {}
+
+    @pytest.mark.it("Does not schedule a call for an op without a deadline")
+    def test_no_deadline(self, mocker, stage, mock_call_at):
+        stage.run_op(make_fake_request_and_response(mocker))
+        assert mock_call_at.call_count == 0
@@ -7,8 +7,11 @@ import logging
 import pytest
 import sys
 import six
+import threading
 from azure.iot.device.common import errors, unhandled_exceptions
 from azure.iot.device.common.pipeline import (
+    operation_flow,
+    pipeline_instrumentation,
     pipeline_ops_base,
     pipeline_stages_base,
     pipeline_ops_mqtt,
@@ -201,8 +204,24 @@ class TestMQTTProviderRunOpWithSetConnectionArgs(RunOpTests):
             username=fake_username,
             ca_cert=fake_ca_cert,
             x509_cert=fake_certificate,
+            port=8883,
+            ack_timeout=None,
         )
 
+    @pytest.mark.it("Initializes the MQTTTransport object with the port the stage was created with")
+    def test_passes_port(self, stage, transport, op_set_connection_args):
+        stage.port = 1883
+        stage.run_op(op_set_connection_args)
+        assert transport.call_args[1]["port"] == 1883
+
+    @pytest.mark.it(
+        "Initializes the MQTTTransport object with the ack_timeout the stage was created with"
+    )
+    def test_passes_ack_timeout(self, stage, transport, op_set_connection_args):
+        stage.ack_timeout = 30
+        stage.run_op(op_set_connection_args)
+        assert transport.call_args[1]["ack_timeout"] == 30
+
     @pytest.mark.it("Sets handlers on the transport")
     def test_sets_parameters(self, stage, transport, mocker, op_set_connection_args):
         stage.run_op(op_set_connection_args)
@@ -370,7 +389,7 @@ class TestMQTTProviderExecuteOpWithMQTTPublishOperation(RunOpTests):
         stage.run_op(op_publish)
         assert stage.transport.publish.call_count == 1
         assert stage.transport.publish.call_args == mocker.call(
-            topic=op_publish.topic, payload=op_publish.payload, callback=mocker.ANY
+            topic=op_publish.topic, payload=op_publish.payload, qos=1, callback=mocker.ANY
         )
 
     @pytest.mark.it(
@@ -385,6 +404,337 @@ class TestMQTTProviderExecuteOpWithMQTTPublishOperation(RunOpTests):
 
         assert_callback_succeeded(op=op_publish)
 
+    @pytest.mark.it("Completes the operation with failure if the MQTTTransport fails the publish")
+    def test_fails(self, mocker, stage, create_transport, op_publish, fake_exception):
+        stage.run_op(op_publish)
+        stage.transport.publish.call_args[1]["callback"](error=fake_exception)
+        assert_callback_failed(op=op_publish, error=fake_exception)
+        assert stage._inflight_publish_count == 0
+
+    @pytest.mark.it(
+        "Does a QoS 0 MQTT publish and completes the operation as soon as the MQTTTransport accepts it, if the op has a qos of 0"
+    )
+    def test_qos_0(self, mocker, stage, create_transport, op_publish):
+        op_publish.qos = 0
+        stage.run_op(op_publish)
+        assert stage.transport.publish.call_args == mocker.call(
+            topic=op_publish.topic, payload=op_publish.payload, qos=0
+        )
+        assert_callback_succeeded(op=op_publish)
+        assert stage._inflight_publish_count == 0
+
+    @pytest.mark.it(
+        "Completes the operation with failure if the MQTTTransport raises an Exception during a QoS 0 publish"
+    )
+    def test_qos_0_fails(self, stage, create_transport, op_publish, fake_exception):
+        op_publish.qos = 0
+        stage.transport.publish.side_effect = fake_exception
+        stage.run_op(op_publish)
+        assert_callback_failed(op=op_publish, error=fake_exception)
+
+
+@pytest.mark.describe(
+    "MQTTTransportStage - .run_op() -- called with MQTTPublishOperation while using an in-flight window"
+)
+class TestMQTTProviderExecuteOpWithMQTTPublishOperationAndWindow(object):
+    @pytest.fixture
+    def stage(self, stage):
+        stage.max_inflight_publishes = 2
+        return stage
+
+    @pytest.fixture
+    def publish_ops(self, mocker):
+        return [
+            pipeline_ops_mqtt.MQTTPublishOperation(
+                topic=fake_topic, payload="payload {}".format(i), callback=mocker.MagicMock()
+            )
+            for i in range(4)
+        ]
+
+    def trigger_puback(self, stage, index):
+        stage.transport.publish.call_args_list[index][1]["callback"]()
+
+    @pytest.mark.it("Sets the maximum number of in-flight messages on the MQTTTransport")
+    def test_sets_transport_max_inflight(self, mocker, stage, create_transport):
+        assert stage.transport.set_max_inflight_messages.call_count == 1
+        assert stage.transport.set_max_inflight_messages.call_args == mocker.call(2)
+
+    @pytest.mark.it(
+        "Does not set the maximum number of in-flight messages on the MQTTTransport if there is no window"
+    )
+    def test_no_window(self, stage, transport, op_set_connection_args):
+        stage.max_inflight_publishes = None
+        stage.run_op(op_set_connection_args)
+        assert stage.transport.set_max_inflight_messages.call_count == 0
+
+    @pytest.mark.it("Publishes immediately while the window is not full")
+    def test_publishes_within_window(self, stage, create_transport, publish_ops):
+        stage.run_op(publish_ops[0])
+        stage.run_op(publish_ops[1])
+        assert stage.transport.publish.call_count == 2
+
+    @pytest.mark.it("Queues publishes which do not fit in the window")
+    def test_queues_beyond_window(self, stage, create_transport, publish_ops):
+        for op in publish_ops:
+            stage.run_op(op)
+        assert stage.transport.publish.call_count == 2
+        assert list(stage._queued_publishes) == publish_ops[2:]
+        for op in publish_ops:
+            assert op.callback.call_count == 0
+
+    @pytest.mark.it("Publishes the oldest queued op when a PUBACK is received")
+    def test_publishes_queued_op_on_puback(self, stage, create_transport, publish_ops):
+        for op in publish_ops:
+            stage.run_op(op)
+
+        self.trigger_puback(stage, 1)
+
+        assert_callback_succeeded(op=publish_ops[1])
+        assert stage.transport.publish.call_count == 3
+        assert stage.transport.publish.call_args[1]["payload"] == publish_ops[2].payload
+        assert list(stage._queued_publishes) == publish_ops[3:]
+
+    @pytest.mark.it("Publishes every queued op once enough PUBACKs are received")
+    def test_drains_queue(self, stage, create_transport, publish_ops):
+        for op in publish_ops:
+            stage.run_op(op)
+        for i in range(len(publish_ops)):
+            self.trigger_puback(stage, i)
+
+        assert stage.transport.publish.call_count == len(publish_ops)
+        for op in publish_ops:
+            assert_callback_succeeded(op=op)
+        assert stage._inflight_publish_count == 0
+
+    @pytest.mark.it(
+        "Completes a queued op with failure if the MQTTTransport raises an Exception while publishing it"
+    )
+    def test_queued_publish_fails(self, stage, create_transport, publish_ops, fake_exception):
+        for op in publish_ops[:3]:
+            stage.run_op(op)
+
+        stage.transport.publish.side_effect = fake_exception
+        self.trigger_puback(stage, 0)
+
+        assert_callback_failed(op=publish_ops[2], error=fake_exception)
+        assert stage._inflight_publish_count == 1
+
+    @pytest.mark.it(
+        "Completes a queued op with a TimeoutError without publishing it if it passed its deadline while queued"
+    )
+    def test_queued_publish_expires(self, mocker, stage, create_transport, publish_ops):
+        now = [1000.0]
+        mocker.patch.object(operation_flow, "clock", side_effect=lambda: now[0])
+        operation_flow.set_timeout(publish_ops[2], 5)
+        for op in publish_ops:
+            stage.run_op(op)
+        now[0] += 5
+
+        self.trigger_puback(stage, 0)
+
+        assert_callback_failed(op=publish_ops[2], error=errors.TimeoutError)
+        assert stage.transport.publish.call_count == 3
+        assert stage.transport.publish.call_args[1]["payload"] == publish_ops[3].payload
+        assert stage._inflight_publish_count == 2
+
+    @pytest.mark.it(
+        "Does not count a publish against the window if the MQTTTransport raises an Exception"
+    )
+    def test_publish_fails(self, stage, create_transport, publish_ops, fake_exception):
+        stage.transport.publish.side_effect = fake_exception
+        stage.run_op(publish_ops[0])
+        assert_callback_failed(op=publish_ops[0], error=fake_exception)
+        assert stage._inflight_publish_count == 0
+
+    @pytest.mark.it("Publishes QoS 0 ops immediately even when the window is full")
+    def test_qos_0_bypasses_window(self, stage, create_transport, publish_ops):
+        stage.run_op(publish_ops[0])
+        stage.run_op(publish_ops[1])
+        publish_ops[2].qos = 0
+        stage.run_op(publish_ops[2])
+
+        assert stage.transport.publish.call_count == 3
+        assert_callback_succeeded(op=publish_ops[2])
+        assert len(stage._queued_publishes) == 0
+        assert stage._inflight_publish_count == 2
+
+    @pytest.mark.it(
+        "Completes queued ops with a ConnectionDroppedError if the connection drops while the window is full and there is no ReconnectStage"
+    )
+    def test_connection_dropped(self, mocker, stage, create_transport, publish_ops, fake_exception):
+        mocker.patch.object(unhandled_exceptions, "exception_caught_in_background_thread")
+        for op in publish_ops:
+            stage.run_op(op)
+
+        stage.transport.on_mqtt_disconnected_handler(fake_exception)
+
+        for op in publish_ops[2:]:
+            assert_callback_failed(op=op, error=errors.ConnectionDroppedError)
+            if six.PY3:
+                assert op.error.__cause__ is fake_exception
+        assert len(stage._queued_publishes) == 0
+        # The in-flight publishes are still held by the transport, which sends them again
+        for op in publish_ops[:2]:
+            assert op.callback.call_count == 0
+        assert stage._inflight_publish_count == 2
+
+        self.trigger_puback(stage, 0)
+        self.trigger_puback(stage, 1)
+        assert_callback_succeeded(op=publish_ops[0])
+        assert_callback_succeeded(op=publish_ops[1])
+        assert stage._inflight_publish_count == 0
+        assert stage.transport.publish.call_count == 2
+
+    @pytest.mark.it(
+        "Completes queued ops with a ConnectionDroppedError if the connection fails while the window is full and there is no ReconnectStage"
+    )
+    def test_connection_failure(self, mocker, stage, create_transport, publish_ops, fake_exception):
+        stage.run_op(pipeline_ops_base.ReconnectOperation(callback=mocker.MagicMock()))
+        for op in publish_ops:
+            stage.run_op(op)
+
+        stage.transport.on_mqtt_connection_failure_handler(fake_exception)
+
+        for op in publish_ops[2:]:
+            assert_callback_failed(op=op, error=errors.ConnectionDroppedError)
+        assert len(stage._queued_publishes) == 0
+        assert stage._inflight_publish_count == 2
+
+    @pytest.mark.it("Publishes new ops again once the window drains after the connection drops")
+    def test_publishes_after_connection_dropped(
+        self, mocker, stage, create_transport, publish_ops, fake_exception
+    ):
+        mocker.patch.object(unhandled_exceptions, "exception_caught_in_background_thread")
+        for op in publish_ops[:3]:
+            stage.run_op(op)
+        stage.transport.on_mqtt_disconnected_handler(fake_exception)
+        self.trigger_puback(stage, 0)
+
+        stage.run_op(publish_ops[3])
+
+        assert stage.transport.publish.call_count == 3
+        assert stage.transport.publish.call_args[1]["payload"] == publish_ops[3].payload
+        assert stage._inflight_publish_count == 2
+
+
+@pytest.mark.describe(
+    "MQTTTransportStage - .run_op() -- called with MQTTPublishOperation while using an in-flight window below a ReconnectStage"
+)
+class TestMQTTProviderExecuteOpWithMQTTPublishOperationAndReconnectStage(object):
+    @pytest.fixture
+    def stage(self, mocker, stage):
+        mocker.patch.object(threading, "Timer")
+        mocker.patch.object(unhandled_exceptions, "exception_caught_in_background_thread")
+        stage.max_inflight_publishes = 2
+        root = stage.previous
+        reconnect_stage = pipeline_stages_base.ReconnectStage(max_attempts=2)
+        root.next = reconnect_stage
+        reconnect_stage.previous = root
+        reconnect_stage.next = stage
+        reconnect_stage.pipeline_root = root
+        stage.previous = reconnect_stage
+        return stage
+
+    @pytest.fixture
+    def publish_ops(self, mocker):
+        return [
+            pipeline_ops_mqtt.MQTTPublishOperation(
+                topic=fake_topic, payload="payload {}".format(i), callback=mocker.MagicMock()
+            )
+            for i in range(4)
+        ]
+
+    def trigger_puback(self, stage, index):
+        stage.transport.publish.call_args_list[index][1]["callback"]()
+
+    @pytest.fixture
+    def connected_with_full_window(self, mocker, stage, create_transport, publish_ops):
+        stage.run_op(pipeline_ops_base.ConnectOperation(callback=mocker.MagicMock()))
+        stage.transport.on_mqtt_connected_handler()
+        for op in publish_ops:
+            stage.run_op(op)
+
+    def reconnect(self, stage):
+        threading.Timer.call_args[0][1]()
+        assert stage.transport.reconnect.call_count == 1
+
+    @pytest.mark.it(
+        "Keeps queued ops across an unexpected drop, and publishes them as PUBACKs arrive once the ReconnectStage reconnects"
+    )
+    def test_connection_dropped(
+        self, stage, connected_with_full_window, publish_ops, fake_exception
+    ):
+        stage.transport.on_mqtt_disconnected_handler(fake_exception)
+        assert list(stage._queued_publishes) == publish_ops[2:]
+
+        self.reconnect(stage)
+        stage.transport.on_mqtt_connected_handler()
+        for i in range(len(publish_ops)):
+            self.trigger_puback(stage, i)
+
+        for op in publish_ops:
+            assert_callback_succeeded(op=op)
+        assert stage.transport.publish.call_count == len(publish_ops)
+        assert stage._inflight_publish_count == 0
+
+    @pytest.mark.it("Keeps queued ops when a reconnect attempt fails and another one will be made")
+    def test_connection_failure(
+        self, stage, connected_with_full_window, publish_ops, fake_exception
+    ):
+        stage.transport.on_mqtt_disconnected_handler(fake_exception)
+        self.reconnect(stage)
+        stage.transport.on_mqtt_connection_failure_handler(fake_exception)
+
+        assert stage.previous.reconnecting
+        assert list(stage._queued_publishes) == publish_ops[2:]
+        for op in publish_ops:
+            assert op.callback.call_count == 0
+
+    @pytest.mark.it(
+        "Completes queued ops with a ConnectionDroppedError when the ReconnectStage gives up"
+    )
+    def test_reconnect_abandoned(
+        self, stage, connected_with_full_window, publish_ops, fake_exception
+    ):
+        stage.transport.on_mqtt_disconnected_handler(fake_exception)
+        self.reconnect(stage)
+        stage.transport.on_mqtt_connection_failure_handler(fake_exception)
+        threading.Timer.call_args[0][1]()
+        stage.transport.on_mqtt_connection_failure_handler(fake_exception)
+
+        assert not stage.previous.reconnecting
+        for op in publish_ops[2:]:
+            assert_callback_failed(op=op, error=errors.ConnectionDroppedError)
+            if six.PY3:
+                assert op.error.__cause__ is fake_exception
+        assert len(stage._queued_publishes) == 0
+        assert stage._inflight_publish_count == 2
+
+    @pytest.mark.it(
+        "Completes queued ops with a ConnectionDroppedError when a DisconnectOperation is run while waiting to reconnect"
+    )
+    def test_disconnect_while_reconnecting(
+        self, stage, connected_with_full_window, publish_ops, fake_exception
+    ):
+        stage.transport.on_mqtt_disconnected_handler(fake_exception)
+        stage.previous.run_op(pipeline_ops_base.DisconnectOperation())
+
+        for op in publish_ops[2:]:
+            assert_callback_failed(op=op, error=errors.ConnectionDroppedError)
+        assert len(stage._queued_publishes) == 0
+
+    @pytest.mark.it(
+        "Completes queued ops with a ConnectionDroppedError when a requested disconnect completes"
+    )
+    def test_requested_disconnect(self, mocker, stage, connected_with_full_window, publish_ops):
+        stage.previous.run_op(pipeline_ops_base.DisconnectOperation(callback=mocker.MagicMock()))
+        stage.transport.on_mqtt_disconnected_handler(None)
+
+        assert not stage.previous.reconnecting
+        for op in publish_ops[2:]:
+            assert_callback_failed(op=op, error=errors.ConnectionDroppedError)
+        assert len(stage._queued_publishes) == 0
+
 
 @pytest.mark.describe("MQTTTransportStage - .run_op() -- called with MQTTSubscribeOperation")
 class TestMQTTProviderExecuteOpWithMQTTSubscribeOperation(RunOpTests):
@@ -408,6 +758,12 @@ class TestMQTTProviderExecuteOpWithMQTTSubscribeOperation(RunOpTests):
 
         assert_callback_succeeded(op=op_subscribe)
 
+    @pytest.mark.it("Completes the operation with failure if the MQTTTransport fails the subscribe")
+    def test_fails(self, mocker, stage, create_transport, op_subscribe, fake_exception):
+        stage.run_op(op_subscribe)
+        stage.transport.subscribe.call_args[1]["callback"](error=fake_exception)
+        assert_callback_failed(op=op_subscribe, error=fake_exception)
+
 
 @pytest.mark.describe("MQTTTransportStage - .run_op() -- called with MQTTUnsubscribeOperation")
 class TestMQTTProviderExecuteOpWithMQTTUnsubscribeOperation(RunOpTests):
@@ -431,6 +787,14 @@ class TestMQTTProviderExecuteOpWithMQTTUnsubscribeOperation(RunOpTests):
 
         assert_callback_succeeded(op=op_unsubscribe)
 
+    @pytest.mark.it(
+        "Completes the operation with failure if the MQTTTransport fails the unsubscribe"
+    )
+    def test_fails(self, mocker, stage, create_transport, op_unsubscribe, fake_exception):
+        stage.run_op(op_unsubscribe)
+        stage.transport.unsubscribe.call_args[1]["callback"](error=fake_exception)
+        assert_callback_failed(op=op_unsubscribe, error=fake_exception)
+
 
 @pytest.mark.describe("MQTTTransportStage - EVENT: MQTT message received")
 class TestMQTTProviderProtocolClientEvents(object):
@@ -448,6 +812,19 @@ class TestMQTTProviderProtocolClientEvents(object):
         assert call_arg.payload == fake_payload
         assert call_arg.topic == fake_topic
 
+    @pytest.mark.it(
+        "Records how long each message waits for the pipeline thread if the pipeline is instrumented"
+    )
+    def test_instrumented(self, stage, transport, op_set_connection_args):
+        stage.pipeline_root.instrumentation = pipeline_instrumentation.PipelineInstrumentation()
+        stage.run_op(op_set_connection_args)
+
+        stage.transport.on_mqtt_message_received_handler(topic=fake_topic, payload=fake_payload)
+
+        assert stage.previous.handle_pipeline_event.call_count == 1
+        stats = stage.pipeline_root.instrumentation.get_stats()
+        assert stats["pipeline_queue"]["IncomingMQTTMessageEvent"]["count"] == 1
+
 
 @pytest.mark.describe("MQTTTransportStage - EVENT: MQTT connected")
 class TestMQTTProviderOnConnected(object):
@@ -0,0 +1,263 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+import threading
+from azure.iot.device.common import unhandled_exceptions
+from azure.iot.device.common.pipeline import pipeline_stages_base, pipeline_thread
+
+logging.basicConfig(level=logging.INFO)
+
+
+def get_thread():
+    return threading.current_thread()
+
+
+@pytest.mark.describe("pipeline_thread - .get_executors()")
+class TestGetExecutors(object):
+    @pytest.mark.it("Returns None for the global scope")
+    def test_global(self):
+        assert pipeline_thread.get_executors(pipeline_thread.SCOPE_GLOBAL, key="device") is None
+
+    @pytest.mark.it("Returns a new Executors object every time for the client scope")
+    def test_client(self):
+        first = pipeline_thread.get_executors(pipeline_thread.SCOPE_CLIENT, key="device")
+        second = pipeline_thread.get_executors(pipeline_thread.SCOPE_CLIENT, key="device")
+        assert isinstance(first, pipeline_thread.Executors)
+        assert first is not second
+
+    @pytest.mark.it(
+        "Returns one of shard_count Executors objects, picked by key, for the sharded scope"
+    )
+    def test_sharded(self):
+        def get(key):
+            return pipeline_thread.get_executors(
+                pipeline_thread.SCOPE_SHARDED, key=key, shard_count=2
+            )
+
+        assert get("device1") is get("device1")
+        assert len(set(get("device{}".format(i)) for i in range(20))) == 2
+
+    @pytest.mark.it("Returns a new, unbound EventLoopExecutors object for the event_loop scope")
+    def test_event_loop(self):
+        executors = pipeline_thread.get_executors(pipeline_thread.SCOPE_EVENT_LOOP, key="device")
+        assert isinstance(executors, pipeline_thread.EventLoopExecutors)
+        assert executors.loop is None
+
+    @pytest.mark.it("Raises a ValueError for an unknown scope")
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            pipeline_thread.get_executors("thread", key="device")
+
+
+@pytest.mark.describe("pipeline_thread - Executors")
+class TestExecutors(object):
+    @pytest.fixture
+    def executors(self):
+        return pipeline_thread.Executors(name="test")
+
+    @pytest.fixture
+    def global_pipeline_thread(self):
+        return pipeline_thread.invoke_on_pipeline_thread(get_thread)()
+
+    @pytest.mark.it(
+        "Runs functions which are given the Executors object on its own pipeline thread"
+    )
+    def test_explicit(self, executors, global_pipeline_thread):
+        thread = pipeline_thread.invoke_on_pipeline_thread(get_thread, executors=executors)()
+        assert thread.name == "pipeline"
+        assert thread is not global_pipeline_thread
+        assert (
+            pipeline_thread.invoke_on_pipeline_thread(get_thread, executors=executors)() is thread
+        )
+
+    @pytest.mark.it("Runs callbacks on its own callback thread")
+    def test_callback(self, executors):
+        thread = pipeline_thread.invoke_on_callback_thread_nowait(
+            get_thread, executors=executors
+        )().result()
+        assert thread.name == "callback"
+        assert thread is not pipeline_thread.invoke_on_callback_thread_nowait(get_thread)().result()
+
+    @pytest.mark.it("Runs functions which are decorated on one of its threads on its threads")
+    def test_decorated_on_thread(self, executors):
+        def decorate():
+            return (
+                get_thread(),
+                pipeline_thread.invoke_on_pipeline_thread_nowait(get_thread),
+                pipeline_thread.invoke_on_callback_thread_nowait(get_thread),
+            )
+
+        executors_thread = pipeline_thread.invoke_on_pipeline_thread(
+            get_thread, executors=executors
+        )
+        pipeline, on_pipeline, on_callback = pipeline_thread.invoke_on_pipeline_thread(
+            decorate, executors=executors
+        )()
+        # The functions are called from this thread, like the transport or a timer would
+        assert on_pipeline().result() is pipeline
+        assert on_pipeline().result() is executors_thread()
+        assert on_callback().result() is executors.get("callback").submit(get_thread).result()
+
+    @pytest.mark.it("Runs methods of a stage on the threads of the stage's pipeline_root")
+    def test_stage_method(self, executors, global_pipeline_thread):
+        class Stage(pipeline_stages_base.PipelineStage):
+            def _execute_op(self, op):
+                pass
+
+            @pipeline_thread.invoke_on_pipeline_thread_nowait
+            def on_timer(self):
+                return get_thread()
+
+        root = pipeline_stages_base.PipelineRootStage(executors=executors)
+        stage = Stage()
+        root.append_stage(stage)
+        thread = stage.on_timer().result()
+        assert thread.name == "pipeline"
+        assert thread is not global_pipeline_thread
+        assert Stage().on_timer().result() is global_pipeline_thread
+
+    @pytest.mark.it("Doesn't run functions of another Executors object inline")
+    def test_other_executors_not_inline(self, executors, global_pipeline_thread):
+        @pipeline_thread.invoke_on_pipeline_thread
+        def call_other():
+            return (
+                get_thread(),
+                pipeline_thread.invoke_on_pipeline_thread(get_thread, executors=executors)(),
+            )
+
+        caller, callee = call_other()
+        assert caller is global_pipeline_thread
+        assert callee is not caller
+        assert callee.name == "pipeline"
+
+    @pytest.mark.it("Runs the functions of different Executors objects at the same time")
+    def test_concurrent(self):
+        barrier = threading.Event()
+        other = pipeline_thread.Executors(name="other")
+
+        def wait():
+            return barrier.wait(5)
+
+        def release():
+            barrier.set()
+            return True
+
+        waiting = pipeline_thread.invoke_on_pipeline_thread_nowait(
+            wait, executors=pipeline_thread.Executors(name="waiting")
+        )()
+        assert pipeline_thread.invoke_on_pipeline_thread(release, executors=other)()
+        assert waiting.result() is True
+
+
+class FakeLoop(object):
+    """Event loop which only runs the functions scheduled on it when it is told to"""
+
+    def __init__(self):
+        self.scheduled = []
+
+    def call_soon(self, fn):
+        self.scheduled.append(("call_soon", fn))
+
+    def call_soon_threadsafe(self, fn):
+        self.scheduled.append(("call_soon_threadsafe", fn))
+
+    def run_scheduled(self):
+        while self.scheduled:
+            self.scheduled.pop(0)[1]()
+
+
+@pytest.mark.describe("pipeline_thread - EventLoopExecutors")
+class TestEventLoopExecutors(object):
+    @pytest.fixture
+    def executors(self):
+        return pipeline_thread.EventLoopExecutors(name="test")
+
+    @pytest.fixture
+    def loop(self, executors):
+        loop = FakeLoop()
+        executors.bind(loop)
+        return loop
+
+    @pytest.mark.it("Runs functions inline, as the pipeline thread, until it is bound to a loop")
+    def test_unbound(self, executors):
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_pipeline():
+            return get_thread()
+
+        assert pipeline_thread.invoke_on_pipeline_thread(on_pipeline, executors=executors)() is (
+            threading.current_thread()
+        )
+        assert pipeline_thread.invoke_on_pipeline_thread_nowait(get_thread, executors=executors)()
+        assert threading.current_thread().name != "pipeline"
+
+    @pytest.mark.it("Runs pipeline functions inline when they are called on the loop's thread")
+    def test_bound_inline(self, executors, loop):
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_pipeline():
+            return get_thread()
+
+        result = pipeline_thread.invoke_on_pipeline_thread_nowait(
+            on_pipeline, executors=executors
+        )()
+        assert result is threading.current_thread()
+        assert loop.scheduled == []
+
+    @pytest.mark.it("Schedules callbacks on the loop with call_soon instead of running them inline")
+    def test_callback(self, executors, loop):
+        future = pipeline_thread.invoke_on_callback_thread_nowait(get_thread, executors=executors)()
+        assert not future.done()
+        assert [method for method, _ in loop.scheduled] == ["call_soon"]
+        loop.run_scheduled()
+        assert future.result() is threading.current_thread()
+
+    @pytest.mark.it(
+        "Schedules functions called from other threads on the loop with call_soon_threadsafe"
+    )
+    def test_other_thread(self, executors, loop):
+        @pipeline_thread.runs_on_pipeline_thread
+        def on_pipeline():
+            return get_thread()
+
+        futures = []
+        t = threading.Thread(
+            target=lambda: futures.append(
+                pipeline_thread.invoke_on_pipeline_thread_nowait(on_pipeline, executors=executors)()
+            )
+        )
+        t.start()
+        t.join()
+        assert [method for method, _ in loop.scheduled] == ["call_soon_threadsafe"]
+        loop.run_scheduled()
+        assert futures[0].result() is threading.current_thread()
+
+    @pytest.mark.it(
+        "Reports an exception raised by a scheduled function as an unhandled background exception"
+    )
+    def test_exception(self, mocker, executors, loop):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
+        error = ValueError()
+
+        def raise_error():
+            raise error
+
+        future = pipeline_thread.invoke_on_callback_thread_nowait(
+            raise_error, executors=executors
+        )()
+        loop.run_scheduled()
+        assert future.done()
+        assert mock_handler.call_args == mocker.call(error)
+
+    @pytest.mark.it(
+        "Can be bound to the same loop again, but raises a RuntimeError for another one"
+    )
+    def test_rebind(self, executors, loop):
+        executors.bind(loop)
+        with pytest.raises(RuntimeError):
+            executors.bind(FakeLoop())
+        assert executors.loop is loop
@@ -8,6 +8,7 @@ import pytest
 import inspect
 import asyncio
 import logging
+import threading
 import azure.iot.device.common.async_adapter as async_adapter
 
 logging.basicConfig(level=logging.INFO)
@@ -90,6 +91,15 @@ class TestAwaitableCallback(object):
         await asyncio.sleep(0.1)  # wait to give time to complete the callback
         assert callback.future.done()
 
+    @pytest.mark.it(
+        "Completes the instance Future straight away when called on the event loop's thread"
+    )
+    async def test_calling_object_on_loop_completes_future(self, mock_function):
+        callback = async_adapter.AwaitableCallback(mock_function)
+        callback()
+        assert callback.future.done()
+        assert callback.future.result() == mock_function.return_value
+
     @pytest.mark.it("Can be called using positional arguments")
     async def test_can_be_called_using_positional_args(self, mocker, mock_function):
         callback = async_adapter.AwaitableCallback(mock_function)
@@ -112,3 +122,41 @@ class TestAwaitableCallback(object):
         callback()
         assert await callback.completion() == mock_function.return_value
         assert callback.future.done()
+
+    @pytest.mark.it(
+        "Raises the error when awaiting completion if called with an 'error' keyword argument, without invoking the callback function"
+    )
+    async def test_error_kwarg(self, mock_function):
+        callback = async_adapter.AwaitableCallback(mock_function)
+        error = ValueError()
+        callback(error=error)
+        with pytest.raises(ValueError) as e_info:
+            await callback.completion()
+        assert e_info.value is error
+        assert mock_function.call_count == 0
+
+    @pytest.mark.it("Does nothing to the instance Future if it was cancelled before the call")
+    @pytest.mark.parametrize(
+        "kwargs", [pytest.param({}, id="Result"), pytest.param({"error": ValueError()}, id="Error")]
+    )
+    @pytest.mark.parametrize(
+        "on_loop", [pytest.param(True, id="On loop"), pytest.param(False, id="Other thread")]
+    )
+    async def test_cancelled(self, mock_function, kwargs, on_loop):
+        loop = asyncio.get_event_loop()
+        loop_errors = []
+        loop.set_exception_handler(lambda loop, context: loop_errors.append(context))
+        try:
+            callback = async_adapter.AwaitableCallback(mock_function)
+            callback.future.cancel()
+            if on_loop:
+                callback(**kwargs)
+            else:
+                t = threading.Thread(target=lambda: callback(**kwargs))
+                t.start()
+                t.join()
+            await asyncio.sleep(0.1)  # wait to give time to complete the callback
+        finally:
+            loop.set_exception_handler(None)
+        assert callback.future.cancelled()
+        assert loop_errors == []
@@ -0,0 +1,122 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import array
+import logging
+import six
+from azure.iot.device.common import buffers
+
+logging.basicConfig(level=logging.INFO)
+
+fake_text = b"\xc3\xa9t\xc3\xa9".decode("utf-8")
+fake_bytes = b"\xc3\xa9t\xc3\xa9"
+
+
+@pytest.mark.describe("buffers - .get_size()")
+class TestGetSize(object):
+    @pytest.mark.it("Returns the number of bytes the payload is sent as")
+    @pytest.mark.parametrize(
+        "payload, expected",
+        [
+            pytest.param(None, 0, id="None"),
+            pytest.param(b"abc", 3, id="bytes"),
+            pytest.param(bytearray(b"abcd"), 4, id="bytearray"),
+            pytest.param(memoryview(b"abcde")[1:], 4, id="memoryview"),
+            pytest.param(fake_text, 5, id="text"),
+            pytest.param(1234, 4, id="int"),
+            pytest.param(array.array("i", [1, 2]), 2 * array.array("i").itemsize, id="array"),
+        ],
+    )
+    def test_size(self, payload, expected):
+        assert buffers.get_size(payload) == expected
+
+    @pytest.mark.it("Raises a TypeError for an unsupported payload")
+    def test_unsupported(self):
+        with pytest.raises(TypeError):
+            buffers.get_size({"a": 1})
+
+
+@pytest.mark.describe("buffers - .get_bytes_like()")
+class TestGetBytesLike(object):
+    @pytest.mark.it("Returns bytes and bytearrays without copying them")
+    @pytest.mark.parametrize("payload", [b"abc", bytearray(b"abc")], ids=["bytes", "bytearray"])
+    def test_not_copied(self, payload):
+        assert buffers.get_bytes_like(payload) is payload
+
+    @pytest.mark.it("Returns other buffers without copying them on Python 3")
+    @pytest.mark.skipif(six.PY2, reason="The Python 2.7 standard library can't read memoryviews")
+    def test_memoryview_not_copied(self):
+        payload = memoryview(b"abc")
+        assert buffers.get_bytes_like(payload) is payload
+
+    @pytest.mark.it("Encodes text and numbers as UTF-8")
+    @pytest.mark.parametrize(
+        "payload, expected",
+        [
+            pytest.param(None, b"", id="None"),
+            pytest.param(fake_text, fake_bytes, id="text"),
+            pytest.param(12, b"12", id="int"),
+            pytest.param(1.5, b"1.5", id="float"),
+        ],
+    )
+    def test_encoded(self, payload, expected):
+        assert buffers.get_bytes_like(payload) == expected
+
+    @pytest.mark.it("Raises a TypeError for an unsupported payload")
+    def test_unsupported(self):
+        with pytest.raises(TypeError):
+            buffers.get_bytes_like(object())
+
+
+@pytest.mark.describe("buffers - .get_publishable()")
+class TestGetPublishable(object):
+    @pytest.mark.it("Returns payloads which paho accepts as they are")
+    @pytest.mark.parametrize(
+        "payload",
+        [None, b"abc", bytearray(b"abc"), fake_text, 12, 1.5],
+        ids=["None", "bytes", "bytearray", "text", "int", "float"],
+    )
+    def test_accepted(self, payload):
+        assert buffers.get_publishable(payload) is payload
+
+    @pytest.mark.it("Unwraps a memoryview over a whole bytes or bytearray object")
+    @pytest.mark.parametrize("obj", [b"abc", bytearray(b"abc")], ids=["bytes", "bytearray"])
+    @pytest.mark.skipif(six.PY2, reason="memoryview.obj doesn't exist on Python 2.7")
+    def test_unwrapped(self, obj):
+        assert buffers.get_publishable(memoryview(obj)) is obj
+
+    @pytest.mark.it("Copies a slice of a buffer into bytes")
+    def test_slice(self):
+        publishable = buffers.get_publishable(memoryview(b"abcdef")[2:4])
+        assert isinstance(publishable, bytes)
+        assert publishable == b"cd"
+
+    @pytest.mark.it("Copies any other buffer into bytes")
+    def test_array(self):
+        payload = array.array("b", [1, 2, 3])
+        assert buffers.get_publishable(payload) == b"\x01\x02\x03"
+
+    @pytest.mark.it("Raises a TypeError for an unsupported payload")
+    def test_unsupported(self):
+        with pytest.raises(TypeError):
+            buffers.get_publishable([1, 2, 3])
+
+
+@pytest.mark.describe("buffers - .to_text()")
+class TestToText(object):
+    @pytest.mark.it("Decodes a UTF-8 payload")
+    @pytest.mark.parametrize(
+        "payload",
+        [fake_bytes, bytearray(fake_bytes), memoryview(fake_bytes), fake_text],
+        ids=["bytes", "bytearray", "memoryview", "text"],
+    )
+    def test_decodes(self, payload):
+        assert buffers.to_text(payload) == fake_text
+
+    @pytest.mark.it("Raises a UnicodeDecodeError if the payload isn't UTF-8")
+    def test_invalid(self):
+        with pytest.raises(UnicodeDecodeError):
+            buffers.to_text(b"\xff\xfe")
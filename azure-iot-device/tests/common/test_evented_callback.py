@@ -0,0 +1,81 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+from concurrent import futures
+from azure.iot.device.common.evented_callback import EventedCallback, FutureCallback
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.mark.describe("EventedCallback")
+class TestEventedCallback(object):
+    @pytest.mark.it("Sets the completion event when called")
+    def test_sets_event(self):
+        callback = EventedCallback()
+        assert not callback.completion_event.is_set()
+        callback()
+        assert callback.completion_event.is_set()
+
+    @pytest.mark.it("Returns None from .wait_for_completion() if called without arguments")
+    def test_returns_none(self):
+        callback = EventedCallback()
+        callback()
+        assert callback.wait_for_completion() is None
+
+    @pytest.mark.it(
+        "Returns the first positional argument from .wait_for_completion() if called with one"
+    )
+    def test_returns_result(self):
+        callback = EventedCallback()
+        result = object()
+        callback(result)
+        assert callback.wait_for_completion() is result
+
+    @pytest.mark.it(
+        "Raises the error from .wait_for_completion() if called with an 'error' keyword argument"
+    )
+    def test_raises_error(self):
+        callback = EventedCallback()
+        error = ValueError("fake error")
+        callback(error=error)
+        with pytest.raises(ValueError) as e_info:
+            callback.wait_for_completion()
+        assert e_info.value is error
+
+
+@pytest.mark.describe("FutureCallback")
+class TestFutureCallback(object):
+    @pytest.mark.it("Has a running Future which can't be cancelled")
+    def test_future(self):
+        callback = FutureCallback()
+        assert isinstance(callback.future, futures.Future)
+        assert callback.future.running()
+        assert not callback.future.cancel()
+
+    @pytest.mark.it("Completes the Future with a result of None if called without arguments")
+    def test_returns_none(self):
+        callback = FutureCallback()
+        callback()
+        assert callback.future.result(0) is None
+
+    @pytest.mark.it(
+        "Completes the Future with the first positional argument as its result if called with one"
+    )
+    def test_returns_result(self):
+        callback = FutureCallback()
+        result = object()
+        callback(result)
+        assert callback.future.result(0) is result
+
+    @pytest.mark.it("Fails the Future with the error if called with an 'error' keyword argument")
+    def test_raises_error(self):
+        callback = FutureCallback()
+        error = ValueError("fake error")
+        callback(error=error)
+        with pytest.raises(ValueError) as e_info:
+            callback.future.result(0)
+        assert e_info.value is error
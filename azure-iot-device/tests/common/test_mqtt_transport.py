@@ -4,14 +4,16 @@
 # license information.
 # --------------------------------------------------------------------------
 
+from azure.iot.device.common import mqtt_transport
 from azure.iot.device.common.mqtt_transport import MQTTTransport, OperationManager
 from azure.iot.device.common.models.x509 import X509
-from azure.iot.device.common import errors
+from azure.iot.device.common import errors, ssl_context_cache
 import paho.mqtt.client as mqtt
 import ssl
 import copy
 import pytest
 import logging
+import threading
 
 logging.basicConfig(level=logging.INFO)
 
@@ -28,6 +30,14 @@ fake_rc = 0
 failed_conack_rc = mqtt.CONNACK_REFUSED_IDENTIFIER_REJECTED
 
 
+@pytest.fixture(autouse=True)
+def clear_ssl_context_cache():
+    # Contexts created by one test must not be reused by the next one
+    ssl_context_cache.clear()
+    yield
+    ssl_context_cache.clear()
+
+
 class DummyException(Exception):
     pass
 
@@ -170,9 +180,12 @@ class TestInstantiation(object):
         assert mock_ssl_context.check_hostname is True
         assert mock_ssl_context.verify_mode == ssl.CERT_REQUIRED
 
-        # Verify context has been set
+        # Verify context has been set.  It is wrapped to allow TLS session resumption.
         assert mock_mqtt_client.tls_set_context.call_count == 1
-        assert mock_mqtt_client.tls_set_context.call_args == mocker.call(context=mock_ssl_context)
+        context = mock_mqtt_client.tls_set_context.call_args[1]["context"]
+        assert context._ssl_context is mock_ssl_context
+        assert context.check_hostname is True
+        assert context.verify_mode == ssl.CERT_REQUIRED
 
     @pytest.mark.it(
         "Configures TLS/SSL context using default certificates if protocol wrapper not instantiated with a CA certificate"
@@ -227,6 +240,29 @@ class TestInstantiation(object):
             fake_client_cert.pass_phrase,
         )
 
+    @pytest.mark.it(
+        "Reuses the TLS/SSL context of another protocol wrapper instantiated with the same certificates"
+    )
+    def test_shares_tls_context(self, mocker, mock_mqtt_client):
+        mock_ssl_context_constructor = mocker.patch.object(ssl, "SSLContext")
+        ca_cert = "dummy_certificate"
+
+        MQTTTransport(
+            client_id=fake_device_id,
+            hostname=fake_hostname,
+            username=fake_username,
+            ca_cert=ca_cert,
+        )
+        MQTTTransport(
+            client_id="other_device",
+            hostname=fake_hostname,
+            username=fake_username,
+            ca_cert=ca_cert,
+        )
+
+        assert mock_ssl_context_constructor.call_count == 1
+        assert mock_mqtt_client.tls_set_context.call_count == 2
+
     @pytest.mark.it("Sets Paho MQTT Client callbacks")
     def test_sets_paho_callbacks(self, mocker):
         mock_mqtt_client = mocker.patch.object(mqtt, "Client").return_value
@@ -261,6 +297,22 @@ class TestInstantiation(object):
         assert transport._op_manager._unknown_operation_completions == {}
 
 
+@pytest.mark.describe("MQTTTransport - .set_max_inflight_messages()")
+class TestSetMaxInflightMessages(object):
+    @pytest.mark.it("Sets the maximum number of in-flight messages on the Paho client")
+    def test_calls_paho_max_inflight_messages_set(self, mocker, mock_mqtt_client, transport):
+        transport.set_max_inflight_messages(42)
+
+        assert mock_mqtt_client.max_inflight_messages_set.call_count == 1
+        assert mock_mqtt_client.max_inflight_messages_set.call_args == mocker.call(42)
+
+    @pytest.mark.it("Raises a ValueError if Paho rejects the value")
+    def test_paho_raises_value_error(self, mock_mqtt_client, transport):
+        mock_mqtt_client.max_inflight_messages_set.side_effect = ValueError
+        with pytest.raises(ValueError):
+            transport.set_max_inflight_messages(-1)
+
+
 @pytest.mark.describe("MQTTTransport - .connect()")
 class TestConnect(object):
     @pytest.mark.it("Uses the stored username and provided password for Paho credentials")
@@ -297,6 +349,15 @@ class TestConnect(object):
         assert mock_mqtt_client.connect.call_count == 1
         assert mock_mqtt_client.connect.call_args == mocker.call(host=fake_hostname, port=8883)
 
+    @pytest.mark.it("Connects to the port the protocol wrapper was instantiated with")
+    def test_custom_port(self, mocker, mock_mqtt_client):
+        transport = MQTTTransport(
+            client_id=fake_device_id, hostname=fake_hostname, username=fake_username, port=1883
+        )
+        transport.connect(fake_password)
+
+        assert mock_mqtt_client.connect.call_args == mocker.call(host=fake_hostname, port=1883)
+
     @pytest.mark.it("Starts MQTT Network Loop")
     @pytest.mark.parametrize(
         "password",
@@ -375,6 +436,67 @@ class TestReconnect(object):
             transport.reconnect(fake_password)
 
 
+@pytest.mark.describe("MQTTTransport - TLS Session Resumption")
+class TestTLSSessionResumption(object):
+    @pytest.fixture
+    def mock_ssl_context(self, mocker):
+        return mocker.patch.object(ssl, "SSLContext").return_value
+
+    @pytest.fixture
+    def paho_context(self, mock_ssl_context, mock_mqtt_client, transport):
+        # The context given to Paho, which Paho uses to wrap each new socket
+        return mock_mqtt_client.tls_set_context.call_args[1]["context"]
+
+    def open_connection(self, mocker, mock_mqtt_client, paho_context, session_reused=False):
+        ssl_socket = paho_context.wrap_socket(
+            mocker.MagicMock(), server_hostname=fake_hostname, do_handshake_on_connect=False
+        )
+        ssl_socket.session_reused = session_reused
+        mock_mqtt_client.on_connect(client=mock_mqtt_client, userdata=None, flags=None, rc=fake_rc)
+        return ssl_socket
+
+    @pytest.mark.it("Does not offer a TLS session on the first connection")
+    def test_first_connection(self, mocker, mock_mqtt_client, mock_ssl_context, paho_context):
+        self.open_connection(mocker, mock_mqtt_client, paho_context)
+        assert mock_ssl_context.wrap_socket.call_count == 1
+        assert "session" not in mock_ssl_context.wrap_socket.call_args[1]
+
+    @pytest.mark.it("Offers the TLS session of the previous connection when reconnecting")
+    def test_offers_previous_session(
+        self, mocker, mock_mqtt_client, mock_ssl_context, paho_context
+    ):
+        ssl_socket = self.open_connection(mocker, mock_mqtt_client, paho_context)
+        session = ssl_socket.session
+        self.open_connection(mocker, mock_mqtt_client, paho_context)
+
+        assert mock_ssl_context.wrap_socket.call_count == 2
+        assert mock_ssl_context.wrap_socket.call_args[1]["session"] is session
+        assert mock_ssl_context.wrap_socket.call_args[1]["server_hostname"] == fake_hostname
+
+    @pytest.mark.it("Does not keep the TLS session of a connection which was refused")
+    def test_connection_refused(self, mocker, mock_mqtt_client, mock_ssl_context, paho_context):
+        paho_context.wrap_socket(mocker.MagicMock())
+        mock_mqtt_client.on_connect(
+            client=mock_mqtt_client, userdata=None, flags=None, rc=failed_conack_rc
+        )
+        paho_context.wrap_socket(mocker.MagicMock())
+        assert "session" not in mock_ssl_context.wrap_socket.call_args[1]
+
+    @pytest.mark.it("Reports whether the current connection resumed the previous TLS session")
+    @pytest.mark.parametrize(
+        "session_reused", [pytest.param(True, id="Resumed"), pytest.param(False, id="Not resumed")]
+    )
+    def test_session_reused(
+        self, mocker, mock_mqtt_client, paho_context, transport, session_reused
+    ):
+        self.open_connection(mocker, mock_mqtt_client, paho_context, session_reused=session_reused)
+        assert transport.tls_session_reused is session_reused
+
+    @pytest.mark.it("Reports that the TLS session was not resumed before connecting")
+    def test_not_connected(self, paho_context, transport):
+        assert transport.tls_session_reused is False
+
+
 @pytest.mark.describe("MQTTTransport - EVENT: Connect Completed")
 class TestEventConnectComplete(object):
     @pytest.mark.it(
@@ -1115,6 +1237,27 @@ class TestPublish(object):
             topic=fake_topic, payload=fake_payload, qos=qos
         )
 
+    @pytest.mark.it("Publishes a memoryview over a whole bytes object without copying it")
+    def test_publishes_memoryview(self, mocker, mock_mqtt_client, transport):
+        payload = b"some payload"
+        transport.publish(topic=fake_topic, payload=memoryview(payload), qos=1)
+
+        assert mock_mqtt_client.publish.call_args[1]["payload"] is payload
+
+    @pytest.mark.it("Copies a buffer which Paho can't publish into bytes")
+    def test_publishes_memoryview_slice(self, mocker, mock_mqtt_client, transport):
+        transport.publish(topic=fake_topic, payload=memoryview(b"some payload")[5:], qos=1)
+
+        assert mock_mqtt_client.publish.call_args == mocker.call(
+            topic=fake_topic, payload=b"payload", qos=1
+        )
+
+    @pytest.mark.it("Raises TypeError on a payload of an unsupported type")
+    def test_raises_type_error_invalid_payload_type(self, mock_mqtt_client, transport):
+        with pytest.raises(TypeError):
+            transport.publish(topic=fake_topic, payload={"a": 1}, qos=1)
+        assert mock_mqtt_client.publish.call_count == 0
+
     @pytest.mark.it("Raises ValueError on invalid QoS")
     @pytest.mark.parametrize("qos", [pytest.param(-1, id="QoS < 0"), pytest.param(3, id="Qos > 2")])
     def test_raises_value_error_invalid_qos(self, qos):
@@ -1481,6 +1624,68 @@ class TestMisc(object):
         assert callback3.call_count == 1
 
 
+@pytest.mark.describe("MQTTTransport - ack_timeout")
+class TestAckTimeout(object):
+    @pytest.fixture
+    def transport(self, mock_mqtt_client):
+        return MQTTTransport(
+            client_id=fake_device_id,
+            hostname=fake_hostname,
+            username=fake_username,
+            ack_timeout=0.05,
+        )
+
+    @pytest.mark.it("Fails an operation with a TimeoutError if it is not acknowledged in time")
+    def test_times_out(self, mocker, transport):
+        failed = threading.Event()
+        errors_received = []
+
+        def callback(error=None):
+            errors_received.append(error)
+            failed.set()
+
+        transport.publish(topic=fake_topic, payload=fake_payload, callback=callback)
+
+        assert failed.wait(5)
+        assert isinstance(errors_received[0], errors.TimeoutError)
+        assert transport.operation_stats["timed_out"] == 1
+        assert transport.operation_stats["pending"] == 0
+
+    @pytest.mark.it("Does not fail an operation which is acknowledged in time")
+    def test_acknowledged(self, mocker, mock_mqtt_client, transport):
+        callback = mocker.MagicMock()
+        transport.publish(topic=fake_topic, payload=fake_payload, callback=callback)
+        mock_mqtt_client.on_publish(client=mock_mqtt_client, userdata=None, mid=fake_mid)
+
+        assert callback.call_args == mocker.call()
+        assert transport.operation_stats["completed"] == 1
+        assert transport.operation_stats["timed_out"] == 0
+
+    @pytest.mark.it("Does not check for timeouts if no ack_timeout is set")
+    def test_no_ack_timeout(self, mocker, mock_mqtt_client):
+        timer = mocker.patch.object(threading, "Timer")
+        transport = MQTTTransport(
+            client_id=fake_device_id, hostname=fake_hostname, username=fake_username
+        )
+        transport.publish(topic=fake_topic, payload=fake_payload)
+        assert timer.call_count == 0
+
+
+@pytest.fixture
+def clock(mocker):
+    """
+    Replace the clock used by OperationManager with one which only moves when told to.
+    """
+    now = [1000.0]
+    mocker.patch.object(mqtt_transport, "_clock", side_effect=lambda: now[0])
+
+    class Clock(object):
+        def advance(self, seconds):
+            now[0] += seconds
+
+    return Clock()
+
+
 @pytest.mark.describe("OperationManager")
 class TestOperationManager(object):
     @pytest.mark.it("Instantiates with no operation tracking information")
@@ -1711,3 +1916,124 @@ class TestOperationManagerCompleteOperation(object):
 
         # Callback WAS NOT called while the lock was held
         assert mocker.call.cb() not in calls_during_lock
+
+
+@pytest.mark.describe("OperationManager - MID reuse and stale completions")
+class TestOperationManagerStaleness(object):
+    @pytest.mark.it("Fails a pending operation whose MID is reused by a new operation")
+    def test_mid_reused(self, mocker):
+        manager = OperationManager()
+        old_callback = mocker.MagicMock()
+        new_callback = mocker.MagicMock()
+
+        manager.establish_operation(1, old_callback)
+        manager.establish_operation(1, new_callback)
+
+        assert old_callback.call_count == 1
+        assert isinstance(old_callback.call_args[1]["error"], errors.ProtocolClientError)
+        assert manager._pending_operation_callbacks[1] is new_callback
+
+    @pytest.mark.it(
+        "Does not complete an operation with an unknown completion older than UNKNOWN_COMPLETION_TTL"
+    )
+    def test_stale_unknown_completion(self, mocker, clock):
+        manager = OperationManager()
+        callback = mocker.MagicMock()
+
+        manager.complete_operation(1)
+        clock.advance(mqtt_transport.UNKNOWN_COMPLETION_TTL + 1)
+        manager.establish_operation(1, callback)
+
+        assert callback.call_count == 0
+        assert manager._pending_operation_callbacks[1] is callback
+        assert manager.get_stats()["discarded_unknown_completions"] == 1
+
+    @pytest.mark.it("Remembers at most MAX_UNKNOWN_COMPLETIONS unknown completions")
+    def test_max_unknown_completions(self, mocker):
+        mocker.patch.object(mqtt_transport, "MAX_UNKNOWN_COMPLETIONS", 3)
+        manager = OperationManager()
+
+        for mid in range(5):
+            manager.complete_operation(mid)
+
+        assert list(manager._unknown_operation_completions) == [2, 3, 4]
+
+
+@pytest.mark.describe("OperationManager - .expire_operations()")
+class TestOperationManagerExpireOperations(object):
+    @pytest.mark.it("Fails operations which have been pending for ack_timeout with a TimeoutError")
+    def test_fails_expired(self, mocker, clock):
+        manager = OperationManager(ack_timeout=10)
+        old_callback = mocker.MagicMock()
+        new_callback = mocker.MagicMock()
+
+        manager.establish_operation(1, old_callback)
+        clock.advance(5)
+        manager.establish_operation(2, new_callback)
+        clock.advance(5)
+
+        assert manager.expire_operations() == 1
+        assert isinstance(old_callback.call_args[1]["error"], errors.TimeoutError)
+        assert new_callback.call_count == 0
+        assert list(manager._pending_operation_callbacks) == [2]
+
+    @pytest.mark.it("Never fails operations if there is no ack_timeout")
+    def test_no_ack_timeout(self, mocker, clock):
+        manager = OperationManager()
+        callback = mocker.MagicMock()
+
+        manager.establish_operation(1, callback)
+        clock.advance(100000)
+
+        assert manager.expire_operations() == 0
+        assert callback.call_count == 0
+
+    @pytest.mark.it("Discards unknown completions older than UNKNOWN_COMPLETION_TTL")
+    def test_discards_unknown_completions(self, clock):
+        manager = OperationManager()
+
+        manager.complete_operation(1)
+        clock.advance(mqtt_transport.UNKNOWN_COMPLETION_TTL + 1)
+        manager.expire_operations()
+
+        assert len(manager._unknown_operation_completions) == 0
+
+    @pytest.mark.it("Does not trigger the callbacks while holding the lock")
+    def test_callback_called_after_lock_release(self, mocker, clock):
+        manager = OperationManager(ack_timeout=1)
+        held = []
+        callback = mocker.MagicMock(side_effect=lambda error: held.append(manager._lock.locked()))
+
+        manager.establish_operation(1, callback)
+        clock.advance(1)
+        manager.expire_operations()
+
+        assert held == [False]
+
+
+@pytest.mark.describe("OperationManager - .get_stats()")
+class TestOperationManagerGetStats(object):
+    @pytest.mark.it("Reports the state of the bookkeeping and the ack latency")
+    def test_stats(self, clock):
+        manager = OperationManager()
+        manager.establish_operation(1)
+        manager.establish_operation(2)
+        manager.establish_operation(3)
+        clock.advance(1)
+        manager.complete_operation(1)
+        clock.advance(2)
+        manager.complete_operation(2)
+        manager.complete_operation(4)
+
+        assert manager.get_stats() == {
+            "pending": 1,
+            "unknown_completions": 1,
+            "completed": 2,
+            "timed_out": 0,
+            "discarded_unknown_completions": 0,
+            "ack_latency": {"count": 2, "min": 1.0, "max": 3.0, "mean": 2.0},
+        }
+
+    @pytest.mark.it("Reports no ack latency before anything is acknowledged")
+    def test_no_ack_latency(self):
+        assert OperationManager().get_stats()["ack_latency"] is None
@@ -0,0 +1,8 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""In-process fake of the IoT Hub MQTT endpoint, for local testing and benchmarking."""
+
+from .hub import FakeHub, TelemetryMessage, MethodResult, create_self_signed_certificate
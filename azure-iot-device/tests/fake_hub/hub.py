@@ -0,0 +1,728 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains an in-process stand-in for the MQTT surface of an IoT Hub.  It can be used
+to run the clients against a real socket without a network connection, e.g. to measure throughput
+and latency, and to inject faults such as slow acknowledgements, throttling and dropped connections.
+"""
+
+import base64
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import logging
+import os
+import socket
+import ssl
+import subprocess
+import threading
+import time
+import uuid
+import six.moves.urllib as urllib
+from . import mqtt_codec
+
+logger = logging.getLogger(__name__)
+
+_C2D_FILTER = "devices/{device_id}/messages/devicebound/#"
+_INPUT_FILTER = "devices/{device_id}/modules/{module_id}/inputs/#"
+_METHOD_FILTER = "$iothub/methods/POST/#"
+_TWIN_RESPONSE_FILTER = "$iothub/twin/res/#"
+_TWIN_PATCH_FILTER = "$iothub/twin/PATCH/properties/desired/#"
+
+
+def create_self_signed_certificate(directory, hostname="localhost"):
+    """
+    Create a self-signed server certificate for the fake hub using the openssl command line tool.
+
+    :param str directory: The directory to write the certificate and key to.
+    :param str hostname: The hostname the certificate is valid for.
+
+    :returns: A tuple of (certificate file, key file).
+    :raises: OSError if openssl is not available.
+    :raises: subprocess.CalledProcessError if openssl fails.
+    """
+    cert_file = os.path.join(directory, "fake_hub_cert.pem")
+    key_file = os.path.join(directory, "fake_hub_key.pem")
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-days",
+                "1",
+                "-subj",
+                "/CN={}".format(hostname),
+                "-addext",
+                "subjectAltName=DNS:{},IP:127.0.0.1".format(hostname),
+                "-keyout",
+                key_file,
+                "-out",
+                cert_file,
+            ],
+            stdout=devnull,
+            stderr=devnull,
+        )
+    return cert_file, key_file
+
+
+def _get_feature_filter(feature, identity):
+    if feature == "c2d":
+        return _C2D_FILTER.format(device_id=identity.device_id)
+    if feature == "input":
+        return _INPUT_FILTER.format(device_id=identity.device_id, module_id=identity.module_id)
+    if feature == "methods":
+        return _METHOD_FILTER
+    if feature == "twin":
+        return _TWIN_RESPONSE_FILTER
+    if feature == "twin_patches":
+        return _TWIN_PATCH_FILTER
+    raise ValueError("Unknown feature {}".format(feature))
+
+
+def _encode_properties(properties):
+    if not properties:
+        return ""
+    return "&".join(
+        "{}={}".format(urllib.parse.quote_plus(str(k)), urllib.parse.quote_plus(str(v)))
+        for k, v in properties.items()
+    )
+
+
+def _decode_properties(properties_str):
+    properties = {}
+    for pair in properties_str.split("&"):
+        if pair:
+            key, _, value = pair.partition("=")
+            properties[urllib.parse.unquote_plus(key)] = urllib.parse.unquote_plus(value)
+    return properties
+
+
+def _get_query_properties(topic):
+    return _decode_properties(topic.partition("?")[2])
+
+
+def _merge_patch(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_patch(target[key], value)
+        else:
+            target[key] = value
+
+
+class TelemetryMessage(object):
+    """
+    A telemetry message (or output event) received by the fake hub.
+
+    :ivar device_id: The device which sent the message.
+    :ivar module_id: The module which sent the message, if any.
+    :ivar payload: The payload of the message, as bytes.
+    :ivar properties: The system and custom properties encoded on the topic.
+    :ivar received_time: The time.time() at which the message was received.
+    """
+
+    def __init__(self, device_id, module_id, payload, properties):
+        self.device_id = device_id
+        self.module_id = module_id
+        self.payload = payload
+        self.properties = properties
+        self.received_time = time.time()
+
+    @property
+    def output_name(self):
+        return self.properties.get("$.on")
+
+
+class MethodResult(object):
+    """
+    The response to a method invoked through the fake hub.
+    """
+
+    def __init__(self, status, payload):
+        self.status = status
+        self.payload = payload
+
+
+class _Identity(object):
+    def __init__(self, device_id, module_id, symmetric_key):
+        self.device_id = device_id
+        self.module_id = module_id
+        self.symmetric_key = symmetric_key
+        self.desired = {}
+        self.desired_version = 1
+        self.reported = {}
+        self.reported_version = 1
+
+    @property
+    def client_id(self):
+        if self.module_id:
+            return "{}/{}".format(self.device_id, self.module_id)
+        return self.device_id
+
+    @property
+    def topic_base(self):
+        if self.module_id:
+            return "devices/{}/modules/{}".format(self.device_id, self.module_id)
+        return "devices/{}".format(self.device_id)
+
+    def get_twin(self):
+        desired = dict(self.desired, **{"$version": self.desired_version})
+        reported = dict(self.reported, **{"$version": self.reported_version})
+        return {"desired": desired, "reported": reported}
+
+
+class FakeHub(object):
+    """
+    In-process fake of the MQTT endpoint of an IoT Hub.
+
+    It supports SAS token authentication, telemetry and output events, C2D messages, input messages,
+    direct methods, and twin GET, reported properties PATCH and desired properties PATCH.  All traffic
+    to identities which are not registered with add_device() or add_module() is refused.
+
+    :ivar latency: Seconds to wait before sending each packet to a client.
+    :ivar puback_delay: Additional seconds to wait before acknowledging each telemetry message.
+    :ivar max_telemetry_per_second: If set, telemetry acknowledgements are delayed so that no more
+      than this many telemetry messages are acknowledged per second across the whole hub.
+    :ivar refuse_connections: If set to a CONNACK return code, every new connection is refused with
+      that code.
+    """
+
+    def __init__(
+        self,
+        hostname="localhost",
+        cert_file=None,
+        key_file=None,
+        port=0,
+        latency=0.0,
+        puback_delay=0.0,
+        max_telemetry_per_second=None,
+    ):
+        """
+        Initializer for FakeHub objects.  The hub does not listen until start() is called.
+
+        :param str hostname: The hostname clients must use in their username and SAS token.
+        :param str cert_file: (Optional) Server certificate.  If provided along with key_file, the hub
+          listens for TLS connections.  Otherwise, it listens for plain TCP connections.
+        :param str key_file: (Optional) Key for the server certificate.
+        :param int port: (Optional) Port to listen on.  By default, a free port is picked.
+        :param float latency: (Optional) See the latency attribute.
+        :param float puback_delay: (Optional) See the puback_delay attribute.
+        :param float max_telemetry_per_second: (Optional) See the max_telemetry_per_second attribute.
+        """
+        self.hostname = hostname
+        self.latency = latency
+        self.puback_delay = puback_delay
+        self.max_telemetry_per_second = max_telemetry_per_second
+        self.refuse_connections = None
+
+        self.telemetry = []
+        self.connection_count = 0
+
+        self._requested_port = port
+        self._ssl_context = None
+        if cert_file and key_file:
+            self._ssl_context = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS", ssl.PROTOCOL_SSLv23))
+            self._ssl_context.load_cert_chain(cert_file, key_file)
+
+        self._lock = threading.Condition()
+        self._identities = {}
+        self._connections = {}
+        self._pending_methods = {}
+        self._next_ack_time = 0.0
+        self._listener = None
+        self._accept_thread = None
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def port(self):
+        """
+        The port the hub is listening on.
+        """
+        return self._listener.getsockname()[1]
+
+    def start(self):
+        """
+        Start listening for connections on the loopback interface.
+        """
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", self._requested_port))
+        self._listener.listen(128)
+        self._running = True
+        self._accept_thread = threading.Thread(target=self._accept_loop, name="FakeHubAccept")
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+        logger.info("Fake hub listening on port {}".format(self.port))
+
+    def stop(self):
+        """
+        Stop listening and drop every connection.
+        """
+        self._running = False
+        try:
+            # Unblock accept()
+            socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+        except (OSError, IOError):
+            pass
+        self._listener.close()
+        self._accept_thread.join()
+        self.disconnect()
+
+    def add_device(self, device_id, symmetric_key=None):
+        """
+        Register a device.  If symmetric_key is None, any password is accepted for the device.
+        """
+        self._add_identity(_Identity(device_id, None, symmetric_key))
+
+    def add_module(self, device_id, module_id, symmetric_key=None):
+        """
+        Register a module.  If symmetric_key is None, any password is accepted for the module.
+        """
+        self._add_identity(_Identity(device_id, module_id, symmetric_key))
+
+    def _add_identity(self, identity):
+        with self._lock:
+            self._identities[identity.client_id] = identity
+
+    def _get_identity(self, device_id, module_id):
+        client_id = "{}/{}".format(device_id, module_id) if module_id else device_id
+        with self._lock:
+            return self._identities[client_id]
+
+    def is_connected(self, device_id, module_id=None):
+        identity = self._get_identity(device_id, module_id)
+        with self._lock:
+            return identity.client_id in self._connections
+
+    def wait_for_connection(self, device_id, module_id=None, timeout=10):
+        """
+        Wait until the identity is connected.
+
+        :returns: True if the identity is connected, False if the timeout expired.
+        """
+        identity = self._get_identity(device_id, module_id)
+        with self._lock:
+            return self._wait_for(lambda: identity.client_id in self._connections, timeout)
+
+    def wait_for_subscription(self, feature, device_id, module_id=None, timeout=10):
+        """
+        Wait until the identity has subscribed to the topics of a feature.
+
+        :param str feature: One of "c2d", "input", "methods", "twin" or "twin_patches".
+
+        :returns: True if the identity is subscribed, False if the timeout expired.
+        """
+        identity = self._get_identity(device_id, module_id)
+        topic_filter = _get_feature_filter(feature, identity)
+
+        def is_subscribed():
+            connection = self._connections.get(identity.client_id)
+            return connection is not None and topic_filter in connection.subscriptions
+
+        with self._lock:
+            return self._wait_for(is_subscribed, timeout)
+
+    def wait_for_telemetry(self, count, timeout=10):
+        """
+        Wait until at least count telemetry messages have been received.
+
+        :returns: True if the messages were received, False if the timeout expired.
+        """
+        with self._lock:
+            return self._wait_for(lambda: len(self.telemetry) >= count, timeout)
+
+    def _wait_for(self, predicate, timeout):
+        deadline = time.time() + timeout
+        while not predicate():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._lock.wait(remaining)
+        return True
+
+    def disconnect(self, device_id=None, module_id=None):
+        """
+        Drop the connection of an identity without sending anything, as if the network failed.
+        If device_id is None, every connection is dropped.
+        """
+        with self._lock:
+            if device_id is None:
+                connections = list(self._connections.values())
+                self._connections.clear()
+            else:
+                client_id = self._get_identity(device_id, module_id).client_id
+                connection = self._connections.pop(client_id, None)
+                connections = [connection] if connection else []
+        for connection in connections:
+            connection.close()
+
+    def send_c2d_message(self, device_id, payload, properties=None):
+        """
+        Send a C2D message to a device.  It is dropped if the device is not subscribed.
+
+        :param dict properties: (Optional) Properties to encode on the topic, e.g. {"$.mid": "id"}.
+        """
+        identity = self._get_identity(device_id, None)
+        topic = "{}/messages/devicebound/{}".format(
+            identity.topic_base, _encode_properties(properties)
+        )
+        self._publish_to(identity, topic, payload, qos=1)
+
+    def send_input_message(self, device_id, module_id, input_name, payload, properties=None):
+        """
+        Send a message to an input of a module.  It is dropped if the module is not subscribed.
+        """
+        identity = self._get_identity(device_id, module_id)
+        topic = "{}/inputs/{}/{}".format(
+            identity.topic_base, input_name, _encode_properties(properties)
+        )
+        self._publish_to(identity, topic, payload, qos=1)
+
+    def invoke_method(self, device_id, method_name, payload, module_id=None, timeout=30):
+        """
+        Invoke a direct method and wait for the response.
+
+        :returns: A MethodResult, or None if the client did not respond within the timeout.
+        """
+        identity = self._get_identity(device_id, module_id)
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            self._pending_methods[request_id] = None
+        topic = "$iothub/methods/POST/{}/?$rid={}".format(method_name, request_id)
+        self._publish_to(identity, topic, json.dumps(payload), qos=0)
+        with self._lock:
+            self._wait_for(lambda: self._pending_methods[request_id] is not None, timeout)
+            return self._pending_methods.pop(request_id)
+
+    def get_twin(self, device_id, module_id=None):
+        """
+        Return the twin of an identity as a dict with desired and reported properties.
+        """
+        identity = self._get_identity(device_id, module_id)
+        with self._lock:
+            return identity.get_twin()
+
+    def patch_desired_properties(self, device_id, patch, module_id=None):
+        """
+        Update the desired properties of an identity and notify it if it is subscribed.
+        """
+        identity = self._get_identity(device_id, module_id)
+        with self._lock:
+            _merge_patch(identity.desired, patch)
+            identity.desired_version += 1
+            version = identity.desired_version
+        topic = "$iothub/twin/PATCH/properties/desired/?$version={}".format(version)
+        self._publish_to(identity, topic, json.dumps(dict(patch, **{"$version": version})))
+
+    def _publish_to(self, identity, topic, payload, qos=0):
+        with self._lock:
+            connection = self._connections.get(identity.client_id)
+        if connection:
+            connection.send_if_subscribed(topic, payload, qos)
+        else:
+            logger.info(
+                "{} is not connected.  Dropping message on {}".format(identity.client_id, topic)
+            )
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, _ = self._listener.accept()
+            except (OSError, IOError):
+                break
+            if not self._running:
+                sock.close()
+                break
+            connection = _Connection(self, sock)
+            connection.start()
+
+    def _authenticate(self, connect):
+        """
+        Check the credentials of a CONNECT packet.
+
+        :returns: A tuple of (CONNACK return code, identity).
+        """
+        if self.refuse_connections is not None:
+            return self.refuse_connections, None
+        if connect["protocol_level"] != mqtt_codec.MQTT_PROTOCOL_LEVEL:
+            return mqtt_codec.CONNACK_REFUSED_PROTOCOL_VERSION, None
+        with self._lock:
+            identity = self._identities.get(connect["client_id"])
+        if identity is None:
+            return mqtt_codec.CONNACK_REFUSED_IDENTIFIER_REJECTED, None
+
+        expected_username_prefix = "{}/{}/".format(self.hostname, identity.client_id)
+        if not (connect["username"] or "").startswith(expected_username_prefix):
+            return mqtt_codec.CONNACK_REFUSED_BAD_USERNAME_PASSWORD, None
+        if identity.symmetric_key is not None and not self._check_sas_token(
+            identity, connect["password"]
+        ):
+            return mqtt_codec.CONNACK_REFUSED_NOT_AUTHORIZED, None
+        return mqtt_codec.CONNACK_ACCEPTED, identity
+
+    def _check_sas_token(self, identity, token):
+        prefix = "SharedAccessSignature "
+        if not token or not token.startswith(prefix):
+            return False
+        fields = {}
+        for pair in token[len(prefix) :].split("&"):
+            key, _, value = pair.partition("=")
+            fields[key] = value
+        try:
+            resource_uri = fields["sr"]
+            expiry = fields["se"]
+            signature = urllib.parse.unquote(fields["sig"])
+        except KeyError:
+            return False
+        expected_uri = "{}/{}".format(self.hostname, identity.topic_base)
+        if urllib.parse.unquote_plus(resource_uri) != expected_uri:
+            return False
+        if int(expiry) < time.time():
+            return False
+        message = (resource_uri + "\n" + expiry).encode("utf-8")
+        key = base64.b64decode(identity.symmetric_key.encode("utf-8"))
+        expected = base64.b64encode(hmac.HMAC(key, message, hashlib.sha256).digest())
+        return hmac.compare_digest(expected, signature.encode("utf-8"))
+
+    def _on_connected(self, identity, connection):
+        with self._lock:
+            previous = self._connections.get(identity.client_id)
+            self._connections[identity.client_id] = connection
+            self.connection_count += 1
+            self._lock.notify_all()
+        if previous:
+            # Like IoT Hub, only the newest connection of an identity is kept
+            previous.close()
+
+    def _on_disconnected(self, identity, connection):
+        with self._lock:
+            if self._connections.get(identity.client_id) is connection:
+                del self._connections[identity.client_id]
+            self._lock.notify_all()
+
+    def _on_telemetry(self, identity, topic, payload):
+        """
+        Record a telemetry message.
+
+        :returns: The number of seconds to wait before acknowledging the message.
+        """
+        properties = _decode_properties(topic.partition("/messages/events/")[2])
+        message = TelemetryMessage(identity.device_id, identity.module_id, payload, properties)
+        with self._lock:
+            self.telemetry.append(message)
+            self._lock.notify_all()
+            delay = self.puback_delay
+            if self.max_telemetry_per_second:
+                now = time.time()
+                ack_time = max(now, self._next_ack_time)
+                self._next_ack_time = ack_time + 1.0 / self.max_telemetry_per_second
+                delay += ack_time - now
+        return delay
+
+    def _on_method_response(self, topic, payload):
+        status = int(topic.split("/")[3])
+        request_id = _get_query_properties(topic).get("$rid")
+        with self._lock:
+            if request_id in self._pending_methods:
+                self._pending_methods[request_id] = MethodResult(status, payload)
+                self._lock.notify_all()
+
+    def _on_twin_request(self, identity, topic, payload):
+        """
+        :returns: A tuple of (response topic, response payload).
+        """
+        request_id = _get_query_properties(topic).get("$rid")
+        with self._lock:
+            if topic.startswith("$iothub/twin/GET/"):
+                return (
+                    "$iothub/twin/res/200/?$rid={}".format(request_id),
+                    json.dumps(identity.get_twin()),
+                )
+            if topic.startswith("$iothub/twin/PATCH/properties/reported/"):
+                try:
+                    patch = json.loads(payload.decode("utf-8"))
+                except ValueError:
+                    return "$iothub/twin/res/400/?$rid={}".format(request_id), ""
+                _merge_patch(identity.reported, patch)
+                identity.reported_version += 1
+                return (
+                    "$iothub/twin/res/204/?$rid={}&$version={}".format(
+                        request_id, identity.reported_version
+                    ),
+                    "",
+                )
+        return "$iothub/twin/res/404/?$rid={}".format(request_id), ""
+
+
+class _Connection(object):
+    """
+    A single client connection to the fake hub.  Incoming packets are handled on a reader thread.
+    Outgoing packets are sent on a writer thread, which delays them by the latency of the hub.
+    """
+
+    def __init__(self, hub, sock):
+        self.hub = hub
+        self.identity = None
+        self.subscriptions = set()
+        self._sock = sock
+        self._closed = False
+        self._send_lock = threading.Condition()
+        self._send_queue = []
+        self._sequence = itertools.count()
+        self._packet_ids = itertools.count(1)
+
+    def start(self):
+        reader = threading.Thread(target=self._read_loop, name="FakeHubReader")
+        reader.daemon = True
+        reader.start()
+
+    def close(self):
+        with self._send_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._send_lock.notify_all()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, IOError):
+            pass
+        self._sock.close()
+
+    def send(self, packet, delay=0.0):
+        due = time.time() + self.hub.latency + delay
+        with self._send_lock:
+            heapq.heappush(self._send_queue, (due, next(self._sequence), packet))
+            self._send_lock.notify_all()
+
+    def publish(self, topic, payload, qos=0):
+        packet_id = (next(self._packet_ids) % 65535) + 1 if qos else None
+        self.send(mqtt_codec.publish(topic, payload, qos=qos, packet_id=packet_id))
+
+    def _write_loop(self):
+        while True:
+            with self._send_lock:
+                while not self._closed and (
+                    not self._send_queue or self._send_queue[0][0] > time.time()
+                ):
+                    timeout = self._send_queue[0][0] - time.time() if self._send_queue else None
+                    self._send_lock.wait(timeout)
+                if self._closed:
+                    return
+                _, _, packet = heapq.heappop(self._send_queue)
+            try:
+                self._sock.sendall(packet)
+            except (OSError, IOError):
+                self.close()
+                return
+
+    def _read_loop(self):
+        try:
+            if self.hub._ssl_context:
+                self._sock = self.hub._ssl_context.wrap_socket(self._sock, server_side=True)
+            writer = threading.Thread(target=self._write_loop, name="FakeHubWriter")
+            writer.daemon = True
+            writer.start()
+
+            packet_type, _, body = mqtt_codec.read_packet(self._sock)
+            if packet_type != mqtt_codec.CONNECT:
+                raise mqtt_codec.MQTTProtocolError("First packet was not CONNECT")
+            return_code, identity = self.hub._authenticate(mqtt_codec.parse_connect(body))
+            if return_code != mqtt_codec.CONNACK_ACCEPTED:
+                logger.info("Refused connection with return code {}".format(return_code))
+                # Send the CONNACK directly, since the connection is closed right after it
+                time.sleep(self.hub.latency)
+                self._sock.sendall(mqtt_codec.connack(return_code))
+                return
+            self.send(mqtt_codec.connack(return_code))
+            self.identity = identity
+            self.hub._on_connected(identity, self)
+
+            while True:
+                packet_type, flags, body = mqtt_codec.read_packet(self._sock)
+                if packet_type == mqtt_codec.DISCONNECT:
+                    break
+                self._handle_packet(packet_type, flags, body)
+        except (EOFError, OSError, IOError, ssl.SSLError):
+            pass
+        except mqtt_codec.MQTTProtocolError as e:
+            logger.warning("Dropping connection: {}".format(e))
+        finally:
+            if self.identity:
+                self.hub._on_disconnected(self.identity, self)
+            self.close()
+
+    def _handle_packet(self, packet_type, flags, body):
+        if packet_type == mqtt_codec.PUBLISH:
+            topic, qos, packet_id, payload = mqtt_codec.parse_publish(flags, body)
+            self._handle_publish(topic, qos, packet_id, payload)
+        elif packet_type == mqtt_codec.SUBSCRIBE:
+            packet_id, subscriptions = mqtt_codec.parse_subscribe(body)
+            return_codes = []
+            with self.hub._lock:
+                for topic_filter, qos in subscriptions:
+                    if topic_filter in self._allowed_filters():
+                        self.subscriptions.add(topic_filter)
+                        return_codes.append(min(qos, 1))
+                    else:
+                        return_codes.append(mqtt_codec.SUBACK_FAILURE)
+                self.hub._lock.notify_all()
+            self.send(mqtt_codec.suback(packet_id, return_codes))
+        elif packet_type == mqtt_codec.UNSUBSCRIBE:
+            packet_id, topic_filters = mqtt_codec.parse_unsubscribe(body)
+            with self.hub._lock:
+                for topic_filter in topic_filters:
+                    self.subscriptions.discard(topic_filter)
+            self.send(mqtt_codec.unsuback(packet_id))
+        elif packet_type == mqtt_codec.PINGREQ:
+            self.send(mqtt_codec.pingresp())
+        elif packet_type == mqtt_codec.PUBACK:
+            # Acknowledgement of a message sent by the hub.  Nothing is retried, so nothing to do.
+            pass
+        else:
+            raise mqtt_codec.MQTTProtocolError("Unexpected packet type {}".format(packet_type))
+
+    def _allowed_filters(self):
+        features = ["methods", "twin", "twin_patches"]
+        features.append("input" if self.identity.module_id else "c2d")
+        return [_get_feature_filter(feature, self.identity) for feature in features]
+
+    def _handle_publish(self, topic, qos, packet_id, payload):
+        ack_delay = 0.0
+        if topic.startswith(self.identity.topic_base + "/messages/events/"):
+            ack_delay = self.hub._on_telemetry(self.identity, topic, payload)
+        elif topic.startswith("$iothub/methods/res/"):
+            self.hub._on_method_response(topic, payload)
+        elif topic.startswith("$iothub/twin/"):
+            response_topic, response_payload = self.hub._on_twin_request(
+                self.identity, topic, payload
+            )
+            self.send_if_subscribed(response_topic, response_payload)
+        else:
+            # IoT Hub drops the connection when a client publishes to a topic it doesn't own
+            raise mqtt_codec.MQTTProtocolError("Publish to unsupported topic {}".format(topic))
+        if qos:
+            self.send(mqtt_codec.puback(packet_id), delay=ack_delay)
+
+    def _is_subscribed(self, topic):
+        with self.hub._lock:
+            return any(mqtt_codec.topic_matches(f, topic) for f in self.subscriptions)
+
+    def send_if_subscribed(self, topic, payload, qos=0):
+        if self._is_subscribed(topic):
+            self.publish(topic, payload, qos)
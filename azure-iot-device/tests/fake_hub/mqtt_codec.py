@@ -0,0 +1,236 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+"""This module contains the encoding and decoding of the MQTT 3.1.1 packets used by the fake hub.
+Only the server side of the protocol is implemented, and only QoS 0 and 1 are supported.
+"""
+
+import struct
+
+# Packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# CONNACK return codes
+CONNACK_ACCEPTED = 0
+CONNACK_REFUSED_PROTOCOL_VERSION = 1
+CONNACK_REFUSED_IDENTIFIER_REJECTED = 2
+CONNACK_REFUSED_SERVER_UNAVAILABLE = 3
+CONNACK_REFUSED_BAD_USERNAME_PASSWORD = 4
+CONNACK_REFUSED_NOT_AUTHORIZED = 5
+
+# SUBACK return code for a rejected subscription
+SUBACK_FAILURE = 0x80
+
+MQTT_PROTOCOL_LEVEL = 4
+
+
+class MQTTProtocolError(Exception):
+    """
+    Raised when a client sends something which is not valid MQTT 3.1.1.
+    """
+
+    pass
+
+
+def _recv_exactly(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return data
+
+
+def read_packet(sock):
+    """
+    Read a single packet from a socket.
+
+    :returns: A tuple of (packet type, flags, body).
+    :raises: EOFError if the connection was closed.
+    """
+    header = ord(_recv_exactly(sock, 1))
+    remaining_length = 0
+    multiplier = 1
+    while True:
+        byte = ord(_recv_exactly(sock, 1))
+        remaining_length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128**3:
+            raise MQTTProtocolError("Malformed remaining length")
+    body = _recv_exactly(sock, remaining_length) if remaining_length else b""
+    return (header >> 4, header & 0x0F, body)
+
+
+def _encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_packet(packet_type, flags, body=b""):
+    return (
+        struct.pack("!B", (packet_type << 4) | flags) + _encode_remaining_length(len(body)) + body
+    )
+
+
+def _encode_string(value):
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def _decode_bytes(body, offset):
+    (length,) = struct.unpack_from("!H", body, offset)
+    offset += 2
+    return body[offset : offset + length], offset + length
+
+
+def _decode_string(body, offset):
+    value, offset = _decode_bytes(body, offset)
+    return value.decode("utf-8"), offset
+
+
+def parse_connect(body):
+    """
+    :returns: A dict with the protocol_level, client_id, username, password and keepalive.
+    """
+    protocol_name, offset = _decode_string(body, 0)
+    if protocol_name != "MQTT":
+        raise MQTTProtocolError("Unsupported protocol {}".format(protocol_name))
+    protocol_level, connect_flags, keepalive = struct.unpack_from("!BBH", body, offset)
+    offset += 4
+    client_id, offset = _decode_string(body, offset)
+    if connect_flags & 0x04:
+        # Skip the will topic and will message
+        _, offset = _decode_bytes(body, offset)
+        _, offset = _decode_bytes(body, offset)
+    username = password = None
+    if connect_flags & 0x80:
+        username, offset = _decode_string(body, offset)
+    if connect_flags & 0x40:
+        password, offset = _decode_string(body, offset)
+    return {
+        "protocol_level": protocol_level,
+        "clean_session": bool(connect_flags & 0x02),
+        "client_id": client_id,
+        "username": username,
+        "password": password,
+        "keepalive": keepalive,
+    }
+
+
+def parse_publish(flags, body):
+    """
+    :returns: A tuple of (topic, qos, packet id, payload).  The packet id is None for QoS 0.
+    """
+    qos = (flags >> 1) & 0x03
+    if qos > 1:
+        raise MQTTProtocolError("QoS {} is not supported".format(qos))
+    topic, offset = _decode_string(body, 0)
+    packet_id = None
+    if qos:
+        (packet_id,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+    return topic, qos, packet_id, body[offset:]
+
+
+def parse_subscribe(body):
+    """
+    :returns: A tuple of (packet id, list of (topic filter, requested qos) tuples).
+    """
+    (packet_id,) = struct.unpack_from("!H", body, 0)
+    offset = 2
+    subscriptions = []
+    while offset < len(body):
+        topic_filter, offset = _decode_string(body, offset)
+        subscriptions.append((topic_filter, ord(body[offset : offset + 1])))
+        offset += 1
+    return packet_id, subscriptions
+
+
+def parse_unsubscribe(body):
+    """
+    :returns: A tuple of (packet id, list of topic filters).
+    """
+    (packet_id,) = struct.unpack_from("!H", body, 0)
+    offset = 2
+    topic_filters = []
+    while offset < len(body):
+        topic_filter, offset = _decode_string(body, offset)
+        topic_filters.append(topic_filter)
+    return packet_id, topic_filters
+
+
+def parse_packet_id(body):
+    (packet_id,) = struct.unpack_from("!H", body, 0)
+    return packet_id
+
+
+def connack(return_code, session_present=False):
+    return _encode_packet(CONNACK, 0, struct.pack("!BB", int(session_present), return_code))
+
+
+def publish(topic, payload, qos=0, packet_id=None):
+    if not isinstance(payload, bytes):
+        payload = payload.encode("utf-8")
+    body = _encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return _encode_packet(PUBLISH, qos << 1, body + payload)
+
+
+def puback(packet_id):
+    return _encode_packet(PUBACK, 0, struct.pack("!H", packet_id))
+
+
+def suback(packet_id, return_codes):
+    return _encode_packet(
+        SUBACK,
+        0,
+        struct.pack("!H", packet_id) + struct.pack("!{}B".format(len(return_codes)), *return_codes),
+    )
+
+
+def unsuback(packet_id):
+    return _encode_packet(UNSUBACK, 0, struct.pack("!H", packet_id))
+
+
+def pingresp():
+    return _encode_packet(PINGRESP, 0)
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Return True if a topic matches a subscription topic filter, which may contain wildcards.
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
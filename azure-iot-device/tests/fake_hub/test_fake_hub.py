@@ -0,0 +1,257 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import base64
+import io
+import json
+import logging
+import subprocess
+import threading
+import time
+from azure.iot.device import IoTHubDeviceClient, IoTHubModuleClient, Message, MethodResponse
+from azure.iot.device.common import errors
+from tests.fake_hub import FakeHub, create_self_signed_certificate
+from tests.fake_hub import mqtt_codec
+
+logging.basicConfig(level=logging.INFO)
+
+device_id = "fake_device"
+module_id = "fake_module"
+shared_access_key = base64.b64encode(b"fake shared access key").decode("utf-8")
+device_connection_string = "HostName=localhost;DeviceId={};SharedAccessKey={}".format(
+    device_id, shared_access_key
+)
+module_connection_string = "HostName=localhost;DeviceId={};ModuleId={};SharedAccessKey={}".format(
+    device_id, module_id, shared_access_key
+)
+
+
+@pytest.fixture(scope="module")
+def certificate(tmpdir_factory):
+    try:
+        cert_file, key_file = create_self_signed_certificate(str(tmpdir_factory.mktemp("fake_hub")))
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl is required to create a certificate for the fake hub")
+    with io.open(cert_file, mode="r") as f:
+        ca_cert = f.read()
+    return cert_file, key_file, ca_cert
+
+
+@pytest.fixture
+def hub(certificate):
+    hub = FakeHub(cert_file=certificate[0], key_file=certificate[1])
+    hub.add_device(device_id, shared_access_key)
+    hub.add_module(device_id, module_id, shared_access_key)
+    hub.start()
+    yield hub
+    hub.stop()
+
+
+def create_client(client_class, connection_string, hub, certificate, **kwargs):
+    return client_class.create_from_connection_string(
+        connection_string,
+        ca_cert=certificate[2],
+        port=hub.port,
+        reconnect_initial_delay=0.1,
+        reconnect_max_delay=0.5,
+        **kwargs
+    )
+
+
+@pytest.fixture
+def device_client(hub, certificate):
+    client = create_client(IoTHubDeviceClient, device_connection_string, hub, certificate)
+    client.connect()
+    yield client
+    client.disconnect()
+
+
+@pytest.fixture
+def module_client(hub, certificate):
+    client = create_client(IoTHubModuleClient, module_connection_string, hub, certificate)
+    client.connect()
+    yield client
+    client.disconnect()
+
+
+def run_in_thread(fn):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn()))
+    thread.daemon = True
+    thread.start()
+    return thread, result
+
+
+@pytest.mark.describe("FakeHub - Connect")
+class TestFakeHubConnect(object):
+    @pytest.mark.it("Accepts a client with a valid SAS token")
+    def test_connect(self, hub, device_client):
+        assert hub.is_connected(device_id)
+
+    @pytest.mark.it("Refuses a client whose SAS token is signed with the wrong key")
+    def test_wrong_key(self, hub, certificate):
+        wrong_key = base64.b64encode(b"wrong key").decode("utf-8")
+        client = create_client(
+            IoTHubDeviceClient,
+            device_connection_string.replace(shared_access_key, wrong_key),
+            hub,
+            certificate,
+        )
+        with pytest.raises(errors.UnauthorizedError):
+            client.connect()
+        assert not hub.is_connected(device_id)
+
+    @pytest.mark.it("Refuses every client when refuse_connections is set")
+    def test_refuse_connections(self, hub, certificate):
+        hub.refuse_connections = mqtt_codec.CONNACK_REFUSED_SERVER_UNAVAILABLE
+        client = create_client(IoTHubDeviceClient, device_connection_string, hub, certificate)
+        with pytest.raises(errors.ConnectionFailedError):
+            client.connect()
+
+
+@pytest.mark.describe("FakeHub - Telemetry")
+class TestFakeHubTelemetry(object):
+    @pytest.mark.it("Records telemetry messages along with their properties")
+    def test_telemetry(self, hub, device_client):
+        message = Message("hello", message_id="mid")
+        message.custom_properties["key"] = "value"
+        device_client.send_d2c_message(message)
+
+        assert len(hub.telemetry) == 1
+        assert hub.telemetry[0].device_id == device_id
+        assert hub.telemetry[0].payload == b"hello"
+        assert hub.telemetry[0].properties == {"$.mid": "mid", "key": "value"}
+
+    @pytest.mark.it("Records output events along with their output name")
+    def test_output_event(self, hub, module_client):
+        module_client.send_to_output(Message("hello"), "output1")
+
+        assert hub.telemetry[0].module_id == module_id
+        assert hub.telemetry[0].output_name == "output1"
+
+    @pytest.mark.it("Delays the acknowledgement of telemetry by puback_delay")
+    def test_puback_delay(self, hub, device_client):
+        hub.puback_delay = 0.3
+        start = time.time()
+        device_client.send_d2c_message(Message("hello"))
+        assert time.time() - start >= 0.3
+
+    @pytest.mark.it("Records QoS 0 telemetry without acknowledging it")
+    def test_qos_0(self, hub, device_client):
+        hub.puback_delay = 5
+        start = time.time()
+        device_client.send_d2c_message(Message("hello", qos=0))
+        assert time.time() - start < 5
+        assert hub.wait_for_telemetry(1)
+        assert hub.telemetry[0].payload == b"hello"
+
+    @pytest.mark.it("Limits the rate of acknowledgements to max_telemetry_per_second")
+    def test_throttling(self, hub, device_client):
+        hub.max_telemetry_per_second = 20
+        start = time.time()
+        device_client.send_d2c_messages([Message(str(i)) for i in range(10)])
+        # The first message is acknowledged straight away
+        assert time.time() - start >= 9 / 20.0
+
+    @pytest.mark.it("Delays every packet sent to the client by latency")
+    def test_latency(self, hub, device_client):
+        hub.latency = 0.2
+        start = time.time()
+        device_client.send_d2c_message(Message("hello"))
+        assert time.time() - start >= 0.2
+
+
+@pytest.mark.describe("FakeHub - Messages to the client")
+class TestFakeHubMessagesToClient(object):
+    @pytest.mark.it("Delivers C2D messages along with their properties")
+    def test_c2d(self, hub, device_client):
+        thread, result = run_in_thread(device_client.receive_c2d_message)
+        assert hub.wait_for_subscription("c2d", device_id)
+        hub.send_c2d_message(device_id, "c2d payload", {"$.mid": "mid", "key": "value"})
+        thread.join(10)
+
+        assert result[0].data == b"c2d payload"
+        assert result[0].message_id == "mid"
+        assert result[0].custom_properties == {"key": "value"}
+
+    @pytest.mark.it("Delivers input messages")
+    def test_input(self, hub, module_client):
+        thread, result = run_in_thread(lambda: module_client.receive_input_message("input1"))
+        assert hub.wait_for_subscription("input", device_id, module_id)
+        hub.send_input_message(device_id, module_id, "input1", "input payload")
+        thread.join(10)
+
+        assert result[0].data == b"input payload"
+
+
+@pytest.mark.describe("FakeHub - Methods")
+class TestFakeHubMethods(object):
+    @pytest.mark.it("Invokes a method and returns the response of the client")
+    def test_method(self, hub, device_client):
+        def respond():
+            request = device_client.receive_method_request("reboot")
+            device_client.send_method_response(
+                MethodResponse.create_from_method_request(request, 200, {"got": request.payload})
+            )
+
+        thread, _ = run_in_thread(respond)
+        assert hub.wait_for_subscription("methods", device_id)
+        result = hub.invoke_method(device_id, "reboot", {"delay": 1}, timeout=10)
+        thread.join(10)
+
+        assert result.status == 200
+        assert json.loads(result.payload.decode("utf-8")) == {"got": {"delay": 1}}
+
+    @pytest.mark.it("Returns None if the client does not respond in time")
+    def test_method_timeout(self, hub, device_client):
+        assert hub.invoke_method(device_id, "reboot", None, timeout=0.1) is None
+
+
+@pytest.mark.describe("FakeHub - Twin")
+class TestFakeHubTwin(object):
+    @pytest.mark.it("Returns the twin to the client")
+    def test_get_twin(self, hub, device_client):
+        hub.patch_desired_properties(device_id, {"interval": 5})
+        twin = device_client.get_twin()
+        assert twin["desired"] == {"interval": 5, "$version": 2}
+
+    @pytest.mark.it("Applies reported properties patches from the client")
+    def test_patch_reported(self, hub, device_client):
+        device_client.patch_twin_reported_properties({"status": "ok", "nested": {"a": 1}})
+        device_client.patch_twin_reported_properties({"nested": {"b": 2}, "status": None})
+        assert hub.get_twin(device_id)["reported"] == {"nested": {"a": 1, "b": 2}, "$version": 3}
+
+    @pytest.mark.it("Sends desired properties patches to the client")
+    def test_patch_desired(self, hub, device_client):
+        thread, result = run_in_thread(device_client.receive_twin_desired_properties_patch)
+        assert hub.wait_for_subscription("twin_patches", device_id)
+        hub.patch_desired_properties(device_id, {"interval": 5})
+        thread.join(10)
+
+        assert result[0] == {"interval": 5, "$version": 2}
+
+
+@pytest.mark.describe("FakeHub - Disconnect")
+class TestFakeHubDisconnect(object):
+    @pytest.mark.it("Drops the connection of a client, which then reconnects")
+    def test_disconnect(self, hub, device_client):
+        hub.disconnect(device_id)
+        assert hub.wait_for_connection(device_id)
+        assert hub.connection_count == 2
+        device_client.send_d2c_message(Message("after reconnect"))
+        assert hub.telemetry[-1].payload == b"after reconnect"
+
+    @pytest.mark.it("Lets a reconnecting client resume its TLS session")
+    def test_tls_session_resumption(self, hub, device_client):
+        transport_stage = device_client._iothub_pipeline._pipeline
+        while transport_stage.next:
+            transport_stage = transport_stage.next
+        assert transport_stage.transport.tls_session_reused is False
+
+        hub.disconnect(device_id)
+        assert hub.wait_for_connection(device_id)
+        device_client.send_d2c_message(Message("after reconnect"))
+        assert transport_stage.transport.tls_session_reused is True
@@ -12,10 +12,12 @@ import time
 import os
 import io
 from azure.iot.device.iothub.aio import IoTHubDeviceClient, IoTHubModuleClient
-from azure.iot.device.iothub.pipeline import IoTHubPipeline, constant
+from azure.iot.device.iothub.pipeline import IoTHubPipeline, IoTHubPipelineConfig, constant
+from azure.iot.device.iothub.pipeline import config as pipeline_config
 from azure.iot.device.iothub.models import Message, MethodRequest
 from azure.iot.device.iothub.aio.async_inbox import AsyncClientInbox
 from azure.iot.device.common import async_adapter
+from azure.iot.device.common.pipeline import pipeline_thread
 from azure.iot.device.iothub.auth import IoTEdgeError
 from azure.iot.device.common.models.x509 import X509
 
@@ -64,6 +66,22 @@ class SharedClientInstantiationTests(object):
             == client._inbox_manager.route_method_request
         )
 
+    @pytest.mark.it("Sets on_publish_slot_released handler in the IoTHubPipeline")
+    async def test_sets_on_publish_slot_released_handler_in_pipeline(
+        self, client_class, iothub_pipeline
+    ):
+        client = client_class(iothub_pipeline)
+
+        assert client._iothub_pipeline.on_publish_slot_released == client._on_publish_slot_released
+
+    @pytest.mark.it(
+        "Makes the IoTHubPipeline hand operations to the pipeline without waiting for them to start"
+    )
+    async def test_sets_submit_nowait(self, client_class, iothub_pipeline):
+        client = client_class(iothub_pipeline)
+
+        assert client._iothub_pipeline.submit_nowait is True
+
 
 class SharedClientCreateFromConnectionStringTests(object):
     @pytest.mark.it(
@@ -112,7 +130,34 @@ class SharedClientCreateFromConnectionStringTests(object):
         client_class.create_from_connection_string(*args, **kwargs)
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
+
+    @pytest.mark.it(
+        "Creates the IoTHubPipeline with an IoTHubPipelineConfig built from any additional keyword arguments"
+    )
+    def test_pipeline_configuration(self, mocker, client_class, connection_string):
+        mocker.patch("azure.iot.device.iothub.auth.SymmetricKeyAuthenticationProvider")
+        mock_pipeline_init = mocker.patch("azure.iot.device.iothub.pipeline.IoTHubPipeline")
+
+        client_class.create_from_connection_string(
+            connection_string,
+            max_inflight_publishes=5,
+            max_queued_publishes=10,
+            queue_full_policy=pipeline_config.QUEUE_FULL_ERROR,
+        )
+
+        pipeline_configuration = mock_pipeline_init.call_args[0][1]
+        assert isinstance(pipeline_configuration, IoTHubPipelineConfig)
+        assert pipeline_configuration.max_inflight_publishes == 5
+        assert pipeline_configuration.max_queued_publishes == 10
+        assert pipeline_configuration.queue_full_policy == pipeline_config.QUEUE_FULL_ERROR
+
+    @pytest.mark.it("Raises a TypeError if given an unknown keyword argument")
+    def test_unknown_kwarg(self, mocker, client_class, connection_string):
+        mocker.patch("azure.iot.device.iothub.auth.SymmetricKeyAuthenticationProvider")
+        mocker.patch("azure.iot.device.iothub.pipeline.IoTHubPipeline")
+        with pytest.raises(TypeError):
+            client_class.create_from_connection_string(connection_string, not_an_option=True)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     @pytest.mark.parametrize(
@@ -195,7 +240,7 @@ class SharedClientCreateFromSharedAccessSignature(object):
         client_class.create_from_shared_access_signature(sas_token_string)
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     async def test_client_instantiation(self, mocker, client_class, sas_token_string):
@@ -235,6 +280,11 @@ class SharedClientConnectTests(object):
         await client.connect()
         assert iothub_pipeline.connect.call_count == 1
 
+    @pytest.mark.it("Passes the timeout to the 'connect' pipeline operation")
+    async def test_passes_timeout(self, client, iothub_pipeline):
+        await client.connect(timeout=5)
+        assert iothub_pipeline.connect.call_args[1]["timeout"] == 5
+
     @pytest.mark.it("Waits for the completion of the 'connect' pipeline operation before returning")
     async def test_waits_for_pipeline_op_completion(self, mocker, client, iothub_pipeline):
         cb_mock = mocker.patch.object(async_adapter, "AwaitableCallback").return_value
@@ -247,6 +297,18 @@ class SharedClientConnectTests(object):
         # Assert callback completion is waited upon
         assert cb_mock.completion.call_count == 1
 
+    @pytest.mark.it("Raises the error if the 'connect' pipeline operation fails")
+    async def test_raises_op_error(self, client, iothub_pipeline):
+        error = ValueError("fake error")
+
+        def fail_connect(callback, timeout=None):
+            callback(error=error)
+
+        iothub_pipeline.connect.side_effect = fail_connect
+        with pytest.raises(ValueError) as e_info:
+            await client.connect()
+        assert e_info.value is error
+
 
 class SharedClientDisconnectTests(object):
     @pytest.mark.it("Begins a 'disconnect' pipeline operation")
@@ -278,6 +340,32 @@ class SharedClientDisconnectEventTests(object):
         client._on_disconnected()
         assert clear_method_request_spy.call_count == 1
 
+    @pytest.mark.it(
+        "Releases the sends waiting for room in the publish queue, which then check for room again"
+    )
+    async def test_releases_publish_waiters(self, client, iothub_pipeline, message):
+        iothub_pipeline.publish_would_block.side_effect = [True, True, True, True, False, False]
+
+        first = asyncio.ensure_future(client.send_d2c_message(message))
+        second = asyncio.ensure_future(client.send_d2c_message(message))
+        await asyncio.sleep(0.01)
+
+        client._on_disconnected()
+        assert len(client._publish_waiters) == 0
+        await first
+        await second
+        assert iothub_pipeline.send_d2c_message.call_count == 2
+
+    @pytest.mark.it("Drops the sends waiting for room in the publish queue if the loop is closed")
+    async def test_drops_publish_waiters_on_closed_loop(self, mocker, client):
+        client._loop = mocker.MagicMock()
+        client._loop.is_closed.return_value = True
+        client._publish_waiters.append(mocker.MagicMock())
+
+        client._on_disconnected()
+        assert len(client._publish_waiters) == 0
+        assert client._loop.call_soon_threadsafe.call_count == 0
+
 
 class SharedClientSendD2CMessageTests(object):
     @pytest.mark.it("Begins a 'send_d2c_message' pipeline operation")
@@ -286,6 +374,11 @@ class SharedClientSendD2CMessageTests(object):
         assert iothub_pipeline.send_d2c_message.call_count == 1
         assert iothub_pipeline.send_d2c_message.call_args[0][0] is message
 
+    @pytest.mark.it("Passes the timeout to the 'send_d2c_message' pipeline operation")
+    async def test_passes_timeout(self, client, iothub_pipeline, message):
+        await client.send_d2c_message(message, timeout=5)
+        assert iothub_pipeline.send_d2c_message.call_args[1]["timeout"] == 5
+
     @pytest.mark.it(
         "Waits for the completion of the 'send_d2c_message' pipeline operation before returning"
     )
@@ -323,6 +416,153 @@ class SharedClientSendD2CMessageTests(object):
         assert isinstance(sent_message, Message)
         assert sent_message.data == message_input
 
+    @pytest.mark.it(
+        "Calls the 'send_d2c_message' pipeline operation on the event loop's thread, without an executor"
+    )
+    async def test_calls_pipeline_on_loop(self, mocker, client, iothub_pipeline, message):
+        threads = []
+
+        def send_d2c_message(*args, **kwargs):
+            threads.append(threading.current_thread())
+            kwargs["callback"]()
+
+        iothub_pipeline.send_d2c_message.side_effect = send_d2c_message
+        emulate_async = mocker.spy(async_adapter, "emulate_async")
+
+        await client.send_d2c_message(message)
+
+        assert threads == [threading.current_thread()]
+        assert emulate_async.call_count == 0
+
+    @pytest.mark.it("Binds the pipeline to the running event loop if the pipeline runs on one")
+    async def test_event_loop_binds(self, client_class, iothub_pipeline, message):
+        iothub_pipeline.executors = pipeline_thread.EventLoopExecutors(name="test")
+        client = client_class(iothub_pipeline)
+
+        await client.send_d2c_message(message)
+
+        assert iothub_pipeline.send_d2c_message.call_count == 1
+        assert iothub_pipeline.executors.loop is asyncio.get_event_loop()
+
+    @pytest.mark.it(
+        "Waits on the event loop until the pipeline reports room in the publish queue, from any thread"
+    )
+    async def test_waits_for_publish_slot(self, client, iothub_pipeline, message):
+        iothub_pipeline.publish_would_block.side_effect = [True, True, False]
+
+        send = asyncio.ensure_future(client.send_d2c_message(message))
+        await asyncio.sleep(0.01)
+        assert not send.done()
+        assert iothub_pipeline.send_d2c_message.call_count == 0
+
+        t = threading.Thread(target=iothub_pipeline.on_publish_slot_released)
+        t.start()
+        t.join()
+        await send
+        assert iothub_pipeline.send_d2c_message.call_count == 1
+
+    @pytest.mark.it(
+        "Doesn't wait if there is room in the publish queue by the time it starts waiting"
+    )
+    async def test_publish_slot_released_before_wait(self, client, iothub_pipeline, message):
+        iothub_pipeline.publish_would_block.side_effect = [True, False]
+
+        await client.send_d2c_message(message)
+        assert iothub_pipeline.send_d2c_message.call_count == 1
+
+    @pytest.mark.it(
+        "Passes room in the publish queue on to the next waiting send if a woken send is cancelled"
+    )
+    async def test_cancelled_waiter(self, client, iothub_pipeline, message):
+        iothub_pipeline.publish_would_block.side_effect = [True, True, True, True, False]
+
+        first = asyncio.ensure_future(client.send_d2c_message(message))
+        second = asyncio.ensure_future(client.send_d2c_message(message))
+        await asyncio.sleep(0.01)
+
+        client._on_publish_slot_released()
+        await asyncio.sleep(0)
+        first.cancel()
+        await second
+        assert first.cancelled()
+        assert iothub_pipeline.send_d2c_message.call_count == 1
+
+    @pytest.mark.it("Does not wake a waiting send if the loop has been closed")
+    async def test_slot_released_on_closed_loop(self, mocker, client):
+        client._loop = mocker.MagicMock()
+        client._loop.is_closed.return_value = True
+        client._publish_waiters.append(mocker.MagicMock())
+
+        client._on_publish_slot_released()
+        assert client._loop.call_soon_threadsafe.call_count == 0
+
+    @pytest.mark.it(
+        "Does not raise if the loop is closed while a waiting send is being woken from another thread"
+    )
+    async def test_slot_released_loop_closing(self, mocker, client):
+        client._loop = mocker.MagicMock()
+        client._loop.is_closed.return_value = False
+        client._loop.call_soon_threadsafe.side_effect = RuntimeError("Event loop is closed")
+        client._publish_waiters.append(mocker.MagicMock())
+
+        client._on_publish_slot_released()
+        assert client._loop.call_soon_threadsafe.call_count == 1
+
+
+class SharedClientSendD2CMessagesTests(object):
+    @pytest.mark.it("Begins a single 'send_d2c_messages' pipeline operation for the batch")
+    async def test_calls_pipeline_send_d2c_messages(self, client, iothub_pipeline, message):
+        messages = [message, Message("second"), Message("third")]
+        await client.send_d2c_messages(messages)
+        assert iothub_pipeline.send_d2c_messages.call_count == 1
+        assert iothub_pipeline.send_d2c_messages.call_args[0][0] == messages
+        assert iothub_pipeline.send_d2c_message.call_count == 0
+
+    @pytest.mark.it("Passes the 'max_inflight' parameter to the pipeline")
+    @pytest.mark.parametrize(
+        "max_inflight", [pytest.param(None, id="Default"), pytest.param(10, id="Custom value")]
+    )
+    async def test_passes_max_inflight(self, client, iothub_pipeline, message, max_inflight):
+        await client.send_d2c_messages([message], max_inflight=max_inflight)
+        assert iothub_pipeline.send_d2c_messages.call_args[1]["max_inflight"] == max_inflight
+
+    @pytest.mark.it(
+        "Waits for the completion of the 'send_d2c_messages' pipeline operation before returning"
+    )
+    async def test_waits_for_pipeline_op_completion(self, mocker, client, iothub_pipeline, message):
+        cb_mock = mocker.patch.object(async_adapter, "AwaitableCallback").return_value
+        cb_mock.completion.return_value = await create_completed_future(None)
+
+        await client.send_d2c_messages([message])
+
+        # Assert callback is sent to pipeline
+        assert iothub_pipeline.send_d2c_messages.call_args[1]["callback"] is cb_mock
+        # Assert callback completion is waited upon
+        assert cb_mock.completion.call_count == 1
+
+    @pytest.mark.it("Returns the per-message results from the pipeline operation")
+    async def test_returns_results(self, mocker, client, iothub_pipeline, message):
+        results = [None, ValueError("fake error")]
+
+        def immediate_callback(messages, max_inflight, callback, timeout=None):
+            callback(results)
+
+        mocker.patch.object(iothub_pipeline, "send_d2c_messages", side_effect=immediate_callback)
+
+        returned_results = await client.send_d2c_messages([message, message])
+        assert returned_results is results
+
+    @pytest.mark.it(
+        "Wraps each item in the 'messages' input parameter in a Message object if it is not a Message object"
+    )
+    async def test_wraps_data_in_message(self, client, iothub_pipeline, message):
+        await client.send_d2c_messages([message, "string", 222, {"a": 2}])
+        sent_messages = iothub_pipeline.send_d2c_messages.call_args[0][0]
+        assert sent_messages[0] is message
+        for sent_message, expected_data in zip(sent_messages[1:], ["string", 222, {"a": 2}]):
+            assert isinstance(sent_message, Message)
+            assert sent_message.data == expected_data
+
 
 class SharedClientReceiveMethodRequestTests(object):
     @pytest.mark.it("Implicitly enables methods feature if not already enabled")
@@ -429,7 +669,7 @@ class SharedClientGetTwinTests(object):
     @pytest.mark.it("Implicitly enables twin messaging feature if not already enabled")
     async def test_enables_twin_only_if_not_already_enabled(self, mocker, client, iothub_pipeline):
         # patch this so get_twin won't block
-        def immediate_callback(callback):
+        def immediate_callback(callback, timeout=None):
             callback(None)
 
         mocker.patch.object(iothub_pipeline, "get_twin", side_effect=immediate_callback)
@@ -454,6 +694,15 @@ class SharedClientGetTwinTests(object):
         await client.get_twin()
         assert iothub_pipeline.get_twin.call_count == 1
 
+    @pytest.mark.it(
+        "Passes the timeout to the 'get_twin' pipeline operation and to enabling the twin feature"
+    )
+    async def test_passes_timeout(self, client, iothub_pipeline):
+        iothub_pipeline.feature_enabled.__getitem__.return_value = False
+        await client.get_twin(timeout=5)
+        assert iothub_pipeline.enable_feature.call_args[1]["timeout"] == 5
+        assert iothub_pipeline.get_twin.call_args[1]["timeout"] == 5
+
     @pytest.mark.it(
         "Waits for the completion of the 'get_twin' pipeline operation before returning"
     )
@@ -474,7 +723,7 @@ class SharedClientGetTwinTests(object):
         twin = {"reported": {"foo": "bar"}}
 
         # make the pipeline the twin
-        def immediate_callback(callback):
+        def immediate_callback(callback, timeout=None):
             callback(twin)
 
         mocker.patch.object(iothub_pipeline, "get_twin", side_effect=immediate_callback)
@@ -489,7 +738,7 @@ class SharedClientPatchTwinReportedPropertiesTests(object):
         self, mocker, client, iothub_pipeline, twin_patch_reported
     ):
         # patch this so x_get_twin won't block
-        def immediate_callback(patch, callback):
+        def immediate_callback(patch, callback, timeout=None):
             callback()
 
         mocker.patch.object(
@@ -675,7 +924,7 @@ class TestIoTHubDeviceClientCreateFromX509Certificate(IoTHubDeviceClientTestsCon
         )
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     async def test_client_instantiation(self, mocker, client_class, x509):
@@ -722,6 +971,13 @@ class TestIoTHubDeviceClientSendD2CMessage(
     pass
 
 
+@pytest.mark.describe("IoTHubDeviceClient (Asynchronous) - .send_d2c_messages()")
+class TestIoTHubDeviceClientSendD2CMessages(
+    IoTHubDeviceClientTestsConfig, SharedClientSendD2CMessagesTests
+):
+    pass
+
+
 @pytest.mark.describe("IoTHubDeviceClient (Asynchronous) - .receive_c2d_message()")
 class TestIoTHubDeviceClientReceiveC2DMessage(IoTHubDeviceClientTestsConfig):
     @pytest.mark.it("Implicitly enables C2D messaging feature if not already enabled")
@@ -940,7 +1196,7 @@ class TestIoTHubModuleClientCreateFromEdgeEnvironmentWithContainerEnv(
         client_class.create_from_edge_environment()
 
         assert mock_iothub_pipeline_init.call_count == 1
-        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
         assert mock_edge_pipeline_init.call_count == 1
         assert mock_edge_pipeline_init.call_args == mocker.call(mock_auth)
 
@@ -1102,9 +1358,9 @@ class TestIoTHubModuleClientCreateFromEdgeEnvironmentWithDebugEnv(IoTHubModuleCl
         client_class.create_from_edge_environment()
 
         assert mock_iothub_pipeline_init.call_count == 1
-        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
         assert mock_edge_pipeline_init.call_count == 1
-        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline and the EdgePipeline to instantiate the client")
     async def test_client_instantiation(
@@ -1228,7 +1484,7 @@ class TestIoTHubModuleClientCreateFromX509Certificate(IoTHubModuleClientTestsCon
         )
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     async def test_client_instantiation(self, mocker, client_class, x509):
@@ -1275,6 +1531,13 @@ class TestIoTHubNModuleClientSendD2CMessage(
     pass
 
 
+@pytest.mark.describe("IoTHubModuleClient (Asynchronous) - .send_d2c_messages()")
+class TestIoTHubModuleClientSendD2CMessages(
+    IoTHubModuleClientTestsConfig, SharedClientSendD2CMessagesTests
+):
+    pass
+
+
 @pytest.mark.describe("IoTHubModuleClient (Asynchronous) - .send_to_output()")
 class TestIoTHubModuleClientSendToOutput(IoTHubModuleClientTestsConfig):
     @pytest.mark.it("Begins a 'send_output_event' pipeline operation")
@@ -173,32 +173,41 @@ def edge_local_debug_environment():
 class FakeIoTHubPipeline:
     def __init__(self):
         self.feature_enabled = {}  # This just has to be here for the spec
+        self.executors = None
+        self.submit_nowait = False
+        self.on_publish_slot_released = None
 
-    def connect(self, callback=None):
+    def connect(self, callback=None, timeout=None):
         callback()
 
-    def disconnect(self, callback=None):
+    def disconnect(self, callback=None, timeout=None):
         callback()
 
-    def enable_feature(self, feature_name, callback=None):
+    def enable_feature(self, feature_name, callback=None, timeout=None):
         callback()
 
-    def disable_feature(self, feature_name, callback=None):
+    def disable_feature(self, feature_name, callback=None, timeout=None):
         callback()
 
-    def send_d2c_message(self, event, callback=None):
+    def send_d2c_message(self, event, callback=None, timeout=None):
         callback()
 
-    def send_output_event(self, event, callback=None):
+    def send_d2c_messages(self, events, max_inflight=None, callback=None, timeout=None):
+        callback([None] * len(events))
+
+    def send_output_event(self, event, callback=None, timeout=None):
         callback()
 
-    def send_method_response(self, method_response, callback=None):
+    def publish_would_block(self):
+        return False
+
+    def send_method_response(self, method_response, callback=None, timeout=None):
         callback()
 
-    def get_twin(self, callback=None):
+    def get_twin(self, callback=None, timeout=None):
         callback(None)
 
-    def patch_twin_reported_properties(self, patch, callback=None):
+    def patch_twin_reported_properties(self, patch, callback=None, timeout=None):
         callback()
 
 
@@ -6,7 +6,7 @@
 
 import pytest
 import logging
-from azure.iot.device.iothub.models import Message
+from azure.iot.device.iothub.models import Message, MessageTemplate
 
 logging.basicConfig(level=logging.INFO)
 
@@ -42,6 +42,19 @@ class TestMessage(object):
         assert msg.content_encoding == encoding
         assert msg.content_type == ctype
 
+    @pytest.mark.it("Instantiates with optional qos, which defaults to None")
+    @pytest.mark.parametrize("qos", [None, 0, 1])
+    def test_instantiates_with_optional_qos(self, qos):
+        msg = Message("data", qos=qos)
+        assert msg.qos == qos
+        assert Message("data").qos is None
+
+    @pytest.mark.it("Raises a ValueError if qos is not 0 or 1")
+    @pytest.mark.parametrize("qos", [2, -1, "0"])
+    def test_invalid_qos(self, qos):
+        with pytest.raises(ValueError):
+            Message("data", qos=qos)
+
     @pytest.mark.it(
         "Uses string representation of data/payload attribute as string representation of Message"
     )
@@ -51,3 +64,85 @@ class TestMessage(object):
     def test_str_rep(self, data):
         msg = Message(data)
         assert str(msg) == str(data)
+
+    @pytest.mark.it("Does not create the custom_properties dictionary until it is used")
+    def test_custom_properties_lazy(self):
+        msg = Message("data")
+        assert msg._custom_properties is None
+        msg.custom_properties["key"] = "value"
+        assert msg.custom_properties == {"key": "value"}
+
+    @pytest.mark.it("Allows custom_properties to be replaced")
+    def test_custom_properties_settable(self):
+        msg = Message("data")
+        msg.custom_properties = {"key": "value"}
+        assert msg.custom_properties == {"key": "value"}
+
+    @pytest.mark.it("Does not have a __dict__")
+    def test_no_dict(self):
+        msg = Message("data")
+        assert not hasattr(msg, "__dict__")
+        with pytest.raises(AttributeError):
+            msg.not_an_attribute = "value"
+
+
+@pytest.mark.describe("MessageTemplate")
+class TestMessageTemplate(object):
+    @pytest.fixture
+    def template(self):
+        return MessageTemplate(
+            content_type="application/json",
+            content_encoding="utf-8",
+            output_name="output1",
+            custom_properties={"key": "value"},
+        )
+
+    @pytest.mark.it("Creates messages with the properties of the template")
+    def test_create_message(self, template):
+        msg = template.create_message("data", message_id="mid", qos=0)
+        assert msg.data == "data"
+        assert msg.message_id == "mid"
+        assert msg.qos == 0
+        assert msg.content_type == "application/json"
+        assert msg.content_encoding == "utf-8"
+        assert msg.output_name == "output1"
+        assert msg.custom_properties == {"key": "value"}
+        assert msg.template is template
+
+    @pytest.mark.it("Gives each message its own copy of the custom properties")
+    def test_custom_properties_copied(self, template):
+        msg = template.create_message("data")
+        msg.custom_properties["other"] = "value"
+        assert template.custom_properties == {"key": "value"}
+        assert template.create_message("data").custom_properties == {"key": "value"}
+
+    @pytest.mark.it("Has read-only properties")
+    @pytest.mark.parametrize(
+        "attribute", ["content_type", "content_encoding", "output_name", "custom_properties"]
+    )
+    def test_read_only(self, template, attribute):
+        with pytest.raises(AttributeError):
+            setattr(template, attribute, None)
+
+    @pytest.mark.it("Matches the messages created from it until a templated property is changed")
+    @pytest.mark.parametrize(
+        "attribute, value",
+        [
+            pytest.param("content_type", "text/plain", id="content_type"),
+            pytest.param("content_encoding", "gzip", id="content_encoding"),
+            pytest.param("output_name", "output2", id="output_name"),
+            pytest.param("custom_properties", {}, id="custom_properties"),
+        ],
+    )
+    def test_matches(self, template, attribute, value):
+        msg = template.create_message("data", message_id="mid")
+        msg.correlation_id = "cid"
+        assert template.matches(msg)
+        setattr(msg, attribute, value)
+        assert not template.matches(msg)
+
+    @pytest.mark.it("Matches a message without custom properties if it has none")
+    def test_matches_no_custom_properties(self):
+        template = MessageTemplate(content_type="application/json")
+        assert template.matches(template.create_message("data"))
+        assert template.matches(Message("data", content_type="application/json"))
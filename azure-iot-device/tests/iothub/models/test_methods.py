@@ -48,6 +48,11 @@ class TestMethodRequest(object):
         assert m_req.payload != new_payload
         assert m_req.payload == dummy_payload
 
+    @pytest.mark.it("Does not have a __dict__")
+    def test_no_dict(self):
+        m_req = MethodRequest(request_id=dummy_rid, name=dummy_name, payload=dummy_payload)
+        assert not hasattr(m_req, "__dict__")
+
 
 @pytest.mark.describe("MethodResponse - Instantiation")
 class TestMethodResponseInstantiation(object):
@@ -0,0 +1,120 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import json
+import logging
+from datetime import datetime
+from azure.iot.device.iothub.models import Message
+from azure.iot.device.iothub.pipeline import aggregation
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.mark.describe("aggregation - .encode_messages()")
+class TestEncodeMessages(object):
+    @pytest.mark.it("Creates a JSON message marked with the number of messages it contains")
+    def test_message(self):
+        message = aggregation.encode_messages([Message("a"), Message("b")])
+        assert message.content_type == "application/json"
+        assert message.content_encoding == "utf-8"
+        assert message.custom_properties == {aggregation.AGGREGATED_PROPERTY: "2"}
+        assert len(json.loads(message.data.decode("utf-8"))) == 2
+
+    @pytest.mark.it("Stores text payloads as text and other payloads as base64")
+    def test_body(self):
+        message = aggregation.encode_messages(
+            [Message("text"), Message(b"\xff\x00"), Message(12), Message(None)]
+        )
+        assert json.loads(message.data.decode("utf-8")) == [
+            {"body": "text", "base64Encoded": False, "properties": {}, "systemProperties": {}},
+            {"body": "/wA=", "base64Encoded": True, "properties": {}, "systemProperties": {}},
+            {"body": "12", "base64Encoded": False, "properties": {}, "systemProperties": {}},
+            {"body": "", "base64Encoded": False, "properties": {}, "systemProperties": {}},
+        ]
+
+    @pytest.mark.it(
+        "Stores the custom properties and the system properties which are set, except the expiry time"
+    )
+    def test_properties(self):
+        message = Message("data", message_id="mid", content_type="application/json")
+        message.correlation_id = "cid"
+        message.expiry_time_utc = datetime(2030, 1, 2, 3, 4, 5)
+        message.custom_properties["key"] = "value"
+        item = json.loads(aggregation.encode_messages([message]).data.decode("utf-8"))[0]
+        assert item["properties"] == {"key": "value"}
+        assert item["systemProperties"] == {
+            "messageId": "mid",
+            "correlationId": "cid",
+            "contentType": "application/json",
+        }
+
+    @pytest.mark.it("Uses the entries from encode_item if they are given")
+    def test_items(self):
+        messages = [Message("a"), Message("b")]
+        items = [aggregation.encode_item(message) for message in messages]
+        assert aggregation.encode_messages(messages, items=items).data == (
+            "[" + ",".join(items) + "]"
+        ).encode("utf-8")
+        assert (
+            aggregation.encode_messages(messages, items=items).data
+            == aggregation.encode_messages(messages).data
+        )
+
+
+@pytest.mark.describe("aggregation - .encode_item()")
+class TestEncodeItem(object):
+    @pytest.mark.it("Returns ASCII-only JSON, so its length is its size in bytes")
+    @pytest.mark.parametrize(
+        "data",
+        [
+            pytest.param("text", id="Text"),
+            pytest.param("caf\u00e9 \u2603", id="Non-ASCII text"),
+            pytest.param(b"\xff\x00" * 10, id="Binary"),
+        ],
+    )
+    def test_ascii(self, data):
+        message = Message(data)
+        message.custom_properties["k\u00e9y"] = "v\u00e4lue"
+        item = aggregation.encode_item(message)
+        assert len(item.encode("utf-8")) == len(item)
+        assert json.loads(item)["properties"] == {"k\u00e9y": "v\u00e4lue"}
+
+
+@pytest.mark.describe("aggregation - .encode_messages() -- qos")
+class TestEncodeMessagesQos(object):
+    @pytest.mark.it("Uses a qos of 0 only if every message has a qos of 0")
+    @pytest.mark.parametrize(
+        "qos_values, expected",
+        [
+            pytest.param([0, 0], 0, id="All 0"),
+            pytest.param([0, 1], 1, id="0 and 1"),
+            pytest.param([0, None], None, id="0 and default"),
+            pytest.param([None, 1], 1, id="Default and 1"),
+            pytest.param([None, None], None, id="All default"),
+        ],
+    )
+    def test_qos(self, qos_values, expected):
+        messages = [Message("data", qos=qos) for qos in qos_values]
+        assert aggregation.encode_messages(messages).qos == expected
+
+
+@pytest.mark.describe("aggregation - .decode_messages()")
+class TestDecodeMessages(object):
+    @pytest.mark.it("Returns the messages which were encoded")
+    def test_round_trip(self):
+        first = Message("text", message_id="mid", content_encoding="utf-8")
+        first.custom_properties["key"] = "value"
+        second = Message(b"\xff\x00")
+        second.user_id = "user"
+
+        decoded = aggregation.decode_messages(aggregation.encode_messages([first, second]).data)
+        assert [m.data for m in decoded] == [b"text", b"\xff\x00"]
+        assert decoded[0].message_id == "mid"
+        assert decoded[0].content_encoding == "utf-8"
+        assert decoded[0].custom_properties == {"key": "value"}
+        assert decoded[1].user_id == "user"
+        assert decoded[1].message_id is None
+        assert decoded[1].custom_properties == {}
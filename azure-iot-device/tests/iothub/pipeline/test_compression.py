@@ -0,0 +1,85 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import gzip
+import io
+import logging
+import zlib
+from azure.iot.device.iothub.pipeline import compression
+
+logging.basicConfig(level=logging.INFO)
+
+data = b'{"temperature": 21.5, "humidity": 40}' * 50
+
+
+@pytest.mark.describe("compression - .compress() and .decompress()")
+class TestCompressAndDecompress(object):
+    @pytest.mark.it("Round-trips the data")
+    @pytest.mark.parametrize("algorithm", [compression.GZIP, compression.DEFLATE])
+    def test_round_trip(self, algorithm):
+        compressed = compression.compress(algorithm, data)
+        assert len(compressed) < len(data)
+        assert compression.decompress(algorithm, compressed) == data
+
+    @pytest.mark.it("Produces gzip data which the gzip module can read")
+    def test_gzip_format(self):
+        compressed = compression.compress(compression.GZIP, data)
+        assert gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() == data
+
+    @pytest.mark.it("Produces deflate data in the zlib format")
+    def test_deflate_format(self):
+        assert zlib.decompress(compression.compress(compression.DEFLATE, data)) == data
+
+    @pytest.mark.it("Decompresses a bytearray")
+    def test_decompress_bytearray(self):
+        compressed = bytearray(compression.compress(compression.GZIP, data))
+        assert compression.decompress(compression.GZIP, compressed) == data
+
+    @pytest.mark.it("Raises a ValueError when decompressing with an unavailable algorithm")
+    @pytest.mark.parametrize("algorithm", ["brotli", compression.ZSTD])
+    def test_decompress_unavailable(self, mocker, algorithm):
+        mocker.patch.object(compression, "zstandard", None)
+        with pytest.raises(ValueError):
+            compression.decompress(algorithm, data)
+
+
+@pytest.mark.describe("compression - .is_available()")
+class TestIsAvailable(object):
+    @pytest.mark.it("Returns True for gzip and deflate")
+    @pytest.mark.parametrize("algorithm", [compression.GZIP, compression.DEFLATE])
+    def test_builtin(self, algorithm):
+        assert compression.is_available(algorithm)
+
+    @pytest.mark.it("Returns True for zstd only if the zstandard package is installed")
+    def test_zstd(self, mocker):
+        mocker.patch.object(compression, "zstandard", None)
+        assert not compression.is_available(compression.ZSTD)
+        mocker.patch.object(compression, "zstandard", mocker.MagicMock())
+        assert compression.is_available(compression.ZSTD)
+
+    @pytest.mark.it("Returns False for an unknown algorithm")
+    def test_unknown(self):
+        assert not compression.is_available("brotli")
+
+
+@pytest.mark.describe("compression - .get_payload_bytes()")
+class TestGetPayloadBytes(object):
+    @pytest.mark.it("Returns the bytes of a text or bytes payload")
+    @pytest.mark.parametrize(
+        "payload, expected",
+        [
+            pytest.param(b"abc", b"abc", id="bytes"),
+            pytest.param(bytearray(b"abc"), b"abc", id="bytearray"),
+            pytest.param(b"\xc3\xa9t\xc3\xa9".decode("utf-8"), b"\xc3\xa9t\xc3\xa9", id="text"),
+        ],
+    )
+    def test_bytes(self, payload, expected):
+        assert compression.get_payload_bytes(payload) == expected
+
+    @pytest.mark.it("Returns None for any other payload")
+    @pytest.mark.parametrize("payload", [None, 10, {"a": 1}])
+    def test_other(self, payload):
+        assert compression.get_payload_bytes(payload) is None
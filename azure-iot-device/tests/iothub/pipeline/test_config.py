@@ -0,0 +1,177 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+from azure.iot.device.common.pipeline import pipeline_instrumentation
+from azure.iot.device.iothub.pipeline import config
+from azure.iot.device.iothub.pipeline.config import IoTHubPipelineConfig
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.mark.describe("IoTHubPipelineConfig - Instantiation")
+class TestIoTHubPipelineConfigInstantiation(object):
+    @pytest.mark.it("Uses default values for all options if none are provided")
+    def test_defaults(self):
+        pipeline_configuration = IoTHubPipelineConfig()
+        assert (
+            pipeline_configuration.max_inflight_publishes == config.DEFAULT_MAX_INFLIGHT_PUBLISHES
+        )
+        assert pipeline_configuration.max_queued_publishes == config.DEFAULT_MAX_QUEUED_PUBLISHES
+        assert pipeline_configuration.queue_full_policy == config.QUEUE_FULL_BLOCK
+        assert pipeline_configuration.outbox_path is None
+        assert pipeline_configuration.outbox_max_bytes == config.DEFAULT_OUTBOX_MAX_BYTES
+        assert pipeline_configuration.auto_reconnect is True
+        assert (
+            pipeline_configuration.reconnect_initial_delay == config.DEFAULT_RECONNECT_INITIAL_DELAY
+        )
+        assert pipeline_configuration.reconnect_max_delay == config.DEFAULT_RECONNECT_MAX_DELAY
+        assert pipeline_configuration.reconnect_max_attempts is None
+        assert pipeline_configuration.port == 8883
+        assert pipeline_configuration.ack_timeout is None
+        assert pipeline_configuration.operation_timeout is None
+        assert pipeline_configuration.compression is None
+        assert pipeline_configuration.compression_threshold == 1024
+        assert pipeline_configuration.decompress_received is False
+        assert pipeline_configuration.aggregation_max_messages is None
+        assert pipeline_configuration.aggregation_max_bytes == 128 * 1024
+        assert pipeline_configuration.aggregation_linger == 0.1
+        assert pipeline_configuration.telemetry_qos == 1
+        assert pipeline_configuration.memoryview_payloads is False
+        assert pipeline_configuration.serializer is None
+        assert pipeline_configuration.executor_scope == "global"
+        assert pipeline_configuration.executor_shards == 4
+        assert pipeline_configuration.callback_dispatch == "thread"
+        assert pipeline_configuration.callback_workers == 4
+        assert pipeline_configuration.instrumentation is None
+
+    @pytest.mark.it("Stores the provided options")
+    def test_custom_values(self):
+        instrumentation = pipeline_instrumentation.PipelineInstrumentation()
+        pipeline_configuration = IoTHubPipelineConfig(
+            max_inflight_publishes=5,
+            max_queued_publishes=0,
+            queue_full_policy=config.QUEUE_FULL_ERROR,
+            outbox_path="outbox.db",
+            outbox_max_bytes=1024,
+            auto_reconnect=False,
+            reconnect_initial_delay=0.5,
+            reconnect_max_delay=30,
+            reconnect_max_attempts=10,
+            port=1883,
+            ack_timeout=30,
+            operation_timeout=60,
+            compression="gzip",
+            compression_threshold=0,
+            decompress_received=True,
+            aggregation_max_messages=50,
+            aggregation_max_bytes=4096,
+            aggregation_linger=0,
+            telemetry_qos=0,
+            memoryview_payloads=True,
+            serializer="json",
+            executor_scope="sharded",
+            executor_shards=8,
+            callback_dispatch="ordered",
+            callback_workers=2,
+            instrumentation=instrumentation,
+        )
+        assert pipeline_configuration.max_inflight_publishes == 5
+        assert pipeline_configuration.max_queued_publishes == 0
+        assert pipeline_configuration.queue_full_policy == config.QUEUE_FULL_ERROR
+        assert pipeline_configuration.outbox_path == "outbox.db"
+        assert pipeline_configuration.outbox_max_bytes == 1024
+        assert pipeline_configuration.auto_reconnect is False
+        assert pipeline_configuration.reconnect_initial_delay == 0.5
+        assert pipeline_configuration.reconnect_max_delay == 30
+        assert pipeline_configuration.reconnect_max_attempts == 10
+        assert pipeline_configuration.port == 1883
+        assert pipeline_configuration.ack_timeout == 30
+        assert pipeline_configuration.operation_timeout == 60
+        assert pipeline_configuration.compression == "gzip"
+        assert pipeline_configuration.compression_threshold == 0
+        assert pipeline_configuration.decompress_received is True
+        assert pipeline_configuration.aggregation_max_messages == 50
+        assert pipeline_configuration.aggregation_max_bytes == 4096
+        assert pipeline_configuration.aggregation_linger == 0
+        assert pipeline_configuration.telemetry_qos == 0
+        assert pipeline_configuration.memoryview_payloads is True
+        assert pipeline_configuration.serializer == "json"
+        assert pipeline_configuration.executor_scope == "sharded"
+        assert pipeline_configuration.executor_shards == 8
+        assert pipeline_configuration.callback_dispatch == "ordered"
+        assert pipeline_configuration.callback_workers == 2
+        assert pipeline_configuration.instrumentation is instrumentation
+
+    @pytest.mark.it("Accepts every executor_scope")
+    @pytest.mark.parametrize("scope", ["global", "client", "sharded", "event_loop"])
+    def test_executor_scopes(self, scope):
+        assert IoTHubPipelineConfig(executor_scope=scope).executor_scope == scope
+
+    @pytest.mark.it("Accepts every callback_dispatch mode")
+    @pytest.mark.parametrize("mode", ["thread", "pool", "ordered", "inline"])
+    def test_callback_dispatch_modes(self, mode):
+        assert IoTHubPipelineConfig(callback_dispatch=mode).callback_dispatch == mode
+
+    @pytest.mark.it("Raises a ValueError if given an invalid option")
+    @pytest.mark.parametrize(
+        "kwargs",
+        [
+            pytest.param({"max_inflight_publishes": 0}, id="max_inflight_publishes=0"),
+            pytest.param({"max_queued_publishes": -1}, id="Negative max_queued_publishes"),
+            pytest.param({"queue_full_policy": "drop"}, id="Unknown queue_full_policy"),
+            pytest.param({"outbox_max_bytes": 0}, id="outbox_max_bytes=0"),
+            pytest.param({"reconnect_initial_delay": 0}, id="reconnect_initial_delay=0"),
+            pytest.param(
+                {"reconnect_initial_delay": 10, "reconnect_max_delay": 5},
+                id="reconnect_max_delay < reconnect_initial_delay",
+            ),
+            pytest.param({"reconnect_max_attempts": 0}, id="reconnect_max_attempts=0"),
+            pytest.param({"port": 0}, id="port=0"),
+            pytest.param({"port": 65536}, id="port=65536"),
+            pytest.param({"ack_timeout": 0}, id="ack_timeout=0"),
+            pytest.param({"operation_timeout": 0}, id="operation_timeout=0"),
+            pytest.param({"compression": "brotli"}, id="Unknown compression"),
+            pytest.param({"compression_threshold": -1}, id="Negative compression_threshold"),
+            pytest.param({"aggregation_max_messages": 1}, id="aggregation_max_messages=1"),
+            pytest.param({"aggregation_max_bytes": 0}, id="aggregation_max_bytes=0"),
+            pytest.param({"aggregation_linger": -1}, id="Negative aggregation_linger"),
+            pytest.param({"telemetry_qos": 2}, id="telemetry_qos=2"),
+            pytest.param({"serializer": "msgpack"}, id="Unknown serializer"),
+            pytest.param({"executor_scope": "thread"}, id="Unknown executor_scope"),
+            pytest.param({"executor_shards": 0}, id="executor_shards=0"),
+            pytest.param({"callback_dispatch": "queue"}, id="Unknown callback_dispatch"),
+            pytest.param({"callback_workers": 0}, id="callback_workers=0"),
+            pytest.param({"instrumentation": object()}, id="Unknown instrumentation"),
+        ],
+    )
+    def test_invalid_values(self, kwargs):
+        with pytest.raises(ValueError):
+            IoTHubPipelineConfig(**kwargs)
+
+
+@pytest.mark.describe("IoTHubPipelineConfig - .max_outstanding_publishes")
+class TestIoTHubPipelineConfigMaxOutstandingPublishes(object):
+    @pytest.mark.it("Is the sum of max_inflight_publishes and max_queued_publishes")
+    def test_sum(self):
+        pipeline_configuration = IoTHubPipelineConfig(
+            max_inflight_publishes=5, max_queued_publishes=7
+        )
+        assert pipeline_configuration.max_outstanding_publishes == 12
+
+    @pytest.mark.it("Is None if either limit is None")
+    @pytest.mark.parametrize(
+        "max_inflight_publishes, max_queued_publishes",
+        [
+            pytest.param(None, 7, id="No in-flight limit"),
+            pytest.param(5, None, id="No queue limit"),
+        ],
+    )
+    def test_unlimited(self, max_inflight_publishes, max_queued_publishes):
+        pipeline_configuration = IoTHubPipelineConfig(
+            max_inflight_publishes=max_inflight_publishes, max_queued_publishes=max_queued_publishes
+        )
+        assert pipeline_configuration.max_outstanding_publishes is None
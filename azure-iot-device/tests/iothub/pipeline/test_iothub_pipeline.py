@@ -5,21 +5,30 @@
 # --------------------------------------------------------------------------
 
 import pytest
+import os
 import logging
+import threading
 import six.moves.urllib as urllib
 from azure.iot.device.common.pipeline import (
+    callback_dispatcher,
+    operation_flow,
+    pipeline_instrumentation,
     pipeline_stages_base,
     pipeline_stages_mqtt,
     pipeline_ops_base,
+    pipeline_thread,
 )
 from azure.iot.device.iothub.pipeline import (
     pipeline_stages_iothub,
     pipeline_stages_iothub_mqtt,
     pipeline_ops_iothub,
     pipeline_events_iothub,
+    serializers,
 )
 from azure.iot.device.iothub import Message
-from azure.iot.device.iothub.pipeline import IoTHubPipeline, constant
+from azure.iot.device.iothub.pipeline import IoTHubPipeline, IoTHubPipelineConfig, constant
+from azure.iot.device.iothub.pipeline import config as pipeline_config
+from azure.iot.device.common import errors, unhandled_exceptions
 from azure.iot.device.iothub.auth import (
     SymmetricKeyAuthenticationProvider,
     X509AuthenticationProvider,
@@ -86,6 +95,40 @@ class TestIoTHubPipelineInstantiation(object):
         assert pipeline._pipeline.on_connected_handler is not None
         assert pipeline._pipeline.on_disconnected_handler is not None
 
+    @pytest.mark.it("Uses a default IoTHubPipelineConfig if none is provided")
+    def test_default_configuration(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider)
+        assert isinstance(pipeline.pipeline_configuration, IoTHubPipelineConfig)
+
+    @pytest.mark.it(
+        "Configures the MQTTTransportStage with the max_inflight_publishes from the IoTHubPipelineConfig"
+    )
+    def test_transport_stage_window(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(max_inflight_publishes=3))
+        curr_stage = pipeline._pipeline
+        while curr_stage.next:
+            curr_stage = curr_stage.next
+        assert isinstance(curr_stage, pipeline_stages_mqtt.MQTTTransportStage)
+        assert curr_stage.max_inflight_publishes == 3
+
+    @pytest.mark.it("Configures the MQTTTransportStage with the port from the IoTHubPipelineConfig")
+    def test_transport_stage_port(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(port=1883))
+        curr_stage = pipeline._pipeline
+        while curr_stage.next:
+            curr_stage = curr_stage.next
+        assert curr_stage.port == 1883
+
+    @pytest.mark.it(
+        "Configures the MQTTTransportStage with the ack_timeout from the IoTHubPipelineConfig"
+    )
+    def test_transport_stage_ack_timeout(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(ack_timeout=30))
+        curr_stage = pipeline._pipeline
+        while curr_stage.next:
+            curr_stage = curr_stage.next
+        assert curr_stage.ack_timeout == 30
+
     @pytest.mark.it("Configures the pipeline with a series of PipelineStages")
     def test_pipeline_configuration(self, auth_provider):
         pipeline = IoTHubPipeline(auth_provider)
@@ -94,9 +137,11 @@ class TestIoTHubPipelineInstantiation(object):
         expected_stage_order = [
             pipeline_stages_base.PipelineRootStage,
             pipeline_stages_iothub.UseAuthProviderStage,
+            pipeline_stages_iothub.HandleD2CMessageBatchStage,
             pipeline_stages_iothub.HandleTwinOperationsStage,
             pipeline_stages_base.CoordinateRequestAndResponseStage,
             pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage,
+            pipeline_stages_base.ReconnectStage,
             pipeline_stages_base.EnsureConnectionStage,
             pipeline_stages_base.SerializeConnectOpsStage,
             pipeline_stages_mqtt.MQTTTransportStage,
@@ -111,6 +156,210 @@ class TestIoTHubPipelineInstantiation(object):
         # Assert there are no more additional stages
         assert curr_stage is None
 
+    @pytest.mark.it(
+        "Adds a StoreAndForwardStage after the HandleD2CMessageBatchStage if an outbox_path is configured"
+    )
+    def test_outbox_stage(self, auth_provider, tmpdir):
+        outbox_path = os.path.join(str(tmpdir), "outbox.db")
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                max_inflight_publishes=3, outbox_path=outbox_path, outbox_max_bytes=1024
+            ),
+        )
+        stage = pipeline._pipeline.next.next.next
+        assert isinstance(stage, pipeline_stages_iothub.StoreAndForwardStage)
+        assert isinstance(stage.next, pipeline_stages_iothub.HandleTwinOperationsStage)
+        assert stage.outbox.path == outbox_path
+        assert stage.outbox.max_bytes == 1024
+        assert stage.drain_window == 3
+        stage.outbox.close()
+
+    @pytest.mark.it(
+        "Adds an AggregateMessagesStage after the CoordinateRequestAndResponseStage if aggregation_max_messages is configured"
+    )
+    def test_aggregation_stage(self, auth_provider):
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                aggregation_max_messages=10, aggregation_max_bytes=2048, aggregation_linger=0.5
+            ),
+        )
+        stage = pipeline._pipeline
+        while not isinstance(stage, pipeline_stages_iothub.AggregateMessagesStage):
+            stage = stage.next
+        assert isinstance(stage.previous, pipeline_stages_base.CoordinateRequestAndResponseStage)
+        assert isinstance(stage.next, pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage)
+        assert stage.max_messages == 10
+        assert stage.max_bytes == 2048
+        assert stage.linger == 0.5
+
+    @pytest.mark.it(
+        "Adds a CompressMessagesStage before the IoTHubMQTTConverterStage, configured with the compression options from the IoTHubPipelineConfig, if compression or decompress_received is configured"
+    )
+    @pytest.mark.parametrize(
+        "compression, decompress_received",
+        [
+            pytest.param("deflate", False, id="Compression"),
+            pytest.param(None, True, id="Decompression"),
+            pytest.param("deflate", True, id="Both"),
+        ],
+    )
+    def test_compression_stage(self, auth_provider, compression, decompress_received):
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                compression=compression,
+                compression_threshold=100,
+                decompress_received=decompress_received,
+            ),
+        )
+        stage = pipeline._pipeline
+        while not isinstance(stage, pipeline_stages_iothub.CompressMessagesStage):
+            stage = stage.next
+        assert isinstance(stage.previous, pipeline_stages_base.CoordinateRequestAndResponseStage)
+        assert isinstance(stage.next, pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage)
+        assert stage.algorithm == compression
+        assert stage.threshold == 100
+        assert stage.decompress is decompress_received
+
+    @pytest.mark.it(
+        "Configures the IoTHubMQTTConverterStage with the telemetry_qos and memoryview_payloads from the IoTHubPipelineConfig"
+    )
+    def test_converter_stage_qos(self, auth_provider):
+        pipeline = IoTHubPipeline(
+            auth_provider, IoTHubPipelineConfig(telemetry_qos=0, memoryview_payloads=True)
+        )
+        stage = pipeline._pipeline
+        while not isinstance(stage, pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage):
+            stage = stage.next
+        assert stage.telemetry_qos == 0
+        assert stage.memoryview_payloads is True
+
+    @pytest.mark.it(
+        "Gives the HandleTwinOperationsStage and the IoTHubMQTTConverterStage the serializer from the IoTHubPipelineConfig"
+    )
+    def test_serializer(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(serializer="json"))
+        stage = pipeline._pipeline
+        serializers_used = []
+        while stage:
+            if isinstance(
+                stage,
+                (
+                    pipeline_stages_iothub.HandleTwinOperationsStage,
+                    pipeline_stages_iothub_mqtt.IoTHubMQTTConverterStage,
+                ),
+            ):
+                serializers_used.append(stage.serializer)
+            stage = stage.next
+        assert len(serializers_used) == 2
+        assert serializers_used[0] is serializers_used[1]
+        assert serializers_used[0].name == "json"
+
+    @pytest.mark.it("Uses the fastest serializer which is installed if the config doesn't name one")
+    def test_default_serializer(self, mocker, auth_provider):
+        get_serializer = mocker.spy(serializers, "get_serializer")
+        IoTHubPipeline(auth_provider, IoTHubPipelineConfig())
+        assert get_serializer.call_args == mocker.call(None)
+
+    @pytest.mark.it("Uses the threads shared by every pipeline if the executor_scope is global")
+    def test_global_executors(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig())
+        assert pipeline._pipeline.executors is None
+
+    @pytest.mark.it("Gives the pipeline threads of its own if the executor_scope is client")
+    def test_client_executors(self, auth_provider):
+        first = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(executor_scope="client"))
+        second = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(executor_scope="client"))
+        assert isinstance(first._pipeline.executors, pipeline_thread.Executors)
+        assert first._pipeline.executors is not second._pipeline.executors
+
+    @pytest.mark.it(
+        "Shares threads with the pipelines of the same device and module if the executor_scope is sharded"
+    )
+    def test_sharded_executors(self, mocker):
+        def make_pipeline(device_id, module_id):
+            auth_provider = mocker.MagicMock(device_id=device_id, module_id=module_id)
+            return IoTHubPipeline(
+                auth_provider, IoTHubPipelineConfig(executor_scope="sharded", executor_shards=3)
+            )
+
+        first = make_pipeline("device", "module")
+        assert isinstance(first._pipeline.executors, pipeline_thread.Executors)
+        assert make_pipeline("device", "module")._pipeline.executors is first._pipeline.executors
+        others = set(
+            make_pipeline("device{}".format(i), None)._pipeline.executors for i in range(20)
+        )
+        assert len(others) == 3
+
+    @pytest.mark.it(
+        "Gives the pipeline an EventLoopExecutors object, for the client to bind, if the executor_scope is event_loop"
+    )
+    def test_event_loop_executors(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(executor_scope="event_loop"))
+        assert isinstance(pipeline.executors, pipeline_thread.EventLoopExecutors)
+        assert pipeline._pipeline.executors is pipeline.executors
+        assert pipeline.executors.loop is None
+
+    @pytest.mark.it("Runs callbacks on the callback thread if the callback_dispatch is thread")
+    def test_callback_thread(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig())
+        assert pipeline.callback_dispatcher is None
+        assert pipeline._pipeline.callback_dispatcher is None
+
+    @pytest.mark.it(
+        "Gives the pipeline a CallbackDispatcher with the callback options from the IoTHubPipelineConfig"
+    )
+    def test_callback_dispatcher(self, mocker, auth_provider):
+        create = mocker.spy(callback_dispatcher, "create_callback_dispatcher")
+        pipeline = IoTHubPipeline(
+            auth_provider, IoTHubPipelineConfig(callback_dispatch="ordered", callback_workers=2)
+        )
+        assert create.call_args == mocker.call(
+            "ordered",
+            name="{}/{}".format(auth_provider.device_id, auth_provider.module_id),
+            workers=2,
+        )
+        assert isinstance(pipeline.callback_dispatcher, callback_dispatcher.CallbackDispatcher)
+        assert pipeline._pipeline.callback_dispatcher is pipeline.callback_dispatcher
+
+    @pytest.mark.it("Gives the pipeline the instrumentation from the IoTHubPipelineConfig")
+    def test_instrumentation(self, auth_provider):
+        instrumentation = pipeline_instrumentation.PipelineInstrumentation()
+        pipeline = IoTHubPipeline(
+            auth_provider, IoTHubPipelineConfig(instrumentation=instrumentation)
+        )
+        assert pipeline._pipeline.instrumentation is instrumentation
+        assert (
+            IoTHubPipeline(auth_provider, IoTHubPipelineConfig())._pipeline.instrumentation is None
+        )
+
+    @pytest.mark.it(
+        "Configures the ReconnectStage with the reconnect options from the IoTHubPipelineConfig"
+    )
+    def test_reconnect_stage(self, auth_provider):
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                reconnect_initial_delay=0.5, reconnect_max_delay=10, reconnect_max_attempts=4
+            ),
+        )
+        stage = pipeline._pipeline
+        while not isinstance(stage, pipeline_stages_base.ReconnectStage):
+            stage = stage.next
+        assert stage.initial_delay == 0.5
+        assert stage.max_delay == 10
+        assert stage.max_attempts == 4
+
+    @pytest.mark.it("Does not add a ReconnectStage if auto_reconnect is disabled")
+    def test_no_reconnect_stage(self, auth_provider):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(auto_reconnect=False))
+        stage = pipeline._pipeline
+        while stage:
+            assert not isinstance(stage, pipeline_stages_base.ReconnectStage)
+            stage = stage.next
+
     # TODO: revist these tests after auth revision
     # They are too tied to auth types (and there's too much variance in auths to effectively test)
     # Ideally IoTHubPipeline is entirely insulated from any auth differential logic (and module/device distinctions)
@@ -203,28 +452,33 @@ class TestIoTHubPipelineConnect(object):
 
         # No assertions required - if the code executes without error, the test passes
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the ConnectOperation")
-    def test_op_fail(self, mocker, pipeline):
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the ConnectOperation if no callback is provided"
+    )
+    def test_op_fail_no_callback(self, mocker, pipeline):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.connect()
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the ConnectOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the ConnectOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline):
+    def test_op_fail(self, mocker, pipeline):
         cb = mocker.MagicMock()
         pipeline.connect(callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .disconnect()")
@@ -263,28 +517,33 @@ class TestIoTHubPipelineDisconnect(object):
 
         # No assertions required - if the code executes without error, the test passes
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the DisconnectOperation")
-    def test_op_fail(self, mocker, pipeline):
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the DisconnectOperation if no callback is provided"
+    )
+    def test_op_fail_no_callback(self, mocker, pipeline):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.disconnect()
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the DisconnectOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the DisconnectOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline):
+    def test_op_fail(self, mocker, pipeline):
         cb = mocker.MagicMock()
         pipeline.disconnect(callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .send_d2c_message()")
@@ -324,29 +583,309 @@ class TestIoTHubPipelineSendD2CMessage(object):
 
         # No assertions required - if the code executes without error, the test passes
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the SendD2CMessageOperation")
-    def test_op_fail(self, mocker, pipeline, message):
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the SendD2CMessageOperation if no callback is provided"
+    )
+    def test_op_fail_no_callback(self, mocker, pipeline, message):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.send_d2c_message(message)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the SendD2CMessageOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the SendD2CMessageOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline, message):
+    def test_op_fail(self, mocker, pipeline, message):
         cb = mocker.MagicMock()
         pipeline.send_d2c_message(message, callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
+
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
+
+
+@pytest.mark.describe("IoTHubPipeline - .send_d2c_message() and .send_output_event() backpressure")
+class TestIoTHubPipelinePublishBackpressure(object):
+    @pytest.fixture(params=["send_d2c_message", "send_output_event"])
+    def send_function_name(self, request):
+        return request.param
+
+    def make_pipeline(self, mocker, auth_provider, policy):
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                max_inflight_publishes=1, max_queued_publishes=1, queue_full_policy=policy
+            ),
+        )
+        mocker.patch.object(pipeline._pipeline, "run_op")
+        return pipeline
+
+    def finish_last_op(self, pipeline):
+        # The pipeline is mocked, so do what the real one does when it is done with the op
+        args, kwargs = pipeline._pipeline.run_op.call_args
+        op = args[0]
+        kwargs["on_finished"](op)
+        op.callback(op)
+        return op
+
+    @pytest.mark.it(
+        "Raises a PipelineQueueFullError without running an op if the queue is full and the policy is QUEUE_FULL_ERROR"
+    )
+    def test_error_policy(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        send(message)
+        with pytest.raises(errors.PipelineQueueFullError):
+            send(message)
+        assert pipeline._pipeline.run_op.call_count == 2
+
+    @pytest.mark.it("Makes room in the queue when a message op completes")
+    def test_completion_frees_slot(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        send(message)
+
+        self.finish_last_op(pipeline)
+
+        send(message)
+        assert pipeline._pipeline.run_op.call_count == 3
+
+    @pytest.mark.it(
+        "Keeps the slot until the pipeline is done with the op, even if the op's callback is called first"
+    )
+    def test_slot_held_until_finished(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        send(message)
+
+        # This is what happens when an op reaches its deadline while it waits for a PUBACK
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        op.callback(op)
+        with pytest.raises(errors.PipelineQueueFullError):
+            send(message)
+
+        pipeline._pipeline.run_op.call_args[1]["on_finished"](op)
+        send(message)
+        assert pipeline._pipeline.run_op.call_count == 3
+
+    @pytest.mark.it("Raises a PipelineQueueFullError which is a PipelineError")
+    def test_error_type(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        send(message)
+        with pytest.raises(errors.PipelineError):
+            send(message)
+
+    @pytest.mark.it("Gives the slot back if running the op raises an Exception")
+    def test_run_op_raises(
+        self, mocker, auth_provider, message, send_function_name, fake_exception
+    ):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        send = getattr(pipeline, send_function_name)
+        pipeline._pipeline.run_op.side_effect = fake_exception
+        for _ in range(3):
+            with pytest.raises(type(fake_exception)):
+                send(message)
+
+        pipeline._pipeline.run_op.side_effect = None
+        send(message)
+        send(message)
+        assert pipeline._pipeline.run_op.call_count == 5
+
+    @pytest.mark.it("Does not take slots for batches sent with send_d2c_messages")
+    def test_batches_exempt(self, mocker, auth_provider, message):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        pipeline.send_d2c_message(message)
+        pipeline.send_d2c_message(message)
+
+        pipeline.send_d2c_messages([message, message, message])
+
+        assert pipeline._pipeline.run_op.call_count == 3
+        with pytest.raises(errors.PipelineQueueFullError):
+            pipeline.send_d2c_message(message)
+
+    @pytest.mark.it(
+        "Blocks the caller until there is room in the queue if the policy is QUEUE_FULL_BLOCK"
+    )
+    def test_block_policy(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_BLOCK)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        send(message)
+
+        third_send_complete = threading.Event()
+
+        def third_send():
+            send(message)
+            third_send_complete.set()
+
+        t = threading.Thread(target=third_send)
+        t.start()
+        assert not third_send_complete.wait(0.1)
+        assert pipeline._pipeline.run_op.call_count == 2
+
+        self.finish_last_op(pipeline)
+
+        assert third_send_complete.wait(5)
+        t.join()
+        assert pipeline._pipeline.run_op.call_count == 3
+
+    @pytest.mark.it(
+        "Reports whether a send would block, without taking a slot, if the policy is QUEUE_FULL_BLOCK"
+    )
+    def test_publish_would_block(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_BLOCK)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        assert not pipeline.publish_would_block()
+        assert not pipeline.publish_would_block()
+        send(message)
+        assert pipeline.publish_would_block()
+
+        self.finish_last_op(pipeline)
+        assert not pipeline.publish_would_block()
+
+    @pytest.mark.it("Never reports that a send would block if the policy is QUEUE_FULL_ERROR")
+    def test_publish_would_block_error_policy(
+        self, mocker, auth_provider, message, send_function_name
+    ):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_ERROR)
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        send(message)
+        assert not pipeline.publish_would_block()
+
+    @pytest.mark.it("Calls on_publish_slot_released when a message op completes")
+    def test_on_publish_slot_released(self, mocker, auth_provider, message, send_function_name):
+        pipeline = self.make_pipeline(mocker, auth_provider, pipeline_config.QUEUE_FULL_BLOCK)
+        pipeline.on_publish_slot_released = mocker.MagicMock()
+        getattr(pipeline, send_function_name)(message)
+        assert pipeline.on_publish_slot_released.call_count == 0
+
+        self.finish_last_op(pipeline)
+        assert pipeline.on_publish_slot_released.call_count == 1
+
+    @pytest.mark.it(
+        "Records the time spent waiting for room in the queue, if the pipeline is instrumented"
+    )
+    def test_instrumented(self, mocker, auth_provider, message, send_function_name):
+        instrumentation = pipeline_instrumentation.PipelineInstrumentation()
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                max_inflight_publishes=1, max_queued_publishes=0, instrumentation=instrumentation
+            ),
+        )
+        mocker.patch.object(pipeline._pipeline, "run_op")
+        send = getattr(pipeline, send_function_name)
+        send(message)
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        threading.Timer(0.05, self.finish_last_op, [pipeline]).start()
+        send(message)
+
+        histograms = instrumentation.get_stats()["publish_queue"][op.name]
+        assert histograms["count"] == 2
+        assert histograms["max"] >= 0.04
+
+    @pytest.mark.it("Never blocks or raises if the queue size is unlimited")
+    def test_unlimited(self, mocker, auth_provider, message, send_function_name):
+        pipeline = IoTHubPipeline(
+            auth_provider,
+            IoTHubPipelineConfig(
+                max_queued_publishes=None, queue_full_policy=pipeline_config.QUEUE_FULL_ERROR
+            ),
+        )
+        mocker.patch.object(pipeline._pipeline, "run_op")
+        send = getattr(pipeline, send_function_name)
+        for _ in range(50):
+            send(message)
+        assert pipeline._pipeline.run_op.call_count == 50
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
 
+@pytest.mark.describe("IoTHubPipeline - .send_d2c_messages()")
+class TestIoTHubPipelineSendD2CMessages(object):
+    @pytest.fixture
+    def messages(self, message):
+        return [message, Message("second message")]
+
+    @pytest.mark.it(
+        "Runs a single SendD2CMessageBatchOperation with the provided messages on the pipeline"
+    )
+    def test_runs_op(self, pipeline, messages):
+        pipeline.send_d2c_messages(messages)
+        op = pipeline._pipeline.run_op.call_args[0][0]
+
+        assert pipeline._pipeline.run_op.call_count == 1
+        assert isinstance(op, pipeline_ops_iothub.SendD2CMessageBatchOperation)
+        assert op.messages == messages
+
+    @pytest.mark.it("Uses the default max_inflight value if none is provided")
+    def test_default_max_inflight(self, pipeline, messages):
+        pipeline.send_d2c_messages(messages)
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        assert op.max_inflight == constant.DEFAULT_BATCH_MAX_INFLIGHT
+
+    @pytest.mark.it("Uses the provided max_inflight value")
+    def test_custom_max_inflight(self, pipeline, messages):
+        pipeline.send_d2c_messages(messages, max_inflight=7)
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        assert op.max_inflight == 7
+
+    @pytest.mark.it(
+        "Triggers an optionally provided callback with the per-message results upon successful completion of the SendD2CMessageBatchOperation"
+    )
+    def test_op_success_with_callback(self, mocker, pipeline, messages):
+        cb = mocker.MagicMock()
+
+        # Begin operation
+        pipeline.send_d2c_messages(messages, callback=cb)
         assert cb.call_count == 0
 
+        # Trigger op completion callback
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        op.results = [None, None]
+        op.callback(op)
+
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(op.results)
+
+    @pytest.mark.it(
+        "Does nothing upon successful completion of the SendD2CMessageBatchOperation if no callback is provided"
+    )
+    def test_op_success_no_callback(self, pipeline, messages):
+        pipeline.send_d2c_messages(messages)
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        op.callback(op)
+
+        # No assertions required - if the code executes without error, the test passes
+
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the SendD2CMessageBatchOperation if no callback is provided"
+    )
+    def test_op_fail_no_callback(self, mocker, pipeline, messages):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
+        pipeline.send_d2c_messages(messages)
+        op = pipeline._pipeline.run_op.call_args[0][0]
+        op.error = Exception()
+        op.callback(op)
+
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
+
 
 @pytest.mark.describe("IoTHubPipeline - .send_output_event()")
 class TestIoTHubPipelineSendOutputEvent(object):
@@ -391,28 +930,33 @@ class TestIoTHubPipelineSendOutputEvent(object):
 
         # No assertions required - if the code executes without error, the test passes
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the SendOutputEventOperation")
-    def test_op_fail(self, mocker, pipeline, message):
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the SendOutputEventOperation if no callback is provided"
+    )
+    def test_op_fail_no_callback(self, mocker, pipeline, message):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.send_output_event(message)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the SendOutputEventOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the SendOutputEventOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline, message):
+    def test_op_fail(self, mocker, pipeline, message):
         cb = mocker.MagicMock()
         pipeline.send_output_event(message, callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .send_method_response()")
@@ -455,29 +999,32 @@ class TestIoTHubPipelineSendMethodResponse(object):
         # No assertions required - if the code executes without error, the test passes
 
     @pytest.mark.it(
-        "Raise SystemExit upon unsuccessful completion of the SendMethodResponseOperation"
+        "Reports the error as an unhandled exception upon unsuccessful completion of the SendMethodResponseOperation if no callback is provided"
     )
-    def test_op_fail(self, mocker, pipeline, method_response):
+    def test_op_fail_no_callback(self, mocker, pipeline, method_response):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.send_method_response(method_response)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the SendMethodResponseOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the SendMethodResponseOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline, method_response):
+    def test_op_fail(self, mocker, pipeline, method_response):
         cb = mocker.MagicMock()
         pipeline.send_method_response(method_response, callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .get_twin()")
@@ -507,29 +1054,18 @@ class TestIoTHubPipelineGetTwin(object):
 
         assert cb.call_count == 1
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the GetTwinOperation")
-    def test_op_fail(self, mocker, pipeline):
-        cb = mocker.MagicMock()
-        pipeline.get_twin(callback=cb)
-        op = pipeline._pipeline.run_op.call_args[0][0]
-        op.error = Exception()
-
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the GetTwinOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the GetTwinOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline):
+    def test_op_fail(self, mocker, pipeline):
         cb = mocker.MagicMock()
         pipeline.get_twin(callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .patch_twin_reported_properties()")
@@ -572,29 +1108,32 @@ class TestIoTHubPipelinePatchTwinReportedProperties(object):
         # No assertions required - if the code executes without error, the test passes
 
     @pytest.mark.it(
-        "Raise SystemExit upon unsuccessful completion of the PatchTwinReportedPropertiesOperation"
+        "Reports the error as an unhandled exception upon unsuccessful completion of the PatchTwinReportedPropertiesOperation if no callback is provided"
     )
-    def test_op_fail(self, mocker, pipeline, twin_patch):
+    def test_op_fail_no_callback(self, mocker, pipeline, twin_patch):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.patch_twin_reported_properties(twin_patch)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the PatchTwinReportedPropertiesOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the PatchTwinReportedPropertiesOperation"
     )
-    def test_op_fail_no_callback(self, mocker, pipeline, twin_patch):
+    def test_op_fail(self, mocker, pipeline, twin_patch):
         cb = mocker.MagicMock()
         pipeline.patch_twin_reported_properties(twin_patch, callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .enable_feature()")
@@ -654,30 +1193,35 @@ class TestIoTHubPipelineEnableFeature(object):
 
         # No assertions required - if the code executes without error, the test passes
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the EnableFeatureOperation")
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the EnableFeatureOperation if no callback is provided"
+    )
     @pytest.mark.parametrize("feature", all_features)
-    def test_op_fail(self, mocker, pipeline, feature):
+    def test_op_fail_no_callback(self, mocker, pipeline, feature):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.enable_feature(feature)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the EnableFeatureOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the EnableFeatureOperation"
     )
     @pytest.mark.parametrize("feature", all_features)
-    def test_op_fail_no_callback(self, mocker, pipeline, feature):
+    def test_op_fail(self, mocker, pipeline, feature):
         cb = mocker.MagicMock()
         pipeline.enable_feature(feature, callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
-
-        assert cb.call_count == 0
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
 
 
 @pytest.mark.describe("IoTHubPipeline - .disable_feature()")
@@ -739,30 +1283,123 @@ class TestIoTHubPipelineDisableFeature(object):
 
         # No assertions required - if the code executes without error, the test passes
 
-    @pytest.mark.it("Raise SystemExit upon unsuccessful completion of the DisableFeatureOperation")
+    @pytest.mark.it(
+        "Reports the error as an unhandled exception upon unsuccessful completion of the DisableFeatureOperation if no callback is provided"
+    )
     @pytest.mark.parametrize("feature", all_features)
-    def test_op_fail(self, mocker, pipeline, feature):
+    def test_op_fail_no_callback(self, mocker, pipeline, feature):
+        mock_handler = mocker.patch.object(
+            unhandled_exceptions, "exception_caught_in_background_thread"
+        )
         pipeline.disable_feature(feature)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert mock_handler.call_count == 1
+        assert mock_handler.call_args == mocker.call(op.error)
 
     @pytest.mark.it(
-        "Does not trigger callback upon unsuccessful completion of the DisableFeatureOperation"
+        "Triggers the callback with the error upon unsuccessful completion of the DisableFeatureOperation"
     )
     @pytest.mark.parametrize("feature", all_features)
-    def test_op_fail_no_callback(self, mocker, pipeline, feature):
+    def test_op_fail(self, mocker, pipeline, feature):
         cb = mocker.MagicMock()
         pipeline.disable_feature(feature, callback=cb)
         op = pipeline._pipeline.run_op.call_args[0][0]
         op.error = Exception()
+        op.callback(op)
 
-        with pytest.raises(SystemExit):
-            op.callback(op)
+        assert cb.call_count == 1
+        assert cb.call_args == mocker.call(error=op.error)
+
+
+pipeline_calls = [
+    pytest.param(lambda pipeline, **kwargs: pipeline.connect(**kwargs), id="connect"),
+    pytest.param(lambda pipeline, **kwargs: pipeline.disconnect(**kwargs), id="disconnect"),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.send_d2c_message(Message("msg"), **kwargs),
+        id="send_d2c_message",
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.send_d2c_messages([Message("msg")], **kwargs),
+        id="send_d2c_messages",
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.send_output_event(Message("msg"), **kwargs),
+        id="send_output_event",
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.send_method_response(object(), **kwargs),
+        id="send_method_response",
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.get_twin(callback=None, **kwargs), id="get_twin"
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.patch_twin_reported_properties({}, **kwargs),
+        id="patch_twin_reported_properties",
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.enable_feature(constant.TWIN, **kwargs),
+        id="enable_feature",
+    ),
+    pytest.param(
+        lambda pipeline, **kwargs: pipeline.disable_feature(constant.TWIN, **kwargs),
+        id="disable_feature",
+    ),
+]
 
-        assert cb.call_count == 0
+
+@pytest.mark.describe("IoTHubPipeline - operation timeouts")
+class TestIoTHubPipelineOperationTimeout(object):
+    @pytest.fixture(autouse=True)
+    def clock(self, mocker):
+        mocker.patch.object(operation_flow, "clock", return_value=1000.0)
+
+    @pytest.mark.it("Gives the operation a deadline timeout seconds from now")
+    @pytest.mark.parametrize("pipeline_call", pipeline_calls)
+    def test_timeout(self, pipeline, pipeline_call):
+        pipeline_call(pipeline, timeout=5)
+        assert pipeline._pipeline.run_op.call_args[0][0].deadline == 1005.0
+
+    @pytest.mark.it(
+        "Uses the operation_timeout from the IoTHubPipelineConfig if no timeout is provided"
+    )
+    @pytest.mark.parametrize("pipeline_call", pipeline_calls)
+    def test_default_timeout(self, mocker, auth_provider, pipeline_call):
+        pipeline = IoTHubPipeline(auth_provider, IoTHubPipelineConfig(operation_timeout=60))
+        mocker.patch.object(pipeline._pipeline, "run_op")
+        pipeline_call(pipeline)
+        assert pipeline._pipeline.run_op.call_args[0][0].deadline == 1060.0
+
+    @pytest.mark.it("Does not give the operation a deadline if there is no timeout")
+    @pytest.mark.parametrize("pipeline_call", pipeline_calls)
+    def test_no_timeout(self, pipeline, pipeline_call):
+        pipeline_call(pipeline)
+        assert pipeline._pipeline.run_op.call_args[0][0].deadline is None
+
+
+@pytest.mark.describe("IoTHubPipeline - .submit_nowait")
+class TestIoTHubPipelineSubmitNowait(object):
+    @pytest.mark.it("Is False by default, so operations are run with run_op")
+    @pytest.mark.parametrize("pipeline_call", pipeline_calls)
+    def test_default(self, mocker, pipeline, pipeline_call):
+        mocker.patch.object(pipeline._pipeline, "run_op_nowait")
+        assert pipeline.submit_nowait is False
+        pipeline_call(pipeline)
+        assert pipeline._pipeline.run_op.call_count == 1
+        assert pipeline._pipeline.run_op_nowait.call_count == 0
+
+    @pytest.mark.it("Makes operations run with run_op_nowait when it is True")
+    @pytest.mark.parametrize("pipeline_call", pipeline_calls)
+    def test_nowait(self, mocker, pipeline, pipeline_call):
+        mocker.patch.object(pipeline._pipeline, "run_op_nowait")
+        pipeline.submit_nowait = True
+        pipeline_call(pipeline, timeout=5)
+        assert pipeline._pipeline.run_op.call_count == 0
+        assert pipeline._pipeline.run_op_nowait.call_count == 1
+        assert pipeline._pipeline.run_op_nowait.call_args[0][0].deadline is not None
 
 
 @pytest.mark.describe("IoTHubPipeline - EVENT: Connected")
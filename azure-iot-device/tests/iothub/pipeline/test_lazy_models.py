@@ -0,0 +1,189 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+import threading
+from azure.iot.device.iothub.models import Message, MethodRequest
+from azure.iot.device.iothub.pipeline import lazy_models, mqtt_topic_iothub, serializers
+
+logging.basicConfig(level=logging.INFO)
+
+encoded_properties = "%24.mid=message+1&%24.ce=utf-8&%24.ct=application%2Fjson&color=dark+blue"
+
+
+def block_first_call(func):
+    """
+    Return a function which calls func, but makes the first call wait until the returned proceed
+    event is set, after setting the returned blocked event.  The arguments of every call are kept
+    in the returned list.
+    """
+    blocked = threading.Event()
+    proceed = threading.Event()
+    calls = []
+
+    def wrapper(arg):
+        calls.append(arg)
+        if len(calls) == 1:
+            blocked.set()
+            proceed.wait(5)
+        return func(arg)
+
+    return wrapper, blocked, proceed, calls
+
+
+def read_on_thread(read):
+    """Start a thread which calls read, and return it along with a list for the result"""
+    results = []
+    t = threading.Thread(target=lambda: results.append(read()))
+    t.start()
+    return t, results
+
+
+@pytest.mark.describe("LazyMessage")
+class TestLazyMessage(object):
+    @pytest.fixture
+    def spy(self, mocker):
+        return mocker.spy(mqtt_topic_iothub, "decode_message_properties")
+
+    @pytest.mark.it("Is a Message without a __dict__")
+    def test_is_message(self):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        assert isinstance(message, Message)
+        assert not hasattr(message, "__dict__")
+
+    @pytest.mark.it("Doesn't decode its properties when it is created, or when its data is read")
+    def test_not_decoded(self, spy):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        assert message.data == b"payload"
+        assert message.lock_token is None
+        assert spy.call_count == 0
+
+    @pytest.mark.it("Decodes its properties once, the first time any of them is read")
+    @pytest.mark.parametrize(
+        "attribute, expected",
+        [
+            pytest.param("message_id", "message 1", id="message_id"),
+            pytest.param("content_encoding", "utf-8", id="content_encoding"),
+            pytest.param("content_type", "application/json", id="content_type"),
+            pytest.param("correlation_id", None, id="correlation_id"),
+            pytest.param("custom_properties", {"color": "dark blue"}, id="custom_properties"),
+        ],
+    )
+    def test_decodes_once(self, spy, attribute, expected):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        assert getattr(message, attribute) == expected
+        assert message.message_id == "message 1"
+        assert message.custom_properties == {"color": "dark blue"}
+        assert spy.call_count == 1
+
+    @pytest.mark.it("Decodes its properties before one of them is set, so the new value is kept")
+    def test_set(self, spy):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        message.message_id = "message 2"
+        assert spy.call_count == 1
+        assert message.message_id == "message 2"
+        assert message.content_type == "application/json"
+
+    @pytest.mark.it("Has no properties if it was received without any")
+    @pytest.mark.parametrize("properties", [None, ""])
+    def test_no_properties(self, spy, properties):
+        message = lazy_models.LazyMessage(b"payload", properties)
+        assert message.message_id is None
+        assert message.custom_properties == {}
+        assert spy.call_count == 0
+
+    @pytest.mark.it("Can have its properties read while another thread is decoding them")
+    def test_read_while_decoding(self, mocker):
+        decode, blocked, proceed, calls = block_first_call(
+            mqtt_topic_iothub.decode_message_properties
+        )
+        mocker.patch.object(mqtt_topic_iothub, "decode_message_properties", side_effect=decode)
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+
+        t, results = read_on_thread(lambda: message.custom_properties)
+        assert blocked.wait(5)
+        assert message.message_id == "message 1"
+        proceed.set()
+        t.join()
+
+        assert results == [{"color": "dark blue"}]
+        assert message.custom_properties == {"color": "dark blue"}
+        assert calls == [encoded_properties, encoded_properties]
+
+    @pytest.mark.it("Doesn't decode again if another thread decoded its properties first")
+    def test_decoded_by_other_thread(self, spy):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        t, results = read_on_thread(lambda: message.message_id)
+        t.join()
+        # As if this thread had checked for encoded properties just before the other one cleared
+        # them
+        message._decode_properties()
+        assert results == ["message 1"]
+        assert message.content_type == "application/json"
+        assert spy.call_count == 1
+
+
+@pytest.mark.describe("LazyMessage - .may_have_property()")
+class TestLazyMessageMayHaveProperty(object):
+    @pytest.mark.it("Returns True if a system property or custom property is in the topic")
+    @pytest.mark.parametrize("name", ["message_id", "content_encoding", "color"])
+    def test_present(self, name):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        assert message.may_have_property(name)
+
+    @pytest.mark.it("Returns False if a property isn't in the topic, without decoding the topic")
+    @pytest.mark.parametrize("name", ["user_id", "iothub-compression", "size"])
+    def test_absent(self, mocker, name):
+        spy = mocker.spy(mqtt_topic_iothub, "decode_message_properties")
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        assert not message.may_have_property(name)
+        assert spy.call_count == 0
+
+    @pytest.mark.it("Returns True once the properties have been decoded")
+    def test_decoded(self):
+        message = lazy_models.LazyMessage(b"payload", encoded_properties)
+        message.custom_properties
+        assert message.may_have_property("user_id")
+
+
+@pytest.mark.describe("LazyMethodRequest")
+class TestLazyMethodRequest(object):
+    @pytest.mark.it("Is a MethodRequest with the given request id and name")
+    def test_is_method_request(self):
+        request = lazy_models.LazyMethodRequest("1", "reboot", b'{"delay": 5}')
+        assert isinstance(request, MethodRequest)
+        assert request.request_id == "1"
+        assert request.name == "reboot"
+
+    @pytest.mark.it("Deserializes the payload once, the first time it is read")
+    def test_payload(self, mocker):
+        spy = mocker.spy(serializers.Serializer, "loads")
+        request = lazy_models.LazyMethodRequest("1", "reboot", b'{"delay": 5}')
+        assert spy.call_count == 0
+        assert request.payload == {"delay": 5}
+        assert request.payload == {"delay": 5}
+        assert spy.call_count == 1
+
+    @pytest.mark.it("Can have its payload read while another thread is deserializing it")
+    def test_read_while_deserializing(self, mocker):
+        loads, blocked, proceed, calls = block_first_call(serializers.standard_serializer.loads)
+        serializer = mocker.MagicMock(loads=mocker.MagicMock(side_effect=loads))
+        request = lazy_models.LazyMethodRequest("1", "reboot", b'{"delay": 5}', serializer)
+
+        t, results = read_on_thread(lambda: request.payload)
+        assert blocked.wait(5)
+        assert request.payload == {"delay": 5}
+        proceed.set()
+        t.join()
+
+        assert results == [{"delay": 5}]
+        assert calls == [b'{"delay": 5}', b'{"delay": 5}']
+
+    @pytest.mark.it("Raises a ValueError when the payload is read if it isn't JSON")
+    def test_not_json(self):
+        request = lazy_models.LazyMethodRequest("1", "reboot", b"not json")
+        with pytest.raises(ValueError):
+            request.payload
@@ -0,0 +1,227 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import datetime
+import logging
+import six.moves.urllib as urllib
+from azure.iot.device.iothub.models import Message, MessageTemplate
+from azure.iot.device.iothub.pipeline import lazy_models, mqtt_topic_iothub
+
+logging.basicConfig(level=logging.INFO)
+
+fake_topic = "devices/fake_device/messages/events/"
+fake_custom_properties = {"sensor": "sensor 1", "temperature_alert": "false"}
+
+
+def get_properties(topic):
+    assert topic.startswith(fake_topic)
+    return dict(urllib.parse.parse_qsl(topic[len(fake_topic) :]))
+
+
+@pytest.mark.describe("mqtt_topic_iothub - .encode_properties()")
+class TestEncodeProperties(object):
+    @pytest.mark.it("Encodes the system properties followed by the custom properties")
+    def test_properties(self):
+        message = Message("data", message_id="mid", output_name="output1")
+        message.custom_properties.update(fake_custom_properties)
+        topic = mqtt_topic_iothub.encode_properties(message, fake_topic)
+        assert topic.startswith(fake_topic + "%24.on=output1&%24.mid=mid&")
+        assert get_properties(topic) == dict(
+            fake_custom_properties, **{"$.on": "output1", "$.mid": "mid"}
+        )
+
+    @pytest.mark.it("Doesn't give a message without custom properties a dict of them")
+    @pytest.mark.parametrize(
+        "message_id, expected",
+        [pytest.param(None, "", id="No properties"), pytest.param("mid", "%24.mid=mid", id="Id")],
+    )
+    def test_no_custom_properties(self, message_id, expected):
+        message = Message("data", message_id=message_id)
+        assert mqtt_topic_iothub.encode_properties(message, fake_topic) == fake_topic + expected
+        assert message._custom_properties is None
+
+    @pytest.mark.it("Encodes the custom properties of a received message which hasn't decoded them")
+    def test_lazy_message(self):
+        message = lazy_models.LazyMessage(b"data", "%24.mid=mid&key=value")
+        topic = mqtt_topic_iothub.encode_properties(message, fake_topic)
+        assert get_properties(topic) == {"$.mid": "mid", "key": "value"}
+
+
+@pytest.mark.describe("mqtt_topic_iothub - .encode_properties() -- called with a templated message")
+class TestEncodePropertiesWithTemplate(object):
+    @pytest.fixture
+    def template(self):
+        return MessageTemplate(
+            content_type="application/json",
+            content_encoding="utf-8",
+            output_name="output1",
+            custom_properties=fake_custom_properties,
+        )
+
+    def make_plain_message(self, template, message_id):
+        message = Message(
+            "data",
+            message_id=message_id,
+            content_type=template.content_type,
+            content_encoding=template.content_encoding,
+            output_name=template.output_name,
+        )
+        message.custom_properties.update(template.custom_properties)
+        return message
+
+    @pytest.mark.it("Encodes the same properties as for a message which isn't templated")
+    def test_same_properties(self, template):
+        message = template.create_message("data", message_id="mid")
+        message.correlation_id = "cid"
+        message.expiry_time_utc = datetime.datetime(2019, 1, 2, 3, 4, 5)
+        plain_message = self.make_plain_message(template, "mid")
+        plain_message.correlation_id = "cid"
+        plain_message.expiry_time_utc = datetime.datetime(2019, 1, 2, 3, 4, 5)
+
+        properties = get_properties(mqtt_topic_iothub.encode_properties(message, fake_topic))
+        assert properties == get_properties(
+            mqtt_topic_iothub.encode_properties(plain_message, fake_topic)
+        )
+        assert properties["$.mid"] == "mid"
+        assert properties["$.on"] == "output1"
+        assert properties["sensor"] == "sensor 1"
+
+    @pytest.mark.it("Only encodes the properties of the template once")
+    def test_cached(self, mocker, template):
+        mqtt_topic_iothub.encode_properties(template.create_message("data"), fake_topic)
+        spy = mocker.spy(urllib.parse, "urlencode")
+        topic = mqtt_topic_iothub.encode_properties(
+            template.create_message("data", message_id="mid2"), fake_topic
+        )
+        assert spy.call_count == 1
+        assert spy.call_args == mocker.call([("$.mid", "mid2")])
+        assert get_properties(topic)["$.mid"] == "mid2"
+
+    @pytest.mark.it("Encodes a message which no longer matches its template like any other message")
+    def test_changed(self, template):
+        message = template.create_message("data", message_id="mid")
+        message.content_encoding = "gzip"
+        message.custom_properties["extra"] = "value"
+        properties = get_properties(mqtt_topic_iothub.encode_properties(message, fake_topic))
+        assert properties["$.ce"] == "gzip"
+        assert properties["extra"] == "value"
+
+    @pytest.mark.it("Encodes a template without properties and a message without an id")
+    @pytest.mark.parametrize(
+        "template_kwargs, message_id, expected",
+        [
+            pytest.param({}, None, "", id="Neither"),
+            pytest.param({}, "mid", "%24.mid=mid", id="Message id only"),
+            pytest.param(
+                {"content_type": "text/plain"}, None, "%24.ct=text%2Fplain", id="Template only"
+            ),
+        ],
+    )
+    def test_empty(self, template_kwargs, message_id, expected):
+        message = MessageTemplate(**template_kwargs).create_message("data", message_id=message_id)
+        assert mqtt_topic_iothub.encode_properties(message, fake_topic) == fake_topic + expected
+
+
+@pytest.mark.describe("mqtt_topic_iothub - TopicParser")
+class TestTopicParser(object):
+    @pytest.fixture
+    def parser(self):
+        return mqtt_topic_iothub.TopicParser("fake_device", "fake_module")
+
+    @pytest.mark.it("Parses C2D topics, with or without properties")
+    @pytest.mark.parametrize(
+        "topic, properties",
+        [
+            pytest.param("devices/fake_device/messages/devicebound", None, id="No slash"),
+            pytest.param("devices/fake_device/messages/devicebound/", None, id="No properties"),
+            pytest.param(
+                "devices/fake_device/messages/devicebound/%24.mid=mid&key=value",
+                "%24.mid=mid&key=value",
+                id="Properties",
+            ),
+        ],
+    )
+    def test_c2d(self, parser, topic, properties):
+        parsed = parser.parse(topic)
+        assert parsed.kind == mqtt_topic_iothub.C2D_TOPIC
+        assert parsed.properties == properties
+
+    @pytest.mark.it("Parses input topics into the input name and properties")
+    @pytest.mark.parametrize(
+        "topic, properties",
+        [
+            pytest.param("devices/fake_device/modules/fake_module/inputs/input1", None, id="Bare"),
+            pytest.param(
+                "devices/fake_device/modules/fake_module/inputs/input1/%24.mid=mid",
+                "%24.mid=mid",
+                id="Properties",
+            ),
+        ],
+    )
+    def test_input(self, parser, topic, properties):
+        parsed = parser.parse(topic)
+        assert parsed.kind == mqtt_topic_iothub.INPUT_TOPIC
+        assert parsed.input_name == "input1"
+        assert parsed.properties == properties
+
+    @pytest.mark.it("Parses method topics into the method name and request id")
+    def test_method(self, parser):
+        parsed = parser.parse("$iothub/methods/POST/reboot/?$rid=12")
+        assert parsed.kind == mqtt_topic_iothub.METHOD_TOPIC
+        assert parsed.method_name == "reboot"
+        assert parsed.request_id == "12"
+
+    @pytest.mark.it("Parses twin response topics into the status code and request id")
+    def test_twin_response(self, parser):
+        parsed = parser.parse("$iothub/twin/res/204/?$rid=abc&$version=3")
+        assert parsed.kind == mqtt_topic_iothub.TWIN_RESPONSE_TOPIC
+        assert parsed.status_code == 204
+        assert parsed.request_id == "abc"
+
+    @pytest.mark.it("Parses twin desired property patch topics")
+    def test_twin_patch(self, parser):
+        parsed = parser.parse("$iothub/twin/PATCH/properties/desired/?$version=2")
+        assert parsed.kind == mqtt_topic_iothub.TWIN_PATCH_TOPIC
+
+    @pytest.mark.it("Returns None for topics of other devices and modules, and unknown topics")
+    @pytest.mark.parametrize(
+        "topic",
+        [
+            "devices/other_device/messages/devicebound/",
+            "devices/fake_device/modules/other_module/inputs/input1/",
+            "$iothub/unknown/topic",
+            "unknown",
+        ],
+    )
+    def test_unknown(self, parser, topic):
+        assert parser.parse(topic) is None
+
+    @pytest.mark.it("Only recognizes method and twin topics if the device id isn't known")
+    def test_no_device_id(self):
+        parser = mqtt_topic_iothub.TopicParser(None, None)
+        assert parser.parse("devices/None/messages/devicebound/") is None
+        assert parser.parse("$iothub/methods/POST/reboot/?$rid=1").kind == (
+            mqtt_topic_iothub.METHOD_TOPIC
+        )
+
+    @pytest.mark.it("Doesn't recognize input topics if the parser isn't for a module")
+    def test_no_module_id(self):
+        parser = mqtt_topic_iothub.TopicParser("fake_device", None)
+        assert parser.parse("devices/fake_device/modules/None/inputs/input1/") is None
+
+    @pytest.mark.it("Raises an error if a known kind of topic is malformed")
+    @pytest.mark.parametrize(
+        "topic, error",
+        [
+            pytest.param("devices/fake_device/messages/deviceboundx", ValueError, id="C2D"),
+            pytest.param("devices/fake_device/modules/fake_module/inputs/", ValueError, id="Input"),
+            pytest.param("$iothub/methods/POST/reboot", IndexError, id="Method without rid"),
+            pytest.param("$iothub/twin/res/abc/?$rid=1", ValueError, id="Bad status code"),
+        ],
+    )
+    def test_malformed(self, parser, topic, error):
+        with pytest.raises(error):
+            parser.parse(topic)
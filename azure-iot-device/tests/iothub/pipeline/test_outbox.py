@@ -0,0 +1,273 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from azure.iot.device.iothub.models import Message
+from azure.iot.device.iothub.pipeline import outbox
+
+logging.basicConfig(level=logging.INFO)
+
+
+@pytest.fixture
+def outbox_path(tmpdir):
+    return os.path.join(str(tmpdir), "outbox.db")
+
+
+@pytest.fixture
+def store(outbox_path):
+    store = outbox.SqliteOutbox(outbox_path)
+    yield store
+    store.close()
+
+
+@pytest.mark.describe("SqliteOutbox - .put() and .peek()")
+class TestSqliteOutboxPutAndPeek(object):
+    @pytest.mark.it("Returns stored messages oldest first")
+    def test_fifo(self, store):
+        for i in range(3):
+            store.put(outbox.D2C_MESSAGE, Message("message {}".format(i)))
+        entries = store.peek(limit=10)
+        assert [e.message.data for e in entries] == [b"message 0", b"message 1", b"message 2"]
+        assert len(store) == 3
+
+    @pytest.mark.it("Returns at most 'limit' entries")
+    def test_limit(self, store):
+        for i in range(5):
+            store.put(outbox.D2C_MESSAGE, Message(str(i)))
+        assert len(store.peek(limit=2)) == 2
+
+    @pytest.mark.it("Skips entries whose ids are in 'exclude'")
+    def test_exclude(self, store):
+        ids = [store.put(outbox.D2C_MESSAGE, Message(str(i))) for i in range(4)]
+        entries = store.peek(limit=2, exclude=ids[:2])
+        assert [e.id for e in entries] == ids[2:]
+
+    @pytest.mark.it("Stores the kind of each message")
+    def test_kind(self, store):
+        store.put(outbox.D2C_MESSAGE, Message("a"))
+        store.put(outbox.OUTPUT_EVENT, Message("b", output_name="out1"))
+        entries = store.peek(limit=10)
+        assert [e.kind for e in entries] == [outbox.D2C_MESSAGE, outbox.OUTPUT_EVENT]
+
+    @pytest.mark.it("Stores the payload as the bytes that would be sent on the wire")
+    @pytest.mark.parametrize(
+        "data, expected",
+        [
+            pytest.param("text é", "text é".encode("utf-8"), id="Text"),
+            pytest.param(b"\x00\x01\x02", b"\x00\x01\x02", id="Bytes"),
+            pytest.param(bytearray(b"abc"), b"abc", id="Bytearray"),
+            pytest.param(memoryview(b"abcdef")[1:4], b"bcd", id="Memoryview"),
+            pytest.param(42, b"42", id="Integer"),
+            pytest.param(None, b"", id="None"),
+        ],
+    )
+    def test_payload(self, store, data, expected):
+        store.put(outbox.D2C_MESSAGE, Message(data))
+        assert store.peek(limit=1)[0].message.data == expected
+
+    @pytest.mark.it("Raises a TypeError if the payload can't be sent on the wire")
+    def test_bad_payload(self, store):
+        with pytest.raises(TypeError):
+            store.put(outbox.D2C_MESSAGE, Message({"a": 1}))
+        assert len(store) == 0
+
+    @pytest.mark.it("Preserves the message properties")
+    def test_properties(self, store):
+        message = Message(
+            "data",
+            message_id="mid",
+            content_encoding="utf-8",
+            content_type="application/json",
+            output_name="out1",
+        )
+        message.custom_properties["key"] = "value"
+        message.correlation_id = "cid"
+        store.put(outbox.OUTPUT_EVENT, message)
+
+        stored = store.peek(limit=1)[0].message
+        assert stored.message_id == "mid"
+        assert stored.content_encoding == "utf-8"
+        assert stored.content_type == "application/json"
+        assert stored.output_name == "out1"
+        assert stored.custom_properties == {"key": "value"}
+        assert stored.correlation_id == "cid"
+
+    @pytest.mark.it("Does not store custom properties, or create them, for a message without any")
+    def test_no_custom_properties(self, store):
+        message = Message("data")
+        store.put(outbox.D2C_MESSAGE, message)
+        assert message._custom_properties is None
+        (properties,) = store._db.execute("SELECT properties FROM outbox").fetchone()
+        assert "custom_properties" not in properties
+
+    @pytest.mark.it("Stores a datetime expiry_time_utc in ISO format")
+    def test_datetime_expiry(self, store):
+        message = Message("data")
+        message.expiry_time_utc = datetime.utcnow() + timedelta(days=1)
+        store.put(outbox.D2C_MESSAGE, message)
+        assert store.peek(limit=1)[0].message.expiry_time_utc == message.expiry_time_utc.isoformat()
+
+    @pytest.mark.it("Keeps messages after the outbox is closed and reopened")
+    def test_durable(self, outbox_path):
+        store = outbox.SqliteOutbox(outbox_path)
+        store.put(outbox.D2C_MESSAGE, Message("persisted"))
+        store.close()
+
+        store = outbox.SqliteOutbox(outbox_path)
+        assert [e.message.data for e in store.peek(limit=10)] == [b"persisted"]
+        store.close()
+
+
+@pytest.mark.describe("SqliteOutbox - len() and .size")
+class TestSqliteOutboxTotals(object):
+    def assert_totals_match_table(self, store):
+        assert (len(store), store.size) == store._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outbox"
+        ).fetchone()
+
+    @pytest.mark.it("Keeps the number of entries and their size as entries are added and removed")
+    def test_totals(self, store):
+        ids = [store.put(outbox.D2C_MESSAGE, Message("x" * i)) for i in range(1, 6)]
+        self.assert_totals_match_table(store)
+        store.remove(ids[2])
+        store.remove(ids[2])
+        self.assert_totals_match_table(store)
+        message = Message("expired")
+        message.expiry_time_utc = time.time() - 60
+        store.put(outbox.D2C_MESSAGE, message)
+        store.remove_expired()
+        self.assert_totals_match_table(store)
+        assert len(store) == 4
+
+    @pytest.mark.it("Reads the number of entries and their size when the outbox is opened")
+    def test_totals_on_open(self, outbox_path):
+        store = outbox.SqliteOutbox(outbox_path)
+        store.put(outbox.D2C_MESSAGE, Message("a"))
+        store.put(outbox.D2C_MESSAGE, Message("bb"))
+        size = store.size
+        store.close()
+
+        store = outbox.SqliteOutbox(outbox_path)
+        assert len(store) == 2
+        assert store.size == size
+        store.close()
+
+
+@pytest.mark.describe("SqliteOutbox - .remove()")
+class TestSqliteOutboxRemove(object):
+    @pytest.mark.it("Removes the entry with the given id")
+    def test_remove(self, store):
+        ids = [store.put(outbox.D2C_MESSAGE, Message(str(i))) for i in range(3)]
+        store.remove(ids[1])
+        assert [e.id for e in store.peek(limit=10)] == [ids[0], ids[2]]
+
+    @pytest.mark.it("Does nothing if the entry is not in the outbox")
+    def test_remove_unknown(self, store):
+        store.put(outbox.D2C_MESSAGE, Message("a"))
+        store.remove(12345)
+        assert len(store) == 1
+
+
+@pytest.mark.describe("SqliteOutbox - Expiry")
+class TestSqliteOutboxExpiry(object):
+    @pytest.mark.it("Drops expired messages instead of returning them")
+    @pytest.mark.parametrize(
+        "expiry",
+        [
+            pytest.param(datetime.utcnow() - timedelta(minutes=1), id="datetime"),
+            pytest.param(
+                (datetime.utcnow() - timedelta(minutes=1)).isoformat() + "Z", id="ISO string"
+            ),
+            pytest.param(time.time() - 60, id="Timestamp"),
+        ],
+    )
+    def test_expired(self, store, expiry):
+        message = Message("expired")
+        message.expiry_time_utc = expiry
+        store.put(outbox.D2C_MESSAGE, message)
+        store.put(outbox.D2C_MESSAGE, Message("fresh"))
+
+        assert [e.message.data for e in store.peek(limit=10)] == [b"fresh"]
+        assert len(store) == 1
+
+    @pytest.mark.it("Keeps messages which have not expired yet")
+    def test_not_expired(self, store):
+        message = Message("data")
+        message.expiry_time_utc = datetime.utcnow() + timedelta(days=1)
+        store.put(outbox.D2C_MESSAGE, message)
+        assert len(store.peek(limit=10)) == 1
+
+    @pytest.mark.it("Never expires messages with an expiry_time_utc that can't be parsed")
+    def test_unparseable(self, store):
+        message = Message("data")
+        message.expiry_time_utc = "sometime next week"
+        store.put(outbox.D2C_MESSAGE, message)
+        assert len(store.peek(limit=10)) == 1
+
+
+@pytest.mark.describe("SqliteOutbox - max_bytes")
+class TestSqliteOutboxMaxBytes(object):
+    @pytest.mark.it("Evicts the oldest messages when the outbox grows beyond max_bytes")
+    def test_evicts_oldest(self, outbox_path):
+        store = outbox.SqliteOutbox(outbox_path)
+        store.put(outbox.D2C_MESSAGE, Message("x" * 100))
+        entry_size = store.size
+        store.close()
+
+        store = outbox.SqliteOutbox(outbox_path, max_bytes=entry_size * 3)
+        for i in range(4):
+            store.put(outbox.D2C_MESSAGE, Message(str(i) * 100))
+
+        assert store.size <= entry_size * 3
+        assert [e.message.data[:1] for e in store.peek(limit=10)] == [b"1", b"2", b"3"]
+        store.close()
+
+    @pytest.mark.it(
+        "Raises a ValueError without adding or evicting anything if the message is larger than max_bytes"
+    )
+    def test_too_large(self, outbox_path):
+        store = outbox.SqliteOutbox(outbox_path, max_bytes=1000)
+        store.put(outbox.D2C_MESSAGE, Message("a"))
+        size = store.size
+
+        with pytest.raises(ValueError):
+            store.put(outbox.D2C_MESSAGE, Message("b" * 1000))
+
+        assert len(store) == 1
+        assert store.size == size
+        assert [e.message.data for e in store.peek(limit=10)] == [b"a"]
+        store.close()
+
+    @pytest.mark.it("Never evicts the message being added, even if it fills the outbox by itself")
+    def test_fills_outbox(self, outbox_path):
+        store = outbox.SqliteOutbox(outbox_path)
+        store.put(outbox.D2C_MESSAGE, Message("x" * 100))
+        entry_size = store.size
+        store.close()
+
+        store = outbox.SqliteOutbox(outbox_path, max_bytes=entry_size)
+        entry_id = store.put(outbox.D2C_MESSAGE, Message("y" * 100))
+
+        assert len(store) == 1
+        assert store.size == entry_size
+        assert [e.id for e in store.peek(limit=10)] == [entry_id]
+        store.close()
+
+    @pytest.mark.it("Adds nothing and evicts nothing if evicting fails")
+    def test_evict_fails(self, mocker, outbox_path):
+        store = outbox.SqliteOutbox(outbox_path, max_bytes=1000)
+        store.put(outbox.D2C_MESSAGE, Message("a"))
+        mocker.patch.object(store, "_evict", side_effect=ValueError)
+
+        with pytest.raises(ValueError):
+            store.put(outbox.D2C_MESSAGE, Message("b"))
+
+        assert len(store) == 1
+        assert store._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 1
+        store.close()
@@ -5,6 +5,7 @@
 # --------------------------------------------------------------------------
 import sys
 import logging
+import pytest
 from azure.iot.device.iothub.pipeline import pipeline_events_iothub
 from tests.common.pipeline import pipeline_data_object_test
 
@@ -35,3 +36,19 @@ pipeline_data_object_test.add_event_test(
     positional_arguments=["patch"],
     keyword_arguments={},
 )
+
+
+@pytest.mark.describe("TwinDesiredPropertiesPatchEvent - .patch")
+class TestTwinDesiredPropertiesPatchEventPatch(object):
+    @pytest.mark.it("Deserializes the JSON payload the first time it is read")
+    def test_payload(self):
+        event = pipeline_events_iothub.TwinDesiredPropertiesPatchEvent(payload=b'{"a": 1}')
+        patch = event.patch
+        assert patch == {"a": 1}
+        assert event.patch is patch
+
+    @pytest.mark.it("Can be set, replacing the payload")
+    def test_set(self):
+        event = pipeline_events_iothub.TwinDesiredPropertiesPatchEvent(payload=b"not json")
+        event.patch = {"b": 2}
+        assert event.patch == {"b": 2}
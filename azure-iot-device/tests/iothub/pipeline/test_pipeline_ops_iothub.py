@@ -42,6 +42,12 @@ pipeline_data_object_test.add_operation_test(
     positional_arguments=["message"],
     keyword_arguments={"callback": None},
 )
+pipeline_data_object_test.add_operation_test(
+    cls=pipeline_ops_iothub.SendD2CMessageBatchOperation,
+    module=this_module,
+    positional_arguments=["messages"],
+    keyword_arguments={"max_inflight": None, "callback": None},
+)
 pipeline_data_object_test.add_operation_test(
     cls=pipeline_ops_iothub.SendOutputEventOperation,
     module=this_module,
@@ -3,13 +3,31 @@
 # Licensed under the MIT License. See License.txt in the project root for
 # license information.
 # --------------------------------------------------------------------------
+import datetime
 import functools
 import json
 import logging
 import pytest
 import sys
-from azure.iot.device.common.pipeline import pipeline_ops_base
-from azure.iot.device.iothub.pipeline import pipeline_stages_iothub, pipeline_ops_iothub
+import threading
+import zlib
+from azure.iot.device.common import errors
+from azure.iot.device.common.pipeline import (
+    pipeline_ops_base,
+    pipeline_stages_base,
+    operation_flow,
+)
+from azure.iot.device.iothub.pipeline import (
+    pipeline_stages_iothub,
+    pipeline_ops_iothub,
+    pipeline_events_iothub,
+    outbox,
+    compression,
+    aggregation,
+    lazy_models,
+    mqtt_topic_iothub,
+    serializers,
+)
 from tests.common.pipeline.helpers import (
     assert_callback_succeeded,
     assert_callback_failed,
@@ -22,6 +40,7 @@ from tests.common.pipeline.helpers import (
 from tests.iothub.pipeline.helpers import all_iothub_ops, all_iothub_events
 from tests.common.pipeline import pipeline_stage_test
 from azure.iot.device.common.models.x509 import X509
+from azure.iot.device.iothub.models import Message
 from azure.iot.device.iothub.auth.x509_authentication_provider import X509AuthenticationProvider
 
 logging.basicConfig(level=logging.INFO)
@@ -276,6 +295,892 @@ class TestUseAuthProviderRunOpWithSetAuthProviderOperation(object):
             stage.run_op(set_auth_provider)
 
 
+pipeline_stage_test.add_base_pipeline_stage_tests(
+    cls=pipeline_stages_iothub.HandleD2CMessageBatchStage,
+    module=this_module,
+    all_ops=all_common_ops + all_iothub_ops,
+    handled_ops=[pipeline_ops_iothub.SendD2CMessageBatchOperation],
+    all_events=all_common_events + all_iothub_events,
+    handled_events=[],
+)
+
+
+@pytest.mark.describe(
+    "HandleD2CMessageBatchStage - .run_op() -- called with SendD2CMessageBatchOperation"
+)
+class TestHandleD2CMessageBatchRunOpWithSendD2CMessageBatch(object):
+    @pytest.fixture
+    def stage(self, mocker):
+        return make_mock_stage(mocker, pipeline_stages_iothub.HandleD2CMessageBatchStage)
+
+    @pytest.fixture
+    def messages(self):
+        return [Message("message {}".format(i)) for i in range(5)]
+
+    @pytest.fixture
+    def pending_ops(self, stage):
+        """Make the next stage hold on to every op it receives instead of completing it"""
+        ops = []
+        stage.next.run_op = ops.append
+        return ops
+
+    @pytest.mark.it("Runs one SendD2CMessageOperation on the next stage for each message, in order")
+    def test_runs_op_per_message(self, stage, messages, callback):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=100, callback=callback
+        )
+        stage.run_op(op)
+        assert stage.next.run_op.call_count == len(messages)
+        for i, call in enumerate(stage.next.run_op.call_args_list):
+            new_op = call[0][0]
+            assert isinstance(new_op, pipeline_ops_iothub.SendD2CMessageOperation)
+            assert new_op.message is messages[i]
+
+    @pytest.mark.it(
+        "Completes the batch without error and with a None result for every message if all messages succeed"
+    )
+    def test_all_messages_succeed(self, stage, messages, callback):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=2, callback=callback
+        )
+        stage.run_op(op)
+        assert_callback_succeeded(op=op)
+        assert op.results == [None] * len(messages)
+
+    @pytest.mark.it("Completes the batch immediately if there are no messages")
+    def test_no_messages(self, stage, callback):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=[], max_inflight=2, callback=callback
+        )
+        stage.run_op(op)
+        assert stage.next.run_op.call_count == 0
+        assert_callback_succeeded(op=op)
+        assert op.results == []
+
+    @pytest.mark.it("Accepts any iterable of messages")
+    def test_accepts_generator(self, stage, messages, callback):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=(m for m in messages), max_inflight=2, callback=callback
+        )
+        stage.run_op(op)
+        assert stage.next.run_op.call_count == len(messages)
+        assert_callback_succeeded(op=op)
+
+    @pytest.mark.it("Does not have more than max_inflight messages outstanding at any one time")
+    def test_max_inflight(self, stage, messages, callback, pending_ops):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=2, callback=callback
+        )
+        stage.run_op(op)
+        assert len(pending_ops) == 2
+
+        # completing one message allows exactly one more to be sent
+        pending_ops[0].callback(pending_ops[0])
+        assert len(pending_ops) == 3
+        assert pending_ops[2].message is messages[2]
+        assert callback.call_count == 0
+
+    @pytest.mark.it("Sends every message at once if max_inflight is None")
+    def test_no_max_inflight(self, stage, messages, callback, pending_ops):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=None, callback=callback
+        )
+        stage.run_op(op)
+        assert len(pending_ops) == len(messages)
+
+    @pytest.mark.it("Completes the batch only after every message has completed")
+    def test_completes_after_all_messages(self, stage, messages, callback, pending_ops):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=len(messages), callback=callback
+        )
+        stage.run_op(op)
+
+        # complete them out of order
+        for message_op in reversed(pending_ops):
+            assert callback.call_count == 0
+            message_op.callback(message_op)
+        assert_callback_succeeded(op=op)
+
+    @pytest.mark.it(
+        "Returns the error for each failed message in the results, in the same position as the message"
+    )
+    def test_message_fails(self, stage, messages, callback, pending_ops, fake_exception):
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=len(messages), callback=callback
+        )
+        stage.run_op(op)
+
+        for i, message_op in enumerate(list(pending_ops)):
+            if i == 1:
+                message_op.error = fake_exception
+            message_op.callback(message_op)
+
+        assert_callback_succeeded(op=op)
+        assert op.results == [None, fake_exception, None, None, None]
+
+    @pytest.mark.it("Keeps sending the rest of the batch after a message fails")
+    def test_continues_after_failure(self, stage, messages, fake_exception, callback):
+        def next_stage_run_op(self, op):
+            if op.message is messages[0]:
+                op.error = fake_exception
+            op.callback(op)
+
+        stage.next.run_op = functools.partial(next_stage_run_op, (stage.next,))
+        op = pipeline_ops_iothub.SendD2CMessageBatchOperation(
+            messages=messages, max_inflight=1, callback=callback
+        )
+        stage.run_op(op)
+        assert_callback_succeeded(op=op)
+        assert op.results == [fake_exception, None, None, None, None]
+
+
+class StoreAndForwardStageWithMemoryOutbox(pipeline_stages_iothub.StoreAndForwardStage):
+    """StoreAndForwardStage needs an outbox, so give it an in-memory one for the generic stage tests"""
+
+    def __init__(self):
+        super(StoreAndForwardStageWithMemoryOutbox, self).__init__(
+            outbox=outbox.SqliteOutbox(":memory:"), drain_window=2
+        )
+
+
+pipeline_stage_test.add_base_pipeline_stage_tests(
+    cls=StoreAndForwardStageWithMemoryOutbox,
+    module=this_module,
+    all_ops=all_common_ops + all_iothub_ops,
+    handled_ops=[
+        pipeline_ops_iothub.SendD2CMessageOperation,
+        pipeline_ops_iothub.SendOutputEventOperation,
+    ],
+    all_events=all_common_events + all_iothub_events,
+    handled_events=[],
+    extra_initializer_defaults={"drain_window": 2},
+)
+
+
+class StoreAndForwardTestBase(object):
+    @pytest.fixture
+    def stage(self, mocker):
+        return make_mock_stage(mocker, StoreAndForwardStageWithMemoryOutbox)
+
+    @pytest.fixture
+    def pending_ops(self, stage):
+        """Make the next stage hold on to every op it receives instead of completing it"""
+        ops = []
+        stage.next.run_op = ops.append
+        return ops
+
+    @pytest.fixture(
+        params=[
+            pipeline_ops_iothub.SendD2CMessageOperation,
+            pipeline_ops_iothub.SendOutputEventOperation,
+        ]
+    )
+    def op_class(self, request):
+        return request.param
+
+    def make_op(self, op_class, data, callback):
+        return op_class(message=Message(data, output_name="output"), callback=callback)
+
+    def stored_data(self, stage):
+        return [e.message.data for e in stage.outbox.peek(limit=100)]
+
+
+@pytest.mark.describe(
+    "StoreAndForwardStage - .run_op() -- called while connected with an empty outbox"
+)
+class TestStoreAndForwardRunOpConnected(StoreAndForwardTestBase):
+    @pytest.fixture(autouse=True)
+    def connected(self, stage):
+        stage.pipeline_root.connected = True
+
+    @pytest.mark.it("Passes the op to the next stage")
+    def test_passes_op_down(self, stage, op_class, callback):
+        op = self.make_op(op_class, "data", callback)
+        stage.run_op(op)
+        assert stage.next.run_op.call_count == 1
+        assert stage.next.run_op.call_args[0][0] is op
+        assert_callback_succeeded(op=op)
+        assert len(stage.outbox) == 0
+
+    @pytest.mark.it(
+        "Stores the message and completes the op successfully if sending fails with a connection error"
+    )
+    @pytest.mark.parametrize(
+        "error", [errors.ConnectionDroppedError(), errors.ConnectionFailedError()]
+    )
+    def test_stores_on_connection_error(self, stage, op_class, callback, pending_ops, error):
+        op = self.make_op(op_class, "data", callback)
+        stage.run_op(op)
+        pending_ops[0].error = error
+        pending_ops[0].callback(pending_ops[0])
+
+        assert_callback_succeeded(op=op)
+        assert self.stored_data(stage) == [b"data"]
+
+    @pytest.mark.it("Fails the op without storing the message if sending fails with another error")
+    def test_fails_on_other_error(self, stage, op_class, callback, pending_ops, fake_exception):
+        op = self.make_op(op_class, "data", callback)
+        stage.run_op(op)
+        pending_ops[0].error = fake_exception
+        pending_ops[0].callback(pending_ops[0])
+
+        assert_callback_failed(op=op, error=fake_exception)
+        assert len(stage.outbox) == 0
+
+
+@pytest.mark.describe("StoreAndForwardStage - .run_op() -- called while not connected")
+class TestStoreAndForwardRunOpDisconnected(StoreAndForwardTestBase):
+    @pytest.mark.it("Stores the message in the outbox and completes the op successfully")
+    def test_stores(self, stage, op_class, callback):
+        op = self.make_op(op_class, "data", callback)
+        stage.run_op(op)
+        assert_callback_succeeded(op=op)
+        assert self.stored_data(stage) == [b"data"]
+
+    @pytest.mark.it("Starts a single ConnectOperation, even if several messages are stored")
+    def test_connects(self, stage, op_class, mocker, pending_ops):
+        for i in range(3):
+            stage.run_op(self.make_op(op_class, str(i), mocker.MagicMock()))
+        assert len(pending_ops) == 1
+        assert isinstance(pending_ops[0], pipeline_ops_base.ConnectOperation)
+
+    @pytest.mark.it(
+        "Starts a new ConnectOperation for the next message if the previous connect failed"
+    )
+    def test_connects_again_after_failure(
+        self, stage, op_class, mocker, pending_ops, fake_exception
+    ):
+        stage.run_op(self.make_op(op_class, "1", mocker.MagicMock()))
+        pending_ops[0].error = fake_exception
+        pending_ops[0].callback(pending_ops[0])
+
+        stage.run_op(self.make_op(op_class, "2", mocker.MagicMock()))
+        assert len(pending_ops) == 2
+        assert isinstance(pending_ops[1], pipeline_ops_base.ConnectOperation)
+        assert self.stored_data(stage) == [b"1", b"2"]
+
+    @pytest.mark.it(
+        "Does not start a ConnectOperation while a ReconnectStage below is reconnecting, and drains once connected"
+    )
+    def test_waits_for_reconnect_stage(self, stage, op_class, mocker, pending_ops):
+        reconnect_stage = pipeline_stages_base.ReconnectStage()
+        reconnect_stage.reconnecting = True
+        stage.next.next = reconnect_stage
+        stage.run_op(self.make_op(op_class, "1", mocker.MagicMock()))
+        stage.run_op(self.make_op(op_class, "2", mocker.MagicMock()))
+        assert pending_ops == []
+
+        stage.pipeline_root.connected = True
+        stage.on_connected()
+        assert [op.message.data for op in pending_ops] == [b"1", b"2"]
+
+    @pytest.mark.it("Starts a ConnectOperation if a ReconnectStage below is not reconnecting")
+    def test_connects_with_idle_reconnect_stage(self, stage, op_class, mocker, pending_ops):
+        stage.next.next = pipeline_stages_base.ReconnectStage()
+        stage.run_op(self.make_op(op_class, "1", mocker.MagicMock()))
+        assert len(pending_ops) == 1
+        assert isinstance(pending_ops[0], pipeline_ops_base.ConnectOperation)
+
+    @pytest.mark.it("Fails the op if the message can't be stored")
+    def test_store_fails(self, stage, op_class, callback):
+        op = op_class(message=Message({"not": "storable"}), callback=callback)
+        stage.run_op(op)
+        assert_callback_failed(op=op, error=TypeError)
+
+    @pytest.mark.it("Fails the op with a ValueError if the message is larger than the outbox")
+    def test_too_large(self, stage, op_class, callback):
+        stage.outbox.max_bytes = 100
+        op = self.make_op(op_class, "x" * 200, callback)
+        stage.run_op(op)
+        assert_callback_failed(op=op, error=ValueError)
+        assert len(stage.outbox) == 0
+
+
+@pytest.mark.describe(
+    "StoreAndForwardStage - .run_op() -- called while connected with messages in the outbox"
+)
+class TestStoreAndForwardRunOpWithBacklog(StoreAndForwardTestBase):
+    @pytest.mark.it("Stores the message behind the backlog so that messages are sent in order")
+    def test_keeps_order(self, stage, op_class, mocker, pending_ops):
+        stage.outbox.put(outbox.D2C_MESSAGE, Message("old"))
+        stage.pipeline_root.connected = True
+
+        op = self.make_op(op_class, "new", mocker.MagicMock())
+        stage.run_op(op)
+
+        assert_callback_succeeded(op=op)
+        assert [o.message.data for o in pending_ops] == [b"old", b"new"]
+
+
+@pytest.mark.describe("StoreAndForwardStage - .on_connected()")
+class TestStoreAndForwardOnConnected(StoreAndForwardTestBase):
+    @pytest.fixture
+    def stored(self, stage):
+        stage.outbox.put(outbox.D2C_MESSAGE, Message("d2c"))
+        stage.outbox.put(outbox.OUTPUT_EVENT, Message("output", output_name="out1"))
+        stage.outbox.put(outbox.D2C_MESSAGE, Message("last"))
+
+    def connect(self, stage):
+        stage.pipeline_root.connected = True
+        stage.on_connected()
+
+    @pytest.mark.it("Forwards stored messages, oldest first, with the right kind of operation")
+    def test_forwards(self, stage, stored, pending_ops):
+        self.connect(stage)
+        assert len(pending_ops) == 2
+        assert isinstance(pending_ops[0], pipeline_ops_iothub.SendD2CMessageOperation)
+        assert pending_ops[0].message.data == b"d2c"
+        assert isinstance(pending_ops[1], pipeline_ops_iothub.SendOutputEventOperation)
+        assert pending_ops[1].message.output_name == "out1"
+
+    @pytest.mark.it("Keeps at most drain_window stored messages in flight")
+    def test_drain_window(self, stage, stored, pending_ops):
+        self.connect(stage)
+        assert len(pending_ops) == 2
+
+        pending_ops[0].callback(pending_ops[0])
+        assert len(pending_ops) == 3
+        assert pending_ops[2].message.data == b"last"
+
+    @pytest.mark.it("Removes messages from the outbox once they've been sent")
+    def test_removes_sent(self, stage, stored):
+        self.connect(stage)
+        assert len(stage.outbox) == 0
+        assert stage.next.run_op.call_count == 3
+
+    @pytest.mark.it("Keeps a message in the outbox if forwarding fails with a connection error")
+    def test_keeps_on_connection_error(self, stage, stored, pending_ops):
+        self.connect(stage)
+        stage.pipeline_root.connected = False
+        pending_ops[0].error = errors.ConnectionDroppedError()
+        pending_ops[0].callback(pending_ops[0])
+
+        assert self.stored_data(stage) == [b"d2c", b"output", b"last"]
+        assert len(pending_ops) == 2
+
+    @pytest.mark.it("Drops a message from the outbox if forwarding fails with another error")
+    def test_drops_on_other_error(self, stage, stored, pending_ops, fake_exception):
+        self.connect(stage)
+        pending_ops[0].error = fake_exception
+        pending_ops[0].callback(pending_ops[0])
+
+        assert self.stored_data(stage) == [b"output", b"last"]
+
+    @pytest.mark.it("Does nothing if the outbox is empty")
+    def test_empty(self, stage):
+        self.connect(stage)
+        assert stage.next.run_op.call_count == 0
+
+
+pipeline_stage_test.add_base_pipeline_stage_tests(
+    cls=pipeline_stages_iothub.AggregateMessagesStage,
+    module=this_module,
+    all_ops=all_common_ops + all_iothub_ops,
+    handled_ops=[pipeline_ops_iothub.SendD2CMessageOperation],
+    all_events=all_common_events + all_iothub_events,
+    handled_events=[],
+    methods_that_enter_pipeline_thread=["_on_timer_expired"],
+    extra_initializer_defaults={
+        "max_messages": 100,
+        "max_bytes": 128 * 1024,
+        "linger": 0.1,
+        "waiting_ops": list,
+        "waiting_items": list,
+        "waiting_bytes": 0,
+    },
+)
+
+
+@pytest.mark.describe("AggregateMessagesStage - .run_op() -- called with SendD2CMessageOperation")
+class TestAggregateMessagesRunOpWithSendD2CMessage(object):
+    @pytest.fixture
+    def mock_timer(self, mocker):
+        return mocker.patch.object(threading, "Timer")
+
+    @pytest.fixture
+    def stage(self, mocker, mock_timer):
+        return make_mock_stage(
+            mocker,
+            functools.partial(
+                pipeline_stages_iothub.AggregateMessagesStage,
+                max_messages=3,
+                max_bytes=1000,
+                linger=0.5,
+            ),
+        )
+
+    @pytest.fixture
+    def pending_ops(self, stage):
+        """Make the next stage hold on to every op it receives instead of completing it"""
+        ops = []
+        stage.next.run_op = ops.append
+        return ops
+
+    def make_ops(self, mocker, count, data="data"):
+        return [
+            pipeline_ops_iothub.SendD2CMessageOperation(
+                message=Message("{} {}".format(data, i)), callback=mocker.MagicMock()
+            )
+            for i in range(count)
+        ]
+
+    def expire_timer(self, mock_timer):
+        mock_timer.call_args[0][1]()
+
+    @pytest.mark.it("Holds on to the op and starts a linger timer")
+    def test_holds_op(self, mocker, stage, mock_timer):
+        op = self.make_ops(mocker, 1)[0]
+        stage.run_op(op)
+        assert stage.next.run_op.call_count == 0
+        assert op.callback.call_count == 0
+        assert mock_timer.call_count == 1
+        assert mock_timer.call_args[0][0] == 0.5
+        assert mock_timer.return_value.start.call_count == 1
+
+    @pytest.mark.it("Only starts one linger timer for the messages which are waiting")
+    def test_one_timer(self, mocker, stage, mock_timer):
+        for op in self.make_ops(mocker, 2):
+            stage.run_op(op)
+        assert mock_timer.call_count == 1
+
+    @pytest.mark.it(
+        "Sends the waiting messages in one aggregated message once max_messages messages are waiting"
+    )
+    def test_max_messages(self, mocker, stage, mock_timer, pending_ops):
+        ops = self.make_ops(mocker, 3)
+        for op in ops:
+            stage.run_op(op)
+
+        assert len(pending_ops) == 1
+        aggregated_message = pending_ops[0].message
+        assert aggregated_message.custom_properties[aggregation.AGGREGATED_PROPERTY] == "3"
+        assert [m.data for m in aggregation.decode_messages(aggregated_message.data)] == [
+            b"data 0",
+            b"data 1",
+            b"data 2",
+        ]
+        assert mock_timer.return_value.cancel.call_count == 1
+        assert stage.waiting_ops == []
+
+    @pytest.mark.it("Sends the waiting messages once their aggregated body reaches max_bytes")
+    def test_max_bytes(self, mocker, stage, pending_ops):
+        ops = self.make_ops(mocker, 2)
+        stage.max_bytes = len(aggregation.encode_messages([op.message for op in ops]).data)
+        for op in ops:
+            stage.run_op(op)
+        assert len(pending_ops) == 1
+        assert pending_ops[0].message.custom_properties[aggregation.AGGREGATED_PROPERTY] == "2"
+        assert len(pending_ops[0].message.data) == stage.max_bytes
+
+    @pytest.mark.it(
+        "Sends the waiting messages first if a new message would take them over max_bytes"
+    )
+    def test_over_max_bytes(self, mocker, stage, pending_ops):
+        small_op = self.make_ops(mocker, 1)[0]
+        big_op = self.make_ops(mocker, 1, data="x" * 999)[0]
+        stage.run_op(small_op)
+        stage.run_op(big_op)
+        assert pending_ops == [small_op, big_op]
+
+    @pytest.mark.it(
+        "Counts the encoded size of the messages against max_bytes, including base64 and properties"
+    )
+    def test_encoded_size(self, mocker, stage, pending_ops):
+        ops = [
+            pipeline_ops_iothub.SendD2CMessageOperation(
+                message=Message(bytes(bytearray(range(200))) * 2), callback=mocker.MagicMock()
+            )
+            for _ in range(3)
+        ]
+        ops[0].message.custom_properties["key"] = "value"
+        # Less than max_bytes of raw payload, but base64 makes it more
+        assert sum(len(op.message.data) for op in ops[:2]) < stage.max_bytes
+        for op in ops:
+            stage.run_op(op)
+
+        assert pending_ops == [ops[0], ops[1]]
+        assert stage.waiting_ops == [ops[2]]
+
+    @pytest.mark.it("Never sends an aggregated body larger than max_bytes")
+    def test_body_size(self, mocker, stage, mock_timer, pending_ops):
+        stage.max_messages = 100
+        for i in range(50):
+            op = pipeline_ops_iothub.SendD2CMessageOperation(
+                message=Message("\u2603" * (i * 7 % 30)), callback=mocker.MagicMock()
+            )
+            op.message.custom_properties["index"] = str(i)
+            stage.run_op(op)
+        self.expire_timer(mock_timer)
+
+        aggregated = [
+            op.message
+            for op in pending_ops
+            if aggregation.AGGREGATED_PROPERTY in op.message.custom_properties
+        ]
+        assert len(aggregated) > 1
+        for message in aggregated:
+            assert len(message.data) <= stage.max_bytes
+
+    @pytest.mark.it(
+        "Sends a message with an expiry_time_utc on its own, after the waiting messages"
+    )
+    def test_expiry(self, mocker, stage, pending_ops):
+        ops = self.make_ops(mocker, 3)
+        ops[2].message.expiry_time_utc = datetime.datetime(2030, 1, 1)
+        for op in ops:
+            stage.run_op(op)
+
+        assert len(pending_ops) == 2
+        assert pending_ops[0].message.custom_properties[aggregation.AGGREGATED_PROPERTY] == "2"
+        assert pending_ops[1] is ops[2]
+        assert stage.waiting_ops == []
+
+    @pytest.mark.it("Sends the waiting messages when the linger timer expires")
+    def test_linger(self, mocker, stage, mock_timer, pending_ops):
+        ops = self.make_ops(mocker, 2)
+        for op in ops:
+            stage.run_op(op)
+        assert pending_ops == []
+
+        self.expire_timer(mock_timer)
+        assert len(pending_ops) == 1
+        assert pending_ops[0].message.custom_properties[aggregation.AGGREGATED_PROPERTY] == "2"
+
+    @pytest.mark.it("Passes a lone waiting op down as it is")
+    def test_single_op(self, mocker, stage, mock_timer, pending_ops):
+        op = self.make_ops(mocker, 1)[0]
+        stage.run_op(op)
+        self.expire_timer(mock_timer)
+        assert pending_ops == [op]
+
+    @pytest.mark.it("Completes every waiting op when the aggregated message is sent")
+    def test_completes_ops(self, mocker, stage, pending_ops):
+        ops = self.make_ops(mocker, 3)
+        for op in ops:
+            stage.run_op(op)
+        assert all(op.callback.call_count == 0 for op in ops)
+
+        operation_flow.complete_op(stage.next, pending_ops[0])
+        for op in ops:
+            assert_callback_succeeded(op=op)
+
+    @pytest.mark.it("Fails every waiting op if sending the aggregated message fails")
+    def test_fails_ops(self, mocker, stage, pending_ops, fake_exception):
+        ops = self.make_ops(mocker, 3)
+        for op in ops:
+            stage.run_op(op)
+
+        pending_ops[0].error = fake_exception
+        operation_flow.complete_op(stage.next, pending_ops[0])
+        for op in ops:
+            assert_callback_failed(op=op, error=fake_exception)
+
+    @pytest.mark.it("Fails waiting ops which have passed their deadline instead of sending them")
+    def test_expired_ops(self, mocker, stage, mock_timer, pending_ops):
+        now = [1000.0]
+        mocker.patch.object(operation_flow, "clock", side_effect=lambda: now[0])
+        ops = self.make_ops(mocker, 3)
+        operation_flow.set_timeout(ops[0], 1)
+        stage.run_op(ops[0])
+        stage.run_op(ops[1])
+        now[0] += 2
+        stage.run_op(ops[2])
+
+        assert_callback_failed(op=ops[0], error=errors.TimeoutError)
+        assert len(pending_ops) == 1
+        assert pending_ops[0].message.custom_properties[aggregation.AGGREGATED_PROPERTY] == "2"
+
+
+@pytest.mark.describe("AggregateMessagesStage - .run_op() -- called with DisconnectOperation")
+class TestAggregateMessagesRunOpWithDisconnect(object):
+    @pytest.fixture
+    def stage(self, mocker):
+        mocker.patch.object(threading, "Timer")
+        stage = make_mock_stage(mocker, pipeline_stages_iothub.AggregateMessagesStage)
+        stage.next.run_op = mocker.MagicMock()
+        return stage
+
+    @pytest.mark.it("Sends the waiting messages before passing the op down")
+    def test_flushes(self, mocker, stage, callback):
+        for i in range(2):
+            stage.run_op(
+                pipeline_ops_iothub.SendD2CMessageOperation(
+                    message=Message("data"), callback=mocker.MagicMock()
+                )
+            )
+        op = pipeline_ops_base.DisconnectOperation(callback=callback)
+        stage.run_op(op)
+
+        assert stage.next.run_op.call_count == 2
+        assert isinstance(
+            stage.next.run_op.call_args_list[0][0][0], pipeline_ops_iothub.SendD2CMessageOperation
+        )
+        assert stage.next.run_op.call_args_list[1][0][0] is op
+
+
+pipeline_stage_test.add_base_pipeline_stage_tests(
+    cls=pipeline_stages_iothub.CompressMessagesStage,
+    module=this_module,
+    all_ops=all_common_ops + all_iothub_ops,
+    handled_ops=[
+        pipeline_ops_iothub.SendD2CMessageOperation,
+        pipeline_ops_iothub.SendOutputEventOperation,
+    ],
+    all_events=all_common_events + all_iothub_events,
+    handled_events=[
+        pipeline_events_iothub.C2DMessageEvent,
+        pipeline_events_iothub.InputMessageEvent,
+    ],
+    extra_initializer_defaults={"algorithm": None, "threshold": 1024, "decompress": False},
+)
+
+compressible_data = json.dumps([{"temperature": 21.5, "humidity": 40}] * 100)
+
+
+@pytest.mark.describe("CompressMessagesStage - .__init__()")
+class TestCompressMessagesStageInit(object):
+    @pytest.mark.it("Raises a ValueError if the algorithm is not available")
+    @pytest.mark.parametrize("algorithm", ["brotli", "zstd"])
+    def test_unavailable_algorithm(self, mocker, algorithm):
+        mocker.patch.object(compression, "zstandard", None)
+        with pytest.raises(ValueError):
+            pipeline_stages_iothub.CompressMessagesStage(algorithm=algorithm)
+
+
+@pytest.mark.describe(
+    "CompressMessagesStage - .run_op() -- called with SendD2CMessageOperation or SendOutputEventOperation"
+)
+class TestCompressMessagesRunOpWithSendMessage(object):
+    @pytest.fixture(params=[compression.GZIP, compression.DEFLATE])
+    def algorithm(self, request):
+        return request.param
+
+    @pytest.fixture
+    def stage(self, mocker, algorithm):
+        return make_mock_stage(
+            mocker,
+            functools.partial(
+                pipeline_stages_iothub.CompressMessagesStage, algorithm=algorithm, threshold=100
+            ),
+        )
+
+    @pytest.fixture
+    def pending_ops(self, stage):
+        """Make the next stage hold on to every op it receives instead of completing it"""
+        ops = []
+        stage.next.run_op = ops.append
+        return ops
+
+    @pytest.fixture(
+        params=[
+            pipeline_ops_iothub.SendD2CMessageOperation,
+            pipeline_ops_iothub.SendOutputEventOperation,
+        ]
+    )
+    def op_class(self, request):
+        return request.param
+
+    def make_op(self, op_class, data, callback, **kwargs):
+        message = Message(data, **kwargs)
+        message.custom_properties["key"] = "value"
+        return op_class(message=message, callback=callback)
+
+    @pytest.mark.it(
+        "Sends a compressed copy of the message, with content_encoding and the compression property set to the algorithm"
+    )
+    def test_compresses(self, stage, op_class, callback, pending_ops, algorithm):
+        op = self.make_op(op_class, compressible_data, callback, message_id="mid")
+        original_message = op.message
+        stage.run_op(op)
+
+        sent_message = pending_ops[0].message
+        assert sent_message is not original_message
+        assert len(sent_message.data) < len(compressible_data)
+        assert compression.decompress(algorithm, sent_message.data) == compressible_data.encode(
+            "utf-8"
+        )
+        assert sent_message.content_encoding == algorithm
+        assert sent_message.custom_properties == {
+            "key": "value",
+            compression.COMPRESSION_PROPERTY: algorithm,
+        }
+        assert sent_message.message_id == "mid"
+
+    @pytest.mark.it("Compresses bytearray and memoryview payloads")
+    @pytest.mark.parametrize("buffer_type", [bytearray, memoryview])
+    def test_compresses_buffer(
+        self, stage, op_class, callback, pending_ops, algorithm, buffer_type
+    ):
+        data = compressible_data.encode("utf-8")
+        op = self.make_op(op_class, buffer_type(data), callback)
+        stage.run_op(op)
+
+        sent_message = pending_ops[0].message
+        assert compression.decompress(algorithm, sent_message.data) == data
+        assert sent_message.content_encoding == algorithm
+
+    @pytest.mark.it(
+        "Puts the original message back on the op and completes it when the send completes"
+    )
+    def test_restores_message(self, stage, op_class, callback, pending_ops, fake_exception):
+        op = self.make_op(op_class, compressible_data, callback)
+        original_message = op.message
+        stage.run_op(op)
+        assert callback.call_count == 0
+
+        pending_ops[0].error = fake_exception
+        pending_ops[0].callback(pending_ops[0])
+        assert_callback_failed(op=op, error=fake_exception)
+        assert op.message is original_message
+        assert original_message.data == compressible_data
+        assert original_message.content_encoding is None
+        assert original_message.custom_properties == {"key": "value"}
+
+    @pytest.mark.it("Sends the message as it is if the payload is smaller than the threshold")
+    def test_below_threshold(self, stage, op_class, callback):
+        op = self.make_op(op_class, "x" * 99, callback)
+        original_message = op.message
+        stage.run_op(op)
+        assert stage.next.run_op.call_args[0][0].message is original_message
+        assert original_message.data == "x" * 99
+        assert_callback_succeeded(op=op)
+
+    @pytest.mark.it("Sends the message as it is if compressing doesn't make the payload smaller")
+    def test_incompressible(self, stage, op_class, callback):
+        data = zlib.compress(compressible_data.encode("utf-8"))
+        op = self.make_op(op_class, data, callback)
+        stage.run_op(op)
+        assert stage.next.run_op.call_args[0][0].message.data is data
+
+    @pytest.mark.it("Sends the message as it is if the payload is already compressed")
+    def test_already_compressed(self, stage, op_class, callback):
+        op = self.make_op(op_class, compressible_data, callback, content_encoding="gzip")
+        stage.run_op(op)
+        assert stage.next.run_op.call_args[0][0].message.data is compressible_data
+
+    @pytest.mark.it("Sends the message as it is if the payload is not text or bytes")
+    def test_not_bytes(self, stage, op_class, callback):
+        op = self.make_op(op_class, 10**200, callback)
+        stage.run_op(op)
+        assert stage.next.run_op.call_args[0][0].message.data == 10**200
+
+    @pytest.mark.it("Sends every message as it is if no algorithm is configured")
+    def test_no_algorithm(self, mocker, op_class, callback):
+        stage = make_mock_stage(mocker, pipeline_stages_iothub.CompressMessagesStage)
+        op = self.make_op(op_class, compressible_data, callback)
+        stage.run_op(op)
+        assert stage.next.run_op.call_args[0][0].message.data is compressible_data
+
+
+@pytest.mark.describe(
+    "CompressMessagesStage - .handle_pipeline_event() -- called with C2DMessageEvent or InputMessageEvent"
+)
+class TestCompressMessagesHandlePipelineEventWithMessage(object):
+    @pytest.fixture
+    def stage(self, mocker):
+        stage = make_mock_stage(mocker, pipeline_stages_iothub.CompressMessagesStage)
+        stage.decompress = True
+        stage.previous = mocker.MagicMock()
+        return stage
+
+    @pytest.fixture(
+        params=[
+            lambda message: pipeline_events_iothub.C2DMessageEvent(message),
+            lambda message: pipeline_events_iothub.InputMessageEvent("input1", message),
+        ],
+        ids=["C2DMessageEvent", "InputMessageEvent"],
+    )
+    def make_event(self, request):
+        return request.param
+
+    def make_message(self, data, content_encoding=None, compression_property=None):
+        message = Message(data, content_encoding=content_encoding)
+        message.custom_properties["key"] = "value"
+        if compression_property:
+            message.custom_properties[compression.COMPRESSION_PROPERTY] = compression_property
+        return message
+
+    @pytest.mark.it(
+        "Decompresses the payload if the content_encoding or the compression property names an algorithm"
+    )
+    @pytest.mark.parametrize(
+        "algorithm, content_encoding, compression_property",
+        [
+            pytest.param("gzip", "gzip", "gzip", id="gzip"),
+            pytest.param("deflate", "deflate", "deflate", id="deflate"),
+            pytest.param("gzip", "gzip", None, id="content_encoding only"),
+            pytest.param("deflate", "utf-8", "deflate", id="compression property only"),
+        ],
+    )
+    def test_decompresses(
+        self, stage, make_event, algorithm, content_encoding, compression_property
+    ):
+        compressed = compression.compress(algorithm, compressible_data.encode("utf-8"))
+        event = make_event(self.make_message(compressed, content_encoding, compression_property))
+        stage.handle_pipeline_event(event)
+
+        assert stage.previous.handle_pipeline_event.call_args[0][0] is event
+        assert event.message.data == compressible_data.encode("utf-8")
+        assert event.message.content_encoding is None
+        assert event.message.custom_properties == {"key": "value"}
+
+    @pytest.mark.it("Replaces a memoryview payload with a memoryview over the decompressed bytes")
+    def test_decompresses_memoryview(self, stage, make_event):
+        compressed = compression.compress("gzip", compressible_data.encode("utf-8"))
+        event = make_event(self.make_message(memoryview(compressed), "gzip", "gzip"))
+        stage.handle_pipeline_event(event)
+
+        assert isinstance(event.message.data, memoryview)
+        assert event.message.data.tobytes() == compressible_data.encode("utf-8")
+
+    @pytest.mark.it("Passes the message up as it is if it isn't compressed")
+    def test_not_compressed(self, stage, make_event):
+        event = make_event(self.make_message(b"payload", "utf-8"))
+        stage.handle_pipeline_event(event)
+        assert stage.previous.handle_pipeline_event.call_args[0][0] is event
+        assert event.message.data == b"payload"
+        assert event.message.content_encoding == "utf-8"
+
+    @pytest.mark.it("Passes the message up as it is if the payload can't be decompressed")
+    def test_corrupt(self, stage, make_event):
+        event = make_event(self.make_message(b"not gzip", "gzip", "gzip"))
+        stage.handle_pipeline_event(event)
+        assert stage.previous.handle_pipeline_event.call_args[0][0] is event
+        assert event.message.data == b"not gzip"
+        assert event.message.content_encoding == "gzip"
+
+    @pytest.mark.it("Decompresses a received message whose properties haven't been decoded yet")
+    def test_decompresses_lazy_message(self, stage, make_event):
+        compressed = compression.compress("gzip", compressible_data.encode("utf-8"))
+        event = make_event(lazy_models.LazyMessage(compressed, "%24.ce=gzip&key=value"))
+        stage.handle_pipeline_event(event)
+        assert event.message.data == compressible_data.encode("utf-8")
+        assert event.message.content_encoding is None
+        assert event.message.custom_properties == {"key": "value"}
+
+    @pytest.mark.it(
+        "Doesn't decode the properties of a received message which can't have been compressed"
+    )
+    def test_lazy_message_not_compressed(self, mocker, stage, make_event):
+        spy = mocker.spy(mqtt_topic_iothub, "decode_message_properties")
+        event = make_event(lazy_models.LazyMessage(b"payload", "%24.ct=text%2Fplain&key=value"))
+        stage.handle_pipeline_event(event)
+        assert stage.previous.handle_pipeline_event.call_args[0][0] is event
+        assert spy.call_count == 0
+        assert event.message.data == b"payload"
+
+    @pytest.mark.it("Passes every message up as it is if decompress is not set")
+    def test_no_decompress(self, mocker, stage, make_event):
+        spy = mocker.spy(mqtt_topic_iothub, "decode_message_properties")
+        stage.decompress = False
+        compressed = compression.compress("gzip", compressible_data.encode("utf-8"))
+        event = make_event(lazy_models.LazyMessage(compressed, "%24.ce=gzip&key=value"))
+        stage.handle_pipeline_event(event)
+        assert stage.previous.handle_pipeline_event.call_args[0][0] is event
+        assert spy.call_count == 0
+        assert event.message.data == compressed
+
+
 pipeline_stage_test.add_base_pipeline_stage_tests(
     cls=pipeline_stages_iothub.HandleTwinOperationsStage,
     module=this_module,
@@ -286,6 +1191,7 @@ pipeline_stage_test.add_base_pipeline_stage_tests(
     ],
     all_events=all_common_events + all_iothub_events,
     handled_events=[],
+    extra_initializer_defaults={"serializer": serializers.Serializer},
 )
 
 
@@ -382,6 +1288,20 @@ class TestHandleTwinOperationsRunOpWithGetTwin(object):
         assert_callback_succeeded(op=op)
         assert op.twin == twin
 
+    @pytest.mark.it("Deserializes the twin with the serializer of the stage")
+    def test_serializer(self, mocker, stage, op, twin_as_bytes):
+        stage.serializer = mocker.MagicMock()
+
+        def next_stage_run_op(self, op):
+            op.status_code = 200
+            op.response_body = twin_as_bytes
+            op.callback(op)
+
+        stage.next.run_op = functools.partial(next_stage_run_op, (stage.next,))
+        stage.run_op(op)
+        assert stage.serializer.loads.call_args == mocker.call(twin_as_bytes)
+        assert op.twin is stage.serializer.loads.return_value
+
 
 @pytest.mark.describe(
     "HandleTwinOperationsStage - .run_op() -- called with PatchTwinReportedPropertiesOperation"
@@ -418,6 +1338,14 @@ class TestHandleTwinOperationsRunOpWithPatchTwinReportedProperties(object):
         assert new_op.resource_location == "/properties/reported/"
         assert new_op.request_body == patch_as_string
 
+    @pytest.mark.it("Serializes the patch with the serializer of the stage")
+    def test_serializer(self, mocker, stage, op, patch):
+        stage.serializer = mocker.MagicMock()
+        stage.run_op(op)
+        new_op = stage.next.run_op.call_args[0][0]
+        assert stage.serializer.dumps.call_args == mocker.call(patch)
+        assert new_op.request_body is stage.serializer.dumps.return_value
+
     @pytest.mark.it("Returns an Exception through the op callback if there is no next stage")
     def test_runs_with_no_next_stage(self, stage, op):
         stage.next = None
@@ -18,9 +18,11 @@ from azure.iot.device.common.pipeline import (
 )
 from azure.iot.device.iothub.pipeline import (
     constant,
+    mqtt_topic_iothub,
     pipeline_events_iothub,
     pipeline_ops_iothub,
     pipeline_stages_iothub_mqtt,
+    serializers,
 )
 from azure.iot.device.iothub.models.message import Message
 from azure.iot.device.iothub.models.methods import MethodRequest, MethodResponse
@@ -131,7 +133,13 @@ pipeline_stage_test.add_base_pipeline_stage_tests(
     handled_ops=ops_handled_by_this_stage,
     all_events=all_common_events + all_iothub_events,
     handled_events=events_handled_by_this_stage,
-    extra_initializer_defaults={"feature_to_topic": dict},
+    extra_initializer_defaults={
+        "feature_to_topic": dict,
+        "telemetry_qos": 1,
+        "memoryview_payloads": False,
+        "topic_parser": mqtt_topic_iothub.TopicParser,
+        "serializer": serializers.Serializer,
+    },
 )
 
 
@@ -664,6 +672,48 @@ class TestIoTHubMQTTConverterForPublishOps(object):
         new_op = stage.next._execute_op.call_args[0][0]
         assert new_op.payload == params["publish_payload"]
 
+    @pytest.mark.it("Publishes with the telemetry_qos of the stage if the message has no qos")
+    @pytest.mark.parametrize("telemetry_qos", [0, 1])
+    def test_default_qos(self, stage, stages_configured_for_both, op, telemetry_qos):
+        if not hasattr(op, "message"):
+            pytest.skip()
+        stage.telemetry_qos = telemetry_qos
+        stage.run_op(op)
+        new_op = stage.next._execute_op.call_args[0][0]
+        assert new_op.qos == telemetry_qos
+
+    @pytest.mark.it("Publishes with the qos of the message if it has one")
+    @pytest.mark.parametrize("qos", [0, 1])
+    def test_message_qos(self, stage, stages_configured_for_both, op, qos):
+        if not hasattr(op, "message"):
+            pytest.skip()
+        stage.telemetry_qos = 1 - qos
+        op.message.qos = qos
+        stage.run_op(op)
+        new_op = stage.next._execute_op.call_args[0][0]
+        assert new_op.qos == qos
+
+    @pytest.mark.it("Publishes method responses with a qos of 1 regardless of telemetry_qos")
+    def test_method_response_qos(self, stage, stages_configured_for_both, op):
+        if hasattr(op, "message"):
+            pytest.skip()
+        stage.telemetry_qos = 0
+        stage.run_op(op)
+        new_op = stage.next._execute_op.call_args[0][0]
+        assert new_op.qos == 1
+
+    @pytest.mark.it("Serializes the payload of method responses with the serializer of the stage")
+    def test_method_response_serializer(
+        self, mocker, stage, stages_configured_for_both, op, params
+    ):
+        if hasattr(op, "message"):
+            pytest.skip()
+        stage.serializer = mocker.MagicMock()
+        stage.run_op(op)
+        new_op = stage.next._execute_op.call_args[0][0]
+        assert stage.serializer.dumps.call_args == mocker.call(fake_method_payload)
+        assert new_op.payload is stage.serializer.dumps.return_value
+
 
 feature_name_to_subscribe_topic = [
     {
@@ -795,6 +845,29 @@ class TestIoTHubMQTTConverterHandlePipelineEventC2D(object):
         new_event = stage.previous.handle_pipeline_event.call_args[0][0]
         assert isinstance(new_event.message, Message)
 
+    @pytest.mark.it("Sets the data of the Message object to the mqtt payload")
+    def test_c2d_message_data(
+        self, mocker, stage, stage_configured_for_device, add_pipeline_root, c2d_event
+    ):
+        stage.handle_pipeline_event(c2d_event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert new_event.message.data is fake_mqtt_payload
+
+    @pytest.mark.it(
+        "Sets the data of the Message object to a read-only memoryview over the mqtt payload if memoryview_payloads is set"
+    )
+    def test_c2d_message_data_memoryview(
+        self, mocker, stage, stage_configured_for_device, add_pipeline_root
+    ):
+        stage.memoryview_payloads = True
+        payload = b"some payload"
+        event = pipeline_events_mqtt.IncomingMQTTMessageEvent(topic=fake_c2d_topic, payload=payload)
+        stage.handle_pipeline_event(event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert isinstance(new_event.message.data, memoryview)
+        assert new_event.message.data.readonly
+        assert new_event.message.data.tobytes() == payload
+
     @pytest.mark.it("Extracts message properties from the mqtt topic for c2d messages")
     def test_extracts_c2d_message_properties_from_topic_name(
         self, mocker, stage, stage_configured_for_device, add_pipeline_root
@@ -806,6 +879,20 @@ class TestIoTHubMQTTConverterHandlePipelineEventC2D(object):
         new_event = stage.previous.handle_pipeline_event.call_args[0][0]
         assert new_event.message.content_type == fake_content_type
 
+    @pytest.mark.it("Doesn't decode the message properties until one of them is used")
+    def test_c2d_message_properties_lazy(
+        self, mocker, stage, stage_configured_for_device, add_pipeline_root
+    ):
+        spy = mocker.spy(mqtt_topic_iothub, "decode_message_properties")
+        event = pipeline_events_mqtt.IncomingMQTTMessageEvent(
+            topic=fake_c2d_topic_with_content_type, payload=fake_mqtt_payload
+        )
+        stage.handle_pipeline_event(event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert spy.call_count == 0
+        assert new_event.message.content_type == fake_content_type
+        assert spy.call_count == 1
+
     @pytest.mark.it("Passes up c2d messages destined for another device")
     def test_if_topic_is_c2d_for_another_device(
         self, mocker, stage, stage_configured_for_device, add_pipeline_root
@@ -970,6 +1057,19 @@ class TestIoTHubMQTTConverterHandlePipelineEventInputMessages(object):
         new_event = stage.previous.handle_pipeline_event.call_args[0][0]
         assert new_event.input_name == fake_input_name
 
+    @pytest.mark.it(
+        "Sets the data of the Message object to a read-only memoryview over the mqtt payload if memoryview_payloads is set"
+    )
+    def test_input_message_data_memoryview(
+        self, mocker, stage, stage_configured_for_module, add_pipeline_root, input_message_event
+    ):
+        stage.memoryview_payloads = True
+        input_message_event.payload = b"some payload"
+        stage.handle_pipeline_event(input_message_event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert isinstance(new_event.message.data, memoryview)
+        assert new_event.message.data.tobytes() == b"some payload"
+
     @pytest.mark.it("Extracts message properties from the mqtt topic for input messages")
     def test_extracts_input_message_properties_from_topic_name(
         self, mocker, stage, stage_configured_for_module, add_pipeline_root
@@ -1056,6 +1156,29 @@ class TestIoTHubMQTTConverterHandlePipelineEventMethodRequets(object):
             fake_method_request_payload.decode("utf-8")
         )
 
+    @pytest.mark.it("Doesn't deserialize the payload of the method request until it is read")
+    def test_method_request_payload_lazy(
+        self, mocker, stage, stages_configured_for_both, add_pipeline_root, method_request_event
+    ):
+        spy = mocker.spy(serializers.Serializer, "loads")
+        stage.handle_pipeline_event(method_request_event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert spy.call_count == 0
+        assert new_event.method_request.payload == {}
+        assert spy.call_count == 1
+
+    @pytest.mark.it(
+        "Deserializes the payload of the method request with the serializer of the stage"
+    )
+    def test_method_request_serializer(
+        self, mocker, stage, stages_configured_for_both, add_pipeline_root, method_request_event
+    ):
+        stage.serializer = mocker.MagicMock()
+        stage.handle_pipeline_event(method_request_event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert new_event.method_request.payload is stage.serializer.loads.return_value
+        assert stage.serializer.loads.call_args == mocker.call(fake_method_request_payload)
+
 
 @pytest.mark.describe(
     "IotHubMQTTConverter - .handle_pipeline_event() -- called with twin response topic"
@@ -1242,26 +1365,44 @@ class TestIotHubMQTTConverterHandlePipelineEventTwinPatch(object):
         assert unhandled_error_handler.call_count == 1
         assert isinstance(unhandled_error_handler.call_args[0][0], NotImplementedError)
 
-    @pytest.mark.it("Calls the unhandled exception handler if the payload is not a Bytes object")
+    @pytest.mark.it("Doesn't deserialize the payload until the patch is read")
+    def test_lazy(self, mocker, stage, fixup_stage_for_test, fake_event, fake_patch):
+        spy = mocker.spy(serializers.Serializer, "loads")
+        stage.handle_pipeline_event(fake_event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert spy.call_count == 0
+        assert new_event.patch == fake_patch
+        assert new_event.patch == fake_patch
+        assert spy.call_count == 1
+
+    @pytest.mark.it("Deserializes the patch with the serializer of the stage")
+    def test_serializer(self, mocker, stage, fixup_stage_for_test, fake_event, fake_patch_as_bytes):
+        stage.serializer = mocker.MagicMock()
+        stage.handle_pipeline_event(fake_event)
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        assert new_event.patch is stage.serializer.loads.return_value
+        assert stage.serializer.loads.call_args == mocker.call(fake_patch_as_bytes)
+
+    @pytest.mark.it("Raises an error when the patch is read if the payload is not a Bytes object")
     def test_payload_not_bytes(
         self, stage, fixup_stage_for_test, fake_event, fake_patch_not_bytes, unhandled_error_handler
     ):
         fake_event.payload = fake_patch_not_bytes
         stage.handle_pipeline_event(fake_event)
-        assert unhandled_error_handler.call_count == 1
-        if not (
-            isinstance(unhandled_error_handler.call_args[0][0], AttributeError)
-            or isinstance(unhandled_error_handler.call_args[0][0], ValueError)
-        ):
-            assert False
+        assert unhandled_error_handler.call_count == 0
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        with pytest.raises((AttributeError, ValueError)):
+            new_event.patch
 
     @pytest.mark.it(
-        "Calls the unhandled exception handler if the payload cannot be deserialized as a JSON object"
+        "Raises a ValueError when the patch is read if the payload cannot be deserialized as a JSON object"
     )
     def test_payload_not_json(
         self, stage, fixup_stage_for_test, fake_event, fake_patch_not_json, unhandled_error_handler
     ):
         fake_event.payload = fake_patch_not_json
         stage.handle_pipeline_event(fake_event)
-        assert unhandled_error_handler.call_count == 1
-        assert isinstance(unhandled_error_handler.call_args[0][0], ValueError)
+        assert unhandled_error_handler.call_count == 0
+        new_event = stage.previous.handle_pipeline_event.call_args[0][0]
+        with pytest.raises(ValueError):
+            new_event.patch
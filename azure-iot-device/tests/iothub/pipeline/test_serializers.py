@@ -0,0 +1,118 @@
+# -------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+# --------------------------------------------------------------------------
+import pytest
+import json
+import logging
+from azure.iot.device.iothub.pipeline import serializers
+
+logging.basicConfig(level=logging.INFO)
+
+document = {"desired": {"interval": 5, "name": "caf\u00e9 / bar", "nested": [1, 2.5, None, True]}}
+
+available = [
+    name
+    for name in (serializers.JSON, serializers.ORJSON, serializers.UJSON)
+    if serializers.is_available(name)
+]
+
+
+@pytest.mark.describe("serializers - Serializer")
+@pytest.mark.parametrize("name", available)
+class TestSerializer(object):
+    @pytest.mark.it("Round-trips a JSON document")
+    def test_round_trip(self, name):
+        serializer = serializers.Serializer(name)
+        assert serializer.name == name
+        assert serializer.loads(serializer.dumps(document)) == document
+
+    @pytest.mark.it("Produces JSON which the standard library can read")
+    def test_standard_json(self, name):
+        encoded = serializers.Serializer(name).dumps(document)
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode("utf-8")
+        assert json.loads(encoded) == document
+
+    @pytest.mark.it("Deserializes text, bytes, bytearrays and memoryviews")
+    @pytest.mark.parametrize(
+        "convert",
+        [
+            pytest.param(lambda data: data, id="text"),
+            pytest.param(lambda data: data.encode("utf-8"), id="bytes"),
+            pytest.param(lambda data: bytearray(data.encode("utf-8")), id="bytearray"),
+            pytest.param(lambda data: memoryview(data.encode("utf-8")), id="memoryview"),
+        ],
+    )
+    def test_loads_types(self, name, convert):
+        data = convert(json.dumps(document))
+        assert serializers.Serializer(name).loads(data) == document
+
+    @pytest.mark.it("Raises a ValueError when deserializing something which isn't JSON")
+    def test_loads_invalid(self, name):
+        with pytest.raises(ValueError):
+            serializers.Serializer(name).loads(b"not json")
+
+    @pytest.mark.it("Serializes values the standard library can, even if the library can't")
+    @pytest.mark.parametrize(
+        "value",
+        [pytest.param({"big": 2**70}, id="Big integer"), pytest.param({1: "a"}, id="Int key")],
+    )
+    def test_dumps_fallback(self, name, value):
+        encoded = serializers.Serializer(name).dumps(value)
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode("utf-8")
+        assert json.loads(encoded) == json.loads(json.dumps(value))
+
+    @pytest.mark.it("Raises a TypeError when serializing a value which isn't JSON compatible")
+    def test_dumps_invalid(self, name):
+        with pytest.raises(TypeError):
+            serializers.Serializer(name).dumps({"a": object()})
+
+
+@pytest.mark.describe("serializers - .is_available()")
+class TestIsAvailable(object):
+    @pytest.mark.it("Returns True for the standard library")
+    def test_json(self):
+        assert serializers.is_available(serializers.JSON)
+
+    @pytest.mark.it("Returns True for orjson and ujson only if the package is installed")
+    @pytest.mark.parametrize("name", [serializers.ORJSON, serializers.UJSON])
+    def test_optional(self, mocker, name):
+        mocker.patch.object(serializers, name, None)
+        assert not serializers.is_available(name)
+        mocker.patch.object(serializers, name, mocker.MagicMock())
+        assert serializers.is_available(name)
+
+    @pytest.mark.it("Returns False for an unknown library")
+    def test_unknown(self):
+        assert not serializers.is_available("msgpack")
+
+
+@pytest.mark.describe("serializers - .get_serializer()")
+class TestGetSerializer(object):
+    @pytest.mark.it("Returns a Serializer for the named library")
+    def test_named(self):
+        assert serializers.get_serializer(serializers.JSON).name == serializers.JSON
+
+    @pytest.mark.it("Picks orjson, then ujson, then the standard library if no name is given")
+    @pytest.mark.parametrize(
+        "orjson_installed, ujson_installed, expected",
+        [
+            pytest.param(True, True, serializers.ORJSON, id="Both installed"),
+            pytest.param(False, True, serializers.UJSON, id="ujson installed"),
+            pytest.param(False, False, serializers.JSON, id="Neither installed"),
+        ],
+    )
+    def test_default(self, mocker, orjson_installed, ujson_installed, expected):
+        mocker.patch.object(serializers, "orjson", mocker.MagicMock() if orjson_installed else None)
+        mocker.patch.object(serializers, "ujson", mocker.MagicMock() if ujson_installed else None)
+        assert serializers.get_serializer().name == expected
+
+    @pytest.mark.it("Raises a ValueError if the library is not available")
+    @pytest.mark.parametrize("name", ["msgpack", serializers.UJSON])
+    def test_unavailable(self, mocker, name):
+        mocker.patch.object(serializers, "ujson", None)
+        with pytest.raises(ValueError):
+            serializers.get_serializer(name)
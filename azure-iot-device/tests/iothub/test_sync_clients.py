@@ -11,11 +11,14 @@ import time
 import os
 import io
 import six
+from concurrent import futures
 from azure.iot.device.iothub import IoTHubDeviceClient, IoTHubModuleClient
-from azure.iot.device.iothub.pipeline import IoTHubPipeline, constant
+from azure.iot.device.iothub.pipeline import IoTHubPipeline, IoTHubPipelineConfig, constant
+from azure.iot.device.iothub.pipeline import config as pipeline_config
 from azure.iot.device.iothub.models import Message, MethodRequest
 from azure.iot.device.iothub.sync_inbox import SyncClientInbox, InboxEmpty
 from azure.iot.device.iothub.auth import IoTEdgeError
+from azure.iot.device.common.pipeline import pipeline_thread
 import azure.iot.device.iothub.sync_clients as sync_clients
 
 
@@ -60,6 +63,20 @@ class SharedClientInstantiationTests(object):
             == client._inbox_manager.route_method_request
         )
 
+    @pytest.mark.it(
+        "Makes the IoTHubPipeline hand operations to the pipeline without waiting for them to start"
+    )
+    def test_sets_submit_nowait(self, client_class, iothub_pipeline):
+        client = client_class(iothub_pipeline)
+
+        assert client._iothub_pipeline.submit_nowait is True
+
+    @pytest.mark.it("Raises a ValueError if the IoTHubPipeline runs on an event loop")
+    def test_event_loop_executors(self, client_class, iothub_pipeline):
+        iothub_pipeline.executors = pipeline_thread.EventLoopExecutors(name="test")
+        with pytest.raises(ValueError):
+            client_class(iothub_pipeline)
+
 
 class SharedClientCreateFromConnectionStringTests(object):
     @pytest.mark.it(
@@ -108,7 +125,34 @@ class SharedClientCreateFromConnectionStringTests(object):
         client_class.create_from_connection_string(*args, **kwargs)
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
+
+    @pytest.mark.it(
+        "Creates the IoTHubPipeline with an IoTHubPipelineConfig built from any additional keyword arguments"
+    )
+    def test_pipeline_configuration(self, mocker, client_class, connection_string):
+        mocker.patch("azure.iot.device.iothub.auth.SymmetricKeyAuthenticationProvider")
+        mock_pipeline_init = mocker.patch("azure.iot.device.iothub.pipeline.IoTHubPipeline")
+
+        client_class.create_from_connection_string(
+            connection_string,
+            max_inflight_publishes=5,
+            max_queued_publishes=10,
+            queue_full_policy=pipeline_config.QUEUE_FULL_ERROR,
+        )
+
+        pipeline_configuration = mock_pipeline_init.call_args[0][1]
+        assert isinstance(pipeline_configuration, IoTHubPipelineConfig)
+        assert pipeline_configuration.max_inflight_publishes == 5
+        assert pipeline_configuration.max_queued_publishes == 10
+        assert pipeline_configuration.queue_full_policy == pipeline_config.QUEUE_FULL_ERROR
+
+    @pytest.mark.it("Raises a TypeError if given an unknown keyword argument")
+    def test_unknown_kwarg(self, mocker, client_class, connection_string):
+        mocker.patch("azure.iot.device.iothub.auth.SymmetricKeyAuthenticationProvider")
+        mocker.patch("azure.iot.device.iothub.pipeline.IoTHubPipeline")
+        with pytest.raises(TypeError):
+            client_class.create_from_connection_string(connection_string, not_an_option=True)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     @pytest.mark.parametrize(
@@ -191,7 +235,7 @@ class SharedClientCreateFromSharedAccessSignature(object):
         client_class.create_from_shared_access_signature(sas_token_string)
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     def test_client_instantiation(self, mocker, client_class, sas_token_string):
@@ -255,6 +299,11 @@ class SharedClientConnectTests(WaitsForEventCompletion):
         client.connect()
         assert iothub_pipeline.connect.call_count == 1
 
+    @pytest.mark.it("Passes the timeout to the 'connect' pipeline operation")
+    def test_passes_timeout(self, client, iothub_pipeline):
+        client.connect(timeout=5)
+        assert iothub_pipeline.connect.call_args[1]["timeout"] == 5
+
     @pytest.mark.it("Waits for the completion of the 'connect' pipeline operation before returning")
     def test_waits_for_pipeline_op_completion(
         self, mocker, client_manual_cb, iothub_pipeline_manual_cb
@@ -264,6 +313,18 @@ class SharedClientConnectTests(WaitsForEventCompletion):
         )
         client_manual_cb.connect()
 
+    @pytest.mark.it("Raises the error if the 'connect' pipeline operation fails")
+    def test_raises_op_error(self, client, iothub_pipeline):
+        error = ValueError("fake error")
+
+        def fail_connect(callback, timeout=None):
+            callback(error=error)
+
+        iothub_pipeline.connect.side_effect = fail_connect
+        with pytest.raises(ValueError) as e_info:
+            client.connect()
+        assert e_info.value is error
+
 
 class SharedClientDisconnectTests(WaitsForEventCompletion):
     @pytest.mark.it("Begins a 'disconnect' pipeline operation")
@@ -298,6 +359,11 @@ class SharedClientSendD2CMessageTests(WaitsForEventCompletion):
         assert iothub_pipeline.send_d2c_message.call_count == 1
         assert iothub_pipeline.send_d2c_message.call_args[0][0] is message
 
+    @pytest.mark.it("Passes the timeout to the 'send_d2c_message' pipeline operation")
+    def test_passes_timeout(self, client, iothub_pipeline, message):
+        client.send_d2c_message(message, timeout=5)
+        assert iothub_pipeline.send_d2c_message.call_args[1]["timeout"] == 5
+
     @pytest.mark.it(
         "Waits for the completion of the 'send_d2c_message' pipeline operation before returning"
     )
@@ -333,6 +399,99 @@ class SharedClientSendD2CMessageTests(WaitsForEventCompletion):
         assert sent_message.data == message_input
 
 
+class SharedClientSendD2CMessageNowaitTests(object):
+    @pytest.mark.it(
+        "Begins a 'send_d2c_message' IoTHubPipeline operation and returns a Future without waiting for it"
+    )
+    def test_returns_future(self, client_manual_cb, iothub_pipeline_manual_cb, message):
+        future = client_manual_cb.send_d2c_message_nowait(message, timeout=5)
+        assert isinstance(future, futures.Future)
+        assert not future.done()
+        assert iothub_pipeline_manual_cb.send_d2c_message.call_count == 1
+        assert iothub_pipeline_manual_cb.send_d2c_message.call_args[0][0] is message
+        assert iothub_pipeline_manual_cb.send_d2c_message.call_args[1]["timeout"] == 5
+
+    @pytest.mark.it("Completes the Future when the 'send_d2c_message' pipeline operation succeeds")
+    def test_completes_future(self, client_manual_cb, iothub_pipeline_manual_cb, message):
+        future = client_manual_cb.send_d2c_message_nowait(message)
+        iothub_pipeline_manual_cb.send_d2c_message.call_args[1]["callback"]()
+        assert future.result(0) is None
+
+    @pytest.mark.it(
+        "Fails the Future with the error of the 'send_d2c_message' pipeline operation if it fails"
+    )
+    def test_fails_future(self, client_manual_cb, iothub_pipeline_manual_cb, message):
+        future = client_manual_cb.send_d2c_message_nowait(message)
+        error = ValueError()
+        iothub_pipeline_manual_cb.send_d2c_message.call_args[1]["callback"](error=error)
+        assert future.exception(0) is error
+
+    @pytest.mark.it(
+        "Wraps 'message' input parameter in a Message object if it is not a Message object"
+    )
+    def test_wraps_data_in_message(self, client, iothub_pipeline):
+        client.send_d2c_message_nowait("message").result(5)
+        sent_message = iothub_pipeline.send_d2c_message.call_args[0][0]
+        assert isinstance(sent_message, Message)
+        assert sent_message.data == "message"
+
+
+class SharedClientSendD2CMessagesTests(WaitsForEventCompletion):
+    @pytest.mark.it("Begins a single 'send_d2c_messages' IoTHubPipeline operation for the batch")
+    def test_calls_pipeline_send_d2c_messages(self, client, iothub_pipeline, message):
+        messages = [message, Message("second"), Message("third")]
+        client.send_d2c_messages(messages)
+        assert iothub_pipeline.send_d2c_messages.call_count == 1
+        assert iothub_pipeline.send_d2c_messages.call_args[0][0] == messages
+        assert iothub_pipeline.send_d2c_message.call_count == 0
+
+    @pytest.mark.it("Passes the 'max_inflight' parameter to the pipeline")
+    @pytest.mark.parametrize(
+        "max_inflight", [pytest.param(None, id="Default"), pytest.param(10, id="Custom value")]
+    )
+    def test_passes_max_inflight(self, client, iothub_pipeline, message, max_inflight):
+        client.send_d2c_messages([message], max_inflight=max_inflight)
+        assert iothub_pipeline.send_d2c_messages.call_args[1]["max_inflight"] == max_inflight
+
+    @pytest.mark.it(
+        "Waits for the completion of the 'send_d2c_messages' pipeline operation before returning"
+    )
+    def test_waits_for_pipeline_op_completion(
+        self, mocker, client_manual_cb, iothub_pipeline_manual_cb, message
+    ):
+        self.add_event_completion_checks(
+            mocker=mocker,
+            pipeline_function=iothub_pipeline_manual_cb.send_d2c_messages,
+            args=[[None]],
+        )
+        client_manual_cb.send_d2c_messages([message])
+
+    @pytest.mark.it("Returns the per-message results from the pipeline operation")
+    def test_returns_results(self, mocker, client_manual_cb, iothub_pipeline_manual_cb, message):
+        results = [None, ValueError("fake error")]
+        iothub_pipeline_manual_cb.send_d2c_messages.side_effect = lambda *args, **kwargs: kwargs[
+            "callback"
+        ](results)
+        assert client_manual_cb.send_d2c_messages([message, message]) is results
+
+    @pytest.mark.it(
+        "Wraps each item in the 'messages' input parameter in a Message object if it is not a Message object"
+    )
+    def test_wraps_data_in_message(self, client, iothub_pipeline, message):
+        client.send_d2c_messages([message, "string", 222, {"a": 2}])
+        sent_messages = iothub_pipeline.send_d2c_messages.call_args[0][0]
+        assert sent_messages[0] is message
+        for sent_message, expected_data in zip(sent_messages[1:], ["string", 222, {"a": 2}]):
+            assert isinstance(sent_message, Message)
+            assert sent_message.data == expected_data
+
+    @pytest.mark.it("Accepts any iterable of messages, including generators")
+    def test_accepts_generator(self, client, iothub_pipeline):
+        client.send_d2c_messages(Message(str(i)) for i in range(3))
+        sent_messages = iothub_pipeline.send_d2c_messages.call_args[0][0]
+        assert [m.data for m in sent_messages] == ["0", "1", "2"]
+
+
 class SharedClientReceiveMethodRequestTests(object):
     @pytest.mark.it("Implicitly enables methods feature if not already enabled")
     @pytest.mark.parametrize(
@@ -519,7 +678,7 @@ class SharedClientGetTwinTests(WaitsForEventCompletion):
     @pytest.mark.it("Implicitly enables twin messaging feature if not already enabled")
     def test_enables_twin_only_if_not_already_enabled(self, mocker, client, iothub_pipeline):
         # patch this so get_twin won't block
-        def immediate_callback(callback):
+        def immediate_callback(callback, timeout=None):
             callback(None)
 
         mocker.patch.object(iothub_pipeline, "get_twin", side_effect=immediate_callback)
@@ -544,6 +703,15 @@ class SharedClientGetTwinTests(WaitsForEventCompletion):
         client.get_twin()
         assert iothub_pipeline.get_twin.call_count == 1
 
+    @pytest.mark.it(
+        "Passes the timeout to the 'get_twin' pipeline operation and to enabling the twin feature"
+    )
+    def test_passes_timeout(self, client, iothub_pipeline):
+        iothub_pipeline.feature_enabled.__getitem__.return_value = False
+        client.get_twin(timeout=5)
+        assert iothub_pipeline.enable_feature.call_args[1]["timeout"] == 5
+        assert iothub_pipeline.get_twin.call_args[1]["timeout"] == 5
+
     @pytest.mark.it(
         "Waits for the completion of the 'get_twin' pipeline operation before returning"
     )
@@ -571,7 +739,7 @@ class SharedClientPatchTwinReportedPropertiesTests(WaitsForEventCompletion):
         self, mocker, client, iothub_pipeline, twin_patch_reported
     ):
         # patch this so x_get_twin won't block
-        def immediate_callback(patch, callback):
+        def immediate_callback(patch, callback, timeout=None):
             callback()
 
         mocker.patch.object(
@@ -816,7 +984,7 @@ class TestIoTHubDeviceClientCreateFromX509Certificate(IoTHubDeviceClientTestsCon
         )
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     def test_client_instantiation(self, mocker, client_class, x509):
@@ -863,6 +1031,20 @@ class TestIoTHubDeviceClientSendD2CMessage(
     pass
 
 
+@pytest.mark.describe("IoTHubDeviceClient (Synchronous) - .send_d2c_message_nowait()")
+class TestIoTHubDeviceClientSendD2CMessageNowait(
+    IoTHubDeviceClientTestsConfig, SharedClientSendD2CMessageNowaitTests
+):
+    pass
+
+
+@pytest.mark.describe("IoTHubDeviceClient (Synchronous) - .send_d2c_messages()")
+class TestIoTHubDeviceClientSendD2CMessages(
+    IoTHubDeviceClientTestsConfig, SharedClientSendD2CMessagesTests
+):
+    pass
+
+
 @pytest.mark.describe("IoTHubDeviceClient (Synchronous) - .receive_c2d_message()")
 class TestIoTHubDeviceClientReceiveC2DMessage(IoTHubDeviceClientTestsConfig):
     @pytest.mark.it("Implicitly enables C2D messaging feature if not already enabled")
@@ -1142,7 +1324,7 @@ class TestIoTHubModuleClientCreateFromEdgeEnvironmentWithContainerEnv(
         client_class.create_from_edge_environment()
 
         assert mock_iothub_pipeline_init.call_count == 1
-        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
         assert mock_edge_pipeline_init.call_count == 1
         assert mock_edge_pipeline_init.call_args == mocker.call(mock_auth)
 
@@ -1300,9 +1482,9 @@ class TestIoTHubModuleClientCreateFromEdgeEnvironmentWithDebugEnv(IoTHubModuleCl
         client_class.create_from_edge_environment()
 
         assert mock_iothub_pipeline_init.call_count == 1
-        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
         assert mock_edge_pipeline_init.call_count == 1
-        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_iothub_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline and the EdgePipeline to instantiate the client")
     def test_client_instantiation(
@@ -1433,7 +1615,7 @@ class TestIoTHubModuleClientCreateFromX509Certificate(IoTHubModuleClientTestsCon
         )
 
         assert mock_pipeline_init.call_count == 1
-        assert mock_pipeline_init.call_args == mocker.call(mock_auth)
+        assert mock_pipeline_init.call_args == mocker.call(mock_auth, mocker.ANY)
 
     @pytest.mark.it("Uses the IoTHubPipeline to instantiate the client")
     def test_client_instantiation(self, mocker, client_class, x509):
@@ -1480,6 +1662,20 @@ class TestIoTHubNModuleClientSendD2CMessage(
     pass
 
 
+@pytest.mark.describe("IoTHubModuleClient (Synchronous) - .send_d2c_message_nowait()")
+class TestIoTHubModuleClientSendD2CMessageNowait(
+    IoTHubModuleClientTestsConfig, SharedClientSendD2CMessageNowaitTests
+):
+    pass
+
+
+@pytest.mark.describe("IoTHubModuleClient (Synchronous) - .send_d2c_messages()")
+class TestIoTHubModuleClientSendD2CMessages(
+    IoTHubModuleClientTestsConfig, SharedClientSendD2CMessagesTests
+):
+    pass
+
+
 @pytest.mark.describe("IoTHubModuleClient (Synchronous) - .send_to_output()")
 class TestIoTHubModuleClientSendToOutput(IoTHubModuleClientTestsConfig, WaitsForEventCompletion):
     @pytest.mark.it("Begins a 'send_output_event' pipeline operation")
@@ -1527,6 +1723,45 @@ class TestIoTHubModuleClientSendToOutput(IoTHubModuleClientTestsConfig, WaitsFor
         assert sent_message.data == message_input
 
 
+@pytest.mark.describe("IoTHubModuleClient (Synchronous) - .send_to_output_nowait()")
+class TestIoTHubModuleClientSendToOutputNowait(IoTHubModuleClientTestsConfig):
+    @pytest.mark.it(
+        "Begins a 'send_output_event' pipeline operation and returns a Future without waiting for it"
+    )
+    def test_returns_future(self, client_manual_cb, iothub_pipeline_manual_cb, message):
+        future = client_manual_cb.send_to_output_nowait(message, "some_output", timeout=5)
+        assert isinstance(future, futures.Future)
+        assert not future.done()
+        assert iothub_pipeline_manual_cb.send_output_event.call_count == 1
+        assert iothub_pipeline_manual_cb.send_output_event.call_args[0][0] is message
+        assert iothub_pipeline_manual_cb.send_output_event.call_args[1]["timeout"] == 5
+        assert message.output_name == "some_output"
+
+    @pytest.mark.it("Completes the Future when the 'send_output_event' pipeline operation succeeds")
+    def test_completes_future(self, client_manual_cb, iothub_pipeline_manual_cb, message):
+        future = client_manual_cb.send_to_output_nowait(message, "some_output")
+        iothub_pipeline_manual_cb.send_output_event.call_args[1]["callback"]()
+        assert future.result(0) is None
+
+    @pytest.mark.it(
+        "Fails the Future with the error of the 'send_output_event' pipeline operation if it fails"
+    )
+    def test_fails_future(self, client_manual_cb, iothub_pipeline_manual_cb, message):
+        future = client_manual_cb.send_to_output_nowait(message, "some_output")
+        error = ValueError()
+        iothub_pipeline_manual_cb.send_output_event.call_args[1]["callback"](error=error)
+        assert future.exception(0) is error
+
+    @pytest.mark.it(
+        "Wraps 'message' input parameter in Message object if it is not a Message object"
+    )
+    def test_wraps_data_in_message(self, client, iothub_pipeline):
+        client.send_to_output_nowait("message", "some_output").result(5)
+        sent_message = iothub_pipeline.send_output_event.call_args[0][0]
+        assert isinstance(sent_message, Message)
+        assert sent_message.data == "message"
+
+
 @pytest.mark.describe("IoTHubModuleClient (Synchronous) - .receive_input_message()")
 class TestIoTHubModuleClientReceiveInputMessage(IoTHubModuleClientTestsConfig):
     @pytest.mark.it("Implicitly enables input messaging feature if not already enabled")
@@ -56,6 +56,7 @@ class TestClientCreate(object):
         patch_set_sym_client = mocker.patch.object(
             pipeline_ops_provisioning, "SetSymmetricKeySecurityClientOperation"
         )
+        patch_set_sym_client.return_value.deadline = None
         client = ProvisioningDeviceClient.create_from_symmetric_key(
             fake_provisioning_host, fake_symmetric_key, fake_registration_id, fake_id_scope
         )
@@ -77,6 +78,7 @@ class TestClientCreate(object):
         patch_set_x509_client = mocker.patch.object(
             pipeline_ops_provisioning, "SetX509SecurityClientOperation"
         )
+        patch_set_x509_client.return_value.deadline = None
         client = ProvisioningDeviceClient.create_from_x509_certificate(
             fake_provisioning_host, fake_registration_id, fake_id_scope, fake_x509()
         )